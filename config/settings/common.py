@@ -7,6 +7,8 @@ from os.path import join
 from typing import List
 
 import environ
+from celery.schedules import crontab
+from kombu import Queue
 from square.environment import SquareEnvironment
 
 env = environ.Env()
@@ -58,6 +60,7 @@ INSTALLED_APPS = (
     "uobtheatre.mail",
     "uobtheatre.finance",
     "uobtheatre.site_messages",
+    "uobtheatre.live",
     "uobtheatre",
     "admin_confirm",
 )
@@ -146,6 +149,11 @@ STATICFILES_FINDERS = (
 MEDIA_ROOT = join(BASE_DIR, "media")
 MEDIA_PATH = "/media/"
 
+# Files which mustn't be publicly readable, such as report exports. These are
+# stored away from the media files, which are served publicly.
+PRIVATE_FILE_STORAGE = "django.core.files.storage.FileSystemStorage"
+PRIVATE_MEDIAFILES_LOCATION = join(BASE_DIR, "private_media")
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -345,6 +353,52 @@ SQUARE_SETTINGS = {
     "PATH": "square",
 }
 
+# The HTTP connections, timeouts (in seconds), retries and circuit breaker of
+# the Square API client, and the most related objects (such as a checkout's
+# payments) fetched at once
+SQUARE_CLIENT_SETTINGS = {
+    "TIMEOUT": env.float("SQUARE_CLIENT_TIMEOUT", default=30.0),
+    "CONNECT_TIMEOUT": env.float("SQUARE_CLIENT_CONNECT_TIMEOUT", default=5.0),
+    "MAX_CONNECTIONS": env.int("SQUARE_CLIENT_MAX_CONNECTIONS", default=20),
+    "MAX_KEEPALIVE_CONNECTIONS": env.int(
+        "SQUARE_CLIENT_MAX_KEEPALIVE_CONNECTIONS", default=10
+    ),
+    "KEEPALIVE_EXPIRY": env.float("SQUARE_CLIENT_KEEPALIVE_EXPIRY", default=30.0),
+    "ATTEMPTS": env.int("SQUARE_CLIENT_ATTEMPTS", default=3),
+    "BACKOFF": env.float("SQUARE_CLIENT_BACKOFF", default=0.5),
+    "CIRCUIT_FAILURE_THRESHOLD": env.int(
+        "SQUARE_CLIENT_CIRCUIT_FAILURE_THRESHOLD", default=5
+    ),
+    "CIRCUIT_RESET_TIMEOUT": env.float(
+        "SQUARE_CLIENT_CIRCUIT_RESET_TIMEOUT", default=30.0
+    ),
+    "CONCURRENT_FETCHES": env.int("SQUARE_CLIENT_CONCURRENT_FETCHES", default=4),
+}
+
+# Live events pushed to clients (e.g. box office terminals) as server-sent
+# events. Streams poll for events published by other processes, and end after
+# a while so clients reconnect. Events are retained long enough for offline
+# box office devices to catch up on the changes they missed.
+LIVE_EVENT_SETTINGS = {
+    "POLL_INTERVAL": env.float("LIVE_EVENT_POLL_INTERVAL", default=0.5),
+    "KEEPALIVE_INTERVAL": 15.0,
+    "STREAM_DURATION": env.float("LIVE_EVENT_STREAM_DURATION", default=300.0),
+    # The most streams each web process serves at once. Each stream holds a
+    # gunicorn thread and a database connection, so this must be fewer than
+    # the process's threads (GUNICORN_THREADS) to leave some for other requests.
+    "MAX_STREAMS": env.int("LIVE_EVENT_MAX_STREAMS", default=8),
+    "RECONNECT_DELAY_MS": 1000,
+    # How far back streams reread events, to catch those which became visible
+    # after later events (e.g. when published at the same moment by two
+    # processes). It must be longer than a publishing insert takes.
+    "LOOKBACK": 5.0,
+    "SIGNATURE_MAX_AGE": timedelta(hours=12),
+    "RETENTION": timedelta(days=1),
+}
+
+# Bearer token for scraping the metrics endpoint, which is disabled if unset
+METRICS_TOKEN = env("METRICS_TOKEN", default="")
+
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
 # Celery
@@ -355,3 +409,101 @@ CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_INCLUDE = ["uobtheatre.utils.tasks"]
+# Results are pruned by prune_task_results, according to TASK_RESULT_RETENTION,
+# rather than by Celery's own cleanup
+CELERY_RESULT_EXPIRES = None
+# Tasks are routed to queues by the kind of work they do, each with its own
+# workers (see local.yml), so that bulk mail, reports and maintenance can't
+# hold up payments. Any other tasks go to the default "celery" queue.
+# A worker started without -Q consumes all of these queues, so a single
+# worker (as is currently deployed) still runs every task.
+CELERY_TASK_QUEUES = [
+    Queue(name) for name in ["celery", "payments", "mail", "reports", "maintenance"]
+]
+CELERY_TASK_ROUTES = {
+    "uobtheatre.payments.tasks.refund_payment": {"queue": "payments"},
+    "uobtheatre.payments.tasks.refund_payable": {"queue": "payments"},
+    "uobtheatre.payments.tasks.process_square_webhook_events": {"queue": "payments"},
+    "uobtheatre.payments.tasks.resume_square_webhook_events": {"queue": "maintenance"},
+    "uobtheatre.payments.tasks.refresh_square_device_list": {"queue": "payments"},
+    "uobtheatre.mail.tasks.send_emails": {"queue": "mail"},
+    "uobtheatre.reports.tasks.generate_report": {"queue": "reports"},
+    "uobtheatre.reports.tasks.prune_report_jobs": {"queue": "maintenance"},
+    "uobtheatre.payments.tasks.prune_task_results": {"queue": "maintenance"},
+    "uobtheatre.finance.tasks.update_daily_sales_rollups": {"queue": "maintenance"},
+    "uobtheatre.payments.tasks.sync_provider_fees": {"queue": "maintenance"},
+    "uobtheatre.live.tasks.prune_live_events": {"queue": "maintenance"},
+    "uobtheatre.payments.tasks.reconcile_square_transactions": {"queue": "maintenance"},
+    # Bulk refunds are long running, so mustn't tie up the payments workers
+    "uobtheatre.productions.tasks.run_performance_refund_job": {"queue": "maintenance"},
+    "uobtheatre.productions.tasks.resume_performance_refund_jobs": {
+        "queue": "maintenance"
+    },
+}
+CELERY_BEAT_SCHEDULE = {
+    "update-daily-sales-rollups": {
+        "task": "uobtheatre.finance.tasks.update_daily_sales_rollups",
+        "schedule": crontab(minute=15),
+    },
+    "prune-task-results": {
+        "task": "uobtheatre.payments.tasks.prune_task_results",
+        "schedule": crontab(hour=3, minute=30),
+    },
+    "reconcile-square-transactions": {
+        "task": "uobtheatre.payments.tasks.reconcile_square_transactions",
+        "schedule": crontab(hour=4, minute=0),
+    },
+    "sync-provider-fees": {
+        "task": "uobtheatre.payments.tasks.sync_provider_fees",
+        "schedule": crontab(minute="*/15"),
+    },
+    "resume-square-webhook-events": {
+        "task": "uobtheatre.payments.tasks.resume_square_webhook_events",
+        "schedule": crontab(minute="*/15"),
+    },
+    "resume-performance-refund-jobs": {
+        "task": "uobtheatre.productions.tasks.resume_performance_refund_jobs",
+        "schedule": crontab(minute="*/10"),
+    },
+    "prune-live-events": {
+        "task": "uobtheatre.live.tasks.prune_live_events",
+        "schedule": crontab(minute=45),
+    },
+    "prune-report-jobs": {
+        "task": "uobtheatre.reports.tasks.prune_report_jobs",
+        "schedule": crontab(hour=3, minute=45),
+    },
+}
+
+# How long finished report jobs, and their stored reports, are kept
+REPORT_JOB_RETENTION = timedelta(days=7)
+
+# How long the results of tasks are kept, by task name. Tasks whose results
+# aren't needed ignore them instead. Results for refunds still being
+# processed are kept until the refund completes.
+TASK_RESULT_RETENTION = {
+    "default": timedelta(days=14),
+    "uobtheatre.payments.tasks.refund_payment": timedelta(days=365),
+    "uobtheatre.payments.tasks.refund_payable": timedelta(days=365),
+}
+
+# Bulk performance refunds, which are rate limited to stay within the payment
+# providers' API limits
+PERFORMANCE_REFUND_SETTINGS = {
+    "CHUNK_SIZE": env.int("PERFORMANCE_REFUND_CHUNK_SIZE", default=50),
+    "CONCURRENCY": env.int("PERFORMANCE_REFUND_CONCURRENCY", default=4),
+    "REQUESTS_PER_SECOND": env.float(
+        "PERFORMANCE_REFUND_REQUESTS_PER_SECOND", default=5.0
+    ),
+}
+
+# Syncing transactions' fees from the payment providers
+PROVIDER_FEE_SYNC_SETTINGS = {
+    "CONCURRENCY": env.int("PROVIDER_FEE_SYNC_CONCURRENCY", default=4),
+    "REQUESTS_PER_SECOND": env.float(
+        "PROVIDER_FEE_SYNC_REQUESTS_PER_SECOND", default=5.0
+    ),
+    # How far back sync_provider_fees looks for transactions missing a fee, so
+    # that one whose provider never gives a fee isn't fetched forever
+    "WINDOW": timedelta(days=env.int("PROVIDER_FEE_SYNC_WINDOW_DAYS", default=7)),
+}
@@ -34,6 +34,9 @@ STATICFILES_STORAGE = "uobtheatre.storages.StaticStorage"
 MEDIAFILES_LOCATION = "media"
 DEFAULT_FILE_STORAGE = "uobtheatre.storages.MediaStorage"
 
+PRIVATE_MEDIAFILES_LOCATION = "private"
+PRIVATE_FILE_STORAGE = "uobtheatre.storages.PrivateMediaStorage"
+
 SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
 
 if sentry_dns := os.getenv("SENTRY_DNS"):
@@ -51,7 +51,13 @@ EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
 # MEDIA
 # ------------------------------------------------------------------------------
 MEDIA_ROOT = tempfile.mkdtemp()
+PRIVATE_MEDIAFILES_LOCATION = tempfile.mkdtemp()
 
 # OTHER
 # ------------------------------------------------------------------------------
 SQUARE_SETTINGS["SQUARE_LOCATION"] = "LMHPTEST"
+
+# Refund bookings and sync fees in the test's thread, so that they use its database
+# transaction
+PERFORMANCE_REFUND_SETTINGS["CONCURRENCY"] = 1
+PROVIDER_FEE_SYNC_SETTINGS["CONCURRENCY"] = 1
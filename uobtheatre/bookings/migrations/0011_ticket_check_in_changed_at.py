@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bookings", "0010_auto_20250513_2106"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticket",
+            name="check_in_changed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,20 +1,25 @@
 import datetime
 import math
-from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple, Union
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple, Union
 from urllib.parse import urlencode
 
 from django.contrib.postgres.aggregates import BoolAnd
+from django.core import signing
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
-from django.db.models import Case, F, FloatField, Q, Value, When
+from django.db.models import Case, F, FloatField, Prefetch, Q, Value, When
 from django.db.models.functions import Cast
 from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.utils.functional import cached_property
-from graphql_relay.node.node import to_global_id
+from django.utils.http import base36_to_int, int_to_base36
+from graphql_relay.node.node import from_global_id, to_global_id
 
 import uobtheatre.bookings.emails as booking_emails
 from uobtheatre.discounts.models import ConcessionType, DiscountCombination
+from uobtheatre.live.events import publish
+from uobtheatre.live.models import LiveEvent, booking_topic, performance_topic
 from uobtheatre.payments.exceptions import (
     CantBePaidForException,
     CantBeRefundedException,
@@ -24,7 +29,6 @@ from uobtheatre.payments.payables import Payable, PayableQuerySet
 from uobtheatre.productions.models import Performance, Production
 from uobtheatre.users.models import User
 from uobtheatre.utils.exceptions import GQLException
-from uobtheatre.utils.filters import filter_passes_on_model
 from uobtheatre.utils.models import BaseModel, TimeStampedMixin
 from uobtheatre.utils.utils import combinations, create_short_uuid
 from uobtheatre.venues.models import Seat, SeatGroup
@@ -32,6 +36,9 @@ from uobtheatre.venues.models import Seat, SeatGroup
 if TYPE_CHECKING:
     from uobtheatre.payments.transaction_providers import PaymentProvider
 
+# The length of booking references (as made by create_short_uuid)
+BOOKING_REFERENCE_LENGTH = 12
+
 
 class MiscCostQuerySet(PayableQuerySet):
     """QuerySet for bookings"""
@@ -186,6 +193,8 @@ class BookingQuerySet(PayableQuerySet):
     def expired(self, bool_val=True) -> QuerySet:
         """Bookings that are not expired will be returned
 
+        Booking.is_reservation_expired is the in-memory equivalent.
+
         Args:
             bool_val (bool): when True: return only expired bookings,
             when False: return only non-expired bookings
@@ -215,6 +224,10 @@ class BookingQuerySet(PayableQuerySet):
         return self.exclude(accessibility_info__isnull=bool_val)
 
 
+# Signs the booking reference and ticket IDs shown in bookings' QR codes
+scan_code_signer = signing.Signer(salt="uobtheatre.bookings.scan")
+
+
 def generate_expires_at():
     """Generates the expires at timestamp for a booking"""
     return timezone.now() + datetime.timedelta(minutes=15)
@@ -245,7 +258,10 @@ class Booking(TimeStampedMixin, Payable):
         ]
 
     reference = models.CharField(
-        default=create_short_uuid, editable=False, max_length=12, unique=True
+        default=create_short_uuid,
+        editable=False,
+        max_length=BOOKING_REFERENCE_LENGTH,
+        unique=True,
     )
 
     performance = models.ForeignKey(
@@ -561,11 +577,41 @@ class Booking(TimeStampedMixin, Payable):
         confirmation email.
         """
         super().complete()
+        publish(
+            "booking.completed",
+            {"id": self.global_id, "reference": self.reference, "status": self.status},
+            self.live_topics,
+        )
+        ticket_ids = list(self.tickets.values_list("id", flat=True))
+        publish_ticket_changes(
+            "tickets.sold",
+            self,
+            ticket_ids,
+            {
+                "totalTicketsSold": len(ticket_ids),
+                "totalTicketsToCheckIn": len(ticket_ids),
+            },
+        )
 
         booking_emails.send_booking_confirmation_email(self, payment)
         if self.accessibility_info:
             booking_emails.send_booking_accessibility_info_email(self)
 
+    @property
+    def live_topics(self) -> List[str]:
+        return [booking_topic(self.pk), performance_topic(self.performance_id)]
+
+    @property
+    def scan_code(self) -> str:
+        """The signed code shown in the booking's QR code, which box office
+        scanners decode to find its tickets without a search"""
+        return scan_code_signer.sign(
+            ".".join(
+                [self.reference]
+                + [int_to_base36(ticket.pk) for ticket in self.tickets.all()]
+            )
+        )
+
     def clone(self):
         clone = super().clone()
         clone.reference = create_short_uuid()
@@ -585,9 +631,13 @@ class Booking(TimeStampedMixin, Payable):
 
     @property
     def is_reservation_expired(self):
-        """Returns whether the booking is considered expired"""
-        return filter_passes_on_model(
-            self, lambda qs: qs.expired()  # type:ignore
+        """Returns whether the booking is considered expired
+
+        In-memory equivalent of BookingQuerySet.expired
+        """
+        return (
+            self.status == Payable.Status.IN_PROGRESS
+            and self.expires_at < timezone.now()
         )
 
     def validate_cant_be_refunded(self) -> Optional[CantBeRefundedException]:
@@ -629,10 +679,59 @@ class TicketQuerySet(QuerySet):
     def sold(self) -> QuerySet:
         return self.filter(Q(booking__status="PAID"))
 
+    def check_in(self, user: User) -> int:
+        """Check in the tickets which aren't already checked in, with a single
+        UPDATE
+
+        Returns:
+            int: The number of tickets checked in
+        """
+        now = timezone.now()
+        return self.filter(checked_in_at__isnull=True).update(
+            checked_in_at=now, checked_in_by=user, check_in_changed_at=now
+        )
+
+    def uncheck_in(self) -> int:
+        """Un-check in the tickets which are checked in, with a single UPDATE
+
+        Returns:
+            int: The number of tickets un-checked in
+        """
+        return self.filter(checked_in_at__isnull=False).update(
+            checked_in_at=None, checked_in_by=None, check_in_changed_at=timezone.now()
+        )
+
 
 TicketManager = models.Manager.from_queryset(TicketQuerySet)
 
 
+def publish_ticket_changes(
+    event_type: str, booking: "Booking", ticket_ids: List[int], delta: Dict[str, int]
+):
+    """Publish a change to some of a booking's tickets to its performance's
+    live updates, so check-in dashboards can keep their counts up to date
+    without re-counting
+
+    Args:
+        event_type (str): The type of change
+        booking (Booking): The booking the tickets are in
+        ticket_ids (list of int): The IDs of the changed tickets
+        delta (dict): The change to each of the performance's tickets
+            breakdown counts (e.g. totalTicketsCheckedIn)
+    """
+    if not ticket_ids:
+        return
+    publish(
+        event_type,
+        {
+            "bookingId": booking.global_id,
+            "ticketIds": [to_global_id("TicketNode", pk) for pk in ticket_ids],
+            "delta": delta,
+        },
+        [performance_topic(booking.performance_id)],
+    )
+
+
 class Ticket(BaseModel):
     """A booking of a single seat.
 
@@ -663,6 +762,9 @@ class Ticket(BaseModel):
         null=True,
         blank=True,
     )
+    # When the ticket was last checked in or un-checked in, so that changes
+    # made offline can be ordered against those made online
+    check_in_changed_at = models.DateTimeField(null=True, blank=True)
 
     def discounted_price(self, single_discounts_map=None) -> int:
         """Ticket price with single discounts
@@ -720,7 +822,14 @@ class Ticket(BaseModel):
 
         self.checked_in_at = timezone.now()
         self.checked_in_by = user
+        self.check_in_changed_at = self.checked_in_at
         self.save()
+        publish_ticket_changes(
+            "tickets.checked_in",
+            self.booking,
+            [self.pk],
+            {"totalTicketsCheckedIn": 1, "totalTicketsToCheckIn": -1},
+        )
 
     def uncheck_in(self):
         """
@@ -733,7 +842,153 @@ class Ticket(BaseModel):
 
         self.checked_in_at = None
         self.checked_in_by = None
+        self.check_in_changed_at = timezone.now()
         self.save()
+        publish_ticket_changes(
+            "tickets.unchecked_in",
+            self.booking,
+            [self.pk],
+            {"totalTicketsCheckedIn": -1, "totalTicketsToCheckIn": 1},
+        )
 
     def __str__(self):
         return "%s | %s" % (self.seat_group.name, self.concession_type.name)
+
+
+def _event_booking_ids(events: Iterable[LiveEvent]) -> Set[int]:
+    """The IDs of the bookings which live events are about"""
+    booking_ids = set()
+    for event in events:
+        for key in ("id", "bookingId", "payObjectId"):
+            if not isinstance(event.data.get(key), str):
+                continue
+            node_type, pk = from_global_id(event.data[key])
+            if node_type == "BookingNode":
+                booking_ids.add(int(pk))
+    return booking_ids
+
+
+@dataclass
+class CheckInManifest:
+    """The bookings box office devices need to check tickets in for a
+    performance while offline.
+
+    The manifest's version is the last live event published before it was
+    taken. It is read before the bookings, so the bookings are at least as
+    new as the version. Devices catch up by fetching the changes since their
+    version, which are the bookings that events have been published about
+    since. The bookings are replaced rather than changed by a delta, so
+    fetching a change the manifest already has is harmless.
+    """
+
+    version: int
+    # Whether this is the full manifest, rather than the changes since a
+    # version
+    full: bool
+    bookings: List[Booking]
+
+    @classmethod
+    def for_performance(
+        cls, performance: Performance, since_version: Optional[int] = None
+    ) -> "CheckInManifest":
+        """The manifest for the performance
+
+        Args:
+            performance (Performance): The performance
+            since_version (int): The version the device already has. If the
+                changes since it are no longer known, the full manifest is
+                returned.
+
+        Returns:
+            CheckInManifest: The manifest
+        """
+        bookings = (
+            Booking.objects.filter(performance=performance)
+            .prefetch_related(
+                Prefetch(
+                    "tickets",
+                    queryset=Ticket.objects.select_related(
+                        "seat_group", "concession_type"
+                    ).order_by("pk"),
+                )
+            )
+            .order_by("reference")
+        )
+
+        version = LiveEvent.objects.latest_id()
+        if since_version is not None and LiveEvent.objects.retains_after(since_version):
+            events = (
+                LiveEvent.objects.for_topics([performance_topic(performance.pk)])
+                .after(since_version)
+                .filter(pk__lte=version)
+                .only("data")
+            )
+            return cls(
+                version=version,
+                full=False,
+                bookings=list(bookings.filter(pk__in=_event_booking_ids(events))),
+            )
+
+        return cls(
+            version=version,
+            full=True,
+            bookings=list(bookings.filter(status=Payable.Status.PAID)),
+        )
+
+
+@dataclass
+class ScannedBooking:
+    """The booking, and the tickets in it, which a code scanned at the door
+    refers to"""
+
+    # Shorter references are ambiguous, and too easy to guess
+    MIN_REFERENCE_PREFIX_LENGTH = 6
+
+    booking: Booking
+    tickets: List[Ticket]
+
+    @classmethod
+    def for_code(
+        cls, code: str, performance: Performance
+    ) -> Optional["ScannedBooking"]:
+        """Find the booking for the performance which the code refers to.
+
+        The code is either a booking's scan code, for the tickets in it, or
+        (the start of) a booking reference, for all of its tickets. Only
+        exact reference and prefix lookups are made, which use the
+        reference's index.
+
+        Args:
+            code (str): The scanned or typed code
+            performance (Performance): The performance being checked in
+
+        Returns:
+            ScannedBooking: The booking and tickets, or None if the code
+                doesn't match exactly one of the performance's bookings
+        """
+        code = code.strip()
+        tickets = Ticket.objects.select_related(
+            "seat_group", "concession_type"
+        ).order_by("pk")
+        bookings = Booking.objects.filter(performance=performance)
+
+        if scan_code_signer.sep in code:
+            try:
+                reference, *ticket_ids = scan_code_signer.unsign(code).split(".")
+                tickets = tickets.filter(pk__in=map(base36_to_int, ticket_ids))
+            except (signing.BadSignature, ValueError):
+                return None
+            bookings = bookings.filter(reference=reference)
+        elif len(code) >= BOOKING_REFERENCE_LENGTH:
+            bookings = bookings.filter(reference=code)
+        elif len(code) >= cls.MIN_REFERENCE_PREFIX_LENGTH:
+            bookings = bookings.filter(reference__startswith=code)
+        else:
+            return None
+
+        matches = list(
+            bookings.prefetch_related(Prefetch("tickets", queryset=tickets))[:2]
+        )
+        if len(matches) != 1:
+            return None
+        return cls(booking=matches[0], tickets=list(matches[0].tickets.all()))
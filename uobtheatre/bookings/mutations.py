@@ -1,12 +1,14 @@
-from typing import Optional
+import itertools
+from typing import Dict, Iterable, List, Optional
 
 import graphene
 from django.utils import timezone
+from graphql_relay.node.node import to_global_id
 
 import uobtheatre.bookings.emails as booking_emails
 from uobtheatre.bookings.abilities import ModifyAccessibility, ModifyBooking
 from uobtheatre.bookings.forms import BookingForm
-from uobtheatre.bookings.models import Booking, Ticket
+from uobtheatre.bookings.models import Booking, Ticket, publish_ticket_changes
 from uobtheatre.bookings.schema import BookingNode
 from uobtheatre.payments.payables import Payable
 from uobtheatre.payments.transaction_providers import (
@@ -20,11 +22,13 @@ from uobtheatre.productions.abilities import BookForPerformance
 from uobtheatre.productions.exceptions import NotBookableException
 from uobtheatre.productions.models import Performance
 from uobtheatre.users.abilities import AllwaysPasses
+from uobtheatre.users.models import User
 from uobtheatre.utils.exceptions import (
     AuthorizationException,
     BadRequestException,
     GQLException,
     GQLExceptions,
+    NotFoundException,
     SafeMutation,
 )
 from uobtheatre.utils.schema import (
@@ -38,9 +42,6 @@ from uobtheatre.utils.schema import (
 class TicketIDInput(graphene.InputObjectType):
     ticket_id = IdInputField(required=True)
 
-    def to_ticket(self):
-        return Ticket.objects.get(id=self.ticket_id)
-
 
 class BookingMutation(SafeFormMutation, AuthRequiredMixin):
     """Create/update mutation for booking objects"""
@@ -337,6 +338,65 @@ class PayBooking(AuthRequiredMixin, SafeMutation):
         return PayBooking(booking=booking, payment=transaction)
 
 
+def get_tickets(ticket_inputs: Iterable[TicketIDInput]) -> List[Ticket]:
+    """Load the requested tickets with a single query, in the order requested
+
+    Raises:
+        NotFoundException: If any of the tickets don't exist
+    """
+    ticket_ids = list(
+        dict.fromkeys(str(ticket_input.ticket_id) for ticket_input in ticket_inputs)
+    )
+    tickets = {
+        str(ticket.pk): ticket for ticket in Ticket.objects.filter(pk__in=ticket_ids)
+    }
+    if len(tickets) != len(ticket_ids):
+        raise NotFoundException()
+    return [tickets[ticket_id] for ticket_id in ticket_ids]
+
+
+def validate_tickets_in_booking(
+    tickets: Iterable[Ticket], booking: Booking, errors: GQLExceptions
+):
+    """Add an error for each ticket which isn't in the booking"""
+    for ticket in tickets:
+        if ticket.booking_id != booking.pk:
+            errors.add_exception(
+                GQLException(
+                    field="booking_reference",
+                    message=f"The booking of ticket {ticket.id} does not match the given booking.",
+                )
+            )
+
+
+def check_in_tickets(tickets_by_booking: Dict[Booking, List[Ticket]], user: User):
+    """Check in the bookings' tickets with a single conditional UPDATE
+
+    Raises:
+        GQLException: If any of the tickets have been checked in since they
+            were loaded (e.g. by another scanner)
+    """
+    ticket_ids = {
+        ticket.pk for tickets in tickets_by_booking.values() for ticket in tickets
+    }
+    if Ticket.objects.filter(pk__in=ticket_ids).check_in(user) != len(ticket_ids):
+        raise GQLException(
+            message="Some of the tickets have just been checked in. Please try again."
+        )
+
+    for booking, tickets in tickets_by_booking.items():
+        booking_ticket_ids = list(dict.fromkeys(ticket.pk for ticket in tickets))
+        publish_ticket_changes(
+            "tickets.checked_in",
+            booking,
+            booking_ticket_ids,
+            {
+                "totalTicketsCheckedIn": len(booking_ticket_ids),
+                "totalTicketsToCheckIn": -len(booking_ticket_ids),
+            },
+        )
+
+
 class CheckInBooking(AuthRequiredMixin, SafeMutation):
     """Mutation to check in the tickets of a Booking.
 
@@ -371,7 +431,7 @@ class CheckInBooking(AuthRequiredMixin, SafeMutation):
         booking = Booking.objects.get(reference=booking_reference)
 
         # check if the booking pertains to the correct performance
-        if booking.performance != performance:
+        if booking.performance_id != performance.pk:
             raise GQLException(
                 field="performance",
                 message="The booking performance does not match the given performance.",
@@ -393,37 +453,326 @@ class CheckInBooking(AuthRequiredMixin, SafeMutation):
                 message=f"This booking has not been paid for (Status: {booking.get_status_display()})",
             )
 
-        ticket_objects = list(map(lambda ticket: ticket.to_ticket(), tickets))
+        ticket_objects = get_tickets(tickets)
 
-        tickets_not_in_booking = [
-            ticket for ticket in ticket_objects if ticket.booking != booking
-        ]
+        errors = GQLExceptions()
+        validate_tickets_in_booking(ticket_objects, booking, errors)
+        if errors.has_exceptions():
+            raise errors
 
-        if tickets_not_in_booking:
-            raise GQLExceptions(
-                exceptions=[
-                    GQLException(
-                        field="booking_reference",
-                        message=f"The booking of ticket {ticket.id} does not match the given booking.",
-                    )
-                    for ticket in tickets_not_in_booking
+        for ticket in ticket_objects:
+            if ticket.checked_in:
+                errors.add_exception(
+                    GQLException(message=f"Ticket {ticket.id} is already checked in")
+                )
+        if errors.has_exceptions():
+            raise errors
+
+        check_in_tickets({booking: ticket_objects}, info.context.user)
+
+        return CheckInBooking(booking=booking, performance=performance)
+
+
+class BookingTicketsInput(graphene.InputObjectType):
+    booking_reference = graphene.String(required=True)
+    tickets = graphene.List(graphene.NonNull(TicketIDInput), required=True)
+
+
+class CheckInBookings(AuthRequiredMixin, SafeMutation):
+    """Mutation to check in the tickets of several Bookings at once, such as a
+    group arriving together.
+
+    The bookings and tickets are validated together, and either all of the
+    tickets are checked in or none are.
+
+    Args:
+        performance (str): The id of the performance that the bookings are
+            for.
+        bookings (list of BookingTicketsInput): The reference of each
+            booking, with its tickets to check in.
+
+    Returns:
+        bookings (list of BookingNode): The Bookings.
+        performance (PerformanceNode): The Performance.
+
+    Raises:
+        GQLExceptions: If any of the bookings or tickets can't be checked in
+    """
+
+    performance = graphene.Field("uobtheatre.productions.schema.PerformanceNode")
+    bookings = graphene.List(graphene.NonNull(BookingNode))
+
+    class Arguments:
+        performance = IdInputField(required=True)
+        bookings = graphene.List(graphene.NonNull(BookingTicketsInput), required=True)
+
+    @classmethod
+    def resolve_mutation(cls, _, info, bookings, performance):
+        performance = Performance.objects.get(id=performance)
+
+        # Check user has permission to check in for this performance
+        if not info.context.user.has_perm(
+            "productions.boxoffice", performance.production
+        ):
+            raise AuthorizationException(
+                message="You do not have permission to check in these bookings.",
+            )
+
+        booking_objects = {
+            booking.reference: booking
+            for booking in Booking.objects.filter(
+                reference__in=[
+                    booking_input.booking_reference for booking_input in bookings
                 ]
             )
+        }
+        tickets = {
+            ticket.pk: ticket
+            for ticket in get_tickets(
+                ticket_input
+                for booking_input in bookings
+                for ticket_input in booking_input.tickets
+            )
+        }
+
+        errors = GQLExceptions()
+        tickets_by_booking: Dict[Booking, List[Ticket]] = {}
+        for booking_input in bookings:
+            booking = booking_objects.get(booking_input.booking_reference)
+            if booking is None:
+                errors.add_exception(
+                    GQLException(
+                        field="bookings",
+                        message=f"Booking {booking_input.booking_reference} does not exist.",
+                        code=404,
+                    )
+                )
+                continue
+            if booking.performance_id != performance.pk:
+                errors.add_exception(
+                    GQLException(
+                        field="performance",
+                        message=f"The performance of booking {booking.reference} does not match the given performance.",
+                    )
+                )
+                continue
+            if not booking.status == Payable.Status.PAID:
+                errors.add_exception(
+                    GQLException(
+                        field="bookings",
+                        message=f"Booking {booking.reference} has not been paid for (Status: {booking.get_status_display()})",
+                    )
+                )
+                continue
+
+            booking_tickets = [
+                tickets[int(ticket_input.ticket_id)]
+                for ticket_input in booking_input.tickets
+            ]
+            validate_tickets_in_booking(booking_tickets, booking, errors)
+            for ticket in booking_tickets:
+                if ticket.checked_in:
+                    errors.add_exception(
+                        GQLException(
+                            message=f"Ticket {ticket.id} is already checked in"
+                        )
+                    )
+            tickets_by_booking.setdefault(booking, []).extend(booking_tickets)
 
-        tickets_checked_in = [ticket for ticket in ticket_objects if ticket.checked_in]
+        if errors.has_exceptions():
+            raise errors
 
-        if tickets_checked_in:
-            raise GQLExceptions(
-                exceptions=[
-                    GQLException(message=f"Ticket {ticket.id} is already checked in")
-                    for ticket in tickets_checked_in
+        check_in_tickets(tickets_by_booking, info.context.user)
+
+        return CheckInBookings(
+            bookings=list(tickets_by_booking), performance=performance
+        )
+
+
+class OfflineCheckInInput(graphene.InputObjectType):
+    """A check-in or un-check-in of a ticket made on a device while offline"""
+
+    ticket_id = IdInputField(required=True)
+    checked_in = graphene.Boolean(required=True)
+    # When the ticket was checked in or un-checked in on the device. A time
+    # without an offset is taken to be in the current timezone.
+    changed_at = graphene.DateTime(required=True)
+
+
+class OfflineCheckInOutcome(graphene.Enum):
+    """What happened to a check-in made offline once it was uploaded"""
+
+    APPLIED = "APPLIED"
+    # The ticket was already in this state (e.g. the change was uploaded before)
+    UNCHANGED = "UNCHANGED"
+    # The ticket was changed after this change was made, so it isn't applied
+    CONFLICT = "CONFLICT"
+    # The ticket isn't a paid ticket for the performance
+    INVALID = "INVALID"
+
+
+class OfflineCheckInResult(graphene.ObjectType):
+    """The outcome of a check-in made offline"""
+
+    ticket_id = graphene.ID(required=True)
+    outcome = graphene.Field(OfflineCheckInOutcome, required=True)
+    # The ticket's state once the changes have been applied
+    checked_in = graphene.Boolean()
+    check_in_changed_at = graphene.DateTime()
+
+
+class SyncOfflineCheckIns(AuthRequiredMixin, SafeMutation):
+    """Mutation to apply the check-ins and un-check-ins made by a box office
+    device while it was offline.
+
+    The changes are applied in the order they were made, and the most recent
+    change to each ticket wins. Uploading the same changes again has no
+    further effect, so devices can retry uploads safely.
+
+    Args:
+        performance (str): The id of the performance the tickets are for.
+        check_ins (list of OfflineCheckInInput): The changes made offline.
+
+    Returns:
+        results (list of OfflineCheckInResult): The outcome of each change,
+            in the order given.
+
+    Raises:
+        AuthorizationException: If the user can't check in for the
+            performance
+    """
+
+    results = graphene.List(graphene.NonNull(OfflineCheckInResult))
+
+    class Arguments:
+        performance = IdInputField(required=True)
+        check_ins = graphene.List(graphene.NonNull(OfflineCheckInInput), required=True)
+
+    @staticmethod
+    def apply_check_ins(
+        check_ins: List[OfflineCheckInInput], tickets: Dict[str, Ticket], user: User
+    ) -> Dict[int, str]:
+        """Apply the changes to the tickets, in the order they were made, and
+        save the tickets which changed
+
+        Args:
+            check_ins (list of OfflineCheckInInput): The changes made offline
+            tickets (dict): The tickets which can be changed, by ID
+            user (User): The user uploading the changes
+
+        Returns:
+            dict: The outcome of each change, by its index
+        """
+        outcomes: Dict[int, str] = {}
+        for index, check_in in sorted(
+            enumerate(check_ins), key=lambda item: item[1].changed_at
+        ):
+            ticket = tickets.get(str(check_in.ticket_id))
+            if ticket is None:
+                outcomes[index] = OfflineCheckInOutcome.INVALID
+            elif (
+                ticket.check_in_changed_at
+                and ticket.check_in_changed_at > check_in.changed_at
+            ):
+                outcomes[index] = OfflineCheckInOutcome.CONFLICT
+            elif ticket.checked_in == check_in.checked_in:
+                outcomes[index] = OfflineCheckInOutcome.UNCHANGED
+            else:
+                ticket.checked_in_at = (
+                    check_in.changed_at if check_in.checked_in else None
+                )
+                ticket.checked_in_by = user if check_in.checked_in else None
+                ticket.check_in_changed_at = check_in.changed_at
+                outcomes[index] = OfflineCheckInOutcome.APPLIED
+
+        Ticket.objects.bulk_update(
+            {
+                str(check_ins[index].ticket_id): tickets[
+                    str(check_ins[index].ticket_id)
                 ]
+                for index, outcome in outcomes.items()
+                if outcome == OfflineCheckInOutcome.APPLIED
+            }.values(),
+            ["checked_in_at", "checked_in_by", "check_in_changed_at"],
+        )
+        return outcomes
+
+    @staticmethod
+    def publish_changes(changed_tickets: List[Ticket]):
+        """Publish the changed tickets' check-ins and un-check-ins to their
+        performance's live updates, grouped by booking"""
+        for _, group in itertools.groupby(
+            sorted(changed_tickets, key=lambda ticket: ticket.booking_id),
+            key=lambda ticket: ticket.booking_id,
+        ):
+            booking_tickets = list(group)
+            for checked_in, event_type in (
+                (True, "tickets.checked_in"),
+                (False, "tickets.unchecked_in"),
+            ):
+                ticket_ids = [
+                    ticket.pk
+                    for ticket in booking_tickets
+                    if ticket.checked_in == checked_in
+                ]
+                change = len(ticket_ids) if checked_in else -len(ticket_ids)
+                publish_ticket_changes(
+                    event_type,
+                    booking_tickets[0].booking,
+                    ticket_ids,
+                    {"totalTicketsCheckedIn": change, "totalTicketsToCheckIn": -change},
+                )
+
+    @classmethod
+    def resolve_mutation(cls, _, info, performance, check_ins):
+        performance = Performance.objects.get(id=performance)
+
+        if not info.context.user.has_perm(
+            "productions.boxoffice", performance.production
+        ):
+            raise AuthorizationException(
+                message="You do not have permission to check in for this performance.",
             )
 
-        for ticket in ticket_objects:
-            ticket.check_in(info.context.user)
+        for check_in in check_ins:
+            if timezone.is_naive(check_in.changed_at):
+                check_in.changed_at = timezone.make_aware(check_in.changed_at)
 
-        return CheckInBooking(booking=booking, performance=performance)
+        tickets = {
+            str(ticket.pk): ticket
+            for ticket in Ticket.objects.filter(
+                pk__in={str(check_in.ticket_id) for check_in in check_ins},
+                booking__performance=performance,
+                booking__status=Payable.Status.PAID,
+            )
+            .select_related("booking")
+            .select_for_update(of=("self",))
+        }
+        was_checked_in = {pk: ticket.checked_in for pk, ticket in tickets.items()}
+
+        outcomes = cls.apply_check_ins(check_ins, tickets, info.context.user)
+        cls.publish_changes(
+            # Only publish the tickets whose state has changed overall, so the
+            # deltas of a ticket checked in and out again offline cancel out
+            [
+                ticket
+                for pk, ticket in tickets.items()
+                if ticket.checked_in != was_checked_in[pk]
+            ]
+        )
+
+        results = []
+        for index, check_in in enumerate(check_ins):
+            ticket = tickets.get(str(check_in.ticket_id))
+            results.append(
+                OfflineCheckInResult(
+                    ticket_id=to_global_id("TicketNode", check_in.ticket_id),
+                    outcome=outcomes[index],
+                    checked_in=ticket.checked_in if ticket else None,
+                    check_in_changed_at=ticket.check_in_changed_at if ticket else None,
+                )
+            )
+        return SyncOfflineCheckIns(results=results)
 
 
 class UnCheckInBooking(AuthRequiredMixin, SafeMutation):
@@ -459,7 +808,7 @@ class UnCheckInBooking(AuthRequiredMixin, SafeMutation):
         booking = Booking.objects.get(reference=booking_reference)
 
         # check if the booking pertains to the correct performance
-        if booking.performance != performance:
+        if booking.performance_id != performance.pk:
             # raise booking performance does not match performance given
             raise GQLException(
                 field="performance",
@@ -474,33 +823,37 @@ class UnCheckInBooking(AuthRequiredMixin, SafeMutation):
                 message="You do not have permission to uncheck in this booking.",
             )
 
-        ticket_objects = list(map(lambda ticket: ticket.to_ticket(), tickets))
-        # loop through the ticket IDs given
+        ticket_objects = get_tickets(tickets)
 
-        tickets_not_in_booking = [
-            ticket for ticket in ticket_objects if ticket.booking != booking
-        ]
+        errors = GQLExceptions()
+        validate_tickets_in_booking(ticket_objects, booking, errors)
+        if errors.has_exceptions():
+            raise errors
 
-        if tickets_not_in_booking:
-            raise GQLExceptions(
-                exceptions=[
-                    GQLException(
-                        field="booking_reference",
-                        message=f"The booking of ticket {ticket.id} does not match the given booking.",
-                    )
-                    for ticket in tickets_not_in_booking
-                ]
-            )
-
-        tickets_checked_in = [ticket for ticket in ticket_objects if ticket.checked_in]
-
-        if not tickets_checked_in:
+        ticket_ids = list(
+            dict.fromkeys(ticket.pk for ticket in ticket_objects if ticket.checked_in)
+        )
+        if not ticket_ids:
             raise BadRequestException(
                 message="The booking has no checked-in tickets.",
             )
 
-        for ticket in tickets_checked_in:
-            ticket.uncheck_in()
+        # Only the changes made by this UPDATE are published, so fail if
+        # another device un-checked in any of the tickets first
+        if Ticket.objects.filter(pk__in=ticket_ids).uncheck_in() != len(ticket_ids):
+            raise GQLException(
+                message="Some of the tickets have just been un-checked in. Please try again."
+            )
+
+        publish_ticket_changes(
+            "tickets.unchecked_in",
+            booking,
+            ticket_ids,
+            {
+                "totalTicketsCheckedIn": -len(ticket_ids),
+                "totalTicketsToCheckIn": len(ticket_ids),
+            },
+        )
 
         return UnCheckInBooking(booking=booking, performance=performance)
 
@@ -513,4 +866,6 @@ class Mutation(graphene.ObjectType):
     delete_booking = DeleteBooking.Field()
     pay_booking = PayBooking.Field()
     check_in_booking = CheckInBooking.Field()
+    check_in_bookings = CheckInBookings.Field()
+    sync_offline_check_ins = SyncOfflineCheckIns.Field()
     uncheck_in_booking = UnCheckInBooking.Field()
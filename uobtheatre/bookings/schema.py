@@ -7,13 +7,23 @@ from django_filters import OrderingFilter
 from graphene import relay
 from graphene_django import DjangoListField, DjangoObjectType
 from graphene_django.filter import DjangoFilterConnectionField
-from graphql_relay.node.node import from_global_id
-
-from uobtheatre.bookings.models import Booking, MiscCost, Ticket
+from graphql_relay.node.node import from_global_id, to_global_id
+
+from uobtheatre.bookings.models import (
+    Booking,
+    CheckInManifest,
+    MiscCost,
+    ScannedBooking,
+    Ticket,
+)
+from uobtheatre.live.models import LiveEvent, booking_topic
+from uobtheatre.live.utils import live_events_uri
+from uobtheatre.payments.payables import Payable
 from uobtheatre.productions.models import Performance
-from uobtheatre.productions.schema import SalesBreakdownNode
+from uobtheatre.productions.schema import SalesBreakdownLoader, SalesBreakdownNode
 from uobtheatre.users.schema import ExtendedUserNode
 from uobtheatre.utils.filters import FilterSet
+from uobtheatre.utils.schema import IdInputField
 
 
 class MiscCostFilter(FilterSet):
@@ -343,13 +353,28 @@ class BookingNode(DjangoObjectType):
     )
     expired = graphene.Boolean(required=True)
     sales_breakdown = graphene.Field(SalesBreakdownNode)
+    live_updates_uri = graphene.String(
+        description="The URI of a server-sent events stream of the booking's payment and status changes"
+    )
+    scan_code = graphene.String(
+        required=True,
+        description="The signed code to show in the booking's QR code",
+    )
 
     def resolve_price_breakdown(self, _):
         return self
 
+    def resolve_live_updates_uri(self, _):
+        # Continue from the events published before the URI was given, so
+        # changes made before the client connects aren't missed
+        return live_events_uri([booking_topic(self.pk)], LiveEvent.objects.latest_id())
+
     def resolve_expired(self, _):
         return self.is_reservation_expired
 
+    def resolve_sales_breakdown(self, info):
+        return SalesBreakdownLoader.for_request(info, Booking).load(self.pk)
+
     @classmethod
     def get_queryset(cls, queryset, info):
         """Get the queryset for a group of booking nodes"""
@@ -368,6 +393,50 @@ class BookingNode(DjangoObjectType):
         interfaces = (relay.Node,)
 
 
+class CheckInManifestTicketNode(graphene.ObjectType):
+    id = graphene.ID(required=True)
+    seat_group = graphene.String(required=True)
+    concession_type = graphene.String(required=True)
+    checked_in = graphene.Boolean(required=True)
+    check_in_changed_at = graphene.DateTime()
+
+    def resolve_id(self, _):
+        return to_global_id("TicketNode", self.pk)
+
+    def resolve_seat_group(self, _):
+        return self.seat_group.name
+
+    def resolve_concession_type(self, _):
+        return self.concession_type.name
+
+
+class CheckInManifestBookingNode(graphene.ObjectType):
+    reference = graphene.String(required=True)
+    # Whether the booking's tickets can be checked in. Devices drop bookings
+    # which are no longer valid (e.g. because they have been refunded).
+    valid = graphene.Boolean(required=True)
+    tickets = graphene.List(graphene.NonNull(CheckInManifestTicketNode), required=True)
+
+    def resolve_valid(self, _):
+        return self.status == Payable.Status.PAID
+
+    def resolve_tickets(self, _):
+        return self.tickets.all()
+
+
+class CheckInManifestNode(graphene.ObjectType):
+    version = graphene.Int(required=True)
+    full = graphene.Boolean(required=True)
+    bookings = graphene.List(
+        graphene.NonNull(CheckInManifestBookingNode), required=True
+    )
+
+
+class ScannedBookingNode(graphene.ObjectType):
+    booking = graphene.Field(BookingNode, required=True)
+    tickets = graphene.List(graphene.NonNull(TicketNode), required=True)
+
+
 class Query(graphene.ObjectType):
     """Query for production module.
 
@@ -376,3 +445,55 @@ class Query(graphene.ObjectType):
 
     miscCosts = DjangoFilterConnectionField(MiscCostNode)
     bookings = DjangoFilterConnectionField(BookingNode)
+    check_in_manifest = graphene.Field(
+        CheckInManifestNode,
+        performance=IdInputField(required=True),
+        since_version=graphene.Int(),
+    )
+    scan_ticket = graphene.Field(
+        ScannedBookingNode,
+        code=graphene.String(required=True),
+        performance=IdInputField(required=True),
+    )
+
+    def resolve_check_in_manifest(self, info, performance, since_version=None):
+        """
+        Returns the bookings needed to check in a performance's tickets
+        offline, or the changes to them since a version of the manifest.
+
+        Args:
+            performance (str): The id of the performance
+            since_version (int): The version of the manifest the device
+                already has
+
+        Returns:
+            CheckInManifest: The manifest
+        """
+        performance = Performance.objects.filter(pk=performance).first()
+        if not performance or not info.context.user.has_perm(
+            "productions.boxoffice", performance.production
+        ):
+            return None
+
+        return CheckInManifest.for_performance(performance, since_version)
+
+    def resolve_scan_ticket(self, info, code, performance):
+        """
+        Returns the booking, and its tickets, which a code scanned or typed
+        in at the door refers to.
+
+        Args:
+            code (str): A booking's scan code, or (the start of) its reference
+            performance (str): The id of the performance being checked in
+
+        Returns:
+            ScannedBooking: The booking and tickets, or None if the code
+                doesn't match one of the performance's bookings
+        """
+        performance = Performance.objects.filter(pk=performance).first()
+        if not performance or not info.context.user.has_perm(
+            "productions.boxoffice", performance.production
+        ):
+            return None
+
+        return ScannedBooking.for_code(code, performance)
@@ -10,7 +10,7 @@ from django.db.utils import IntegrityError
 from django.utils import timezone
 from graphql_relay.node.node import to_global_id
 
-from uobtheatre.bookings.models import Booking, MiscCost, Ticket
+from uobtheatre.bookings.models import Booking, MiscCost, ScannedBooking, Ticket
 from uobtheatre.bookings.test.factories import (
     BookingFactory,
     PercentageMiscCostFactory,
@@ -34,6 +34,7 @@ from uobtheatre.productions.models import Production
 from uobtheatre.productions.test.factories import PerformanceFactory, ProductionFactory
 from uobtheatre.users.test.factories import UserFactory
 from uobtheatre.utils.exceptions import GQLException
+from uobtheatre.utils.filters import filter_passes_on_model
 from uobtheatre.utils.test_utils import ticket_dict_list_dict_gen, ticket_list_dict_gen
 from uobtheatre.venues.test.factories import SeatFactory, SeatGroupFactory, VenueFactory
 
@@ -930,6 +931,32 @@ def test_ticket_uncheck_in_fails_if_ticket_not_checked_in():
     )
 
 
+@pytest.mark.django_db
+def test_ticket_queryset_check_in(django_assert_num_queries):
+    user = UserFactory()
+    checked_in_ticket = TicketFactory(set_checked_in=True)
+    tickets = [TicketFactory(set_checked_in=False) for _ in range(3)]
+    queryset = Ticket.objects.filter(
+        pk__in=[checked_in_ticket.pk] + [ticket.pk for ticket in tickets]
+    )
+
+    with django_assert_num_queries(1):
+        assert queryset.check_in(user) == 3
+
+    for ticket in tickets:
+        ticket.refresh_from_db()
+        assert ticket.checked_in
+        assert ticket.checked_in_by == user
+    # Tickets already checked in are left as they were
+    checked_in_by = checked_in_ticket.checked_in_by
+    checked_in_ticket.refresh_from_db()
+    assert checked_in_ticket.checked_in_by == checked_in_by
+
+    with django_assert_num_queries(1):
+        assert queryset.uncheck_in() == 4
+    assert not Ticket.objects.filter(checked_in_at__isnull=False).exists()
+
+
 @pytest.mark.django_db
 def test_filter_order_by_checked_in():
     """
@@ -1024,6 +1051,26 @@ def test_booking_expiration():
     assert not expired_booking.is_reservation_expired
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize("status", Payable.Status.values)
+@pytest.mark.parametrize("expires_in_minutes", [-16, -1, 1, 15])
+def test_booking_expiration_matches_queryset(
+    status, expires_in_minutes, django_assert_num_queries
+):
+    booking = BookingFactory(
+        status=status,
+        expires_at=timezone.now() + datetime.timedelta(minutes=expires_in_minutes),
+    )
+
+    with django_assert_num_queries(0):
+        is_expired = booking.is_reservation_expired
+
+    assert is_expired == filter_passes_on_model(booking, lambda qs: qs.expired())
+    assert is_expired != filter_passes_on_model(
+        booking, lambda qs: qs.expired(bool_val=False)
+    )
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "is_refunded,status,production_status,expected",
@@ -1131,3 +1178,63 @@ def test_booking_clone():
     # Check a unique booking reference is assigned
     assert booking_clone.reference is not None
     assert booking_clone.reference != booking.reference
+
+
+@pytest.mark.django_db
+def test_scanned_booking_for_scan_code():
+    booking = BookingFactory(reference="ABCdef123456")
+    tickets = [TicketFactory(booking=booking) for _ in range(2)]
+    scan_code = booking.scan_code
+    TicketFactory(booking=booking)
+
+    scanned = ScannedBooking.for_code(scan_code, booking.performance)
+
+    assert scanned.booking == booking
+    # Only the tickets in the code are returned
+    assert scanned.tickets == tickets
+
+    # The code must be for the performance being checked in
+    assert ScannedBooking.for_code(scan_code, PerformanceFactory()) is None
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "ABCdef123456:invalidsignature",
+        "ABCdef123456.1:invalidsignature",
+        "ABCdef123456.a:",
+    ],
+)
+@pytest.mark.django_db
+def test_scanned_booking_for_tampered_scan_code(code):
+    booking = BookingFactory(reference="ABCdef123456")
+    TicketFactory(booking=booking)
+
+    assert ScannedBooking.for_code(code, booking.performance) is None
+
+
+@pytest.mark.parametrize(
+    "code, found",
+    [
+        ("ABCdef123456", True),
+        (" ABCdef123456 ", True),
+        ("ABCdef", True),
+        ("ABCde", False),
+        ("ABCxyz", False),
+        ("ABCdef123457", False),
+    ],
+)
+@pytest.mark.django_db
+def test_scanned_booking_for_reference(code, found):
+    booking = BookingFactory(reference="ABCdef123456")
+    tickets = [TicketFactory(booking=booking) for _ in range(2)]
+    BookingFactory(performance=booking.performance, reference="ABCxyz123456")
+    BookingFactory(performance=booking.performance, reference="ABCxyz654321")
+
+    scanned = ScannedBooking.for_code(code, booking.performance)
+
+    if found:
+        assert scanned.booking == booking
+        assert scanned.tickets == tickets
+    else:
+        assert scanned is None
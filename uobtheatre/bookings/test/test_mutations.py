@@ -5,6 +5,7 @@ from datetime import timedelta
 from unittest.mock import patch
 
 import pytest
+from django.test import override_settings
 from django.utils import timezone
 from graphql_relay.node.node import from_global_id, to_global_id
 from guardian.shortcuts import assign_perm
@@ -26,6 +27,7 @@ from uobtheatre.discounts.test.factories import (
     ConcessionTypeFactory,
     DiscountRequirementFactory,
 )
+from uobtheatre.live.models import LiveEvent
 from uobtheatre.payments.models import Transaction
 from uobtheatre.payments.payables import Payable
 from uobtheatre.payments.test.factories import TransactionFactory
@@ -2428,6 +2430,52 @@ def test_check_in_booking(
         assert not ticket.checked_in
 
 
+@pytest.mark.django_db
+def test_check_in_booking_tickets_breakdown(
+    gql_client, django_capture_on_commit_callbacks
+):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+    booking = BookingFactory(performance=performance, status=Payable.Status.PAID)
+    ticket = TicketFactory(booking=booking)
+    TicketFactory(booking=booking)
+    previous_event = LiveEvent.objects.create(
+        topic="performance:1", type="tickets.sold"
+    )
+
+    with django_capture_on_commit_callbacks(execute=True):
+        response = gql_client.execute("""
+            mutation {
+                checkInBooking (
+                    bookingReference: "%s"
+                    performance: "%s"
+                    tickets: [{ticketId: "%s"}]
+                ){
+                    performance {
+                        ticketsBreakdown {
+                            totalTicketsCheckedIn
+                            totalTicketsToCheckIn
+                            liveEventId
+                        }
+                    }
+                }
+            }
+            """ % (
+            booking.reference,
+            to_global_id("PerformanceNode", performance.id),
+            to_global_id("TicketNode", ticket.id),
+        ))
+
+    # The counts include the check in, and so continue from before its event
+    assert response["data"]["checkInBooking"]["performance"]["ticketsBreakdown"] == {
+        "totalTicketsCheckedIn": 1,
+        "totalTicketsToCheckIn": 1,
+        "liveEventId": previous_event.pk,
+    }
+    assert LiveEvent.objects.latest_id() > previous_event.pk
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "status",
@@ -2596,6 +2644,256 @@ def test_check_in_booking_fails_if_already_checked_in(gql_client):
     }
 
 
+CHECK_IN_BOOKINGS_MUTATION = """
+    mutation($performance: IdInputField!, $bookings: [BookingTicketsInput!]!) {
+        checkInBookings(performance: $performance, bookings: $bookings) {
+            success
+            errors {
+                __typename
+                ... on NonFieldError {
+                    message
+                }
+                ... on FieldError {
+                    message
+                    field
+                }
+            }
+            bookings {
+                reference
+            }
+        }
+    }
+"""
+
+
+def check_in_bookings_variables(performance, tickets_by_booking):
+    return {
+        "performance": to_global_id("PerformanceNode", performance.id),
+        "bookings": [
+            {
+                "bookingReference": booking.reference,
+                "tickets": [
+                    {"ticketId": to_global_id("TicketNode", ticket.id)}
+                    for ticket in tickets
+                ],
+            }
+            for booking, tickets in tickets_by_booking.items()
+        ],
+    }
+
+
+@pytest.mark.django_db
+def test_check_in_bookings(gql_client, django_assert_max_num_queries):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+    tickets_by_booking = {}
+    for _ in range(3):
+        booking = BookingFactory(performance=performance)
+        tickets_by_booking[booking] = [
+            TicketFactory(booking=booking) for _ in range(4)
+        ]
+
+    # The number of queries doesn't grow with the number of tickets
+    with django_assert_max_num_queries(12):
+        response = gql_client.execute(
+            CHECK_IN_BOOKINGS_MUTATION,
+            variable_values=check_in_bookings_variables(
+                performance, tickets_by_booking
+            ),
+        )
+
+    assert response["data"]["checkInBookings"] == {
+        "success": True,
+        "errors": None,
+        "bookings": [{"reference": booking.reference} for booking in tickets_by_booking],
+    }
+    for tickets in tickets_by_booking.values():
+        for ticket in tickets:
+            ticket.refresh_from_db()
+            assert ticket.checked_in
+            assert ticket.checked_in_by == gql_client.user
+
+
+@pytest.mark.django_db
+def test_check_in_bookings_errors(gql_client):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+
+    booking = BookingFactory(performance=performance)
+    ticket = TicketFactory(booking=booking)
+    checked_in_ticket = TicketFactory(booking=booking, set_checked_in=True)
+    other_performance_booking = BookingFactory()
+    unpaid_booking = BookingFactory(
+        performance=performance, status=Payable.Status.IN_PROGRESS
+    )
+    other_booking = BookingFactory(performance=performance)
+    other_booking_ticket = TicketFactory(booking=other_booking)
+
+    response = gql_client.execute(
+        CHECK_IN_BOOKINGS_MUTATION,
+        variable_values=check_in_bookings_variables(
+            performance,
+            {
+                booking: [ticket, checked_in_ticket, other_booking_ticket],
+                other_performance_booking: [],
+                unpaid_booking: [],
+            },
+        ),
+    )
+
+    assert response["data"]["checkInBookings"] == {
+        "success": False,
+        "errors": [
+            {
+                "__typename": "FieldError",
+                "message": f"The booking of ticket {other_booking_ticket.id} does not match the given booking.",
+                "field": "bookingReference",
+            },
+            {
+                "__typename": "NonFieldError",
+                "message": f"Ticket {checked_in_ticket.id} is already checked in",
+            },
+            {
+                "__typename": "FieldError",
+                "message": f"The performance of booking {other_performance_booking.reference} does not match the given performance.",
+                "field": "performance",
+            },
+            {
+                "__typename": "FieldError",
+                "message": f"Booking {unpaid_booking.reference} has not been paid for (Status: In Progress)",
+                "field": "bookings",
+            },
+        ],
+        "bookings": None,
+    }
+    # Nothing is checked in unless everything can be
+    ticket.refresh_from_db()
+    assert not ticket.checked_in
+
+
+@pytest.mark.django_db
+def test_check_in_bookings_without_boxoffice_perm(gql_client):
+    performance = PerformanceFactory()
+    gql_client.login()
+    booking = BookingFactory(performance=performance)
+    ticket = TicketFactory(booking=booking)
+
+    response = gql_client.execute(
+        CHECK_IN_BOOKINGS_MUTATION,
+        variable_values=check_in_bookings_variables(performance, {booking: [ticket]}),
+    )
+
+    assert response["data"]["checkInBookings"]["errors"] == [
+        {
+            "__typename": "NonFieldError",
+            "message": "You do not have permission to check in these bookings.",
+        }
+    ]
+    ticket.refresh_from_db()
+    assert not ticket.checked_in
+
+
+@pytest.mark.django_db
+def test_check_in_booking_checked_in_concurrently(gql_client):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+    booking = BookingFactory(performance=performance)
+    ticket = TicketFactory(booking=booking)
+
+    # Another scanner checks the ticket in after it is loaded
+    with patch(
+        "uobtheatre.bookings.models.TicketQuerySet.check_in", return_value=0
+    ):
+        response = gql_client.execute(
+            CHECK_IN_BOOKINGS_MUTATION,
+            variable_values=check_in_bookings_variables(
+                performance, {booking: [ticket]}
+            ),
+        )
+
+    assert response["data"]["checkInBookings"]["errors"] == [
+        {
+            "__typename": "NonFieldError",
+            "message": "Some of the tickets have just been checked in. Please try again.",
+        }
+    ]
+
+
+@pytest.mark.django_db
+def test_check_in_bookings_not_found(gql_client):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+    ticket = TicketFactory(booking=BookingFactory(performance=performance))
+
+    variables = check_in_bookings_variables(performance, {ticket.booking: [ticket]})
+    variables["bookings"][0]["bookingReference"] = "NOTREAL00000"
+    response = gql_client.execute(CHECK_IN_BOOKINGS_MUTATION, variable_values=variables)
+    assert response["data"]["checkInBookings"]["errors"] == [
+        {
+            "__typename": "FieldError",
+            "message": "Booking NOTREAL00000 does not exist.",
+            "field": "bookings",
+        }
+    ]
+
+    variables = check_in_bookings_variables(performance, {ticket.booking: [ticket]})
+    variables["bookings"][0]["tickets"].append(
+        {"ticketId": to_global_id("TicketNode", ticket.id + 1)}
+    )
+    response = gql_client.execute(CHECK_IN_BOOKINGS_MUTATION, variable_values=variables)
+    assert response["data"]["checkInBookings"]["errors"] == [
+        {"__typename": "NonFieldError", "message": "Object not found"}
+    ]
+    ticket.refresh_from_db()
+    assert not ticket.checked_in
+
+
+@pytest.mark.django_db
+def test_uncheck_in_booking_unchecked_in_concurrently(gql_client):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+    booking = BookingFactory(performance=performance)
+    tickets = [TicketFactory(booking=booking, set_checked_in=True) for _ in range(2)]
+
+    # Another device un-checks in one of the tickets after they are loaded
+    with patch(
+        "uobtheatre.bookings.models.TicketQuerySet.uncheck_in", return_value=1
+    ), patch("uobtheatre.bookings.mutations.publish_ticket_changes") as publish_mock:
+        response = gql_client.execute(
+            """
+            mutation($booking: String!, $performance: IdInputField!, $tickets: [TicketIDInput]!) {
+                uncheckInBooking(bookingReference: $booking, performance: $performance, tickets: $tickets) {
+                    errors {
+                        ... on NonFieldError {
+                            message
+                        }
+                    }
+                }
+            }
+            """,
+            variable_values={
+                "booking": booking.reference,
+                "performance": to_global_id("PerformanceNode", performance.id),
+                "tickets": [
+                    {"ticketId": to_global_id("TicketNode", ticket.id)}
+                    for ticket in tickets
+                ],
+            },
+        )
+
+    assert response["data"]["uncheckInBooking"]["errors"] == [
+        {
+            "message": "Some of the tickets have just been un-checked in. Please try again."
+        }
+    ]
+    publish_mock.assert_not_called()
+
+
 @pytest.mark.django_db
 def test_uncheck_in_booking(gql_client):
     performance = PerformanceFactory()
@@ -2938,3 +3236,170 @@ def test_past_production_accessibility_denied(gql_client):
         response["data"]["updateBookingAccessibilityInfo"]["errors"][0]["message"]
         == "Accessibility information can only be updated for future performances"
     )
+
+
+SYNC_OFFLINE_CHECK_INS_MUTATION = """
+    mutation($performance: IdInputField!, $checkIns: [OfflineCheckInInput!]!) {
+        syncOfflineCheckIns(performance: $performance, checkIns: $checkIns) {
+            success
+            errors {
+                __typename
+                ... on NonFieldError {
+                    message
+                }
+            }
+            results {
+                ticketId
+                outcome
+                checkedIn
+            }
+        }
+    }
+"""
+
+
+@pytest.mark.django_db
+def test_sync_offline_check_ins(gql_client, django_capture_on_commit_callbacks):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+    booking = BookingFactory(performance=performance)
+    ticket = TicketFactory(booking=booking)
+    checked_in_ticket = TicketFactory(booking=booking, set_checked_in=True)
+    conflicting_ticket = TicketFactory(booking=booking)
+    other_performance_ticket = TicketFactory()
+
+    changed_at = timezone.now() - timedelta(minutes=5)
+    with django_capture_on_commit_callbacks(execute=True):
+        # Checked in at the door since the offline change was made
+        conflicting_ticket.check_in(gql_client.user)
+
+    def sync():
+        def check_in(ticket, checked_in=True):
+            return {
+                "ticketId": to_global_id("TicketNode", ticket.id),
+                "checkedIn": checked_in,
+                "changedAt": changed_at.isoformat(),
+            }
+
+        with django_capture_on_commit_callbacks(execute=True):
+            return gql_client.execute(
+                SYNC_OFFLINE_CHECK_INS_MUTATION,
+                variable_values={
+                    "performance": to_global_id("PerformanceNode", performance.id),
+                    "checkIns": [
+                        check_in(ticket),
+                        check_in(checked_in_ticket),
+                        check_in(conflicting_ticket, checked_in=False),
+                        check_in(other_performance_ticket),
+                    ],
+                },
+            )["data"]["syncOfflineCheckIns"]
+
+    def result(ticket, outcome, checked_in):
+        return {
+            "ticketId": to_global_id("TicketNode", ticket.id),
+            "outcome": outcome,
+            "checkedIn": checked_in,
+        }
+
+    assert sync() == {
+        "success": True,
+        "errors": None,
+        "results": [
+            result(ticket, "APPLIED", True),
+            result(checked_in_ticket, "UNCHANGED", True),
+            result(conflicting_ticket, "CONFLICT", True),
+            result(other_performance_ticket, "INVALID", None),
+        ],
+    }
+    ticket.refresh_from_db()
+    assert ticket.checked_in_at == changed_at
+    assert ticket.checked_in_by == gql_client.user
+    assert ticket.check_in_changed_at == changed_at
+    assert LiveEvent.objects.filter(
+        type="tickets.checked_in", data__ticketIds=[to_global_id("TicketNode", ticket.id)]
+    ).exists()
+
+    # Uploading the changes again has no further effect
+    event_id = LiveEvent.objects.latest_id()
+    assert [result["outcome"] for result in sync()["results"]] == [
+        "UNCHANGED",
+        "UNCHANGED",
+        "CONFLICT",
+        "INVALID",
+    ]
+    assert LiveEvent.objects.latest_id() == event_id
+
+
+@pytest.mark.django_db
+@override_settings(TIME_ZONE="Europe/London")
+def test_sync_offline_check_ins_without_offset(gql_client):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+    booking = BookingFactory(performance=performance)
+    ticket = TicketFactory(booking=booking)
+    # Checked in at the door since the offline changes were made
+    checked_in_ticket = TicketFactory(
+        booking=booking, set_checked_in=True, check_in_changed_at=timezone.now()
+    )
+
+    changed_at = timezone.now() - timedelta(minutes=5)
+    # Times without an offset are in the current timezone
+    local_changed_at = timezone.localtime(changed_at).replace(tzinfo=None)
+
+    def check_in(ticket, checked_in, changed_at):
+        return {
+            "ticketId": to_global_id("TicketNode", ticket.id),
+            "checkedIn": checked_in,
+            "changedAt": changed_at.isoformat(),
+        }
+
+    response = gql_client.execute(
+        SYNC_OFFLINE_CHECK_INS_MUTATION,
+        variable_values={
+            "performance": to_global_id("PerformanceNode", performance.id),
+            "checkIns": [
+                check_in(ticket, False, local_changed_at),
+                check_in(ticket, True, changed_at - timedelta(minutes=1)),
+                check_in(checked_in_ticket, False, local_changed_at),
+            ],
+        },
+    )["data"]["syncOfflineCheckIns"]
+
+    assert response["success"] is True
+    assert [result["outcome"] for result in response["results"]] == [
+        "APPLIED",
+        "APPLIED",
+        "CONFLICT",
+    ]
+    ticket.refresh_from_db()
+    assert not ticket.checked_in
+    assert ticket.check_in_changed_at == changed_at
+
+
+@pytest.mark.django_db
+def test_sync_offline_check_ins_without_boxoffice_perm(gql_client):
+    performance = PerformanceFactory()
+    ticket = TicketFactory(booking=BookingFactory(performance=performance))
+    gql_client.login()
+
+    response = gql_client.execute(
+        SYNC_OFFLINE_CHECK_INS_MUTATION,
+        variable_values={
+            "performance": to_global_id("PerformanceNode", performance.id),
+            "checkIns": [
+                {
+                    "ticketId": to_global_id("TicketNode", ticket.id),
+                    "checkedIn": True,
+                    "changedAt": timezone.now().isoformat(),
+                }
+            ],
+        },
+    )["data"]["syncOfflineCheckIns"]
+
+    assert response["success"] is False
+    assert response["results"] is None
+    ticket.refresh_from_db()
+    assert not ticket.checked_in
@@ -1,5 +1,6 @@
 # pylint: disable=too-many-lines
 import datetime
+from unittest.mock import patch
 
 import pytest
 from django.contrib.auth.models import AnonymousUser, Permission
@@ -21,7 +22,10 @@ from uobtheatre.discounts.test.factories import (
     DiscountFactory,
     DiscountRequirementFactory,
 )
-from uobtheatre.payments.payables import Payable
+from uobtheatre.live.models import LiveEvent
+from uobtheatre.payments.models import SalesBreakdown
+from uobtheatre.payments.payables import Payable, PayableQuerySet
+from uobtheatre.payments.test.factories import TransactionFactory
 from uobtheatre.productions.test.factories import PerformanceFactory, ProductionFactory
 from uobtheatre.users.test.factories import UserFactory
 from uobtheatre.venues.test.factories import SeatGroupFactory
@@ -1295,3 +1299,244 @@ def test_ticket_node_queryset_with_anonymous_user(info, logged_in, expected_incl
 
     qs = TicketNode.get_queryset(Ticket.objects, info)
     assert list(qs.all()) == ([ticket] if expected_includes else [])
+
+
+@pytest.mark.django_db
+def test_booking_sales_breakdowns_are_batched(gql_client):
+    gql_client.login()
+    for value in [100, 200, 300]:
+        TransactionFactory(
+            pay_object=BookingFactory(user=gql_client.user), value=value
+        )
+
+    request = """
+        {
+          me {
+            bookings {
+              edges {
+                node {
+                  salesBreakdown {
+                    totalPayments
+                  }
+                }
+              }
+            }
+          }
+        }
+        """
+    with patch(
+        "uobtheatre.payments.payables.PayableQuerySet.sales_breakdowns",
+        autospec=True,
+        side_effect=PayableQuerySet.sales_breakdowns,
+    ) as mock_sales_breakdowns:
+        response = gql_client.execute(request)
+
+    # A single query for the whole page of bookings
+    assert mock_sales_breakdowns.call_count == 1
+    assert mock_sales_breakdowns.call_args.args[1] == [
+        SalesBreakdown.Enums.TOTAL_PAYMENTS
+    ]
+    assert sorted(
+        edge["node"]["salesBreakdown"]["totalPayments"]
+        for edge in response["data"]["me"]["bookings"]["edges"]
+    ) == [100, 200, 300]
+
+
+CHECK_IN_MANIFEST_QUERY = """
+    query($performance: IdInputField!, $sinceVersion: Int) {
+        checkInManifest(performance: $performance, sinceVersion: $sinceVersion) {
+            version
+            full
+            bookings {
+                reference
+                valid
+                tickets {
+                    id
+                    seatGroup
+                    concessionType
+                    checkedIn
+                }
+            }
+        }
+    }
+"""
+
+
+@pytest.mark.django_db
+def test_check_in_manifest(gql_client, django_capture_on_commit_callbacks):
+    performance = PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+    booking = BookingFactory(performance=performance, reference="AAA")
+    ticket = TicketFactory(booking=booking)
+    changed_booking = BookingFactory(performance=performance, reference="BBB")
+    changed_ticket = TicketFactory(booking=changed_booking)
+    BookingFactory(performance=performance, status=Payable.Status.IN_PROGRESS)
+    BookingFactory()
+
+    def manifest(since_version=None):
+        return gql_client.execute(
+            CHECK_IN_MANIFEST_QUERY,
+            variable_values={
+                "performance": to_global_id("PerformanceNode", performance.id),
+                "sinceVersion": since_version,
+            },
+        )["data"]["checkInManifest"]
+
+    def manifest_ticket(ticket, checked_in=False):
+        return {
+            "id": to_global_id("TicketNode", ticket.id),
+            "seatGroup": ticket.seat_group.name,
+            "concessionType": ticket.concession_type.name,
+            "checkedIn": checked_in,
+        }
+
+    full_manifest = manifest()
+    assert full_manifest == {
+        "version": LiveEvent.objects.latest_id(),
+        "full": True,
+        "bookings": [
+            {"reference": "AAA", "valid": True, "tickets": [manifest_ticket(ticket)]},
+            {
+                "reference": "BBB",
+                "valid": True,
+                "tickets": [manifest_ticket(changed_ticket)],
+            },
+        ],
+    }
+
+    with django_capture_on_commit_callbacks(execute=True):
+        changed_ticket.check_in(gql_client.user)
+
+    # Only the bookings changed since the device's version are returned
+    delta = manifest(full_manifest["version"])
+    assert delta == {
+        "version": LiveEvent.objects.latest_id(),
+        "full": False,
+        "bookings": [
+            {
+                "reference": "BBB",
+                "valid": True,
+                "tickets": [manifest_ticket(changed_ticket, checked_in=True)],
+            },
+        ],
+    }
+    assert manifest(delta["version"])["bookings"] == []
+
+    # Events which refer to a booking's transaction are about the booking
+    with django_capture_on_commit_callbacks(execute=True):
+        TransactionFactory(pay_object=booking)
+    assert [
+        manifest_booking["reference"]
+        for manifest_booking in manifest(delta["version"])["bookings"]
+    ] == ["AAA"]
+
+    # Once the changes since a version have been pruned, the full manifest
+    # is returned
+    LiveEvent.objects.all().delete()
+    assert manifest(delta["version"])["full"]
+
+
+@pytest.mark.django_db
+def test_check_in_manifest_without_boxoffice_perm(gql_client):
+    performance = PerformanceFactory()
+    gql_client.login()
+
+    response = gql_client.execute(
+        CHECK_IN_MANIFEST_QUERY,
+        variable_values={
+            "performance": to_global_id("PerformanceNode", performance.id)
+        },
+    )
+
+    assert response["data"]["checkInManifest"] is None
+
+
+SCAN_TICKET_QUERY = """
+    query($code: String!, $performance: IdInputField!) {
+        scanTicket(code: $code, performance: $performance) {
+            booking {
+                reference
+                status
+            }
+            tickets {
+                id
+                checkedIn
+            }
+        }
+    }
+"""
+
+
+@pytest.mark.django_db
+def test_scan_ticket(gql_client, django_assert_max_num_queries):
+    performance = PerformanceFactory()
+    booking = BookingFactory(performance=performance)
+    tickets = [
+        TicketFactory(booking=booking),
+        TicketFactory(booking=booking, set_checked_in=True),
+    ]
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user, performance.production)
+
+    variables = {
+        "code": booking.scan_code,
+        "performance": to_global_id("PerformanceNode", performance.id),
+    }
+    with django_assert_max_num_queries(8):
+        response = gql_client.execute(SCAN_TICKET_QUERY, variable_values=variables)
+
+    assert response["data"]["scanTicket"] == {
+        "booking": {"reference": booking.reference, "status": "PAID"},
+        "tickets": [
+            {"id": to_global_id("TicketNode", ticket.id), "checkedIn": checked_in}
+            for ticket, checked_in in zip(tickets, [False, True])
+        ],
+    }
+
+    response = gql_client.execute(
+        SCAN_TICKET_QUERY, variable_values={**variables, "code": "unknown"}
+    )
+    assert response["data"]["scanTicket"] is None
+
+
+@pytest.mark.django_db
+def test_scan_ticket_without_boxoffice_perm(gql_client):
+    booking = BookingFactory()
+    gql_client.login()
+
+    response = gql_client.execute(
+        SCAN_TICKET_QUERY,
+        variable_values={
+            "code": booking.reference,
+            "performance": to_global_id("PerformanceNode", booking.performance.id),
+        },
+    )
+
+    assert response["data"]["scanTicket"] is None
+
+
+@pytest.mark.django_db
+def test_booking_scan_code(gql_client):
+    booking = BookingFactory(user=gql_client.login().user)
+    TicketFactory(booking=booking)
+
+    response = gql_client.execute(
+        """
+        {
+            me {
+                bookings {
+                    edges {
+                        node {
+                            scanCode
+                        }
+                    }
+                }
+            }
+        }
+        """
+    )
+
+    assert response["data"]["me"]["bookings"]["edges"][0]["node"] == {
+        "scanCode": booking.scan_code
+    }
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class FinanceConfig(AppConfig):
+    """Configuration for the finance app"""
+
+    name = "uobtheatre.finance"
+    verbose_name = "Finance"
+
+    def ready(self):
+        """Perform initialization tasks for this app (namely, register it's signals)"""
+        import uobtheatre.finance.signals  # pylint: disable=unused-import
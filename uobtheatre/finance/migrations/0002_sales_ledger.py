@@ -0,0 +1,149 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def populate_sales_ledger(apps, _):  # pragma: no cover
+    content_type_model = apps.get_model("contenttypes", "ContentType")
+    booking_model = apps.get_model("bookings", "Booking")
+    transaction_model = apps.get_model("payments", "Transaction")
+    ledger_model = apps.get_model("finance", "SalesLedgerEntry")
+
+    booking_type = content_type_model.objects.filter(
+        app_label="bookings", model="booking"
+    ).first()
+    if not booking_type:
+        return
+
+    bookings = booking_model.objects.filter(pk=OuterRef("pay_object_id"))
+    rows = (
+        transaction_model.objects.filter(pay_object_type=booking_type)
+        .annotate(
+            ledger_production_id=Subquery(
+                bookings.values("performance__production_id")[:1]
+            ),
+            ledger_performance_id=Subquery(bookings.values("performance_id")[:1]),
+        )
+        .order_by()
+        .values(
+            "ledger_production_id",
+            "ledger_performance_id",
+            "provider_name",
+            "type",
+            "status",
+        )
+        .annotate(
+            total_value=Coalesce(Sum("value"), 0),
+            total_provider_fee=Coalesce(Sum("provider_fee"), 0),
+            total_app_fee=Coalesce(Sum("app_fee"), 0),
+            total_count=Count("id"),
+        )
+    )
+    ledger_model.objects.bulk_create(
+        ledger_model(
+            production_id=row["ledger_production_id"],
+            performance_id=row["ledger_performance_id"],
+            provider_name=row["provider_name"],
+            type=row["type"],
+            status=row["status"],
+            value=row["total_value"],
+            provider_fee=row["total_provider_fee"],
+            app_fee=row["total_app_fee"],
+            count=row["total_count"],
+        )
+        for row in rows
+        if row["ledger_performance_id"] is not None
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("productions", "0028_alter_production_options"),
+        ("finance", "0001_initial"),
+        ("bookings", "0010_auto_20250513_2106"),
+        ("payments", "0016_alter_transaction_options"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SalesLedgerEntry",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "provider_name",
+                    models.CharField(
+                        choices=[
+                            ("CASH", "CASH"),
+                            ("CARD", "CARD"),
+                            ("SQUARE_POS", "SQUARE_POS"),
+                            ("SQUARE_ONLINE", "SQUARE_ONLINE"),
+                            ("MANUAL_CARD_REFUND", "MANUAL_CARD_REFUND"),
+                            ("SQUARE_REFUND", "SQUARE_REFUND"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "type",
+                    models.CharField(
+                        choices=[("PAYMENT", "Payment"), ("REFUND", "Refund")],
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("PENDING", "In progress"),
+                            ("COMPLETED", "Completed"),
+                            ("FAILED", "Failed"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("value", models.BigIntegerField(default=0)),
+                ("provider_fee", models.BigIntegerField(default=0)),
+                ("app_fee", models.BigIntegerField(default=0)),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "performance",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sales_ledger_entries",
+                        to="productions.performance",
+                    ),
+                ),
+                (
+                    "production",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sales_ledger_entries",
+                        to="productions.production",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "sales ledger entries",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="salesledgerentry",
+            constraint=models.UniqueConstraint(
+                fields=("production", "performance", "provider_name", "type", "status"),
+                name="unique_sales_ledger_entry",
+            ),
+        ),
+        migrations.RunPython(populate_sales_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("productions", "0028_alter_production_options"),
+        ("finance", "0002_sales_ledger"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailySalesRollupDay",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(unique=True)),
+                ("computed_at", models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name="DailySalesRollup",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                (
+                    "provider_name",
+                    models.CharField(
+                        choices=[
+                            ("CASH", "CASH"),
+                            ("CARD", "CARD"),
+                            ("SQUARE_POS", "SQUARE_POS"),
+                            ("SQUARE_ONLINE", "SQUARE_ONLINE"),
+                            ("MANUAL_CARD_REFUND", "MANUAL_CARD_REFUND"),
+                            ("SQUARE_REFUND", "SQUARE_REFUND"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "type",
+                    models.CharField(
+                        choices=[("PAYMENT", "Payment"), ("REFUND", "Refund")],
+                        max_length=20,
+                    ),
+                ),
+                ("value", models.BigIntegerField(default=0)),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "production",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="daily_sales_rollups",
+                        to="productions.production",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="dailysalesrollup",
+            index=models.Index(fields=["date"], name="finance_dai_date_cb441f_idx"),
+        ),
+    ]
@@ -1,9 +1,18 @@
-from django.db import models
+import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Min, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.db.models.query import QuerySet
+from django.utils import timezone
 
 from uobtheatre.payments.exceptions import (
     CantBeCanceledException,
     CantBeRefundedException,
 )
+from uobtheatre.payments.models import SalesBreakdownQuerySetMixin, Transaction
 from uobtheatre.payments.transaction_providers import (
     Cash,
     PaymentProvider,
@@ -40,3 +49,363 @@ class FinancialTransfer(TimeStampedMixin, BaseModel):
 
     class Meta:
         permissions = (("create_transfer", "Create a transfer entry"),)
+
+
+# The transaction fields that determine its contribution to the sales ledger
+LEDGER_TRANSACTION_FIELDS = (
+    "pay_object_type_id",
+    "pay_object_id",
+    "provider_name",
+    "type",
+    "status",
+    "value",
+    "provider_fee",
+    "app_fee",
+)
+LEDGER_KEY_FIELDS = (
+    "production_id",
+    "performance_id",
+    "provider_name",
+    "type",
+    "status",
+)
+LEDGER_TOTAL_FIELDS = ("value", "provider_fee", "app_fee", "count")
+
+
+def ledger_snapshot(transaction_instance: Transaction) -> Dict:
+    """The fields of a transaction which determine its ledger contribution"""
+    return {
+        field: getattr(transaction_instance, field)
+        for field in LEDGER_TRANSACTION_FIELDS
+    }
+
+
+def ledger_location(snapshot: Dict) -> Optional[Tuple[int, int]]:
+    """The (production ID, performance ID) a transaction snapshot's pay object is for
+
+    Returns None if the pay object isn't for a performance.
+    """
+    model = ContentType.objects.get_for_id(snapshot["pay_object_type_id"]).model_class()
+    if model is None or not hasattr(model, "performance"):
+        return None
+    return (
+        model.objects.filter(pk=snapshot["pay_object_id"])  # type: ignore
+        .values_list("performance__production_id", "performance_id")
+        .first()
+    )
+
+
+class SalesLedgerQuerySet(SalesBreakdownQuerySetMixin, QuerySet):
+    """Queryset for the sales ledger"""
+
+    def _apply(self, key: Dict, deltas: Dict[str, int]):
+        """Add the deltas onto the ledger entry with the given key, creating it if required"""
+        if not any(deltas.values()):
+            return
+        updates = {field: F(field) + delta for field, delta in deltas.items()}
+        if self.filter(**key).update(**updates):
+            return
+        try:
+            with transaction.atomic():
+                self.create(**key, **deltas)
+        except IntegrityError:
+            # The entry was created concurrently
+            self.filter(**key).update(**updates)
+
+    def record_change(self, previous: Optional[Dict], current: Optional[Dict]):
+        """Move a transaction's contribution to the ledger from its previous
+        snapshot (None if it is new) to its current snapshot (None if it has
+        been deleted)"""
+        previous_location = ledger_location(previous) if previous else None
+        if (
+            current
+            and previous
+            and (
+                current["pay_object_type_id"],
+                current["pay_object_id"],
+            )
+            == (previous["pay_object_type_id"], previous["pay_object_id"])
+        ):
+            current_location = previous_location
+        else:
+            current_location = ledger_location(current) if current else None
+
+        changes = []
+        if previous and previous_location:
+            changes.append((previous, previous_location, -1))
+        if current and current_location:
+            changes.append((current, current_location, 1))
+
+        # Combine the changes where they affect the same entry
+        entries: Dict[Tuple, Dict[str, int]] = {}
+        for snapshot, location, multiplier in changes:
+            key = location + (
+                snapshot["provider_name"],
+                snapshot["type"],
+                snapshot["status"],
+            )
+            totals = entries.setdefault(key, dict.fromkeys(LEDGER_TOTAL_FIELDS, 0))
+            totals["value"] += multiplier * snapshot["value"]
+            totals["provider_fee"] += multiplier * (snapshot["provider_fee"] or 0)
+            totals["app_fee"] += multiplier * (snapshot["app_fee"] or 0)
+            totals["count"] += multiplier
+
+        for key, deltas in entries.items():
+            self._apply(dict(zip(LEDGER_KEY_FIELDS, key)), deltas)
+
+    def rebuild(self):
+        """Rebuild the whole ledger from the transactions"""
+        with transaction.atomic():
+            self.all().delete()
+            SalesLedgerEntry.objects.bulk_create(
+                SalesLedgerEntry(**entry) for entry in expected_ledger_entries()
+            )
+
+    def discrepancies(self) -> List[Dict]:
+        """Compare the ledger with the transactions, returning any entries
+        which differ as dicts of the key with the ledger and expected totals"""
+        ledger = {
+            tuple(entry[field] for field in LEDGER_KEY_FIELDS): entry
+            for entry in self.values(*LEDGER_KEY_FIELDS, *LEDGER_TOTAL_FIELDS)
+        }
+        expected = {
+            tuple(entry[field] for field in LEDGER_KEY_FIELDS): entry
+            for entry in expected_ledger_entries()
+        }
+        empty = dict.fromkeys(LEDGER_TOTAL_FIELDS, 0)
+
+        discrepancies = []
+        for key in sorted(ledger.keys() | expected.keys(), key=str):
+            ledger_totals = {
+                field: ledger.get(key, empty)[field] for field in LEDGER_TOTAL_FIELDS
+            }
+            expected_totals = {
+                field: expected.get(key, empty)[field] for field in LEDGER_TOTAL_FIELDS
+            }
+            if ledger_totals != expected_totals:
+                discrepancies.append(
+                    {
+                        **dict(zip(LEDGER_KEY_FIELDS, key)),
+                        "ledger": ledger_totals,
+                        "expected": expected_totals,
+                    }
+                )
+        return discrepancies
+
+
+def expected_ledger_entries() -> List[Dict]:
+    """Aggregate the transactions into the entries the ledger should contain"""
+    rows = (
+        Transaction.objects.annotate_pay_object_performance()  # type: ignore
+        .filter(pay_object_performance_id__isnull=False)
+        .order_by()
+        .values(
+            "pay_object_production_id",
+            "pay_object_performance_id",
+            "provider_name",
+            "type",
+            "status",
+        )
+        .annotate(
+            total_value=Coalesce(Sum("value"), 0),
+            total_provider_fee=Coalesce(Sum("provider_fee"), 0),
+            total_app_fee=Coalesce(Sum("app_fee"), 0),
+            total_count=Count("id"),
+        )
+    )
+    return [
+        {
+            "production_id": row["pay_object_production_id"],
+            "performance_id": row["pay_object_performance_id"],
+            "provider_name": row["provider_name"],
+            "type": row["type"],
+            "status": row["status"],
+            "value": row["total_value"],
+            "provider_fee": row["total_provider_fee"],
+            "app_fee": row["total_app_fee"],
+            "count": row["total_count"],
+        }
+        for row in rows
+    ]
+
+
+SalesLedgerManager = models.Manager.from_queryset(SalesLedgerQuerySet)
+
+
+class SalesLedgerEntry(models.Model):
+    """Running totals of the transactions for a performance, by provider, type and status
+
+    The ledger is kept up to date as transactions are saved and deleted, so
+    that sales breakdowns can be read from a handful of rows rather than
+    aggregating every transaction. It can be rebuilt from the transactions
+    with the rebuild_sales_ledger command, and checked with the
+    check_sales_ledger command.
+    """
+
+    objects = SalesLedgerManager()
+
+    production = models.ForeignKey(
+        "productions.Production",
+        on_delete=models.CASCADE,
+        related_name="sales_ledger_entries",
+    )
+    performance = models.ForeignKey(
+        "productions.Performance",
+        on_delete=models.CASCADE,
+        related_name="sales_ledger_entries",
+    )
+    provider_name = models.CharField(
+        max_length=20, choices=TransactionProvider.choices  # type: ignore
+    )
+    type = models.CharField(max_length=20, choices=Transaction.Type.choices)
+    status = models.CharField(max_length=20, choices=Transaction.Status.choices)
+
+    # Totals of the transactions' values and fees, in pence
+    value = models.BigIntegerField(default=0)
+    provider_fee = models.BigIntegerField(default=0)
+    app_fee = models.BigIntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=[
+                    "production",
+                    "performance",
+                    "provider_name",
+                    "type",
+                    "status",
+                ],
+                name="unique_sales_ledger_entry",
+            )
+        ]
+        verbose_name_plural = "sales ledger entries"
+
+
+def day_start(day: datetime.date) -> datetime.datetime:
+    """The (aware) start of the given day in the current timezone"""
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+class DailySalesRollupQuerySet(QuerySet):
+    """Queryset for the daily sales rollup"""
+
+    def roll_up(self, days: Iterable[datetime.date], computed_at=None):
+        """(Re)compute the rollup rows for the given days"""
+        days = sorted(set(days))
+        if not days:
+            return
+        computed_at = computed_at or timezone.now()
+        rows = (
+            Transaction.objects.filter(
+                status=Transaction.Status.COMPLETED,
+                created_at__gte=day_start(days[0]),
+                created_at__lt=day_start(days[-1] + datetime.timedelta(days=1)),
+            )
+            .annotate_pay_object_performance()  # type: ignore
+            .annotate(date=TruncDate("created_at"))
+            .filter(date__in=days)
+            .order_by()
+            .values("date", "pay_object_production_id", "provider_name", "type")
+            .annotate(total_value=Sum("value"), total_count=Count("id"))
+        )
+        with transaction.atomic():
+            self.filter(date__in=days).delete()
+            DailySalesRollup.objects.bulk_create(
+                DailySalesRollup(
+                    date=row["date"],
+                    production_id=row["pay_object_production_id"],
+                    provider_name=row["provider_name"],
+                    type=row["type"],
+                    value=row["total_value"],
+                    count=row["total_count"],
+                )
+                for row in rows
+            )
+            DailySalesRollupDay.objects.filter(date__in=days).delete()
+            DailySalesRollupDay.objects.bulk_create(
+                DailySalesRollupDay(date=day, computed_at=computed_at) for day in days
+            )
+
+    def days_to_roll_up(self, today=None) -> List[datetime.date]:
+        """The closed days which have not been rolled up, or which have
+        transactions that have changed since they were rolled up.
+
+        Days whose transactions have been deleted have their DailySalesRollupDay
+        removed (see finance.signals), so they are rolled up again too.
+        """
+        today = today or timezone.localdate()
+        transactions = Transaction.objects.filter(created_at__lt=day_start(today))
+        first_created_at = transactions.aggregate(first=Min("created_at"))["first"]
+        if not first_created_at:
+            return []
+        first_day = timezone.localdate(first_created_at)
+
+        rolled_up_days = dict(
+            DailySalesRollupDay.objects.values_list("date", "computed_at")
+        )
+        changed_days = (
+            set(
+                transactions.filter(updated_at__gte=max(rolled_up_days.values()))
+                .annotate(date=TruncDate("created_at"))
+                .order_by()
+                .values_list("date", flat=True)
+                .distinct()
+            )
+            if rolled_up_days
+            else set()
+        )
+
+        missing_days = {
+            first_day + datetime.timedelta(days=offset)
+            for offset in range((today - first_day).days)
+        } - rolled_up_days.keys()
+        return sorted(missing_days | changed_days)
+
+    def update_rollups(self, today=None, batch_size=100):
+        """Roll up any closed days which need (re)computing"""
+        # Changes made while rolling up are picked up by the next update
+        computed_at = timezone.now()
+        days = self.days_to_roll_up(today)
+        for index in range(0, len(days), batch_size):
+            self.roll_up(days[index : index + batch_size], computed_at=computed_at)
+
+
+DailySalesRollupManager = models.Manager.from_queryset(DailySalesRollupQuerySet)
+
+
+class DailySalesRollup(models.Model):
+    """Totals of the completed transactions made on a day, by production, provider and type
+
+    Closed days are rolled up periodically by the update_daily_sales_rollups
+    task, so that reports over long periods only have to aggregate the raw
+    transactions for the partial days at either end. A day is only read from
+    the rollup once it has a DailySalesRollupDay.
+    """
+
+    objects = DailySalesRollupManager()
+
+    date = models.DateField()
+    production = models.ForeignKey(
+        "productions.Production",
+        on_delete=models.CASCADE,
+        null=True,
+        related_name="daily_sales_rollups",
+    )  # Null for transactions not made for a production
+    provider_name = models.CharField(
+        max_length=20, choices=TransactionProvider.choices  # type: ignore
+    )
+    type = models.CharField(max_length=20, choices=Transaction.Type.choices)
+
+    value = models.BigIntegerField(default=0)  # Total value, in pence
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["date"])]
+
+
+class DailySalesRollupDay(models.Model):
+    """A day which has been rolled up into the DailySalesRollup"""
+
+    date = models.DateField(unique=True)
+    computed_at = models.DateTimeField()
@@ -0,0 +1,44 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from uobtheatre.finance.models import (
+    LEDGER_TRANSACTION_FIELDS,
+    DailySalesRollupDay,
+    SalesLedgerEntry,
+    ledger_snapshot,
+)
+from uobtheatre.payments.models import Transaction
+
+
+@receiver(pre_save, sender=Transaction)
+def pre_transaction_save(instance: Transaction, **_):
+    """Store the transaction's ledger contribution before it is saved"""
+    instance._ledger_snapshot = (  # pylint: disable=protected-access
+        Transaction.objects.filter(pk=instance.pk)
+        .values(*LEDGER_TRANSACTION_FIELDS)
+        .first()
+        if instance.pk
+        and not instance._state.adding  # pylint: disable=protected-access
+        else None
+    )
+
+
+@receiver(post_save, sender=Transaction)
+def post_transaction_save(instance: Transaction, **_):
+    """Update the sales ledger with the saved transaction"""
+    SalesLedgerEntry.objects.record_change(
+        instance._ledger_snapshot,  # pylint: disable=protected-access
+        ledger_snapshot(instance),
+    )
+
+
+@receiver(post_delete, sender=Transaction)
+def post_transaction_delete(instance: Transaction, **_):
+    """Remove the deleted transaction from the sales ledger and the daily
+    sales rollup"""
+    SalesLedgerEntry.objects.record_change(ledger_snapshot(instance), None)
+    # The day is read from the transactions until it is rolled up again
+    DailySalesRollupDay.objects.filter(
+        date=timezone.localdate(instance.created_at)
+    ).delete()
@@ -0,0 +1,9 @@
+from config.celery import app
+from uobtheatre.finance.models import DailySalesRollup
+from uobtheatre.utils.tasks import BaseTask
+
+
+@app.task(base=BaseTask, ignore_result=True)
+def update_daily_sales_rollups():
+    """Roll up any closed days which need (re)computing"""
+    DailySalesRollup.objects.update_rollups()
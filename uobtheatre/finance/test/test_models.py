@@ -0,0 +1,229 @@
+import datetime
+from unittest.mock import patch
+
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import CommandError, call_command
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from uobtheatre.bookings.test.factories import BookingFactory
+from uobtheatre.finance.models import (
+    DailySalesRollup,
+    DailySalesRollupDay,
+    SalesLedgerEntry,
+    SalesLedgerQuerySet,
+    day_start,
+    ledger_location,
+)
+from uobtheatre.finance.tasks import update_daily_sales_rollups
+from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.test.factories import TransactionFactory
+from uobtheatre.payments.transaction_providers import Cash, SquareOnline
+from uobtheatre.productions.test.factories import PerformanceFactory
+from uobtheatre.users.models import User
+from uobtheatre.users.test.factories import UserFactory
+
+
+@pytest.mark.django_db
+def test_ledger_records_new_transactions():
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=200, provider_fee=5, app_fee=20)
+    TransactionFactory(pay_object=booking, value=300, provider_fee=None, app_fee=30)
+    TransactionFactory(
+        pay_object=booking, value=100, provider_name=Cash.name, app_fee=None
+    )
+
+    assert SalesLedgerEntry.objects.count() == 2
+    entry = SalesLedgerEntry.objects.get(provider_name=SquareOnline.name)
+    assert entry.production == booking.performance.production
+    assert entry.performance == booking.performance
+    assert entry.type == Transaction.Type.PAYMENT
+    assert entry.status == Transaction.Status.COMPLETED
+    assert (entry.value, entry.provider_fee, entry.app_fee, entry.count) == (
+        500,
+        5,
+        50,
+        2,
+    )
+    assert SalesLedgerEntry.objects.discrepancies() == []
+
+
+@pytest.mark.django_db
+def test_ledger_records_updated_transactions():
+    booking = BookingFactory()
+    transaction = TransactionFactory(
+        pay_object=booking, value=200, status=Transaction.Status.PENDING
+    )
+
+    transaction.status = Transaction.Status.COMPLETED
+    transaction.provider_fee = 12
+    transaction.save()
+
+    assert SalesLedgerEntry.objects.get(status=Transaction.Status.PENDING).count == 0
+    entry = SalesLedgerEntry.objects.get(status=Transaction.Status.COMPLETED)
+    assert entry.count == 1
+    assert entry.provider_fee == 12
+    assert SalesLedgerEntry.objects.discrepancies() == []
+
+    # Move the transaction to a booking for another performance
+    transaction.pay_object = BookingFactory(performance=PerformanceFactory())
+    transaction.save()
+
+    assert not any(
+        SalesLedgerEntry.objects.filter(performance=booking.performance).values_list(
+            "count", flat=True
+        )
+    )
+    assert SalesLedgerEntry.objects.discrepancies() == []
+
+
+@pytest.mark.django_db
+def test_ledger_records_deleted_transactions():
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=200)
+    transaction = TransactionFactory(pay_object=booking, value=300)
+
+    transaction.delete()
+
+    assert SalesLedgerEntry.objects.get().value == 200
+    assert SalesLedgerEntry.objects.discrepancies() == []
+
+
+@pytest.mark.django_db
+def test_ledger_ignores_pay_objects_without_performances():
+    snapshot = {
+        "pay_object_type_id": ContentType.objects.get_for_model(User).pk,
+        "pay_object_id": UserFactory().pk,
+    }
+
+    assert ledger_location(snapshot) is None
+
+
+@pytest.mark.django_db
+def test_ledger_entry_created_concurrently():
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=200)
+    update_calls = []
+
+    def update(queryset, **kwargs):
+        # The first update misses the entry, as if it was created by another
+        # process just after
+        update_calls.append(kwargs)
+        return 0 if len(update_calls) == 1 else QuerySet.update(queryset, **kwargs)
+
+    with patch.object(SalesLedgerQuerySet, "update", autospec=True, side_effect=update):
+        TransactionFactory(pay_object=booking, value=300)
+
+    assert len(update_calls) == 2
+    assert SalesLedgerEntry.objects.get().value == 500
+
+
+@pytest.mark.django_db
+def test_ledger_discrepancies_and_rebuild():
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=200)
+    refund = TransactionFactory(
+        pay_object=booking, value=-200, type=Transaction.Type.REFUND
+    )
+
+    # Changes that bypass the save signals aren't recorded
+    Transaction.objects.filter(pk=refund.pk).update(value=-150)
+
+    discrepancies = SalesLedgerEntry.objects.discrepancies()
+    assert len(discrepancies) == 1
+    assert discrepancies[0]["type"] == Transaction.Type.REFUND
+    assert discrepancies[0]["ledger"]["value"] == -200
+    assert discrepancies[0]["expected"]["value"] == -150
+
+    with pytest.raises(CommandError):
+        call_command("check_sales_ledger")
+
+    call_command("rebuild_sales_ledger")
+
+    assert SalesLedgerEntry.objects.discrepancies() == []
+    call_command("check_sales_ledger")
+    assert booking.performance.sales_breakdown()["net_transactions"] == 50
+
+
+@pytest.mark.django_db
+def test_daily_sales_rollup():
+    booking = BookingFactory()
+    payment = TransactionFactory(pay_object=booking, value=200)
+    TransactionFactory(pay_object=booking, value=300)
+    TransactionFactory(pay_object=booking, value=100, provider_name=Cash.name)
+    TransactionFactory(pay_object=booking, value=50, status=Transaction.Status.PENDING)
+    Transaction.objects.update(created_at=day_start(datetime.date(2021, 9, 1)))
+
+    DailySalesRollup.objects.update_rollups(today=datetime.date(2021, 9, 3))
+
+    assert list(
+        DailySalesRollupDay.objects.order_by("date").values_list("date", flat=True)
+    ) == [datetime.date(2021, 9, 1), datetime.date(2021, 9, 2)]
+    assert sorted(
+        DailySalesRollup.objects.values_list(
+            "date", "production_id", "provider_name", "value", "count"
+        )
+    ) == [
+        (datetime.date(2021, 9, 1), booking.performance.production_id, "CASH", 100, 1),
+        (
+            datetime.date(2021, 9, 1),
+            booking.performance.production_id,
+            "SQUARE_ONLINE",
+            500,
+            2,
+        ),
+    ]
+
+    # Nothing needs rolling up until a transaction changes or a day closes
+    assert DailySalesRollup.objects.days_to_roll_up(datetime.date(2021, 9, 3)) == []
+
+    payment.refresh_from_db()
+    payment.value = 250
+    payment.save()
+    assert DailySalesRollup.objects.days_to_roll_up(datetime.date(2021, 9, 4)) == [
+        datetime.date(2021, 9, 1),
+        datetime.date(2021, 9, 3),
+    ]
+
+    DailySalesRollup.objects.update_rollups(today=datetime.date(2021, 9, 4))
+    assert DailySalesRollup.objects.get(provider_name=SquareOnline.name).value == 550
+    assert DailySalesRollupDay.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_daily_sales_rollup_after_delete():
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=200)
+    payment = TransactionFactory(pay_object=booking, value=300)
+    Transaction.objects.update(created_at=day_start(datetime.date(2021, 9, 1)))
+    DailySalesRollup.objects.update_rollups(today=datetime.date(2021, 9, 3))
+
+    payment.refresh_from_db()
+    payment.delete()
+
+    # The day is no longer read from the rollup, and is rolled up again
+    assert not DailySalesRollupDay.objects.filter(
+        date=datetime.date(2021, 9, 1)
+    ).exists()
+    assert DailySalesRollup.objects.days_to_roll_up(datetime.date(2021, 9, 3)) == [
+        datetime.date(2021, 9, 1)
+    ]
+    DailySalesRollup.objects.update_rollups(today=datetime.date(2021, 9, 3))
+    assert DailySalesRollup.objects.get().value == 200
+
+
+@pytest.mark.django_db
+def test_update_daily_sales_rollups_task():
+    # Without any transactions there is nothing to roll up
+    update_daily_sales_rollups()
+    assert not DailySalesRollupDay.objects.exists()
+
+    TransactionFactory(pay_object=BookingFactory(), value=200)
+    Transaction.objects.update(created_at=timezone.now() - datetime.timedelta(days=2))
+    update_daily_sales_rollups()
+
+    assert DailySalesRollupDay.objects.count() == 2
+    assert DailySalesRollup.objects.get().value == 200
+    DailySalesRollup.objects.roll_up([])
+    assert DailySalesRollupDay.objects.count() == 2
@@ -0,0 +1,74 @@
+"""
+Publishing live events, and waiting for them to be published
+
+Events are stored, so that they reach clients connected to any process
+(e.g. events published by a worker applying a payment webhook). Clients
+connected to the process which published an event are woken straight away
+by the local broker. Other processes pick the event up the next time they
+poll.
+
+Streams and snapshots (e.g. a performance's tickets breakdown) continue
+from the ID of the last event they saw. Event IDs are allocated when the
+events are inserted, just after the publishing transaction commits, so two
+events published at the same moment can become visible in the opposite
+order to their IDs. Streams reread the recent events to send the earlier
+one too. A snapshot already includes the changes of the events before its
+ID, as they were committed before the event IDs were allocated. Only an
+event which becomes visible late while its client is reconnecting can be
+missed.
+"""
+
+import threading
+from typing import Iterable
+
+from django.db import transaction
+
+from uobtheatre.live.models import LiveEvent
+
+
+class LocalBroker:
+    """Wakes up the streams in this process when events are published, so
+    they don't wait for their next poll"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        """Wake up the waiting streams"""
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version: int, timeout: float) -> int:
+        """Wait until events are published after the given version, or the
+        timeout passes
+
+        Returns:
+            int: The current version
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+
+broker = LocalBroker()
+
+
+def publish(event_type: str, data: dict, topics: Iterable[str]):
+    """Publish an event to the clients listening to the topics.
+
+    The event is published once the current transaction commits, so
+    clients are never told about changes which are rolled back.
+    """
+    topics = list(topics)
+    if not topics:
+        return
+
+    def create_events():
+        LiveEvent.objects.bulk_create(
+            LiveEvent(topic=topic, type=event_type, data=data) for topic in topics
+        )
+        broker.notify()
+
+    transaction.on_commit(create_events)
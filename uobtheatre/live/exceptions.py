@@ -0,0 +1,2 @@
+class InvalidLiveEventsSignature(Exception):
+    """Thrown when a signature on a live events url is invalid"""
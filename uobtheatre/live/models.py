@@ -0,0 +1,74 @@
+from typing import Iterable
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Max, Min, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+
+def booking_topic(booking_id: int) -> str:
+    """The topic of the events about a booking"""
+    return f"booking:{booking_id}"
+
+
+def performance_topic(performance_id: int) -> str:
+    """The topic of the events about a performance and its bookings"""
+    return f"performance:{performance_id}"
+
+
+class LiveEventQuerySet(QuerySet):
+    """Queryset for live events"""
+
+    def for_topics(self, topics: Iterable[str]):
+        """Filter to the events published to any of the topics"""
+        return self.filter(topic__in=list(topics))
+
+    def after(self, event_id: int):
+        """Filter to the events published after the given event, in the order
+        they were published"""
+        return self.filter(pk__gt=event_id).order_by("pk")
+
+    def latest_id(self) -> int:
+        """The ID of the most recently published event (0 if there are none)"""
+        return self.aggregate(latest_id=Max("pk"))["latest_id"] or 0
+
+    def latest_id_expression(self):
+        """An expression for latest_id, to read it in the same statement as
+        the data it is the cursor of"""
+        return Coalesce(Subquery(self.order_by("-pk").values("pk")[:1]), 0)
+
+    def retains_after(self, event_id: int) -> bool:
+        """Whether every event published after the given event is still
+        stored, rather than some having been pruned"""
+        oldest_id = self.aggregate(oldest_id=Min("pk"))["oldest_id"]
+        return oldest_id is not None and event_id >= oldest_id - 1
+
+    def expired(self):
+        """Filter to the events older than the LIVE_EVENT_SETTINGS retention,
+        which no client will still be waiting on"""
+        return self.filter(
+            created_at__lt=timezone.now() - settings.LIVE_EVENT_SETTINGS["RETENTION"]
+        )
+
+
+LiveEventManager = models.Manager.from_queryset(LiveEventQuerySet)
+
+
+class LiveEvent(models.Model):
+    """An event published to the clients listening to a topic, such as a
+    box office terminal waiting for a booking's payment to complete"""
+
+    objects = LiveEventManager()
+
+    topic = models.CharField(max_length=255)
+    type = models.CharField(max_length=255)
+    data = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.type} ({self.topic})"
+
+    class Meta:
+        indexes = [models.Index(fields=["topic", "id"])]
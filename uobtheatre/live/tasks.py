@@ -0,0 +1,9 @@
+from config.celery import app
+from uobtheatre.live.models import LiveEvent
+from uobtheatre.utils.tasks import BaseTask
+
+
+@app.task(base=BaseTask, ignore_result=True)
+def prune_live_events():
+    """Delete live events which no client will still be waiting on"""
+    LiveEvent.objects.expired().delete()
@@ -0,0 +1,177 @@
+import threading
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+from graphql_relay.node.node import to_global_id
+
+from uobtheatre.bookings.test.factories import BookingFactory, TicketFactory
+from uobtheatre.live.events import LocalBroker, broker, publish
+from uobtheatre.live.models import LiveEvent, booking_topic, performance_topic
+from uobtheatre.live.tasks import prune_live_events
+from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.payables import Payable
+from uobtheatre.payments.test.factories import TransactionFactory
+from uobtheatre.users.test.factories import UserFactory
+
+
+@pytest.mark.django_db
+def test_publish_once_committed(django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks() as callbacks:
+        publish("thing.happened", {"a": 1}, ["topic:1", "topic:2"])
+        assert not LiveEvent.objects.exists()
+
+    version = broker.version
+    for callback in callbacks:
+        callback()
+
+    assert broker.version == version + 1
+    assert list(LiveEvent.objects.values_list("topic", "type", "data")) == [
+        ("topic:1", "thing.happened", {"a": 1}),
+        ("topic:2", "thing.happened", {"a": 1}),
+    ]
+
+
+@pytest.mark.django_db
+def test_publish_without_topics(django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks() as callbacks:
+        publish("thing.happened", {}, [])
+
+    assert not callbacks
+
+
+def test_local_broker_wakes_waiters():
+    local_broker = LocalBroker()
+    woken = []
+
+    waiter = threading.Thread(target=lambda: woken.append(local_broker.wait(0, 5)))
+    waiter.start()
+    local_broker.notify()
+    waiter.join(timeout=1)
+
+    assert woken == [1]
+    # Without a notification, the wait times out
+    assert local_broker.wait(1, 0.01) == 1
+
+
+@pytest.mark.django_db
+def test_transaction_save_publishes_event(django_capture_on_commit_callbacks):
+    booking = BookingFactory(status=Payable.Status.IN_PROGRESS)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        transaction = TransactionFactory(
+            pay_object=booking, status=Transaction.Status.PENDING
+        )
+        transaction.status = Transaction.Status.COMPLETED
+        transaction.save()
+
+    events = LiveEvent.objects.filter(type="transaction.updated").order_by("pk")
+    assert [event.topic for event in events] == [
+        booking_topic(booking.pk),
+        performance_topic(booking.performance.pk),
+    ] * 2
+    assert events.last().data == {
+        "id": to_global_id("TransactionNode", transaction.pk),
+        "payObjectId": to_global_id("BookingNode", booking.pk),
+        "type": "PAYMENT",
+        "status": "COMPLETED",
+        "providerName": transaction.provider_name,
+    }
+
+
+@pytest.mark.django_db
+def test_booking_complete_publishes_event(django_capture_on_commit_callbacks):
+    booking = BookingFactory(status=Payable.Status.IN_PROGRESS)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        booking.complete()
+
+    events = LiveEvent.objects.filter(type="booking.completed")
+    assert {event.topic for event in events} == {
+        booking_topic(booking.pk),
+        performance_topic(booking.performance.pk),
+    }
+    assert events.first().data == {
+        "id": to_global_id("BookingNode", booking.pk),
+        "reference": booking.reference,
+        "status": "PAID",
+    }
+
+
+@pytest.mark.django_db
+def test_ticket_changes_publish_deltas(django_capture_on_commit_callbacks):
+    booking = BookingFactory(status=Payable.Status.IN_PROGRESS)
+    tickets = [TicketFactory(booking=booking) for _ in range(2)]
+    ticket_ids = [to_global_id("TicketNode", ticket.pk) for ticket in tickets]
+
+    with django_capture_on_commit_callbacks(execute=True):
+        booking.complete()
+        tickets[0].check_in(UserFactory())
+        tickets[0].uncheck_in()
+
+    events = LiveEvent.objects.filter(
+        topic=performance_topic(booking.performance.pk), type__startswith="tickets."
+    ).order_by("pk")
+    booking_id = to_global_id("BookingNode", booking.pk)
+    assert [(event.type, event.data) for event in events] == [
+        (
+            "tickets.sold",
+            {
+                "bookingId": booking_id,
+                "ticketIds": ticket_ids,
+                "delta": {"totalTicketsSold": 2, "totalTicketsToCheckIn": 2},
+            },
+        ),
+        (
+            "tickets.checked_in",
+            {
+                "bookingId": booking_id,
+                "ticketIds": ticket_ids[:1],
+                "delta": {"totalTicketsCheckedIn": 1, "totalTicketsToCheckIn": -1},
+            },
+        ),
+        (
+            "tickets.unchecked_in",
+            {
+                "bookingId": booking_id,
+                "ticketIds": ticket_ids[:1],
+                "delta": {"totalTicketsCheckedIn": -1, "totalTicketsToCheckIn": 1},
+            },
+        ),
+    ]
+
+
+@pytest.mark.django_db
+def test_prune_live_events():
+    old_event = LiveEvent.objects.create(topic="topic:1", type="old")
+    LiveEvent.objects.filter(pk=old_event.pk).update(
+        created_at=timezone.now() - timedelta(days=2)
+    )
+    new_event = LiveEvent.objects.create(topic="topic:1", type="new")
+
+    prune_live_events()
+
+    assert list(LiveEvent.objects.all()) == [new_event]
+
+
+@pytest.mark.django_db
+def test_latest_id():
+    assert LiveEvent.objects.latest_id() == 0
+
+    event = LiveEvent.objects.create(topic="topic:1", type="thing.happened")
+
+    assert LiveEvent.objects.latest_id() == event.pk
+
+
+@pytest.mark.django_db
+def test_retains_after():
+    assert not LiveEvent.objects.retains_after(0)
+
+    pruned_event = LiveEvent.objects.create(topic="topic:1", type="pruned")
+    event = LiveEvent.objects.create(topic="topic:1", type="kept")
+    pruned_id = pruned_event.pk
+    pruned_event.delete()
+
+    assert LiveEvent.objects.retains_after(event.pk)
+    assert LiveEvent.objects.retains_after(pruned_id)
+    assert not LiveEvent.objects.retains_after(pruned_id - 1)
@@ -0,0 +1,79 @@
+import pytest
+from guardian.shortcuts import assign_perm
+
+from uobtheatre.bookings.test.factories import BookingFactory
+from uobtheatre.live.models import LiveEvent
+from uobtheatre.live.utils import validate_live_events_signature
+from uobtheatre.productions.test.factories import PerformanceFactory
+
+
+@pytest.mark.django_db
+def test_booking_live_updates_uri(gql_client):
+    booking = BookingFactory(user=gql_client.login().user)
+    event = LiveEvent.objects.create(topic="booking:1", type="booking.completed")
+
+    response = gql_client.execute("""
+        {
+          me {
+            bookings {
+              edges {
+                node {
+                  liveUpdatesUri
+                }
+              }
+            }
+          }
+        }
+        """)
+
+    uri = response["data"]["me"]["bookings"]["edges"][0]["node"]["liveUpdatesUri"]
+    assert uri.startswith("https://api.example.com/live/events?signature=")
+    signature, last_event_id = uri.split("signature=")[1].split("&last_event_id=")
+    assert validate_live_events_signature(signature) == [f"booking:{booking.pk}"]
+    # The stream continues from the events published before the URI was given
+    assert last_event_id == str(event.pk)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("has_permission", [True, False])
+def test_performance_live_updates_uri(gql_client, has_permission):
+    performance = PerformanceFactory()
+    gql_client.login()
+    if has_permission:
+        assign_perm("productions.boxoffice", gql_client.user, performance.production)
+
+    response = gql_client.execute("""
+        query {
+          performance(id: "%s") {
+            liveUpdatesUri
+          }
+        }
+        """ % performance.global_id)
+
+    uri = response["data"]["performance"]["liveUpdatesUri"]
+    if has_permission:
+        assert validate_live_events_signature(uri.split("signature=")[1]) == [
+            f"performance:{performance.pk}"
+        ]
+    else:
+        assert uri is None
+
+
+@pytest.mark.django_db
+def test_tickets_breakdown_live_event_id(gql_client):
+    performance = PerformanceFactory()
+    event = LiveEvent.objects.create(topic="performance:1", type="tickets.sold")
+
+    response = gql_client.execute("""
+        query {
+          performance(id: "%s") {
+            ticketsBreakdown {
+              liveEventId
+            }
+          }
+        }
+        """ % performance.global_id)
+
+    assert response["data"]["performance"]["ticketsBreakdown"] == {
+        "liveEventId": event.pk
+    }
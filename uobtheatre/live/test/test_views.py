@@ -0,0 +1,144 @@
+from datetime import timedelta
+
+import pytest
+from django.urls import reverse
+from django.utils import timezone
+
+from uobtheatre.live.models import LiveEvent
+from uobtheatre.live.utils import generate_live_events_signature
+from uobtheatre.live.views import stream_events, stream_slots
+
+
+@pytest.fixture(name="live_settings")
+def live_settings_fixture(settings):
+    """Streams which end after a single poll"""
+    settings.LIVE_EVENT_SETTINGS = {
+        **settings.LIVE_EVENT_SETTINGS,
+        "POLL_INTERVAL": 0.01,
+        "STREAM_DURATION": 0,
+    }
+    return settings
+
+
+@pytest.mark.django_db
+def test_stream_events(live_settings):  # pylint: disable=unused-argument
+    old_event = LiveEvent.objects.create(topic="booking:1", type="old")
+    event = LiveEvent.objects.create(
+        topic="booking:1", type="booking.completed", data={"status": "PAID"}
+    )
+    LiveEvent.objects.create(topic="booking:2", type="other.booking")
+
+    assert list(stream_events(["booking:1"], old_event.pk)) == [
+        "retry: 1000\n\n",
+        f"id: {event.pk}\nevent: booking.completed\n"
+        'data: {"topic": "booking:1", "status": "PAID"}\n\n',
+    ]
+
+
+@pytest.mark.django_db
+def test_live_events_view(client, live_settings):  # pylint: disable=unused-argument
+    old_event = LiveEvent.objects.create(topic="booking:1", type="old")
+    url = reverse("live_events")
+
+    response = client.get(url + "?signature=invalid")
+    assert response.status_code == 403
+    assert client.get(url).status_code == 403
+
+    signature = generate_live_events_signature(["booking:1"])
+    response = client.get(url + "?signature=" + signature)
+    assert response.status_code == 200
+    assert response["Content-Type"] == "text/event-stream"
+    # New clients only get events published after they connect
+    assert b"".join(response.streaming_content) == b"retry: 1000\n\n"
+
+    # Reconnecting clients get the events they missed
+    response = client.get(
+        url + "?signature=" + signature, HTTP_LAST_EVENT_ID=str(old_event.pk - 1)
+    )
+    assert f"id: {old_event.pk}\n".encode() in b"".join(response.streaming_content)
+
+    # New clients can continue from a snapshot
+    response = client.get(
+        url + "?signature=" + signature + f"&last_event_id={old_event.pk - 1}"
+    )
+    assert f"id: {old_event.pk}\n".encode() in b"".join(response.streaming_content)
+
+
+@pytest.mark.django_db
+def test_stream_events_in_batches_with_keepalives(live_settings):
+    live_settings.LIVE_EVENT_SETTINGS = {
+        **live_settings.LIVE_EVENT_SETTINGS,
+        "KEEPALIVE_INTERVAL": 0,
+        "STREAM_DURATION": 0.05,
+    }
+    LiveEvent.objects.bulk_create(
+        LiveEvent(topic="booking:1", type="booking.completed") for _ in range(101)
+    )
+
+    messages = list(stream_events(["booking:1"], 0))
+
+    assert [message for message in messages if message.startswith("id: ")] == [
+        f"id: {event.pk}\nevent: booking.completed\n" 'data: {"topic": "booking:1"}\n\n'
+        for event in LiveEvent.objects.order_by("pk")
+    ]
+    assert ": keepalive\n\n" in messages
+    assert stream_slots.active == 0
+
+
+@pytest.mark.django_db
+def test_stream_events_which_become_visible_late(live_settings):
+    live_settings.LIVE_EVENT_SETTINGS = {
+        **live_settings.LIVE_EVENT_SETTINGS,
+        "STREAM_DURATION": 60,
+    }
+
+    stream = stream_events(["booking:1"], 10)
+    assert next(stream) == "retry: 1000\n\n"
+    LiveEvent.objects.create(pk=100, topic="booking:1", type="later")
+    assert next(stream).startswith("id: 100\nevent: later\n")
+
+    # Events before the stream's cursor are already known to the client, and
+    # events older than the lookback aren't reread
+    LiveEvent.objects.create(pk=5, topic="booking:1", type="before.cursor")
+    LiveEvent.objects.create(pk=60, topic="booking:1", type="old")
+    LiveEvent.objects.filter(pk=60).update(
+        created_at=timezone.now() - timedelta(minutes=1)
+    )
+    # An event published before the later one, which became visible after it,
+    # is sent without moving the client's cursor back
+    LiveEvent.objects.create(pk=50, topic="booking:1", type="earlier")
+    assert next(stream).startswith("id: 100\nevent: earlier\n")
+
+    LiveEvent.objects.create(pk=101, topic="booking:1", type="next")
+    assert next(stream).startswith("id: 101\nevent: next\n")
+    stream.close()
+
+
+@pytest.mark.django_db
+def test_stream_events_when_streams_are_full(live_settings):
+    live_settings.LIVE_EVENT_SETTINGS = {
+        **live_settings.LIVE_EVENT_SETTINGS,
+        "MAX_STREAMS": 1,
+        "STREAM_DURATION": 60,
+    }
+    event = LiveEvent.objects.create(topic="booking:1", type="booking.completed")
+    assert str(event) == "booking.completed (booking:1)"
+
+    stream = stream_events(["booking:1"], 0)
+    assert next(stream) == "retry: 1000\n\n"
+    assert next(stream).startswith(f"id: {event.pk}\n")
+    event = LiveEvent.objects.create(topic="booking:1", type="booking.completed")
+    assert next(stream).startswith(f"id: {event.pk}\n")
+
+    # The first stream holds the only slot, so others end straight away,
+    # keeping their client's place
+    assert list(stream_events(["booking:1"], 3)) == ["retry: 1000\n\n", "id: 3\n\n"]
+
+    # Closing the stream frees its slot
+    stream.close()
+    assert stream_slots.active == 0
+    live_settings.LIVE_EVENT_SETTINGS = {
+        **live_settings.LIVE_EVENT_SETTINGS,
+        "STREAM_DURATION": 0,
+    }
+    assert len(list(stream_events(["booking:1"], 0))) == 3
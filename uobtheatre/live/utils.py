@@ -0,0 +1,60 @@
+from typing import List, Optional
+
+from django.conf import settings
+from django.core import signing
+from django.core.signing import TimestampSigner
+from django.urls import reverse
+
+from uobtheatre.live.exceptions import InvalidLiveEventsSignature
+
+signer = TimestampSigner(salt="uobtheatre.live")
+
+
+def generate_live_events_signature(topics: List[str]) -> str:
+    """Generate a signature allowing the holder to listen to the topics
+
+    Args:
+        topics (list of str): The topics
+
+    Returns:
+        str: The signature
+    """
+    return signer.sign_object({"topics": topics})
+
+
+def validate_live_events_signature(signature: str) -> List[str]:
+    """Validate a live events signature
+
+    Args:
+        signature (str): The signature
+
+    Returns:
+        list of str: The topics the signature allows listening to
+
+    Raises:
+        InvalidLiveEventsSignature: Thrown if the signature has been changed,
+            is too old or is invalid
+    """
+    if not signature:
+        raise InvalidLiveEventsSignature
+
+    try:
+        return signer.unsign_object(
+            signature, max_age=settings.LIVE_EVENT_SETTINGS["SIGNATURE_MAX_AGE"]
+        )["topics"]
+    except (signing.BadSignature, signing.SignatureExpired) as error:
+        raise InvalidLiveEventsSignature from error
+
+
+def live_events_uri(topics: List[str], last_event_id: Optional[int] = None) -> str:
+    """The URI of the stream of events published to the topics (after the
+    given event, if one is given)"""
+    uri = (
+        settings.BASE_URL
+        + reverse("live_events")
+        + "?signature="
+        + generate_live_events_signature(topics)
+    )
+    if last_event_id is not None:
+        uri += f"&last_event_id={last_event_id}"
+    return uri
@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from uobtheatre.live.events import broker
+from uobtheatre.live.exceptions import InvalidLiveEventsSignature
+from uobtheatre.live.models import LiveEvent
+from uobtheatre.live.utils import validate_live_events_signature
+
+
+def format_event(event: LiveEvent, last_event_id: int) -> str:
+    """An event in the server-sent events format, with the ID of the last
+    event the client has been sent (which is before the event's own ID if it
+    became visible late)"""
+    data = json.dumps({"topic": event.topic, **event.data})
+    return f"id: {last_event_id}\nevent: {event.type}\ndata: {data}\n\n"
+
+
+class StreamSlots:
+    """Counts the streams this process is serving, so that they can't take
+    all of its threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def acquire(self) -> bool:
+        """Take a slot for a stream, if the process is serving fewer than the
+        LIVE_EVENT_SETTINGS maximum
+
+        Returns:
+            bool: Whether a slot was taken
+        """
+        with self.lock:
+            if self.active >= settings.LIVE_EVENT_SETTINGS["MAX_STREAMS"]:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        """Give back a stream's slot"""
+        with self.lock:
+            self.active -= 1
+
+
+stream_slots = StreamSlots()
+
+
+def stream_events(topics: List[str], last_event_id: int) -> Iterator[str]:
+    """Stream the events published to the topics after the given event.
+
+    The stream ends after the LIVE_EVENT_SETTINGS stream duration, so that
+    connections aren't held forever. Clients then reconnect, continuing
+    from the last event they received. If the process is already serving
+    its maximum number of streams, the stream ends straight away and the
+    client reconnects after the reconnect delay.
+
+    Events can become visible after events with later IDs (see
+    uobtheatre.live.events), so each poll also rereads the events published
+    within the LIVE_EVENT_SETTINGS lookback, and sends those after the given
+    event which haven't been sent yet.
+    """
+    event_settings = settings.LIVE_EVENT_SETTINGS
+    deadline = time.monotonic() + event_settings["STREAM_DURATION"]
+    keepalive_at = time.monotonic() + event_settings["KEEPALIVE_INTERVAL"]
+
+    # Tell clients how long to wait before reconnecting
+    yield f"retry: {event_settings['RECONNECT_DELAY_MS']}\n\n"
+    if not stream_slots.acquire():
+        # Keep the client's place, in case it was given as a query parameter
+        yield f"id: {last_event_id}\n\n"
+        return
+
+    lookback = timedelta(seconds=event_settings["LOOKBACK"])
+    # The events sent which are still within the lookback, by when they were
+    # published
+    sent: Dict[int, datetime] = {}
+    try:
+        version = broker.version
+        events = LiveEvent.objects.for_topics(topics).after(last_event_id)
+        while True:
+            recent = timezone.now() - lookback
+            sent = {pk: at for pk, at in sent.items() if at >= recent}
+            new_events = list(
+                events.filter(
+                    Q(pk__gt=last_event_id) | Q(created_at__gte=recent)
+                ).exclude(pk__in=sent)[:100]
+            )
+            for event in new_events:
+                sent[event.pk] = event.created_at
+                last_event_id = max(last_event_id, event.pk)
+                yield format_event(event, last_event_id)
+
+            if time.monotonic() >= deadline:
+                return
+            if time.monotonic() >= keepalive_at:
+                # Comment lines keep idle connections from being closed by proxies
+                keepalive_at = time.monotonic() + event_settings["KEEPALIVE_INTERVAL"]
+                yield ": keepalive\n\n"
+            if len(new_events) < 100:
+                version = broker.wait(version, event_settings["POLL_INTERVAL"])
+    finally:
+        stream_slots.release()
+
+
+def live_events(request):
+    """Stream the events of the topics allowed by the signature, as
+    server-sent events
+
+    Args:
+        request (HttpRequest): The HttpRequest
+
+    Returns:
+        HttpResponse: The HttpResponse
+    """
+    try:
+        topics = validate_live_events_signature(request.GET.get("signature"))
+    except InvalidLiveEventsSignature:
+        return HttpResponse(
+            content="Invalid signature. Maybe this link has expired?",
+            status=403,
+        )
+
+    # Reconnecting clients continue from the last event they received. New
+    # clients may continue from a snapshot (e.g. a performance's tickets
+    # breakdown), as EventSource can't set the header itself.
+    last_event_id = request.headers.get(
+        "Last-Event-ID", request.GET.get("last_event_id", "")
+    )
+    response = StreamingHttpResponse(
+        stream_events(
+            topics,
+            (
+                int(last_event_id)
+                if last_event_id.isdigit()
+                else LiveEvent.objects.latest_id()
+            ),
+        ),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx buffering the events
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -5,7 +5,7 @@ from django.core.mail import EmailMultiAlternatives, mail_admins
 from config.celery import app
 
 
-@app.task
+@app.task(ignore_result=True)
 def send_emails(email_addresses: list[str], subject: str, plain_text: str, html: str):
     """Send emails async"""
 
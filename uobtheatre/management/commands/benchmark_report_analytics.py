@@ -0,0 +1,163 @@
+import datetime
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from uobtheatre.bookings.models import Booking
+from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.transaction_providers import Card, Cash, SquareOnline
+from uobtheatre.reports.analytics import TIME_BUCKETS
+from uobtheatre.reports.reports import SalesVelocity
+
+VelocityTotals = Dict[Tuple, List]
+
+
+def add_synthetic_payments(rows: int, seed: int = 0):
+    """Add completed payments with random values against the existing bookings"""
+    booking_ids = np.array(Booking.objects.values_list("pk", flat=True))
+    if not booking_ids.size:
+        raise CommandError("Synthetic payments are made for bookings, but none exist")
+
+    rng = np.random.default_rng(seed)
+    providers = [Cash.name, Card.name, SquareOnline.name]
+    booking_type = ContentType.objects.get_for_model(Booking)
+    Transaction.objects.bulk_create(
+        (
+            Transaction(
+                pay_object_type=booking_type,
+                pay_object_id=booking_id,
+                provider_name=providers[provider],
+                value=value,
+            )
+            for booking_id, provider, value in zip(
+                rng.choice(booking_ids, rows).tolist(),
+                rng.integers(0, len(providers), rows).tolist(),
+                rng.integers(100, 5000, rows).tolist(),
+            )
+        ),
+        batch_size=10000,
+    )
+
+
+def bucket_start(created_at: datetime.datetime, bucket: str):
+    """The start of the time bucket (in the current timezone) the time is in,
+    as SalesVelocity buckets it"""
+    created_at = timezone.localtime(created_at)
+    if bucket == "hour":
+        return created_at.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    day = created_at.date()
+    if bucket == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if bucket == "month":
+        return day.replace(day=1)
+    return day
+
+
+def aggregate_instances(start, end, bucket: str) -> VelocityTotals:
+    """The payments and income per time bucket and production, aggregated a
+    model instance at a time (as the reports did before the analytics layer)"""
+    totals: VelocityTotals = {}
+    payments = (
+        Transaction.objects.filter(
+            created_at__gt=start,
+            created_at__lt=end,
+            status=Transaction.Status.COMPLETED,
+            type=Transaction.Type.PAYMENT,
+        )
+        .annotate_pay_object_performance()  # type: ignore
+        .order_by()
+    )
+    for payment in payments.iterator():
+        production_id = payment.pay_object_production_id
+        key = (
+            str(bucket_start(payment.created_at, bucket)),
+            "" if production_id is None else production_id,
+        )
+        row = totals.setdefault(key, [0, 0])
+        row[0] += 1
+        row[1] += payment.value
+    return totals
+
+
+def aggregate_report(start, end, bucket: str) -> VelocityTotals:
+    """The payments and income per time bucket and production, from the
+    SalesVelocity report"""
+    report = SalesVelocity(
+        [
+            {"name": "start_time", "value": start.isoformat()},
+            {"name": "end_time", "value": end.isoformat()},
+            {"name": "bucket", "value": bucket},
+        ]
+    )
+    report.run()
+    return {(row[0], row[1]): [row[3], row[4]] for row in report.datasets[0].data}
+
+
+class Command(BaseCommand):
+    """Command to benchmark the SalesVelocity report"""
+
+    help = (
+        "Time the SalesVelocity report, including loading the transactions, "
+        "against aggregating the same payments as model instances"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--synthetic",
+            type=int,
+            default=0,
+            help="Add this many synthetic payments for the benchmark, which are rolled back afterwards",
+        )
+        parser.add_argument("--bucket", default="day", choices=TIME_BUCKETS)
+        parser.add_argument(
+            "--days", type=int, default=365, help="The length of the period, in days"
+        )
+
+    def handle(self, *args, **options):  # pylint: disable=unused-argument
+        with transaction.atomic():
+            if options["synthetic"]:
+                add_synthetic_payments(options["synthetic"])
+            end = timezone.now() + datetime.timedelta(minutes=1)
+            start = end - datetime.timedelta(days=options["days"])
+            payment_count = Transaction.objects.filter(
+                created_at__gt=start,
+                created_at__lt=end,
+                status=Transaction.Status.COMPLETED,
+                type=Transaction.Type.PAYMENT,
+            ).count()
+
+            results = {}
+            for name, aggregate in (
+                ("Model instances", aggregate_instances),
+                ("SalesVelocity report", aggregate_report),
+            ):
+                started = time.perf_counter()
+                totals = aggregate(start, end, options["bucket"])
+                elapsed = time.perf_counter() - started
+                results[name] = (totals, elapsed)
+                self.stdout.write(
+                    "%s: %.3fs (%d payments/s)"
+                    % (name, elapsed, payment_count / max(elapsed, 1e-9))
+                )
+            transaction.set_rollback(True)
+
+        if results["Model instances"][0] != results["SalesVelocity report"][0]:
+            self.stdout.write(str(self.style.ERROR("The results do not match")))
+            return
+        self.stdout.write(
+            str(
+                self.style.SUCCESS(
+                    "The SalesVelocity report is %.1fx faster over %d payments"
+                    % (
+                        results["Model instances"][1]
+                        / max(results["SalesVelocity report"][1], 1e-9),
+                        payment_count,
+                    )
+                )
+            )
+        )
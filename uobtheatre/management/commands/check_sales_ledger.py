@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from uobtheatre.finance.models import SalesLedgerEntry
+
+
+class Command(BaseCommand):
+    """Command to check the sales ledger against the transactions"""
+
+    help = "Check the sales ledger is consistent with the transactions"
+
+    def handle(self, *args, **options):  # pylint: disable=unused-argument
+        discrepancies = SalesLedgerEntry.objects.discrepancies()
+        for discrepancy in discrepancies:
+            self.stdout.write(
+                str(
+                    self.style.ERROR(
+                        "Production %(production_id)s, performance %(performance_id)s, "
+                        "%(provider_name)s %(type)s %(status)s: "
+                        "ledger %(ledger)s, expected %(expected)s" % discrepancy
+                    )
+                )
+            )
+        if discrepancies:
+            raise CommandError(
+                f"{len(discrepancies)} sales ledger entries are inconsistent. "
+                "Run rebuild_sales_ledger to rebuild the ledger."
+            )
+        self.stdout.write(str(self.style.SUCCESS("Sales ledger is consistent")))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from uobtheatre.finance.models import SalesLedgerEntry
+
+
+class Command(BaseCommand):
+    help = "Rebuild the sales ledger from the transactions"
+
+    def handle(self, *args, **options):  # pylint: disable=unused-argument
+        SalesLedgerEntry.objects.rebuild()
+        self.stdout.write(
+            str(
+                self.style.SUCCESS(
+                    f"Rebuilt sales ledger ({SalesLedgerEntry.objects.count()} entries)"
+                )
+            )
+        )
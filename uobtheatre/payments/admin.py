@@ -1,6 +1,11 @@
 from django.contrib import admin, messages
 
 from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.square_models import (
+    SquareDeviceList,
+    SquareReconciliation,
+    SquareWebhookEvent,
+)
 from uobtheatre.utils.exceptions import SquareException
 
 
@@ -33,3 +38,77 @@ class TransactionAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Transaction, TransactionAdmin)
+
+
+@admin.register(SquareWebhookEvent)
+class SquareWebhookEventAdmin(admin.ModelAdmin):
+    """Read only admin page to inspect received Square webhooks"""
+
+    list_display = (
+        "event_id",
+        "type",
+        "provider_transaction_id",
+        "status",
+        "event_created_at",
+        "processed_at",
+    )
+    list_filter = ("type", "status")
+    search_fields = ("event_id", "provider_transaction_id")
+
+    def has_add_permission(self, _):
+        return False
+
+    def has_change_permission(self, _, __=None):
+        return False
+
+
+@admin.register(SquareReconciliation)
+class SquareReconciliationAdmin(admin.ModelAdmin):
+    """Read only admin page to review reconciliations with Square, and the
+    mismatches they found"""
+
+    list_display = (
+        "begin_time",
+        "end_time",
+        "status",
+        "checked_count",
+        "updated_count",
+        "created_at",
+    )
+    list_filter = ("status",)
+
+    def has_add_permission(self, _):
+        return False
+
+    def has_change_permission(self, _, __=None):
+        return False
+
+
+@admin.action(description="Refresh from square")  # type: ignore
+def refresh_device_lists(modeladmin, request, queryset):
+    """
+    Mark the device lists as stale, so they are refreshed when next used
+    """
+    modeladmin.message_user(
+        request, f"{queryset.invalidate()} device lists will be refreshed."
+    )
+
+
+@admin.register(SquareDeviceList)
+class SquareDeviceListAdmin(admin.ModelAdmin):
+    """Admin page for the cached Square device lists"""
+
+    actions = [refresh_device_lists]
+    list_display = ("__str__", "fetched_at", "invalidated")
+    readonly_fields = (
+        "product_type",
+        "status",
+        "location_id",
+        "devices",
+        "fetched_at",
+        "invalidated",
+        "refresh_requested_at",
+    )
+
+    def has_add_permission(self, _):
+        return False
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0016_alter_transaction_options"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["created_at"], name="payments_tr_created_02ae92_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["updated_at"], name="payments_tr_updated_1788d6_idx"
+            ),
+        ),
+    ]
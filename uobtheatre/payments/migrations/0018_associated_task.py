@@ -0,0 +1,88 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:17
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def link_existing_refund_tasks(apps, _):  # pragma: no cover
+    """Link the results of refund tasks that have already run to the objects
+    they refunded, from the arguments recorded with the results"""
+    task_result_model = apps.get_model("django_celery_results", "taskresult")
+    content_type_model = apps.get_model("contenttypes", "contenttype")
+    associated_task_model = apps.get_model("payments", "associatedtask")
+
+    transaction_content_type, _ = content_type_model.objects.get_or_create(
+        app_label="payments", model="transaction"
+    )
+    links = []
+    for task_id, task_name, task_args in task_result_model.objects.filter(
+        task_name__in=[
+            "uobtheatre.payments.tasks.refund_payment",
+            "uobtheatre.payments.tasks.refund_payable",
+        ]
+    ).values_list("task_id", "task_name", "task_args"):
+        if task_name.endswith("refund_payment"):
+            if match := re.search(r"\((\d+),", task_args or ""):
+                links.append(
+                    associated_task_model(
+                        content_type_id=transaction_content_type.pk,
+                        object_id=int(match[1]),
+                        task_id=task_id,
+                    )
+                )
+        elif match := re.search(r"\((\d+), (\d+)", task_args or ""):
+            links.append(
+                associated_task_model(
+                    content_type_id=int(match[2]),
+                    object_id=int(match[1]),
+                    task_id=task_id,
+                )
+            )
+    associated_task_model.objects.bulk_create(links, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("django_celery_results", "0002_taskresult_periodic_task_name"),
+        ("payments", "0017_transaction_timestamp_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AssociatedTask",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("object_id", models.PositiveIntegerField()),
+                ("task_id", models.CharField(max_length=255)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "content_type",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="contenttypes.contenttype",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="associatedtask",
+            index=models.Index(
+                fields=["content_type", "object_id"],
+                name="payments_as_content_585cb5_idx",
+            ),
+        ),
+        migrations.RunPython(
+            link_existing_refund_tasks, reverse_code=migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0018_associated_task"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="associatedtask",
+            name="task_id",
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0019_associated_task_task_id_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SquareWebhookEvent",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("event_id", models.CharField(max_length=255, unique=True)),
+                ("type", models.CharField(max_length=255)),
+                ("provider_transaction_id", models.CharField(max_length=255)),
+                ("event_created_at", models.DateTimeField()),
+                ("payload", models.JSONField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("PENDING", "Pending"),
+                            ("PROCESSED", "Processed"),
+                            ("IGNORED", "Ignored"),
+                            ("FAILED", "Failed"),
+                        ],
+                        default="PENDING",
+                        max_length=20,
+                    ),
+                ),
+                ("error", models.TextField(blank=True)),
+                ("processed_at", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="squarewebhookevent",
+            index=models.Index(
+                fields=["provider_transaction_id", "status"],
+                name="payments_sq_provide_ca69cd_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="squarewebhookevent",
+            index=models.Index(
+                fields=["status", "created_at"], name="payments_sq_status_ca63ba_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0021_square_reconciliation"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SquareDeviceList",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("product_type", models.CharField(blank=True, max_length=255)),
+                ("status", models.CharField(blank=True, max_length=255)),
+                ("location_id", models.CharField(blank=True, max_length=255)),
+                ("devices", models.JSONField(blank=True, default=list)),
+                ("fetched_at", models.DateTimeField(blank=True, null=True)),
+                ("invalidated", models.BooleanField(default=False)),
+                ("refresh_requested_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "unique_together": {("product_type", "status", "location_id")},
+            },
+        ),
+    ]
@@ -1,14 +1,19 @@
 from enum import Enum
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
 
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models import Q, Sum
+from django.db import transaction as db_transaction
+from django.db.models import Case, OuterRef, Q, Subquery, Sum, When
 from django.db.models.enums import TextChoices
 from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
+from django.utils import timezone
 from django_celery_results.models import TaskResult
+from sentry_sdk import capture_exception
 
 from uobtheatre.mail.composer import MailComposer
 from uobtheatre.payments import transaction_providers
@@ -16,6 +21,14 @@ from uobtheatre.payments.exceptions import (
     CantBeCanceledException,
     CantBeRefundedException,
 )
+
+# The Square models are defined in their own module, and imported here so that
+# Django registers them with the app
+from uobtheatre.payments.square_models import (  # pylint: disable=unused-import
+    SquareDeviceList,
+    SquareReconciliation,
+    SquareWebhookEvent,
+)
 from uobtheatre.payments.tasks import refund_payment
 from uobtheatre.payments.transaction_providers import (
     Cash,
@@ -23,25 +36,24 @@ from uobtheatre.payments.transaction_providers import (
     RefundProvider,
     TransactionProvider,
 )
+from uobtheatre.utils.concurrency import RateLimiter, map_concurrently
+from uobtheatre.utils.exceptions import GQLException
 from uobtheatre.utils.models import BaseModel, TimeStampedMixin
 
 if TYPE_CHECKING:
     from uobtheatre.payments.payables import Payable
 
 
-class TransactionQuerySet(QuerySet):
-    """The query set for payments"""
+class SalesBreakdownQuerySetMixin:
+    """Sales breakdown aggregations for querysets of transactions, or of rows
+    with the same value, fee, provider and type columns (e.g. the sales ledger)
+    """
 
     def annotate_sales_breakdown(
-        self, breakdowns: Optional[list["SalesBreakdown.Enums"]] = None
+        self: Any, breakdowns: Optional[Iterable["SalesBreakdown.Enums"]] = None
     ):
         """Annotate sales breakdown onto payments"""
-        annotations = {
-            breakdown.key: Coalesce(breakdown.value, 0)
-            for breakdown in SalesBreakdown.Enums
-            if breakdowns is None or breakdown in breakdowns
-        }
-        return self.aggregate(**annotations)
+        return self.aggregate(**SalesBreakdown.annotations(breakdowns))
 
     def get_sales_breakdown(self, breakdown: "SalesBreakdown.Enums"):
         # NOTE: Calling aggregate on an empty queryset gives None so the
@@ -49,6 +61,107 @@ class TransactionQuerySet(QuerySet):
         # issue/feature above
         return self.annotate_sales_breakdown(breakdowns=[breakdown])[breakdown.key] or 0
 
+    def sales_breakdowns_by(
+        self: Any,
+        group_by: str,
+        breakdowns: Optional[Iterable["SalesBreakdown.Enums"]] = None,
+    ) -> Dict[Any, Dict[str, int]]:
+        """Sales breakdowns of the transactions grouped by a field or
+        annotation, computed in a single GROUP BY query.
+
+        Groups with no transactions are not included in the result.
+        """
+        # Prefix the annotations as they can't share names with model fields
+        # (e.g. app_fee)
+        annotations = {
+            f"breakdown_{key}": expression
+            for key, expression in SalesBreakdown.annotations(breakdowns).items()
+        }
+        rows = self.order_by().values(group_by).annotate(**annotations)
+        return {
+            row.pop(group_by): {
+                key[len("breakdown_") :]: value for key, value in row.items()
+            }
+            for row in rows
+        }
+
+
+class AssociatedTaskQuerySet(QuerySet):
+    """Queryset for the links between tasks and objects"""
+
+    def for_objects(self, queryset: QuerySet):
+        """The links to the objects in the queryset"""
+        return self.filter(
+            content_type=ContentType.objects.get_for_model(queryset.model),
+            object_id__in=queryset.values("pk"),
+        )
+
+    def open_refunds(self):
+        """The links to payables whose refunds are still being processed, and
+        to their payments"""
+        from uobtheatre.payments.payables import Payable
+
+        query = Q(pk__in=[])
+        for content_type in ContentType.objects.filter(
+            pk__in=self.values("content_type")
+        ):
+            model = content_type.model_class()
+            if model is None or not issubclass(model, Payable):
+                continue
+            refunding = model.objects.filter(  # type: ignore
+                status=Payable.Status.REFUND_PROCESSING
+            ).values("pk")
+            query |= Q(content_type=content_type, object_id__in=refunding)
+            query |= Q(
+                content_type=ContentType.objects.get_for_model(Transaction),
+                object_id__in=Transaction.objects.filter(
+                    pay_object_type=content_type, pay_object_id__in=refunding
+                ).values("pk"),
+            )
+        return self.filter(query)
+
+    def task_results(self):
+        """The results of the linked tasks"""
+        return TaskResult.objects.filter(task_id__in=self.values("task_id"))
+
+    def enqueue(self, task, obj, *args, **kwargs):
+        """Enqueue the task with the given arguments, linked to the object"""
+        task_id = str(uuid4())
+        self.create(
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.pk,
+            task_id=task_id,
+        )
+        return task.apply_async(args, kwargs, task_id=task_id)
+
+
+AssociatedTaskManager = models.Manager.from_queryset(AssociatedTaskQuerySet)
+
+
+class AssociatedTask(models.Model):
+    """A link between a task and the object it acts on (e.g. a refund task and
+    the payment it refunds).
+
+    An object's tasks are found through these links, rather than by
+    searching the arguments of every task result.
+    """
+
+    objects = AssociatedTaskManager()
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    task_id = models.CharField(
+        max_length=255, db_index=True
+    )  # The task result's task_id
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["content_type", "object_id"])]
+
+
+class TransactionQuerySet(SalesBreakdownQuerySetMixin, QuerySet):
+    """The query set for payments"""
+
     def payments(self):
         return self.filter(type=Transaction.Type.PAYMENT)
 
@@ -58,24 +171,104 @@ class TransactionQuerySet(QuerySet):
     def missing_provider_fee(self):
         return self.filter(provider_fee=None)
 
-    def sync(self):
+    def annotate_pay_object_performance(self):
+        """
+        Annotate the IDs of the performance and production that each
+        transaction's pay object is for, as pay_object_performance_id and
+        pay_object_production_id (None if it isn't for a performance).
+        """
+        from uobtheatre.bookings.models import Booking
+
+        bookings = Booking.objects.filter(pk=OuterRef("pay_object_id"))
+        is_booking = Q(pay_object_type=ContentType.objects.get_for_model(Booking))
+        return self.annotate(
+            pay_object_performance_id=Case(
+                When(
+                    is_booking,
+                    then=Subquery(bookings.values("performance_id")[:1]),
+                ),
+                output_field=models.IntegerField(),
+            ),
+            pay_object_production_id=Case(
+                When(
+                    is_booking,
+                    then=Subquery(bookings.values("performance__production_id")[:1]),
+                ),
+                output_field=models.IntegerField(),
+            ),
+        )
+
+    def sync(self) -> int:
         """
         Sync all (non manual) payments with their providers. Currently the only
         syncing we do is for the processing fee.
+
+        The fees are fetched in a limited number of concurrent, rate limited
+        provider calls and written back in bulk. Transactions whose fee
+        can't be fetched are left as they are.
+
+        Returns:
+            int: The number of transactions whose fee changed
+        """
+        sync_settings = settings.PROVIDER_FEE_SYNC_SETTINGS
+        rate_limiter = RateLimiter(sync_settings["REQUESTS_PER_SECOND"])
+
+        def get_provider_fee(transaction: "Transaction") -> Optional[int]:
+            # The provider's client retries transient errors
+            rate_limiter.wait()
+            try:
+                return transaction.provider.get_provider_fee(transaction)
+            except Exception as exc:  # pylint: disable=broad-except
+                if not isinstance(exc, GQLException):
+                    capture_exception(exc)
+                return None
+
+        transactions: List["Transaction"] = list(self)  # type: ignore[arg-type]
+        fees = map_concurrently(
+            get_provider_fee, transactions, sync_settings["CONCURRENCY"]
+        )
+        return Transaction.objects.update_provider_fees(zip(transactions, fees))
+
+    def update_provider_fees(
+        self, fees: Iterable[Tuple["Transaction", Optional[int]]]
+    ) -> int:
         """
-        for payment in self:
-            payment.sync_transaction_with_provider()
+        Write the given provider fees to their transactions in bulk. Fees
+        which are None or unchanged are skipped.
+
+        Returns:
+            int: The number of transactions whose fee changed
+        """
+        from uobtheatre.finance.models import SalesLedgerEntry, ledger_snapshot
+
+        changed = []
+        now = timezone.now()
+        for transaction, fee in fees:
+            if fee is None or fee == transaction.provider_fee:
+                continue
+            previous = ledger_snapshot(transaction)
+            transaction.provider_fee = fee
+            transaction.updated_at = now
+            changed.append((transaction, previous))
+
+        # Bulk updates bypass the save signals, so the ledger is updated here
+        with db_transaction.atomic():
+            Transaction.objects.bulk_update(
+                [transaction for transaction, _ in changed],
+                ["provider_fee", "updated_at"],
+                batch_size=500,
+            )
+            for transaction, previous in changed:
+                SalesLedgerEntry.objects.record_change(
+                    previous, ledger_snapshot(transaction)
+                )
+        return len(changed)
 
     def associated_tasks(self):
         """
         Return a queryset of tasks associated with these transactions
         """
-        pks = self.values_list("pk", flat=True)
-        pks_regex = "|".join(map(str, pks))
-        return TaskResult.objects.filter(
-            task_name="uobtheatre.payments.tasks.refund_payment",
-            task_args__iregex=f"\(({pks_regex}),\)",  # pylint: disable=anomalous-backslash-in-string
-        )
+        return AssociatedTask.objects.for_objects(self).task_results()
 
 
 TransactionManager = models.Manager.from_queryset(TransactionQuerySet)
@@ -163,6 +356,16 @@ class Transaction(TimeStampedMixin, BaseModel):
     # Amount charged by us to process payment
     app_fee = models.IntegerField(null=True, blank=True)
 
+    # The transaction's sales ledger contribution before it is saved, set by
+    # the finance app's pre save signal
+    _ledger_snapshot: Optional[Dict] = None
+
+    def save(self, *args, **kwargs):
+        # Save atomically with the save signal handlers, so that anything they
+        # maintain (e.g. the sales ledger) can't drift from the transaction
+        with db_transaction.atomic():
+            super().save(*args, **kwargs)
+
     @property
     def is_refunded(self) -> bool:
         """
@@ -265,7 +468,9 @@ class Transaction(TimeStampedMixin, BaseModel):
         Create "refund_payment" task to refund the payment. The task queue the
         refund method.
         """
-        refund_payment.delay(
+        AssociatedTask.objects.enqueue(
+            refund_payment,
+            self,
             self.pk,
             preserve_provider_fees=preserve_provider_fees,
             preserve_app_fees=preserve_app_fees,
@@ -334,11 +539,16 @@ class Transaction(TimeStampedMixin, BaseModel):
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["created_at"]),
+            models.Index(fields=["updated_at"]),
+        ]
 
 
 class SalesBreakdown:
     """
     Class representing the sales breakdown for a given transaction query set
+    (or sales ledger query set)
     """
 
     class Enums(Enum):
@@ -377,9 +587,56 @@ class SalesBreakdown:
         def key(self):
             return self.name.lower()
 
-    def __init__(self, transaction_qs: TransactionQuerySet) -> None:
+        @classmethod
+        def from_keys(cls, keys: Iterable[str]) -> list["SalesBreakdown.Enums"]:
+            """The breakdowns matching the provided keys, ignoring unknown keys"""
+            return [cls[key.upper()] for key in keys if key.upper() in cls.__members__]
+
+    def __init__(
+        self,
+        transaction_qs: SalesBreakdownQuerySetMixin,
+        values: Optional[Dict[str, int]] = None,
+    ) -> None:
         super().__init__()
         self.transaction_qs = transaction_qs
+        # Memoised breakdown values, keyed by the breakdown's key
+        self.values: Dict[str, int] = dict(values or {})
+
+    @classmethod
+    def annotations(cls, breakdowns: Optional[Iterable["SalesBreakdown.Enums"]] = None):
+        """The aggregate expressions for the requested breakdowns (or all breakdowns)"""
+        breakdowns = cls.Enums if breakdowns is None else breakdowns
+        return {breakdown.key: Coalesce(breakdown.value, 0) for breakdown in breakdowns}
+
+    def load(
+        self, breakdowns: Optional[Iterable["SalesBreakdown.Enums"]] = None
+    ) -> "SalesBreakdown":
+        """Compute the requested breakdowns (or all breakdowns) that have not
+        already been memoised, in a single aggregate query."""
+        breakdowns = self.Enums if breakdowns is None else breakdowns
+        missing = [
+            breakdown for breakdown in breakdowns if breakdown.key not in self.values
+        ]
+        if missing:
+            self.values.update(
+                {
+                    key: value or 0
+                    for key, value in self.transaction_qs.annotate_sales_breakdown(
+                        missing
+                    ).items()
+                }
+            )
+        return self
+
+    def get(self, breakdown: "SalesBreakdown.Enums") -> int:
+        return self.load([breakdown]).values[breakdown.key]
+
+    def as_dict(
+        self, breakdowns: Optional[Iterable["SalesBreakdown.Enums"]] = None
+    ) -> Dict[str, int]:
+        breakdowns = list(self.Enums if breakdowns is None else breakdowns)
+        self.load(breakdowns)
+        return {breakdown.key: self.values[breakdown.key] for breakdown in breakdowns}
 
     @property
     def total_payments(self) -> int:
@@ -388,40 +645,56 @@ class SalesBreakdown:
         - This does not include refunds.
         - This does include the square fee.
         """
-        return self.transaction_qs.get_sales_breakdown(self.Enums.TOTAL_PAYMENTS)
+        return self.get(self.Enums.TOTAL_PAYMENTS)
+
+    @property
+    def total_card_payments(self) -> int:
+        """The positive amounts paid by the user for this object by card."""
+        return self.get(self.Enums.TOTAL_CARD_PAYMENTS)
 
     @property
     def net_transactions(self) -> int:
         """The net amount paid by the user for this object. (This includes refunds)"""
-        return self.transaction_qs.get_sales_breakdown(self.Enums.NET_TRANSACTIONS)
+        return self.get(self.Enums.NET_TRANSACTIONS)
+
+    @property
+    def net_card_transactions(self) -> int:
+        """The net amount paid by the user for this object by card."""
+        return self.get(self.Enums.NET_CARD_TRANSACTIONS)
 
     @property
     def total_refunds(self) -> int:
         """The negative amounts paid by the user for this object. (i.e. money
         paid back to the user in the form of a refund)
         """
-        return self.transaction_qs.get_sales_breakdown(self.Enums.TOTAL_REFUNDS)
+        return self.get(self.Enums.TOTAL_REFUNDS)
+
+    @property
+    def total_card_refunds(self) -> int:
+        """The amounts refunded to the user for this object by card."""
+        return self.get(self.Enums.TOTAL_CARD_REFUNDS)
 
     @property
     def provider_payment_value(self) -> int:
         """The amount taken by the payment provider in paying for this object."""
-        return self.transaction_qs.get_sales_breakdown(
-            self.Enums.PROVIDER_PAYMENT_VALUE
-        )
+        return self.get(self.Enums.PROVIDER_PAYMENT_VALUE)
+
+    @property
+    def app_fee(self) -> int:
+        """The total of our fees charged on this object."""
+        return self.get(self.Enums.APP_FEE)
 
     @property
     def app_payment_value(self) -> int:
         """The amount taken by us in paying for this object."""
-        return self.transaction_qs.get_sales_breakdown(self.Enums.APP_PAYMENT_VALUE)
+        return self.get(self.Enums.APP_PAYMENT_VALUE)
 
     @property
     def society_revenue(self) -> int:
         """The revenue for the society for selling this object."""
-        return self.transaction_qs.get_sales_breakdown(self.Enums.SOCIETY_REVENUE)
+        return self.get(self.Enums.SOCIETY_REVENUE)
 
     @property
     def society_transfer_value(self) -> int:
         """The amount of money to transfer to the society for object."""
-        return self.transaction_qs.get_sales_breakdown(
-            self.Enums.SOCIETY_TRANSFER_VALUE
-        )
+        return self.get(self.Enums.SOCIETY_TRANSFER_VALUE)
@@ -1,29 +1,34 @@
 import abc
 import math
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
 
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
 from django.core.mail import mail_admins
 from django.db import models
-from django.db.models import Count, Q, Sum
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
 from django.db.models.functions.comparison import Coalesce
 from django.db.models.query import QuerySet
-from django_celery_results.models import TaskResult
+from django.utils.functional import cached_property
 
 from uobtheatre.payments.emails import payable_refund_initiated_email
 from uobtheatre.payments.exceptions import (
     CantBePaidForException,
     CantBeRefundedException,
 )
-from uobtheatre.payments.models import SalesBreakdown, Transaction
+from uobtheatre.payments.models import AssociatedTask, SalesBreakdown, Transaction
 from uobtheatre.payments.tasks import refund_payable
 from uobtheatre.users.models import User
-from uobtheatre.utils.filters import filter_passes_on_model
+from uobtheatre.utils.filters import get_related_objects
 from uobtheatre.utils.models import BaseModel
 
 if TYPE_CHECKING:
     from uobtheatre.payments.transaction_providers import PaymentProvider
 
+# The prefix of the sales breakdown annotations added by
+# PayableQuerySet.annotate_sales_breakdowns
+SALES_BREAKDOWN_ANNOTATION_PREFIX = "sales_breakdown_"
+
 
 class PayableQuerySet(QuerySet):
     """Base queryset for payable objects"""
@@ -35,7 +40,10 @@ class PayableQuerySet(QuerySet):
         return self.annotate(transaction_totals=Coalesce(Sum("transactions__value"), 0))
 
     def locked(self) -> QuerySet:
-        """A payable is locked if it has any pending transactions"""
+        """A payable is locked if it has any pending transactions
+
+        Payable.transactions_are_locked is the in-memory equivalent.
+        """
         return self.filter(transactions__status=Transaction.Status.PENDING)
 
     def refunded(self, bool_val=True) -> QuerySet:
@@ -44,6 +52,8 @@ class PayableQuerySet(QuerySet):
         or, for legacy support, if the value of all the payments for the pay
         object are equal to the value of all the refunds and all payments are
         completed.
+
+        Payable.transactions_are_refunded is the in-memory equivalent.
         """
         qs = self.annotate_transaction_count().annotate_transaction_value()  # type: ignore
         filter_query = Q(transaction_totals=0, transaction_count__gt=1) | Q(
@@ -53,6 +63,48 @@ class PayableQuerySet(QuerySet):
             return qs.filter(filter_query)
         return qs.exclude(filter_query)
 
+    def annotate_sales_breakdowns(
+        self, breakdowns: Optional[Iterable[SalesBreakdown.Enums]] = None
+    ) -> QuerySet:
+        """
+        Annotate the requested breakdowns (or all breakdowns) of each
+        payable's transactions, each computed in a correlated subquery.
+
+        Payable.sales_breakdown uses the annotated values rather than querying
+        the transactions again.
+        """
+        transactions = (
+            Transaction.objects.filter(
+                pay_object_type=ContentType.objects.get_for_model(self.model),
+                pay_object_id=OuterRef("pk"),
+            )
+            .order_by()
+            .values("pay_object_id")
+        )
+        return self.annotate(
+            **{
+                f"{SALES_BREAKDOWN_ANNOTATION_PREFIX}{key}": Coalesce(
+                    Subquery(
+                        transactions.annotate(breakdown=expression).values("breakdown")
+                    ),
+                    0,
+                )
+                for key, expression in SalesBreakdown.annotations(breakdowns).items()
+            }
+        )
+
+    def sales_breakdowns(
+        self, breakdowns: Optional[Iterable[SalesBreakdown.Enums]] = None
+    ) -> Dict[int, SalesBreakdown]:
+        """
+        Returns the sales breakdown of every payable in the queryset, keyed by
+        ID and computed in a single query.
+        """
+        return {
+            payable.pk: payable.sales_breakdown
+            for payable in self.annotate_sales_breakdowns(breakdowns)
+        }
+
 
 PayableManager = models.Manager.from_queryset(PayableQuerySet)
 
@@ -106,14 +158,37 @@ class Payable(BaseModel):  # type: ignore
         raise NotImplementedError
 
     @property
-    def is_refunded(self) -> bool:
-        return not self.is_locked and filter_passes_on_model(
-            self, lambda qs: qs.refunded()  # type: ignore
+    def live_topics(self) -> List[str]:
+        """The topics that live updates about this payable are published to"""
+        return []
+
+    @staticmethod
+    def transactions_are_locked(transactions: Iterable[Transaction]) -> bool:
+        """In-memory equivalent of PayableQuerySet.locked"""
+        return any(
+            transaction.status == Transaction.Status.PENDING
+            for transaction in transactions
         )
 
+    def transactions_are_refunded(self, transactions: Iterable[Transaction]) -> bool:
+        """In-memory equivalent of PayableQuerySet.refunded"""
+        if self.status == Payable.Status.REFUNDED:
+            return True
+        values = [transaction.value for transaction in transactions]
+        return len(values) > 1 and sum(values) == 0
+
+    @property
+    def is_refunded(self) -> bool:
+        transactions = get_related_objects(self, "transactions", Transaction)
+        return not self.transactions_are_locked(
+            transactions
+        ) and self.transactions_are_refunded(transactions)
+
     @property
     def is_locked(self) -> bool:
-        return filter_passes_on_model(self, lambda qs: qs.locked())  # type: ignore
+        return self.transactions_are_locked(
+            get_related_objects(self, "transactions", Transaction)
+        )
 
     @property
     def can_be_refunded(self):
@@ -155,7 +230,9 @@ class Payable(BaseModel):  # type: ignore
         payable. This tasks calls the refund method with `do_async` to queue a
         refund tasks for each payment.
         """
-        refund_payable.delay(
+        AssociatedTask.objects.enqueue(
+            refund_payable,
+            self,
             self.pk,
             self.content_type.pk,
             authorizing_user.pk,
@@ -299,17 +376,21 @@ class Payable(BaseModel):  # type: ignore
         self.status = Payable.Status.PAID
         self.save()
 
-    @property
+    @cached_property
     def sales_breakdown(self) -> SalesBreakdown:
-        return SalesBreakdown(self.transactions)  # type: ignore
+        """The breakdown of the payable's sales, computed once per instance"""
+        # Use any breakdowns annotated by PayableQuerySet.annotate_sales_breakdowns
+        values = {
+            key[len(SALES_BREAKDOWN_ANNOTATION_PREFIX) :]: value
+            for key, value in vars(self).items()
+            if key.startswith(SALES_BREAKDOWN_ANNOTATION_PREFIX)
+        }
+        return SalesBreakdown(self.transactions, values)  # type: ignore
 
     @property
     def associated_tasks(self):
         """Get tasks associated with this payable"""
-        payable_tasks = TaskResult.objects.filter(
-            task_name="uobtheatre.payments.tasks.refund_payable",
-            task_args__iregex=f"\({self.pk}, {self.content_type.pk}",  # pylint: disable=anomalous-backslash-in-string
-        )
+        payable_tasks = AssociatedTask.objects.for_objects(self.qs).task_results()
         payment_tasks = self.transactions.associated_tasks()
         return payable_tasks | payment_tasks
 
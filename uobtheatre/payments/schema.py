@@ -7,6 +7,7 @@ from graphene_django import DjangoObjectType
 
 from uobtheatre.bookings.schema import BookingNode
 from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.square_models import SquareDeviceList
 from uobtheatre.payments.transaction_providers import (
     PaymentProvider,
     SquarePOS,
@@ -50,6 +51,12 @@ class SquarePaymentDevice(graphene.ObjectType):
     location_id = graphene.String()
     product_type = graphene.String()
     status = graphene.String()
+    stale = graphene.Boolean(
+        description="Whether the device list may be out of date, while it is refreshed"
+    )
+    fetched_at = graphene.DateTime(
+        description="When the device list was fetched from Square"
+    )
 
 
 class TransactionNode(DjangoObjectType):
@@ -84,7 +91,8 @@ class Query(graphene.ObjectType):
         paired: Optional[bool] = None,
     ):
         """
-        Returns square payment devices.
+        Returns square payment devices, from a cache which is refreshed in
+        the background when it is stale.
 
         Args:
             payment_provider (str): Filter to only show devices related to
@@ -103,20 +111,17 @@ class Query(graphene.ObjectType):
         if include_all or payment_provider == SquarePOS.name:
             status = None if paired is None else "PAIRED" if paired else "UNPAIRED"
 
+            device_list = SquareDeviceList.objects.get_for(
+                product_type="TERMINAL_API", status=status
+            )
             devices.extend(
                 [
                     SquarePaymentDevice(
-                        id=device.id,
-                        name=device.name,
-                        code=device.code,
-                        status=device.status,
-                        product_type=device.product_type,
-                        location_id=device.location_id,
-                        device_id=device.device_id,
-                    )
-                    for device in SquarePOS.list_devices(
-                        product_type="TERMINAL_API", status=status
+                        **device,
+                        stale=device_list.is_stale,
+                        fetched_at=device_list.fetched_at,
                     )
+                    for device in device_list.devices
                 ]
             )
 
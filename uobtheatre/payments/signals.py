@@ -1,8 +1,11 @@
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
+from graphql_relay.node.node import to_global_id
 
+from uobtheatre.live.events import publish
 from uobtheatre.payments.models import Transaction
 from uobtheatre.payments.payables import Payable
+from uobtheatre.utils.filters import get_related_objects
 
 
 @receiver(pre_save, sender=Transaction)
@@ -38,12 +41,35 @@ def pre_transaction_save_callback(transaction_instance: Transaction):
 
 def post_transaction_save_callback(transaction_instance: Transaction):
     """Post save payment actions"""
+    pay_object = transaction_instance.pay_object
+    # Push the change to clients waiting on the payment, such as box office
+    # terminals, so they don't have to poll for it
+    publish(
+        "transaction.updated",
+        {
+            "id": to_global_id("TransactionNode", transaction_instance.pk),
+            "payObjectId": pay_object.global_id,
+            "type": transaction_instance.type,
+            "status": transaction_instance.status,
+            "providerName": transaction_instance.provider_name,
+        },
+        pay_object.live_topics,
+    )
+
+    if pay_object.status != Payable.Status.REFUND_PROCESSING:
+        return
+
+    # Evaluate the predicates in memory, swapping in the saved instance in
+    # case the pay object's transactions were prefetched before this save
+    transactions = [
+        transaction
+        for transaction in get_related_objects(pay_object, "transactions", Transaction)
+        if transaction.pk != transaction_instance.pk
+    ] + [transaction_instance]
+
     # If the payable is an in-process refund and the transaction has now been completed, mark the payable as refunded
-    if (
-        transaction_instance.pay_object.status == Payable.Status.REFUND_PROCESSING
-        and not transaction_instance.pay_object.Status == Payable.Status.REFUNDED
-        and not transaction_instance.pay_object.is_locked
-        and transaction_instance.pay_object.is_refunded
-    ):
-        transaction_instance.pay_object.status = Payable.Status.REFUNDED
-        transaction_instance.pay_object.save()
+    if not pay_object.transactions_are_locked(
+        transactions
+    ) and pay_object.transactions_are_refunded(transactions):
+        pay_object.status = Payable.Status.REFUNDED
+        pay_object.save()
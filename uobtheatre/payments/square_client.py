@@ -0,0 +1,177 @@
+"""
+The HTTP layer used by the Square API client
+
+Square calls share a pool of kept-alive connections and have timeouts.
+Calls which are safe to repeat are retried with jittered backoff, and a
+circuit breaker fails calls fast while Square is degraded. The latency of
+each call is recorded, by endpoint, in the square_request_duration_seconds
+histogram.
+"""
+
+import re
+import time
+from typing import Optional
+
+import httpx
+from django.conf import settings
+from prometheus_client import Histogram
+from square import Square as Client
+from square.core.api_error import ApiError
+
+from uobtheatre.utils.concurrency import CircuitBreaker, CircuitOpenError, retry
+from uobtheatre.utils.metrics import DEFAULT_BUCKETS
+
+REQUEST_DURATION = Histogram(
+    "square_request_duration_seconds",
+    "The time taken by Square API calls, including retries",
+    ["method", "endpoint", "outcome"],
+    buckets=DEFAULT_BUCKETS,
+)
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+CIRCUIT_OPEN_ERROR_BODY = {
+    "errors": [
+        {
+            "category": "API_ERROR",
+            "code": "SERVICE_UNAVAILABLE",
+            "detail": "Square is currently unavailable",
+        }
+    ]
+}
+
+
+class RetryableResponse(Exception):
+    """Raised for a response worth retrying, such as a server error"""
+
+    def __init__(self, response: httpx.Response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+def is_failure_status(status_code: int) -> bool:
+    """Whether a response status means Square failed, rather than rejected
+    the request"""
+    return status_code == 429 or status_code >= 500
+
+
+def endpoint_name(path: str) -> str:
+    """The endpoint of a Square API path, with IDs replaced by placeholders
+    (e.g. /v2/payments/{id})"""
+    return "/".join(
+        segment if re.fullmatch(r"([a-z][a-z0-9_]*)?", segment) else "{id}"
+        for segment in path.split("/")
+    )
+
+
+def is_retryable_request(request: httpx.Request) -> bool:
+    """Whether a request can be repeated without side effects. Creating
+    requests are only repeated if they carry an idempotency key, which
+    Square uses to ignore repeats."""
+    return request.method in IDEMPOTENT_METHODS or b'"idempotency_key"' in (
+        request.content
+    )
+
+
+class SquareTransport(httpx.BaseTransport):
+    """Transport which retries, circuit breaks and times Square API calls"""
+
+    def __init__(
+        self,
+        transport: httpx.BaseTransport,
+        breaker: CircuitBreaker,
+        attempts: int,
+        backoff: float,
+    ):
+        self.transport = transport
+        self.breaker = breaker
+        self.attempts = attempts
+        self.backoff = backoff
+
+    def send(self, request: httpx.Request) -> httpx.Response:
+        """Send the request once, raising if the response should be retried"""
+        response = self.transport.handle_request(request)
+        if is_failure_status(response.status_code):
+            response.read()
+            response.close()
+            raise RetryableResponse(response)
+        return response
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        labels = {
+            "method": request.method,
+            "endpoint": endpoint_name(request.url.path),
+        }
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError as exc:
+            REQUEST_DURATION.labels(outcome="circuit_open", **labels).observe(0)
+            raise ApiError(status_code=503, body=CIRCUIT_OPEN_ERROR_BODY) from exc
+
+        started = time.monotonic()
+        try:
+            response = retry(
+                lambda: self.send(request),
+                attempts=self.attempts if is_retryable_request(request) else 1,
+                backoff=self.backoff,
+                should_retry=lambda exc: isinstance(
+                    exc, (RetryableResponse, httpx.TransportError)
+                ),
+                jitter=True,
+            )
+        except RetryableResponse as exc:
+            response = exc.response
+        except httpx.TransportError:
+            self.breaker.record_failure()
+            REQUEST_DURATION.labels(outcome="error", **labels).observe(
+                time.monotonic() - started
+            )
+            raise
+
+        if is_failure_status(response.status_code):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        REQUEST_DURATION.labels(outcome=str(response.status_code), **labels).observe(
+            time.monotonic() - started
+        )
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+def create_client(transport: Optional[httpx.BaseTransport] = None, **kwargs) -> Client:
+    """Create a Square API client, using the SQUARE_CLIENT_SETTINGS
+
+    Args:
+        transport (httpx.BaseTransport): The transport to send requests
+            with, instead of a pooled HTTP transport
+        **kwargs: The arguments for the Square client
+    """
+    client_settings = settings.SQUARE_CLIENT_SETTINGS
+    http_transport = transport or httpx.HTTPTransport(
+        limits=httpx.Limits(
+            max_connections=client_settings["MAX_CONNECTIONS"],
+            max_keepalive_connections=client_settings["MAX_KEEPALIVE_CONNECTIONS"],
+            keepalive_expiry=client_settings["KEEPALIVE_EXPIRY"],
+        )
+    )
+    return Client(
+        **kwargs,
+        httpx_client=httpx.Client(
+            transport=SquareTransport(
+                http_transport,
+                CircuitBreaker(
+                    client_settings["CIRCUIT_FAILURE_THRESHOLD"],
+                    client_settings["CIRCUIT_RESET_TIMEOUT"],
+                ),
+                attempts=client_settings["ATTEMPTS"],
+                backoff=client_settings["BACKOFF"],
+            ),
+            timeout=httpx.Timeout(
+                client_settings["TIMEOUT"],
+                connect=client_settings["CONNECT_TIMEOUT"],
+            ),
+        ),
+    )
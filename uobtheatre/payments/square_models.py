@@ -0,0 +1,436 @@
+"""
+Models for our records of Square: the webhook events it sends, the
+reconciliations of our transactions against it, and cached device lists
+"""
+
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from django.db import models
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from sentry_sdk import capture_exception
+
+from uobtheatre.payments import transaction_providers
+from uobtheatre.utils.exceptions import GQLException
+from uobtheatre.utils.models import TimeStampedMixin
+
+if TYPE_CHECKING:
+    from uobtheatre.payments.models import Transaction
+
+
+class SquareWebhookEventQuerySet(QuerySet):
+    """Queryset for received Square webhook events"""
+
+    def pending(self):
+        """Events waiting to be applied"""
+        return self.filter(status=SquareWebhookEvent.Status.PENDING)
+
+    def in_order(self):
+        """The events in the order Square sent them"""
+        return self.order_by("event_created_at", "pk")
+
+
+SquareWebhookEventManager = models.Manager.from_queryset(SquareWebhookEventQuerySet)
+
+
+class SquareWebhookEvent(TimeStampedMixin, models.Model):
+    """A webhook event received from Square, waiting to be (or having been)
+    applied to its transaction.
+
+    Events are stored when they are received and applied in the background.
+    Square may deliver an event more than once, so events are unique by
+    Square's event ID. A transaction's events are applied one at a time, in
+    the order Square sent them.
+    """
+
+    objects = SquareWebhookEventManager()
+
+    class Status(models.TextChoices):
+        """The status of the event"""
+
+        PENDING = "PENDING", "Pending"
+        PROCESSED = "PROCESSED", "Processed"
+        IGNORED = "IGNORED", "Ignored"
+        FAILED = "FAILED", "Failed"
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    # The provider ID of the transaction the event is about
+    provider_transaction_id = models.CharField(max_length=255)
+    event_created_at = models.DateTimeField()
+    payload = models.JSONField()
+
+    status = models.CharField(
+        max_length=20, choices=Status.choices, default=Status.PENDING
+    )
+    error = models.TextField(blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def finish(self, status: "SquareWebhookEvent.Status", error: str = ""):
+        """Record the outcome of applying the event"""
+        self.status = status
+        self.error = error
+        self.processed_at = timezone.now()
+        self.save(update_fields=["status", "error", "processed_at", "updated_at"])
+
+    def is_superseded(self) -> bool:
+        """Whether a later event for the same transaction has already been
+        applied, so applying this one would overwrite newer data"""
+        return SquareWebhookEvent.objects.filter(
+            provider_transaction_id=self.provider_transaction_id,
+            status=SquareWebhookEvent.Status.PROCESSED,
+            event_created_at__gt=self.event_created_at,
+        ).exists()
+
+    def __str__(self):
+        return f"{self.type} ({self.event_id})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["provider_transaction_id", "status"]),
+            models.Index(fields=["status", "created_at"]),
+        ]
+
+
+class SquareReconciliation(TimeStampedMixin, models.Model):
+    """A check of our Square transactions against Square's records of the
+    payments and refunds updated in a time window.
+
+    Square's records are paged through with its list endpoints and indexed
+    by ID, rather than fetched one at a time. Fees which differ are updated
+    in bulk. Statuses which differ are synced through the transaction's
+    provider, so that the effects of the status change (e.g. completing a
+    booking) happen, and are recorded as mismatches along with Square
+    records we have no transaction for.
+    """
+
+    class Status(models.TextChoices):
+        """The status of the reconciliation"""
+
+        RUNNING = "RUNNING", "Running"
+        SUCCESS = "SUCCESS", "Success"
+        FAILURE = "FAILURE", "Failure"
+
+    class Mismatch(models.TextChoices):
+        """The ways a transaction can differ from Square's record of it"""
+
+        STATUS = "STATUS", "Status differed"
+        UNKNOWN = "UNKNOWN", "No matching transaction"
+
+    begin_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    status = models.CharField(
+        max_length=20, choices=Status.choices, default=Status.RUNNING
+    )
+    error = models.TextField(blank=True)
+
+    checked_count = models.PositiveIntegerField(default=0)
+    updated_count = models.PositiveIntegerField(default=0)
+    # List of {"provider_transaction_id", "transaction", "mismatch", "detail"}
+    mismatches = models.JSONField(default=list, blank=True)
+
+    def add_mismatch(
+        self,
+        provider_transaction_id: str,
+        transaction: Optional["Transaction"],
+        mismatch: "SquareReconciliation.Mismatch",
+        detail: str,
+    ):
+        """Record a difference between a transaction and Square's record
+
+        Returns:
+            dict: The recorded mismatch
+        """
+        recorded = {
+            "provider_transaction_id": provider_transaction_id,
+            "transaction": transaction.pk if transaction else None,
+            "mismatch": mismatch.value,
+            "detail": detail,
+        }
+        self.mismatches.append(recorded)
+        return recorded
+
+    def square_records(self) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """Square's payments and refunds updated in the window, indexed by
+        our provider name and ID for them
+
+        Returns:
+            dict: The status (None if the payments' own status isn't ours),
+                total processing fee and Square object for each record. A
+                checkout's record also has the IDs of its payments listed.
+        """
+        # pylint: disable=protected-access
+        processing_fee = (
+            transaction_providers.SquareAPIMixin._square_transaction_processing_fee
+        )
+        records: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for payment in transaction_providers.SquareOnline.list_payments(
+            self.begin_time, self.end_time
+        ):
+            fee = processing_fee(payment)
+            if payment.terminal_checkout_id:
+                # A checkout's transaction has the checkout's status, and the
+                # fees of all its payments
+                record = records.setdefault(
+                    (
+                        transaction_providers.SquarePOS.name,
+                        payment.terminal_checkout_id,
+                    ),
+                    {"status": None, "fee": None, "data": None, "payment_ids": set()},
+                )
+                record["payment_ids"].add(payment.id)
+                if fee is not None:
+                    record["fee"] = (record["fee"] or 0) + fee
+            elif payment.id:
+                records[(transaction_providers.SquareOnline.name, payment.id)] = {
+                    "status": payment.status,
+                    "fee": fee,
+                    "data": payment,
+                }
+
+        for refund in transaction_providers.SquareRefund.list_refunds(
+            self.begin_time, self.end_time
+        ):
+            if refund.id:
+                records[(transaction_providers.SquareRefund.name, refund.id)] = {
+                    "status": refund.status,
+                    "fee": processing_fee(refund),
+                    "data": refund,
+                }
+        return records
+
+    @staticmethod
+    def checkout_fee(checkout_id: str, record: Dict[str, Any]) -> Optional[int]:
+        """The fee of a checkout's record, if the payments listed for it are
+        all of the checkout's payments.
+
+        Only the payments updated in the window are listed, so a split
+        tender checkout's record may have just some of its payments' fees.
+        """
+        try:
+            checkout = transaction_providers.SquarePOS.get_checkout(checkout_id)
+        except GQLException:
+            return None
+        if checkout is None or not record["payment_ids"].issuperset(
+            checkout.payment_ids or []
+        ):
+            return None
+        return record["fee"]
+
+    def reconcile_record(
+        self,
+        key: Tuple[str, str],
+        record: Dict[str, Any],
+        transaction: Optional["Transaction"],
+    ) -> Optional[Tuple["Transaction", Optional[int]]]:
+        """Reconcile a transaction with Square's record of it, recording any
+        mismatch and syncing the transaction's status if it differs
+
+        Returns:
+            tuple, optional: The transaction and the fee to update it with, if
+                its status matched
+        """
+        if transaction is None:
+            self.add_mismatch(
+                key[1],
+                None,
+                self.Mismatch.UNKNOWN,
+                f"Square {key[0]} record with status {record['status'] or 'unknown'}",
+            )
+            return None
+
+        status = (
+            transaction.Status.from_square_status(record["status"])
+            if record["status"]
+            else transaction.status
+        )
+        if status == transaction.status:
+            fee = record["fee"]
+            if "payment_ids" in record and fee not in (None, transaction.provider_fee):
+                fee = self.checkout_fee(key[1], record)
+            return transaction, fee
+
+        mismatch = self.add_mismatch(
+            key[1],
+            transaction,
+            self.Mismatch.STATUS,
+            f"{transaction.status} here, {status} on Square",
+        )
+        try:
+            transaction.sync_transaction_with_provider(record["data"])
+            self.updated_count += 1
+        except GQLException as exc:
+            mismatch["detail"] += f" (not synced: {exc.message})"
+        return None
+
+    def reconcile(self, batch_size: int = 500):
+        """Reconcile the transactions with Square's records"""
+        from uobtheatre.payments.models import Transaction
+
+        records = self.square_records()
+        keys = list(records)
+
+        fees: List[Tuple["Transaction", Optional[int]]] = []
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start : start + batch_size]
+            transactions = {
+                (transaction.provider_name, transaction.provider_transaction_id): (
+                    transaction
+                )
+                for transaction in Transaction.objects.filter(
+                    provider_name__in={provider_name for provider_name, _ in batch},
+                    provider_transaction_id__in=[
+                        provider_transaction_id for _, provider_transaction_id in batch
+                    ],
+                )
+            }
+
+            for key in batch:
+                self.checked_count += 1
+                if fee := self.reconcile_record(
+                    key, records[key], transactions.get(key)
+                ):
+                    fees.append(fee)
+
+        self.updated_count += Transaction.objects.update_provider_fees(fees)
+
+    def run(self):
+        """Run the reconciliation, recording its outcome"""
+        try:
+            self.reconcile()
+            self.status = self.Status.SUCCESS
+        except Exception as exc:  # pylint: disable=broad-except
+            if not isinstance(exc, GQLException):
+                capture_exception(exc)
+            self.status = self.Status.FAILURE
+            self.error = exc.message if isinstance(exc, GQLException) else str(exc)
+        self.save()
+
+    def __str__(self):
+        return f"Square reconciliation of {self.begin_time} to {self.end_time}"
+
+    class Meta:
+        ordering = ["-created_at"]
+
+
+# How long a cached device list is used before being refreshed
+SQUARE_DEVICE_LIST_TTL = timedelta(seconds=30)
+
+
+class SquareDeviceListQuerySet(QuerySet):
+    """Queryset for cached Square device lists"""
+
+    def get_for(
+        self,
+        product_type: Optional[str] = None,
+        status: Optional[str] = None,
+        location_id: Optional[str] = None,
+    ) -> "SquareDeviceList":
+        """The cached list of the devices with the given filters.
+
+        The list is fetched from Square the first time it is needed. After
+        that the cached list is returned straight away, and refreshed in the
+        background once it is stale.
+        """
+        device_list: SquareDeviceList
+        device_list, created = self.get_or_create(  # type: ignore[assignment]
+            product_type=product_type or "",
+            status=status or "",
+            location_id=location_id or "",
+        )
+        if created or device_list.fetched_at is None:
+            device_list.refresh()
+        elif device_list.is_stale:
+            device_list.request_refresh()
+        return device_list
+
+    def invalidate(self) -> int:
+        """Mark the lists as stale, so they are refreshed the next time they
+        are used"""
+        return self.update(invalidated=True)
+
+
+SquareDeviceListManager = models.Manager.from_queryset(SquareDeviceListQuerySet)
+
+
+class SquareDeviceList(models.Model):
+    """A cached list of the Square terminal devices matching some filters, so
+    box office screens don't each wait on Square to list them"""
+
+    objects = SquareDeviceListManager()
+
+    # The list's filters (blank when not filtered)
+    product_type = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=255, blank=True)
+    location_id = models.CharField(max_length=255, blank=True)
+
+    devices = models.JSONField(default=list, blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+    invalidated = models.BooleanField(default=False)
+    refresh_requested_at = models.DateTimeField(null=True, blank=True)
+
+    DEVICE_FIELDS = (
+        "id",
+        "name",
+        "code",
+        "device_id",
+        "location_id",
+        "product_type",
+        "status",
+    )
+
+    @property
+    def is_stale(self) -> bool:
+        """Whether the list may be out of date"""
+        return (
+            self.invalidated
+            or self.fetched_at is None
+            or self.fetched_at < timezone.now() - SQUARE_DEVICE_LIST_TTL
+        )
+
+    def refresh(self):
+        """Fetch the list from Square"""
+        devices = transaction_providers.SquarePOS.list_devices(
+            product_type=self.product_type or None,  # type: ignore[arg-type]
+            status=self.status or None,
+            location_id=self.location_id or None,
+        )
+        self.devices = [
+            {field: getattr(device, field) for field in self.DEVICE_FIELDS}
+            for device in devices
+        ]
+        self.fetched_at = timezone.now()
+        self.invalidated = False
+        self.refresh_requested_at = None
+        self.save()
+
+    def request_refresh(self):
+        """Refresh the list in the background, unless a refresh has recently
+        been requested"""
+        from uobtheatre.payments.tasks import refresh_square_device_list
+
+        now = timezone.now()
+        requested = (
+            SquareDeviceList.objects.filter(pk=self.pk)
+            .filter(
+                Q(refresh_requested_at__isnull=True)
+                | Q(refresh_requested_at__lt=now - SQUARE_DEVICE_LIST_TTL)
+            )
+            .update(refresh_requested_at=now)
+        )
+        if requested:
+            db_transaction.on_commit(lambda: refresh_square_device_list.delay(self.pk))
+
+    def __str__(self):
+        filters = ", ".join(
+            value
+            for value in (self.product_type, self.status, self.location_id)
+            if value
+        )
+        return f"Square devices ({filters or 'all'})"
+
+    class Meta:
+        unique_together = ("product_type", "status", "location_id")
@@ -3,6 +3,9 @@ import hmac
 import json
 
 from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from square.types.payment import Payment
@@ -10,9 +13,13 @@ from square.types.payment_refund import PaymentRefund
 
 from uobtheatre.bookings.models import Booking
 from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.square_models import SquareDeviceList, SquareWebhookEvent
+from uobtheatre.payments.tasks import process_square_webhook_events
 from uobtheatre.payments.transaction_providers import SquarePOS
 from uobtheatre.utils.utils import deep_get
 
+DEVICE_EVENT_TYPES = {"device.code.paired", "device.created"}
+
 
 class SquareWebhooks(APIView):
     """
@@ -75,23 +82,84 @@ class SquareWebhooks(APIView):
 
         return None
 
-    def post(self, request, **_):  # pylint: disable=too-many-return-statements
+    @classmethod
+    def get_provider_transaction_id(cls, request_data: dict) -> str | None:
+        """Returns the provider ID of the transaction a webhook is about, or
+        None if the webhook's type isn't handled"""
+        if request_data.get("type") == "terminal.checkout.updated":
+            return request_data["data"]["object"]["checkout"]["id"]
+        if request_data.get("type") == "payment.updated":
+            # A terminal checkout's payment updates its checkout's transaction
+            square_payment = request_data["data"]["object"]["payment"]
+            return square_payment.get("terminal_checkout_id") or square_payment["id"]
+        if request_data.get("type") == "refund.updated":
+            return request_data["data"]["id"]
+        return None
+
+    def post(self, request, **_):
         """
         Endpoint for square webhooks
+
+        The webhook is stored and applied in the background, so Square gets a
+        response quickly. Webhooks Square delivers more than once are only
+        stored once.
         """
         signature = request.META.get("HTTP_X_SQUARE_SIGNATURE", "")
         if not self.is_valid_callback(request.data, signature):
             return Response("Invalid signature", status=400)
 
         request_data = request.data
+        if request_data.get("type") in DEVICE_EVENT_TYPES:
+            # A device has been paired or unpaired
+            SquareDeviceList.objects.invalidate()
+            return Response(status=200)
+
+        provider_transaction_id = self.get_provider_transaction_id(request_data)
+        if not provider_transaction_id:
+            return Response(status=202)
+
+        event, created = SquareWebhookEvent.objects.get_or_create(
+            event_id=request_data["event_id"],
+            defaults={
+                "type": request_data["type"],
+                "provider_transaction_id": provider_transaction_id,
+                "event_created_at": parse_datetime(request_data.get("created_at", ""))
+                or timezone.now(),
+                "payload": request_data,
+            },
+        )
+        if created:
+            db_transaction.on_commit(
+                lambda: process_square_webhook_events.delay(
+                    event.provider_transaction_id
+                )
+            )
+
+        return Response(status=200)
+
+    @classmethod
+    def process_event(cls, event: SquareWebhookEvent) -> SquareWebhookEvent.Status:
+        """
+        Apply a stored webhook event to its transaction
+
+        Returns:
+            SquareWebhookEvent.Status: PROCESSED if the event was applied, or
+                IGNORED if it doesn't need to be
+
+        Raises:
+            Transaction.DoesNotExist: If the event is for this location but
+                its transaction doesn't exist (yet)
+        """
+        if event.is_superseded():
+            return SquareWebhookEvent.Status.IGNORED
+
+        request_data = event.payload
         try:
-            if request_data["type"] == "terminal.checkout.updated":
+            if event.type == "terminal.checkout.updated":
                 # This is a terminal checkout
                 try:
                     Transaction.objects.get(
-                        provider_transaction_id=request_data["data"]["object"][
-                            "checkout"
-                        ]["id"],
+                        provider_transaction_id=event.provider_transaction_id,
                         provider_name=SquarePOS.name,
                     ).sync_transaction_with_provider()
                 except Transaction.DoesNotExist as exc:
@@ -100,33 +168,34 @@ class SquareWebhooks(APIView):
                         == "CANCELED"
                     ):
                         # If we can't find the transaction, and square is telling us it has been cancelled, we don't mind
-                        return Response(status=201)
+                        return SquareWebhookEvent.Status.IGNORED
                     raise exc
 
-            elif request_data["type"] == "payment.updated":
+            elif event.type == "payment.updated":
                 # This is a payment update webhook
                 square_payment = request_data["data"]["object"]["payment"]
 
-                # First, check if this is a terminal checkout payment update. If it is, the data inside is for the payment not the checkout, so we don't use it
-                provider_id = square_payment.get("terminal_checkout_id")
-                data = None
-
-                if not provider_id:
-                    # Not a terminal checkout, therefore it is a standard payment
-                    provider_id = square_payment["id"]
-                    data = Payment(**square_payment)
-
-                Transaction.objects.get(
-                    provider_transaction_id=provider_id,
-                ).sync_transaction_with_provider(data)
-
-            elif request_data["type"] == "refund.updated":
+                transaction = Transaction.objects.get(
+                    provider_transaction_id=event.provider_transaction_id,
+                )
+                if square_payment.get("terminal_checkout_id"):
+                    # This is one of a terminal checkout's payments, so the
+                    # checkout is synced, reusing this payment's fee
+                    SquarePOS.sync_transaction(
+                        transaction, payments=[Payment(**square_payment)]
+                    )
+                else:
+                    transaction.sync_transaction_with_provider(
+                        Payment(**square_payment)
+                    )
+
+            elif event.type == "refund.updated":
                 # This is a refund webhook
                 square_refund = request_data["data"]["object"]["refund"]
                 refund_data = PaymentRefund(**square_refund)
 
                 transaction = Transaction.objects.get(
-                    provider_transaction_id=request_data["data"]["id"],
+                    provider_transaction_id=event.provider_transaction_id,
                     type=Transaction.Type.REFUND,
                 )
 
@@ -138,15 +207,14 @@ class SquareWebhooks(APIView):
                 booking.status = Booking.Status.REFUNDED
                 booking.save()
             else:
-                return Response(status=202)
-        except Transaction.DoesNotExist:
-            # Check for the correct location
+                return SquareWebhookEvent.Status.IGNORED
+        except Transaction.DoesNotExist as exc:
+            # Transactions taken at other locations aren't ours
             if (
-                not self.get_object_location_id(request_data["data"]["object"])
+                not cls.get_object_location_id(request_data["data"]["object"])
                 == settings.SQUARE_SETTINGS["SQUARE_LOCATION"]
             ):
-                return Response(status=203)
-
-            return Response("Unknown Transaction", status=404)
+                return SquareWebhookEvent.Status.IGNORED
+            raise exc
 
-        return Response(status=200)
+        return SquareWebhookEvent.Status.PROCESSED
@@ -1,13 +1,25 @@
 import abc
+from datetime import timedelta
 from typing import Union
 from uuid import UUID
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+from sentry_sdk import capture_exception
 
 from config.celery import app
 from uobtheatre.payments.exceptions import CantBeRefundedException
 from uobtheatre.utils.tasks import BaseTask
 
+# Pending webhook events older than this were never picked up by a worker
+SQUARE_WEBHOOK_EVENT_TIMEOUT = timedelta(minutes=15)
+
+# How far back each nightly reconciliation with Square looks
+SQUARE_RECONCILIATION_WINDOW = timedelta(days=2)
+
 
 class RefundTask(BaseTask, abc.ABC):
     """Base task for tasks that refund things"""
@@ -69,3 +81,158 @@ def refund_payable(
         preserve_provider_fees=preserve_provider_fees,
         preserve_app_fees=preserve_app_fees,
     )
+
+
+@app.task(base=BaseTask, ignore_result=True)
+def prune_task_results(batch_size: int = 1000) -> int:
+    """Delete the task results which are past their retention period, a batch
+    at a time. Results for refunds still being processed are kept.
+
+    Returns:
+        int: The number of results deleted
+    """
+    from django_celery_results.models import TaskResult
+
+    from uobtheatre.payments.models import AssociatedTask
+
+    now = timezone.now()
+    retention = dict(settings.TASK_RESULT_RETENTION)
+    default_retention = retention.pop("default")
+    expired_query = Q(date_done__lt=now - default_retention) & ~Q(
+        task_name__in=retention
+    )
+    for task_name, task_retention in retention.items():
+        expired_query |= Q(task_name=task_name, date_done__lt=now - task_retention)
+
+    expired = TaskResult.objects.filter(expired_query).exclude(
+        task_id__in=AssociatedTask.objects.open_refunds().values("task_id")
+    )
+    deleted = 0
+    while batch := list(expired.values_list("pk", "task_id")[:batch_size]):
+        pks, task_ids = zip(*batch)
+        AssociatedTask.objects.filter(task_id__in=task_ids).delete()
+        TaskResult.objects.filter(pk__in=pks).delete()
+        deleted += len(batch)
+
+    # Links to tasks whose results were ignored or never recorded
+    AssociatedTask.objects.filter(
+        created_at__lt=now - max([default_retention, *retention.values()])
+    ).exclude(pk__in=AssociatedTask.objects.open_refunds().values("pk")).delete()
+    return deleted
+
+
+# Square may send a webhook for a transaction before we've saved it, so
+# webhooks for unknown transactions are retried for a few minutes
+@app.task(
+    base=BaseTask,
+    bind=True,
+    ignore_result=True,
+    max_retries=5,
+    default_retry_delay=60,
+)
+def process_square_webhook_events(self, provider_transaction_id: str):
+    """Apply a transaction's pending Square webhook events, one at a time and
+    in the order Square sent them"""
+    from uobtheatre.payments.models import Transaction
+    from uobtheatre.payments.square_models import SquareWebhookEvent
+    from uobtheatre.payments.square_webhooks import SquareWebhooks
+
+    while True:
+        with db_transaction.atomic():
+            # Locking the next event stops other workers applying this
+            # transaction's events at the same time
+            event = (
+                SquareWebhookEvent.objects.select_for_update()
+                .pending()
+                .filter(provider_transaction_id=provider_transaction_id)
+                .in_order()
+                .first()
+            )
+            if event is None:
+                return
+
+            error = ""
+            try:
+                with db_transaction.atomic():
+                    status = SquareWebhooks.process_event(event)
+            except Transaction.DoesNotExist:
+                if self.request.retries < self.max_retries:
+                    # Leave the event, and those after it, pending
+                    break
+                status, error = SquareWebhookEvent.Status.FAILED, "Unknown Transaction"
+            except Exception as exc:  # pylint: disable=broad-except
+                capture_exception(exc)
+                status, error = SquareWebhookEvent.Status.FAILED, str(exc)
+            event.finish(status, error)
+
+    raise self.retry()
+
+
+@app.task(base=BaseTask, ignore_result=True)
+def resume_square_webhook_events():
+    """Apply Square webhook events which were never picked up, e.g. because
+    the broker was down when they were received"""
+    from uobtheatre.payments.square_models import SquareWebhookEvent
+
+    for provider_transaction_id in (
+        SquareWebhookEvent.objects.pending()
+        .filter(created_at__lt=timezone.now() - SQUARE_WEBHOOK_EVENT_TIMEOUT)
+        .order_by()
+        .values_list("provider_transaction_id", flat=True)
+        .distinct()
+    ):
+        process_square_webhook_events.delay(provider_transaction_id)
+
+
+@app.task(base=BaseTask, ignore_result=True)
+def sync_provider_fees() -> int:
+    """Sync the fees of recent completed transactions whose providers haven't
+    yet given us their fee, so reports can use them without waiting on the
+    providers
+
+    Returns:
+        int: The number of transactions whose fee changed
+    """
+    from uobtheatre.payments.models import Transaction
+    from uobtheatre.payments.transaction_providers import (
+        SquareAPIMixin,
+        TransactionProvider,
+    )
+
+    return (
+        Transaction.objects.filter(
+            status=Transaction.Status.COMPLETED,
+            created_at__gte=timezone.now()
+            - settings.PROVIDER_FEE_SYNC_SETTINGS["WINDOW"],
+            provider_name__in=[
+                provider.name
+                for provider in list(  # type: ignore[call-overload]
+                    TransactionProvider.__all__
+                )
+                if issubclass(provider, SquareAPIMixin)
+            ],
+        )
+        .missing_provider_fee()
+        .sync()
+    )
+
+
+@app.task(base=BaseTask, ignore_result=True)
+def reconcile_square_transactions():
+    """Reconcile our Square transactions with the payments and refunds Square
+    has updated recently. The windows of successive runs overlap, so nothing
+    is missed if a run fails."""
+    from uobtheatre.payments.square_models import SquareReconciliation
+
+    end_time = timezone.now()
+    SquareReconciliation.objects.create(
+        begin_time=end_time - SQUARE_RECONCILIATION_WINDOW, end_time=end_time
+    ).run()
+
+
+@app.task(base=BaseTask, ignore_result=True)
+def refresh_square_device_list(device_list_pk: int):
+    """Refresh a cached list of Square devices"""
+    from uobtheatre.payments.square_models import SquareDeviceList
+
+    SquareDeviceList.objects.get(pk=device_list_pk).refresh()
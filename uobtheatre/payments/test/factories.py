@@ -1,6 +1,7 @@
 from unittest.mock import MagicMock
 
 import factory
+from square.core.pagination import SyncPager
 
 from uobtheatre.bookings.test.factories import BookingFactory
 from uobtheatre.payments import transaction_providers
@@ -67,3 +68,12 @@ def mock_refund_method(name="refund_method"):
             return name
 
     return MockRefundMethod()
+
+
+def square_pages(items, page_size=2):
+    """A fake Square list response, which pages through the items"""
+    return SyncPager(
+        has_next=len(items) > page_size,
+        items=items[:page_size],
+        get_next=lambda: square_pages(items[page_size:], page_size),
+    )
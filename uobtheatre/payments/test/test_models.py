@@ -3,13 +3,20 @@ from unittest.mock import MagicMock, PropertyMock, patch
 
 import pytest
 from pytest_django.asserts import assertQuerysetEqual
+from square.core.api_error import ApiError
 from square.types.get_payment_response import GetPaymentResponse
 
+from uobtheatre.bookings.test.factories import BookingFactory
+from uobtheatre.finance.models import SalesLedgerEntry
 from uobtheatre.payments.exceptions import (
     CantBeCanceledException,
     CantBeRefundedException,
 )
-from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.models import (
+    AssociatedTask,
+    SalesBreakdown,
+    Transaction,
+)
 from uobtheatre.payments.tasks import refund_payment
 from uobtheatre.payments.test.factories import (
     TransactionFactory,
@@ -22,7 +29,7 @@ from uobtheatre.payments.transaction_providers import (
     SquarePOS,
     SquareRefund,
 )
-from uobtheatre.utils.exceptions import PaymentException
+from uobtheatre.utils.exceptions import PaymentException, SquareException
 from uobtheatre.utils.test.factories import TaskResultFactory
 
 
@@ -69,6 +76,27 @@ def test_transaction_type_filters():
     assertQuerysetEqual(Transaction.objects.refunds(), [refund_1])
 
 
+@pytest.mark.django_db
+def test_transaction_qs_sales_breakdown():
+    TransactionFactory(type=Transaction.Type.PAYMENT, value=1000)
+    TransactionFactory(type=Transaction.Type.REFUND, value=-300)
+    TransactionFactory(
+        type=Transaction.Type.REFUND, value=-200, provider_name=Cash.name
+    )
+
+    assert (
+        Transaction.objects.get_sales_breakdown(SalesBreakdown.Enums.TOTAL_REFUNDS)
+        == -500
+    )
+    assert (
+        Transaction.objects.none().get_sales_breakdown(
+            SalesBreakdown.Enums.TOTAL_REFUNDS
+        )
+        == 0
+    )
+    assert SalesBreakdown(Transaction.objects.all()).total_card_refunds == -300
+
+
 @pytest.mark.django_db
 def test_update_payment_from_square(mock_square):
     payment = TransactionFactory(provider_fee=0, provider_transaction_id="abc")
@@ -197,16 +225,68 @@ def test_cant_be_refunded_when_not_completed(status):
 
 @pytest.mark.django_db
 def test_transaction_qs_sync():
-    transactions = [TransactionFactory() for _ in range(3)]
-    with patch(
-        "uobtheatre.payments.models.Transaction.sync_transaction_with_provider",
-        autospec=True,
-    ) as mock_sync:
-        Transaction.objects.sync()
+    booking = BookingFactory()
+    unchanged = TransactionFactory(pay_object=booking, provider_fee=5)
+    changed = TransactionFactory(
+        pay_object=booking, provider_fee=None, status=Transaction.Status.PENDING
+    )
+    no_fee = TransactionFactory(pay_object=booking, provider_fee=None)
+    failing = TransactionFactory(pay_object=booking, provider_fee=None)
+    fees = {unchanged.pk: 5, changed.pk: 12, no_fee.pk: None}
+
+    def get_provider_fee(transaction):
+        if transaction.pk == failing.pk:
+            raise SquareException(ApiError(status_code=400, body="Bad request"))
+        return fees[transaction.pk]
+
+    with patch.object(
+        SquareOnline, "get_provider_fee", side_effect=get_provider_fee
+    ) as fee_mock:
+        assert Transaction.objects.sync() == 1
+
+    assert fee_mock.call_count == 4
+    changed.refresh_from_db()
+    assert changed.provider_fee == 12
+    # Only the fee is synced
+    assert changed.status == Transaction.Status.PENDING
+    assert Transaction.objects.get(pk=no_fee.pk).provider_fee is None
+    assert Transaction.objects.get(pk=failing.pk).provider_fee is None
+    # The fee is recorded in the ledger, despite the bulk update
+    assert SalesLedgerEntry.objects.discrepancies() == []
+
 
-    assert mock_sync.call_count == 3
-    for transaction in transactions:
-        mock_sync.assert_any_call(transaction)
+@pytest.mark.django_db
+def test_transaction_qs_sync_reports_unexpected_errors():
+    transaction = TransactionFactory(provider_fee=None)
+    error = ValueError("Unexpected")
+
+    with patch.object(SquareOnline, "get_provider_fee", side_effect=error), patch(
+        "uobtheatre.payments.models.capture_exception"
+    ) as capture_mock:
+        assert Transaction.objects.sync() == 0
+
+    capture_mock.assert_called_once_with(error)
+    transaction.refresh_from_db()
+    assert transaction.provider_fee is None
+
+
+@pytest.mark.django_db
+def test_transaction_qs_sync_leaves_retries_to_the_client():
+    transaction = TransactionFactory(provider_fee=None)
+
+    with patch.object(
+        SquareOnline,
+        "get_provider_fee",
+        side_effect=[
+            SquareException(ApiError(status_code=503, body="Unavailable")),
+            10,
+        ],
+    ) as fee_mock:
+        assert Transaction.objects.sync() == 0
+
+    fee_mock.assert_called_once()
+    transaction.refresh_from_db()
+    assert transaction.provider_fee is None
 
 
 @pytest.mark.django_db
@@ -279,11 +359,18 @@ def test_cant_be_refunded_if_provider_not_refundable():
 @pytest.mark.django_db
 def test_async_refund():
     transaction = TransactionFactory(id=45)
-    with patch.object(refund_payment, "delay") as delay_mock:
+    with patch.object(refund_payment, "apply_async") as apply_async_mock:
         transaction.async_refund()
-        delay_mock.assert_called_once_with(
-            45, preserve_provider_fees=True, preserve_app_fees=False
-        )
+
+    link = AssociatedTask.objects.get()
+    apply_async_mock.assert_called_once_with(
+        (45,),
+        {"preserve_provider_fees": True, "preserve_app_fees": False},
+        task_id=link.task_id,
+    )
+    assert not transaction.qs.associated_tasks().exists()
+    related_task = TaskResultFactory(task_id=link.task_id)
+    assert list(transaction.qs.associated_tasks()) == [related_task]
 
 
 @pytest.mark.django_db
@@ -557,18 +644,36 @@ def test_payment_associated_tasks():
     # A related task
     related_task = TaskResultFactory(
         task_name="uobtheatre.payments.tasks.refund_payment",
-        task_args=f'"({transaction.id},)"',
+    )
+    AssociatedTask.objects.create(
+        content_type=transaction.content_type,
+        object_id=transaction.id,
+        task_id=related_task.task_id,
     )
 
     # Unrelated, different transaction
-    TaskResultFactory(
+    other_task = TaskResultFactory(
         task_name="uobtheatre.payments.tasks.refund_payment",
-        task_args=f'"({other_transaction.id},)"',
+    )
+    AssociatedTask.objects.create(
+        content_type=other_transaction.content_type,
+        object_id=other_transaction.id,
+        task_id=other_task.task_id,
     )
 
-    # Unrelated, different task type
+    # Unrelated, different object type with the same ID
+    booking_task = TaskResultFactory(
+        task_name="uobtheatre.payments.tasks.refund_payable",
+    )
+    AssociatedTask.objects.create(
+        content_type=BookingFactory().content_type,
+        object_id=transaction.id,
+        task_id=booking_task.task_id,
+    )
+
+    # Not linked
     TaskResultFactory(
-        task_name="uobtheatre.payments.tasks.refund_production",
+        task_name="uobtheatre.payments.tasks.refund_payment",
         task_args=f'"({transaction.id},)"',
     )
 
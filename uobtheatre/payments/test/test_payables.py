@@ -9,7 +9,7 @@ from uobtheatre.payments.exceptions import (
     CantBePaidForException,
     CantBeRefundedException,
 )
-from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.models import AssociatedTask, SalesBreakdown, Transaction
 from uobtheatre.payments.payables import Payable
 from uobtheatre.payments.tasks import refund_payable
 from uobtheatre.payments.test.factories import TransactionFactory, mock_payment_method
@@ -20,6 +20,7 @@ from uobtheatre.payments.transaction_providers import (
     SquarePOS,
 )
 from uobtheatre.users.test.factories import UserFactory
+from uobtheatre.utils.filters import filter_passes_on_model
 from uobtheatre.utils.test.factories import TaskResultFactory
 
 
@@ -186,6 +187,97 @@ def test_is_locked(has_pending_transaction):
     assert booking.is_locked == has_pending_transaction
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize("prefetch", [False, True])
+@pytest.mark.parametrize("status", Payable.Status.values)
+@pytest.mark.parametrize(
+    "transactions",
+    [
+        [],
+        [(100, Transaction.Status.COMPLETED)],
+        [(100, Transaction.Status.PENDING)],
+        [(100, Transaction.Status.COMPLETED), (-100, Transaction.Status.COMPLETED)],
+        [(100, Transaction.Status.COMPLETED), (-100, Transaction.Status.PENDING)],
+        [(100, Transaction.Status.COMPLETED), (-50, Transaction.Status.COMPLETED)],
+        [(50, Transaction.Status.FAILED), (50, Transaction.Status.COMPLETED)],
+        [(0, Transaction.Status.COMPLETED), (0, Transaction.Status.COMPLETED)],
+        [(0, Transaction.Status.COMPLETED)],
+    ],
+)
+def test_payable_predicates_match_queryset(transactions, status, prefetch):
+    [TransactionFactory() for _ in range(3)]
+    booking = BookingFactory(status=status)
+    for value, transaction_status in transactions:
+        TransactionFactory(pay_object=booking, value=value, status=transaction_status)
+
+    if prefetch:
+        booking = Booking.objects.prefetch_related("transactions").get(pk=booking.pk)
+
+    is_locked = filter_passes_on_model(booking, lambda qs: qs.locked())
+    is_refunded = not is_locked and filter_passes_on_model(
+        booking, lambda qs: qs.refunded()
+    )
+
+    assert booking.is_locked == is_locked
+    assert booking.is_refunded == is_refunded
+
+
+@pytest.mark.django_db
+def test_payable_predicates_use_prefetched_transactions(django_assert_num_queries):
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=100)
+    TransactionFactory(pay_object=booking, value=-100)
+    booking = Booking.objects.prefetch_related("transactions").get(pk=booking.pk)
+
+    with django_assert_num_queries(0):
+        assert booking.is_locked is False
+        assert booking.is_refunded is True
+
+
+@pytest.mark.django_db
+def test_payable_sales_breakdowns_single_query(django_assert_num_queries):
+    booking_1 = BookingFactory()
+    TransactionFactory(pay_object=booking_1, value=300)
+    TransactionFactory(pay_object=booking_1, value=-100, type=Transaction.Type.REFUND)
+    booking_2 = BookingFactory()
+    TransactionFactory(pay_object=booking_2, value=200, provider_name=Cash.name)
+    booking_3 = BookingFactory()
+
+    with django_assert_num_queries(1):
+        breakdowns = Booking.objects.filter(
+            pk__in=[booking_1.pk, booking_2.pk, booking_3.pk]
+        ).sales_breakdowns(
+            [
+                SalesBreakdown.Enums.TOTAL_PAYMENTS,
+                SalesBreakdown.Enums.TOTAL_REFUNDS,
+                SalesBreakdown.Enums.NET_CARD_TRANSACTIONS,
+            ]
+        )
+        values = {
+            pk: (
+                breakdown.total_payments,
+                breakdown.total_refunds,
+                breakdown.net_card_transactions,
+            )
+            for pk, breakdown in breakdowns.items()
+        }
+
+    assert values == {
+        booking_1.pk: (300, -100, 200),
+        booking_2.pk: (200, 0, 0),
+        booking_3.pk: (0, 0, 0),
+    }
+
+
+@pytest.mark.django_db
+def test_payable_predicates_without_prefetch(django_assert_num_queries):
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=100)
+
+    with django_assert_num_queries(1):
+        assert booking.is_refunded is False
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "status,num_payments,is_refunded,is_locked,error_message",
@@ -267,13 +359,18 @@ def test_validate_cant_be_refunded(
 )
 def test_async_refund(preserve_provider_fees, preserve_app_fees):
     booking = BookingFactory(id=45)
-    with patch.object(refund_payable, "delay") as mock:
+    with patch.object(refund_payable, "apply_async") as mock:
         booking.async_refund(
             UserFactory(id=3), preserve_provider_fees, preserve_app_fees
         )
-        mock.assert_called_once_with(
-            45, booking.content_type.pk, 3, preserve_provider_fees, preserve_app_fees
-        )
+
+    link = AssociatedTask.objects.get()
+    assert (link.content_type, link.object_id) == (booking.content_type, 45)
+    mock.assert_called_once_with(
+        (45, booking.content_type.pk, 3, preserve_provider_fees, preserve_app_fees),
+        {},
+        task_id=link.task_id,
+    )
 
 
 @pytest.mark.django_db
@@ -365,31 +462,27 @@ def test_payable_associated_tasks():
     other_payable = BookingFactory()
     transaction = TransactionFactory(type=Transaction.Type.PAYMENT, pay_object=payable)
 
-    # A related task for the payments
-    related_payment_task = TaskResultFactory(
-        task_name="uobtheatre.payments.tasks.refund_payment",
-        task_args=f'"({transaction.id},)"',
-    )
+    def linked_task(obj, content_type=None):
+        task = TaskResultFactory()
+        AssociatedTask.objects.create(
+            content_type=content_type or obj.content_type,
+            object_id=obj.id,
+            task_id=task.task_id,
+        )
+        return task
 
+    # A related task for the payments
+    related_payment_task = linked_task(transaction)
     # A related task for the booking
-    related_task = TaskResultFactory(
-        task_name="uobtheatre.payments.tasks.refund_payable",
-        task_args=f'"({payable.id}, {payable.content_type.id}, abc)"',
-    )
+    related_task = linked_task(payable)
 
     # Task for different booking
-    TaskResultFactory(
-        task_name="uobtheatre.payments.tasks.refund_payable",
-        task_args=f'"({other_payable.id}, {payable.content_type.id}, abc)"',
-    )
+    linked_task(other_payable)
     # Task for different contenttype
+    linked_task(payable, content_type=payable.performance.content_type)
+    # Unlinked task
     TaskResultFactory(
         task_name="uobtheatre.payments.tasks.refund_payable",
-        task_args=f'"({payable.id}, {payable.content_type.id + 1}, abc)"',
-    )
-    # Differnt tasks
-    TaskResultFactory(
-        task_name="uobtheatre.payments.tasks.refund_performance",
         task_args=f'"({payable.id}, {payable.content_type.id}, abc)"',
     )
 
@@ -548,3 +641,5 @@ def test_payable_total(misc_cost_value, subtotal, expected_total):
 
     payable = MockPayable()
     assert payable.total == expected_total
+    # Payables aren't published to any live topics by default
+    assert not payable.live_topics
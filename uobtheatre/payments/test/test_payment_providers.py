@@ -1,4 +1,5 @@
 # pylint: disable=too-many-lines
+import threading
 from unittest.mock import PropertyMock, patch
 
 import pytest
@@ -394,6 +395,42 @@ def test_square_online_sync_payment(mock_square):
     assert payment.status == Transaction.Status.COMPLETED
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "square_payment,expected_fee",
+    [
+        (
+            {
+                "id": "abc",
+                "status": "COMPLETED",
+                "processing_fee": [
+                    {"amount_money": {"amount": -10, "currency": "GBP"}}
+                ],
+            },
+            -10,
+        ),
+        ({"id": "abc", "status": "COMPLETED"}, None),
+        (None, None),
+    ],
+)
+def test_square_online_get_provider_fee(mock_square, square_payment, expected_fee):
+    payment = TransactionFactory(
+        value=100, provider_fee=None, status=Transaction.Status.PENDING
+    )
+
+    with mock_square(
+        SquareOnline.client.payments,
+        "get",
+        GetPaymentResponse(payment=square_payment),
+    ):
+        assert SquareOnline.get_provider_fee(payment) == expected_fee
+
+    # The payment isn't updated
+    payment.refresh_from_db()
+    assert payment.provider_fee is None
+    assert payment.status == Transaction.Status.PENDING
+
+
 @pytest.mark.django_db
 def test_square_online_sync_payment_no_status(mock_square):
     payment = TransactionFactory(
@@ -786,6 +823,45 @@ def test_square_pos_sync_payment(
     assert payment.pay_object.status == expected_booking_status
 
 
+@pytest.mark.django_db
+def test_square_pos_get_provider_fee():
+    payment = TransactionFactory(
+        provider_fee=None,
+        status=Transaction.Status.PENDING,
+        provider_name=SquarePOS.name,
+        provider_transaction_id="abc",
+    )
+
+    with patch.object(
+        SquarePOS,
+        "get_checkout",
+        return_value=TerminalCheckout(
+            id="abc",
+            status="COMPLETED",
+            payment_ids=["abc123", "def123"],
+            amount_money=Money(amount=100, currency="GBP"),
+            device_options=DeviceCheckoutOptions(device_id="abc"),
+        ),
+    ) as get_checkout_mock, patch.object(
+        SquarePOS,
+        "get_payment",
+        return_value=Payment(
+            status="COMPLETED",
+            processing_fee=[{"amount_money": {"amount": -10, "currency": "GBP"}}],
+        ),
+    ):
+        assert SquarePOS.get_provider_fee(payment) == -20
+
+    get_checkout_mock.assert_called_once_with("abc")
+    payment.refresh_from_db()
+    assert payment.status == Transaction.Status.PENDING
+
+
+@pytest.mark.django_db
+def test_manual_payment_get_provider_fee():
+    assert Cash.get_provider_fee(TransactionFactory(provider_name=Cash.name)) is None
+
+
 @pytest.mark.django_db
 def test_square_pos_sync_multiple_payment_ids():
     payment = TransactionFactory(
@@ -837,6 +913,83 @@ def test_square_pos_sync_multiple_payment_ids():
     assert payment.pay_object.status == Payable.Status.PAID
 
 
+@pytest.mark.django_db
+def test_square_pos_sync_fetches_payments_concurrently(settings):
+    settings.SQUARE_CLIENT_SETTINGS = {
+        **settings.SQUARE_CLIENT_SETTINGS,
+        "CONCURRENT_FETCHES": 4,
+    }
+    payment = TransactionFactory(
+        pay_object=BookingFactory(status=Payable.Status.IN_PROGRESS),
+        provider_fee=None,
+        status=Transaction.Status.PENDING,
+        provider_name=SquarePOS.name,
+        provider_transaction_id="abc",
+    )
+    checkout = TerminalCheckout(
+        id="abc",
+        status="IN_PROGRESS",
+        payment_ids=["a", "b", "c", "d"],
+        amount_money=Money(amount=100, currency="GBP"),
+        device_options=DeviceCheckoutOptions(device_id="abc"),
+    )
+
+    # Each fetch waits for all four to have started, so a sequential sync
+    # would break the barrier
+    barrier = threading.Barrier(4, timeout=5)
+
+    def get_payment(payment_id):
+        barrier.wait()
+        return Payment(
+            id=payment_id,
+            processing_fee=[{"amount_money": {"amount": -10, "currency": "GBP"}}],
+        )
+
+    with patch.object(SquarePOS, "get_payment", side_effect=get_payment):
+        payment.sync_transaction_with_provider(checkout)
+
+    payment.refresh_from_db()
+    assert payment.provider_fee == -40
+
+
+@pytest.mark.django_db
+def test_square_pos_sync_reuses_known_payments():
+    payment = TransactionFactory(
+        pay_object=BookingFactory(status=Payable.Status.IN_PROGRESS),
+        provider_fee=None,
+        status=Transaction.Status.PENDING,
+        provider_name=SquarePOS.name,
+        provider_transaction_id="abc",
+    )
+    checkout = TerminalCheckout(
+        id="abc",
+        status="COMPLETED",
+        payment_ids=["abc123", "def123", "ghi123"],
+        amount_money=Money(amount=100, currency="GBP"),
+        device_options=DeviceCheckoutOptions(device_id="abc"),
+    )
+    fee = [{"amount_money": {"amount": -10, "currency": "GBP"}}]
+
+    with patch.object(SquarePOS, "get_checkout", return_value=checkout), patch.object(
+        SquarePOS, "get_payment", return_value=Payment(processing_fee=fee)
+    ) as get_payment_mock:
+        SquarePOS.sync_transaction(
+            payment,
+            payments=[
+                Payment(id="abc123", processing_fee=fee),
+                # Without its fee, the payment is fetched again
+                Payment(id="def123"),
+            ],
+        )
+
+    assert [call.args for call in get_payment_mock.call_args_list] == [
+        ("def123",),
+        ("ghi123",),
+    ]
+    payment.refresh_from_db()
+    assert payment.provider_fee == -30
+
+
 @pytest.mark.django_db
 def test_square_pos_sync_no_payments():
     payment = TransactionFactory(
@@ -397,6 +397,43 @@ def test_square_refund_sync_payment(mock_square, with_data):
     assert payment.status == Transaction.Status.COMPLETED
 
 
+@pytest.mark.django_db
+def test_square_refund_get_provider_fee(mock_square):
+    payment = TransactionFactory(
+        value=-100,
+        provider_fee=None,
+        provider_name=SquareRefund.name,
+        status=Transaction.Status.PENDING,
+    )
+    mock_response = RefundPaymentResponse(
+        refund=PaymentRefund(
+            id="abc",
+            status="COMPLETED",
+            amount_money={"amount": -100, "currency": "GBP"},
+            processing_fee=[
+                ProcessingFee(amount_money={"amount": -7, "currency": "GBP"})
+            ],
+        )
+    )
+
+    with mock_square(SquareRefund.client.refunds, "get", mock_response):
+        assert SquareRefund.get_provider_fee(payment) == -7
+
+    payment.refresh_from_db()
+    assert payment.provider_fee is None
+
+
+@pytest.mark.django_db
+def test_square_refund_get_provider_fee_api_error(mock_square):
+    payment = TransactionFactory(
+        value=-100, provider_fee=None, provider_name=SquareRefund.name
+    )
+
+    with mock_square(SquareRefund.client.refunds, "get", throw_default_exception=True):
+        with pytest.raises(SquareException):
+            SquareRefund.get_provider_fee(payment)
+
+
 @pytest.mark.django_db
 def test_square_refund_sync_payment_api_error(mock_square):
     payment = TransactionFactory(
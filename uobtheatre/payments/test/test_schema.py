@@ -1,3 +1,5 @@
+from unittest.mock import patch
+
 import pytest
 from graphql_relay.node.node import to_global_id
 from guardian.shortcuts import assign_perm
@@ -5,6 +7,8 @@ from square.core.pagination import SyncPager
 from square.types.device_code import DeviceCode
 
 from uobtheatre.bookings.test.factories import BookingFactory
+from uobtheatre.payments.square_models import SquareDeviceList
+from uobtheatre.payments.tasks import refresh_square_device_list
 from uobtheatre.payments.test.factories import TransactionFactory
 from uobtheatre.payments.transaction_providers import SquarePOS
 from uobtheatre.productions.test.factories import PerformanceFactory
@@ -180,6 +184,70 @@ def test_list_devices(gql_client, mock_square):
     }
 
 
+@pytest.mark.django_db
+def test_list_devices_is_cached(
+    gql_client, mock_square, django_capture_on_commit_callbacks
+):
+    PerformanceFactory()
+    gql_client.login()
+    assign_perm("productions.boxoffice", gql_client.user)
+    query = """
+        query {
+          paymentDevices {
+            id
+            stale
+          }
+        }
+    """
+
+    def square_devices(*device_ids):
+        return SyncPager(
+            has_next=False,
+            items=[DeviceCode(id=device_id) for device_id in device_ids],
+            get_next=None,
+        )
+
+    with mock_square(
+        SquarePOS.client.devices.codes, "list", square_devices("a")
+    ) as list_devices_mock:
+        assert gql_client.execute(query) == {
+            "data": {"paymentDevices": [{"id": "a", "stale": False}]}
+        }
+        assert gql_client.execute(query) == {
+            "data": {"paymentDevices": [{"id": "a", "stale": False}]}
+        }
+    list_devices_mock.assert_called_once()
+
+    # Once stale, the cached devices are returned and refreshed in the
+    # background, once
+    SquareDeviceList.objects.invalidate()
+    with mock_square(
+        SquarePOS.client.devices.codes, "list", square_devices("a", "b")
+    ) as list_devices_mock, patch.object(
+        refresh_square_device_list,
+        "delay",
+        side_effect=lambda pk: refresh_square_device_list.apply((pk,)),
+    ) as delay_mock:
+        with django_capture_on_commit_callbacks() as callbacks:
+            for _ in range(2):
+                assert gql_client.execute(query) == {
+                    "data": {"paymentDevices": [{"id": "a", "stale": True}]}
+                }
+        for callback in callbacks:
+            callback()
+
+        delay_mock.assert_called_once()
+        assert gql_client.execute(query) == {
+            "data": {
+                "paymentDevices": [
+                    {"id": "a", "stale": False},
+                    {"id": "b", "stale": False},
+                ]
+            }
+        }
+    list_devices_mock.assert_called_once()
+
+
 @pytest.mark.django_db
 def test_list_devices_without_boxoffice_permissions(gql_client, mock_square):
     """
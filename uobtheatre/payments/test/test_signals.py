@@ -41,3 +41,29 @@ def test_payment_model_signals(mailoutbox):
     assert booking.status == Payable.Status.REFUNDED
     assert booking.is_locked is False
     assert booking.is_refunded is True
+
+
+@pytest.mark.django_db
+def test_payment_signal_with_stale_prefetched_transactions():
+    booking = BookingFactory(status=Payable.Status.REFUND_PROCESSING)
+    TransactionFactory(value=200, pay_object=booking)
+    TransactionFactory(
+        value=-200,
+        pay_object=booking,
+        type=Transaction.Type.REFUND,
+        status=Transaction.Status.PENDING,
+    )
+
+    # Prefetch while the refund is still pending, then complete it
+    booking = booking.qs.prefetch_related("transactions").get()
+    refund_payment = next(
+        transaction
+        for transaction in booking.transactions.all()
+        if transaction.type == Transaction.Type.REFUND
+    )
+    refund_payment.pay_object = booking
+    refund_payment.status = Transaction.Status.COMPLETED
+    refund_payment.save()
+
+    booking.refresh_from_db()
+    assert booking.status == Payable.Status.REFUNDED
@@ -0,0 +1,167 @@
+from unittest.mock import patch
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+from square.core.api_error import ApiError
+
+from uobtheatre.payments.square_client import (
+    SquareTransport,
+    create_client,
+    endpoint_name,
+)
+from uobtheatre.utils.concurrency import CircuitBreaker
+
+PAYMENT_RESPONSE = {"payment": {"id": "abc", "status": "COMPLETED"}}
+
+
+@pytest.fixture(name="square_client")
+def square_client_fixture(settings):
+    """A Square client whose requests are handled by the given function"""
+    settings.SQUARE_CLIENT_SETTINGS = {
+        **settings.SQUARE_CLIENT_SETTINGS,
+        "ATTEMPTS": 3,
+        "CIRCUIT_FAILURE_THRESHOLD": 2,
+    }
+
+    def create(handler):
+        return create_client(transport=httpx.MockTransport(handler), token="token")
+
+    with patch("uobtheatre.utils.concurrency.time.sleep"):
+        yield create
+
+
+def responses(*responses_to_send):
+    """A request handler which sends the responses in turn, and records the
+    requests"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        status, body = responses_to_send[len(requests) - 1]
+        return httpx.Response(status, json=body)
+
+    handler.requests = requests  # type: ignore[attr-defined]
+    return handler
+
+
+@pytest.mark.parametrize(
+    "path,endpoint",
+    [
+        ("/v2/payments", "/v2/payments"),
+        ("/v2/payments/KkAkhdMsgzn59SM8A89WgKwekxLZY", "/v2/payments/{id}"),
+        (
+            "/v2/terminals/checkouts/dhgENdnFOPXqO/cancel",
+            "/v2/terminals/checkouts/{id}/cancel",
+        ),
+    ],
+)
+def test_endpoint_name(path, endpoint):
+    assert endpoint_name(path) == endpoint
+
+
+def test_client_uses_pooled_transport():
+    client = create_client(token="token")
+
+    transport = (
+        client._client_wrapper.httpx_client.httpx_client._transport  # pylint: disable=protected-access
+    )
+    assert isinstance(transport, SquareTransport)
+    assert isinstance(transport.transport, httpx.HTTPTransport)
+
+
+def test_client_retries_idempotent_requests(square_client):
+    handler = responses((503, {}), (429, {}), (200, PAYMENT_RESPONSE))
+
+    payment = square_client(handler).payments.get("abc").payment
+
+    assert payment.id == "abc"
+    assert len(handler.requests) == 3
+
+
+def test_client_retries_requests_with_idempotency_keys(square_client):
+    handler = responses((500, {}), (200, PAYMENT_RESPONSE))
+
+    square_client(handler).payments.create(
+        source_id="cnon:card-nonce-ok",
+        idempotency_key="key",
+        amount_money={"amount": 100, "currency": "GBP"},
+    )
+
+    # The repeated request has the same idempotency key
+    assert len(handler.requests) == 2
+    assert handler.requests[0].content == handler.requests[1].content
+
+
+def test_client_doesnt_retry_other_requests(square_client):
+    handler = responses((500, {}), (200, {}))
+
+    with pytest.raises(ApiError) as exc:
+        square_client(handler).terminal.checkouts.cancel("abc")
+
+    assert exc.value.status_code == 500
+    assert len(handler.requests) == 1
+
+
+def test_client_doesnt_retry_rejected_requests(square_client):
+    handler = responses((404, {"errors": [{"code": "NOT_FOUND"}]}))
+
+    with pytest.raises(ApiError) as exc:
+        square_client(handler).payments.get("abc")
+
+    assert exc.value.status_code == 404
+    assert len(handler.requests) == 1
+
+
+def test_client_circuit_breaker(square_client):
+    handler = responses(*[(503, {})] * 6)
+    client = square_client(handler)
+
+    for _ in range(2):
+        with pytest.raises(ApiError):
+            client.payments.get("abc")
+    assert len(handler.requests) == 6
+
+    # The breaker is open, so the call fails without a request
+    with pytest.raises(ApiError) as exc:
+        client.payments.get("abc")
+    assert exc.value.status_code == 503
+    assert exc.value.errors[0].code == "SERVICE_UNAVAILABLE"
+    assert len(handler.requests) == 6
+
+
+def test_client_records_latency(square_client):
+    handler = responses((200, PAYMENT_RESPONSE))
+
+    square_client(handler).payments.get("latency-test")
+
+    assert REGISTRY.get_sample_value(
+        "square_request_duration_seconds_count",
+        {"method": "GET", "endpoint": "/v2/payments/{id}", "outcome": "200"},
+    )
+
+
+def test_client_retries_transport_errors(square_client):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        raise httpx.ConnectError("Connection refused", request=request)
+
+    with pytest.raises(httpx.ConnectError):
+        square_client(handler).payments.get("transport-error-test")
+
+    assert len(requests) == 3
+    assert REGISTRY.get_sample_value(
+        "square_request_duration_seconds_count",
+        {"method": "GET", "endpoint": "/v2/payments/{id}", "outcome": "error"},
+    )
+
+
+def test_transport_close_closes_pool():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200))
+
+    with patch.object(transport, "close") as mock_close:
+        SquareTransport(transport, CircuitBreaker(1, 1), attempts=1, backoff=0).close()
+
+    mock_close.assert_called_once_with()
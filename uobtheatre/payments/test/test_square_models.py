@@ -0,0 +1,491 @@
+import datetime
+from unittest.mock import patch
+
+import httpx
+import pytest
+from django.utils import timezone
+from square.core.api_error import ApiError
+from square.types.device_code import DeviceCode
+from square.types.payment import Payment
+from square.types.payment_refund import PaymentRefund
+from square.types.terminal_checkout import TerminalCheckout
+
+from uobtheatre.bookings.test.factories import BookingFactory
+from uobtheatre.finance.models import SalesLedgerEntry
+from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.square_client import create_client
+from uobtheatre.payments.square_models import SquareDeviceList, SquareReconciliation
+from uobtheatre.payments.test.factories import TransactionFactory, square_pages
+from uobtheatre.payments.transaction_providers import (
+    SquareAPIMixin,
+    SquareOnline,
+    SquarePOS,
+    SquareRefund,
+)
+from uobtheatre.utils.exceptions import PaymentException, SquareException
+
+
+def square_fee(amount):
+    return [{"amount_money": {"amount": amount, "currency": "GBP"}}]
+
+
+@pytest.mark.django_db
+def test_square_reconciliation(mock_square):
+    booking = BookingFactory()
+    missing_fee = TransactionFactory(
+        pay_object=booking, provider_transaction_id="online-1", provider_fee=None
+    )
+    pending = TransactionFactory(
+        pay_object=booking,
+        provider_transaction_id="online-2",
+        provider_fee=None,
+        status=Transaction.Status.PENDING,
+    )
+    checkout = TransactionFactory(
+        pay_object=booking,
+        provider_name=SquarePOS.name,
+        provider_transaction_id="checkout-1",
+        provider_fee=None,
+    )
+    refund = TransactionFactory(
+        pay_object=booking,
+        type=Transaction.Type.REFUND,
+        provider_name=SquareRefund.name,
+        provider_transaction_id="refund-1",
+        value=-100,
+        provider_fee=None,
+    )
+    unchanged = TransactionFactory(
+        pay_object=booking, provider_transaction_id="online-3", provider_fee=3
+    )
+    split_checkout = TransactionFactory(
+        pay_object=booking,
+        provider_name=SquarePOS.name,
+        provider_transaction_id="checkout-2",
+        provider_fee=None,
+    )
+
+    payments = [
+        Payment(id="online-1", status="COMPLETED", processing_fee=square_fee(10)),
+        Payment(id="online-2", status="COMPLETED", processing_fee=square_fee(12)),
+        Payment(
+            id="pos-1",
+            status="COMPLETED",
+            terminal_checkout_id="checkout-1",
+            processing_fee=square_fee(5),
+        ),
+        Payment(
+            id="pos-2",
+            status="COMPLETED",
+            terminal_checkout_id="checkout-1",
+            processing_fee=square_fee(3),
+        ),
+        Payment(id="online-3", status="COMPLETED", processing_fee=square_fee(3)),
+        # A payment whose fee Square hasn't worked out yet
+        Payment(id="pos-5", status="COMPLETED", terminal_checkout_id="checkout-1"),
+        # Only one of the split tender checkout's payments was updated
+        Payment(
+            id="pos-3",
+            status="COMPLETED",
+            terminal_checkout_id="checkout-2",
+            processing_fee=square_fee(4),
+        ),
+        Payment(id="elsewhere", status="COMPLETED"),
+        # Records without IDs are ignored
+        Payment(status="COMPLETED"),
+    ]
+
+    end_time = timezone.now()
+    reconciliation = SquareReconciliation.objects.create(
+        begin_time=end_time - datetime.timedelta(days=2), end_time=end_time
+    )
+    with mock_square(
+        SquareOnline.client.payments, "list", square_pages(payments)
+    ) as list_payments_mock, mock_square(
+        SquareRefund.client.refunds,
+        "list",
+        square_pages(
+            [
+                PaymentRefund(
+                    id="refund-1",
+                    status="COMPLETED",
+                    amount_money={"amount": 100, "currency": "GBP"},
+                    processing_fee=square_fee(-2),
+                ),
+                PaymentRefund(
+                    id="",
+                    status="COMPLETED",
+                    amount_money={"amount": 100, "currency": "GBP"},
+                ),
+            ]
+        ),
+    ), patch.object(
+        SquarePOS,
+        "get_checkout",
+        side_effect=lambda checkout_id: TerminalCheckout(
+            id=checkout_id,
+            amount_money={"amount": 100, "currency": "GBP"},
+            device_options={"device_id": "abc"},
+            payment_ids={
+                "checkout-1": ["pos-1", "pos-2", "pos-5"],
+                "checkout-2": ["pos-3", "pos-4"],
+            }[checkout_id],
+        ),
+    ):
+        reconciliation.run()
+
+    assert list_payments_mock.call_args.kwargs["location_id"] == "LMHPTEST"
+    reconciliation.refresh_from_db()
+    assert str(reconciliation) == (
+        f"Square reconciliation of {reconciliation.begin_time} to {end_time}"
+    )
+    assert reconciliation.status == SquareReconciliation.Status.SUCCESS
+    assert reconciliation.checked_count == 7
+    assert reconciliation.updated_count == 4
+
+    for transaction, fee, status in [
+        (missing_fee, 10, Transaction.Status.COMPLETED),
+        (pending, 12, Transaction.Status.COMPLETED),
+        (checkout, 8, Transaction.Status.COMPLETED),
+        (refund, -2, Transaction.Status.COMPLETED),
+        (unchanged, 3, Transaction.Status.COMPLETED),
+        # The fee of the payment listed isn't the whole checkout's fee
+        (split_checkout, None, Transaction.Status.COMPLETED),
+    ]:
+        transaction.refresh_from_db()
+        assert (transaction.provider_fee, transaction.status) == (fee, status)
+    assert SalesLedgerEntry.objects.discrepancies() == []
+
+    assert reconciliation.mismatches == [
+        {
+            "provider_transaction_id": "online-2",
+            "transaction": pending.pk,
+            "mismatch": "STATUS",
+            "detail": "PENDING here, COMPLETED on Square",
+        },
+        {
+            "provider_transaction_id": "elsewhere",
+            "transaction": None,
+            "mismatch": "UNKNOWN",
+            "detail": "Square SQUARE_ONLINE record with status COMPLETED",
+        },
+    ]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "get_checkout",
+    [
+        {"return_value": None},
+        {"side_effect": SquareException(ApiError(status_code=500, body={}))},
+    ],
+)
+def test_square_reconciliation_checkout_not_fetched(mock_square, get_checkout):
+    checkout = TransactionFactory(
+        provider_name=SquarePOS.name,
+        provider_transaction_id="checkout-1",
+        provider_fee=None,
+    )
+    payments = [
+        Payment(
+            id="pos-1",
+            status="COMPLETED",
+            terminal_checkout_id="checkout-1",
+            processing_fee=square_fee(5),
+        )
+    ]
+
+    end_time = timezone.now()
+    reconciliation = SquareReconciliation.objects.create(
+        begin_time=end_time - datetime.timedelta(days=2), end_time=end_time
+    )
+    with mock_square(
+        SquareOnline.client.payments, "list", square_pages(payments)
+    ), mock_square(SquareRefund.client.refunds, "list", square_pages([])), patch.object(
+        SquarePOS, "get_checkout", **get_checkout
+    ):
+        reconciliation.run()
+
+    assert reconciliation.status == SquareReconciliation.Status.SUCCESS
+    checkout.refresh_from_db()
+    assert checkout.provider_fee is None
+
+
+@pytest.mark.django_db
+def test_square_reconciliation_status_not_synced(mock_square):
+    pending = TransactionFactory(
+        provider_transaction_id="online-1", status=Transaction.Status.PENDING
+    )
+
+    end_time = timezone.now()
+    reconciliation = SquareReconciliation.objects.create(
+        begin_time=end_time - datetime.timedelta(days=2), end_time=end_time
+    )
+    with mock_square(
+        SquareOnline.client.payments,
+        "list",
+        square_pages([Payment(id="online-1", status="COMPLETED")]),
+    ), mock_square(SquareRefund.client.refunds, "list", square_pages([])), patch.object(
+        Transaction,
+        "sync_transaction_with_provider",
+        side_effect=PaymentException("Sync failed"),
+    ):
+        reconciliation.run()
+
+    assert reconciliation.updated_count == 0
+    assert reconciliation.mismatches == [
+        {
+            "provider_transaction_id": "online-1",
+            "transaction": pending.pk,
+            "mismatch": "STATUS",
+            "detail": "PENDING here, COMPLETED on Square (not synced: Sync failed)",
+        }
+    ]
+
+
+def fake_square(begin_time, end_time):
+    """A request handler which serves Square's list payments and refunds
+    endpoints a page at a time, and its get checkout endpoint, checking the
+    requests are for the location and time window"""
+    pages = {
+        "/v2/payments": [
+            {
+                "payments": [
+                    {
+                        "id": "online-1",
+                        "status": "COMPLETED",
+                        "processing_fee": square_fee(10),
+                    },
+                    {
+                        "id": "pos-1",
+                        "status": "COMPLETED",
+                        "terminal_checkout_id": "checkout-1",
+                        "processing_fee": square_fee(5),
+                    },
+                ],
+                "cursor": "payments-2",
+            },
+            {
+                "payments": [
+                    {
+                        "id": "pos-2",
+                        "status": "COMPLETED",
+                        "terminal_checkout_id": "checkout-1",
+                        "processing_fee": square_fee(3),
+                    }
+                ]
+            },
+        ],
+        "/v2/refunds": [
+            {
+                "refunds": [
+                    {
+                        "id": "refund-1",
+                        "status": "COMPLETED",
+                        "amount_money": {"amount": 100, "currency": "GBP"},
+                        "processing_fee": square_fee(-2),
+                    }
+                ]
+            }
+        ],
+    }
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.url.path == "/v2/terminals/checkouts/checkout-1":
+            return httpx.Response(
+                200,
+                json={
+                    "checkout": {
+                        "id": "checkout-1",
+                        "status": "COMPLETED",
+                        "amount_money": {"amount": 1000, "currency": "GBP"},
+                        "device_options": {"device_id": "device-1"},
+                        "payment_ids": ["pos-1", "pos-2"],
+                    }
+                },
+            )
+
+        params = request.url.params
+        assert params["location_id"] == "LMHPTEST"
+        assert params["updated_at_begin_time"] == begin_time.isoformat()
+        assert params["updated_at_end_time"] == end_time.isoformat()
+        cursor = params.get("cursor")
+        page = 0 if cursor is None else int(cursor.rsplit("-", 1)[1]) - 1
+        return httpx.Response(200, json=pages[request.url.path][page])
+
+    handler.requests = requests  # type: ignore[attr-defined]
+    return handler
+
+
+@pytest.mark.django_db
+def test_square_reconciliation_with_fake_square():
+    booking = BookingFactory()
+    online = TransactionFactory(
+        pay_object=booking, provider_transaction_id="online-1", provider_fee=None
+    )
+    checkout = TransactionFactory(
+        pay_object=booking,
+        provider_name=SquarePOS.name,
+        provider_transaction_id="checkout-1",
+        provider_fee=None,
+    )
+    refund = TransactionFactory(
+        pay_object=booking,
+        type=Transaction.Type.REFUND,
+        provider_name=SquareRefund.name,
+        provider_transaction_id="refund-1",
+        value=-100,
+        provider_fee=None,
+    )
+
+    end_time = timezone.now()
+    begin_time = end_time - datetime.timedelta(days=2)
+    reconciliation = SquareReconciliation.objects.create(
+        begin_time=begin_time, end_time=end_time
+    )
+    handler = fake_square(begin_time, end_time)
+    with patch.object(
+        SquareAPIMixin,
+        "client",
+        create_client(transport=httpx.MockTransport(handler), **SquareAPIMixin.kwargs),
+    ):
+        reconciliation.run()
+
+    assert reconciliation.status == SquareReconciliation.Status.SUCCESS
+    assert not reconciliation.mismatches
+    assert reconciliation.checked_count == 3
+    assert reconciliation.updated_count == 3
+    for transaction, fee in [(online, 10), (checkout, 8), (refund, -2)]:
+        transaction.refresh_from_db()
+        assert transaction.provider_fee == fee
+    assert [
+        (request.url.path, request.url.params.get("cursor"))
+        for request in handler.requests
+    ] == [
+        ("/v2/payments", None),
+        ("/v2/payments", "payments-2"),
+        ("/v2/refunds", None),
+        ("/v2/terminals/checkouts/checkout-1", None),
+    ]
+
+
+@pytest.mark.django_db
+def test_square_reconciliation_unexpected_failure():
+    end_time = timezone.now()
+    reconciliation = SquareReconciliation.objects.create(
+        begin_time=end_time - datetime.timedelta(days=2), end_time=end_time
+    )
+
+    with patch.object(
+        SquareReconciliation, "square_records", side_effect=ValueError("Oops")
+    ), patch("uobtheatre.payments.square_models.capture_exception") as capture_mock:
+        reconciliation.run()
+
+    capture_mock.assert_called_once()
+    reconciliation.refresh_from_db()
+    assert reconciliation.status == SquareReconciliation.Status.FAILURE
+    assert reconciliation.error == "Oops"
+
+
+@pytest.mark.django_db
+def test_square_reconciliation_refunds_failure(mock_square):
+    end_time = timezone.now()
+    reconciliation = SquareReconciliation.objects.create(
+        begin_time=end_time - datetime.timedelta(days=2), end_time=end_time
+    )
+
+    with mock_square(
+        SquareOnline.client.payments, "list", square_pages([])
+    ), mock_square(SquareRefund.client.refunds, "list", throw_default_exception=True):
+        reconciliation.run()
+
+    assert reconciliation.status == SquareReconciliation.Status.FAILURE
+    assert (
+        reconciliation.error == "There was an issue processing your payment (MY_CODE)"
+    )
+
+
+@pytest.mark.django_db
+def test_square_reconciliation_failure(mock_square):
+    end_time = timezone.now()
+    reconciliation = SquareReconciliation.objects.create(
+        begin_time=end_time - datetime.timedelta(days=2), end_time=end_time
+    )
+
+    with mock_square(
+        SquareOnline.client.payments, "list", throw_default_exception=True
+    ):
+        reconciliation.run()
+
+    reconciliation.refresh_from_db()
+    assert reconciliation.status == SquareReconciliation.Status.FAILURE
+    assert (
+        reconciliation.error == "There was an issue processing your payment (MY_CODE)"
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "fetched_seconds_ago, invalidated, is_stale",
+    [(5, False, False), (5, True, True), (31, False, True)],
+)
+def test_square_device_list_is_stale(fetched_seconds_ago, invalidated, is_stale):
+    device_list = SquareDeviceList(
+        fetched_at=timezone.now() - datetime.timedelta(seconds=fetched_seconds_ago),
+        invalidated=invalidated,
+    )
+
+    assert device_list.is_stale == is_stale
+    assert SquareDeviceList().is_stale
+
+
+@pytest.mark.django_db
+def test_square_device_list_refresh():
+    device_list = SquareDeviceList.objects.create(
+        product_type="TERMINAL_API",
+        invalidated=True,
+        refresh_requested_at=timezone.now(),
+    )
+    device = DeviceCode(id="abc", product_type="TERMINAL_API", status="PAIRED")
+
+    with patch.object(SquarePOS, "list_devices", return_value=[device]) as list_mock:
+        device_list.refresh()
+
+    list_mock.assert_called_once_with(
+        product_type="TERMINAL_API", status=None, location_id=None
+    )
+    device_list.refresh_from_db()
+    assert device_list.devices[0]["id"] == "abc"
+    assert device_list.devices[0]["status"] == "PAIRED"
+    assert device_list.fetched_at is not None
+    assert not device_list.invalidated
+    assert device_list.refresh_requested_at is None
+
+
+@pytest.mark.django_db
+def test_square_device_list_request_refresh_once(django_capture_on_commit_callbacks):
+    device_list = SquareDeviceList.objects.create(fetched_at=timezone.now())
+
+    with patch(
+        "uobtheatre.payments.tasks.refresh_square_device_list.delay"
+    ) as delay_mock, django_capture_on_commit_callbacks(execute=True):
+        device_list.request_refresh()
+        device_list.request_refresh()
+
+    delay_mock.assert_called_once_with(device_list.pk)
+
+
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        ({}, "Square devices (all)"),
+        (
+            {"product_type": "TERMINAL_API", "location_id": "LMHPTEST"},
+            "Square devices (TERMINAL_API, LMHPTEST)",
+        ),
+    ],
+)
+def test_square_device_list_str(filters, expected):
+    assert str(SquareDeviceList(**filters)) == expected
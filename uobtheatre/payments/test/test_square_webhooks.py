@@ -1,12 +1,20 @@
+import datetime
 from copy import deepcopy
 from unittest.mock import patch
 
 import pytest
+from django.utils import timezone
+from square.types.payment import Payment
 
 from uobtheatre.bookings.test.factories import BookingFactory
 from uobtheatre.payments.models import Transaction
 from uobtheatre.payments.payables import Payable
+from uobtheatre.payments.square_models import SquareDeviceList, SquareWebhookEvent
 from uobtheatre.payments.square_webhooks import SquareWebhooks
+from uobtheatre.payments.tasks import (
+    process_square_webhook_events,
+    resume_square_webhook_events,
+)
 from uobtheatre.payments.test.factories import TransactionFactory
 from uobtheatre.payments.transaction_providers import SquarePOS, SquareRefund
 
@@ -156,46 +164,68 @@ def test_get_object_location_id(object_data, expected_location):
     assert SquareWebhooks.get_object_location_id(object_data) == expected_location
 
 
+@pytest.fixture(name="post_webhook")
+def post_webhook_fixture(rest_client, django_capture_on_commit_callbacks):
+    """Post a webhook with a valid signature, and apply it as the worker would"""
+
+    def post(payload):
+        with patch.object(
+            SquareWebhooks, "is_valid_callback", return_value=True
+        ), patch.object(
+            process_square_webhook_events,
+            "delay",
+            side_effect=lambda *args: process_square_webhook_events.apply(args),
+        ), django_capture_on_commit_callbacks(
+            execute=True
+        ):
+            return rest_client.post(
+                "/square",
+                payload,
+                HTTP_X_SQUARE_SIGNATURE="signature",
+                format="json",
+            )
+
+    return post
+
+
 @pytest.mark.django_db
-def test_handle_checkout_webhook(rest_client):
+def test_handle_checkout_webhook(post_webhook):
     transaction = TransactionFactory(
         provider_transaction_id="dhgENdnFOPXqO", provider_name=SquarePOS.name
     )
 
     BookingFactory(reference="id72709", status=Payable.Status.IN_PROGRESS)
 
-    with patch.object(
-        SquareWebhooks, "is_valid_callback", return_value=True
-    ), patch.object(SquarePOS, "sync_transaction", autospec=True) as sync_mock:
-        response = rest_client.post(
-            "/square",
-            TEST_TERMINAL_CHECKOUT_PAYLOAD,
-            HTTP_X_SQUARE_SIGNATURE="xoa9/2fAXamuULrlhV1HP7C4ai4=",
-            format="json",
-        )
+    with patch.object(SquarePOS, "sync_transaction", autospec=True) as sync_mock:
+        response = post_webhook(TEST_TERMINAL_CHECKOUT_PAYLOAD)
 
     assert response.status_code == 200
     sync_mock.assert_called_once_with(transaction, None)
+    event = SquareWebhookEvent.objects.get()
+    assert event.event_id == TEST_TERMINAL_CHECKOUT_PAYLOAD["event_id"]
+    assert event.provider_transaction_id == "dhgENdnFOPXqO"
+    assert event.status == SquareWebhookEvent.Status.PROCESSED
+    assert event.processed_at is not None
 
 
 @pytest.mark.django_db
 @pytest.mark.parametrize(
-    "status,expected_code", [("COMPLETED", 404), ("CANCELED", 201)]
+    "status,expected_status",
+    [
+        ("COMPLETED", SquareWebhookEvent.Status.FAILED),
+        ("CANCELED", SquareWebhookEvent.Status.IGNORED),
+    ],
 )
 def test_handle_checkout_webhook_with_unknown_transaction(
-    status, expected_code, rest_client
+    status, expected_status, post_webhook
 ):
     payload = deepcopy(TEST_TERMINAL_CHECKOUT_PAYLOAD)
     payload["data"]["object"]["checkout"]["status"] = status
 
-    with patch.object(SquareWebhooks, "is_valid_callback", return_value=True):
-        response = rest_client.post(
-            "/square",
-            payload,
-            HTTP_X_SQUARE_SIGNATURE="signature",
-            format="json",
-        )
-    assert response.status_code == expected_code
+    response = post_webhook(payload)
+
+    assert response.status_code == 200
+    assert SquareWebhookEvent.objects.get().status == expected_status
 
 
 @pytest.mark.django_db
@@ -209,31 +239,57 @@ def test_handle_webhooks_invalid_signature(rest_client):
     )
     assert response.status_code == 400
     assert response.data == "Invalid signature"
+    assert not SquareWebhookEvent.objects.exists()
 
     booking.refresh_from_db()
     assert booking.status == Payable.Status.IN_PROGRESS
 
 
 @pytest.mark.django_db
-def test_handle_payment_update_webhook_no_processing_fee(rest_client):
+def test_handle_webhook_is_stored_and_enqueued(
+    rest_client, django_capture_on_commit_callbacks
+):
+    with patch.object(
+        SquareWebhooks, "is_valid_callback", return_value=True
+    ), patch.object(
+        process_square_webhook_events, "delay"
+    ) as delay_mock, django_capture_on_commit_callbacks(
+        execute=True
+    ):
+        responses = [
+            rest_client.post(
+                "/square",
+                TEST_PAYMENT_UPDATE_PAYLOAD,
+                HTTP_X_SQUARE_SIGNATURE="signature",
+                format="json",
+            )
+            for _ in range(2)
+        ]
+
+    # The duplicate delivery is acknowledged, but only stored and applied once
+    assert [response.status_code for response in responses] == [200, 200]
+    delay_mock.assert_called_once_with("hYy9pRFVxpDsO1FB05SunFWUe9JZY")
+    event = SquareWebhookEvent.objects.get()
+    assert event.type == "payment.updated"
+    assert event.status == SquareWebhookEvent.Status.PENDING
+    assert event.payload == TEST_PAYMENT_UPDATE_PAYLOAD
+    assert event.event_created_at.isoformat() == "2021-10-03T11:18:16.523273+00:00"
+
+
+@pytest.mark.django_db
+def test_handle_payment_update_webhook_no_processing_fee(post_webhook):
     payment = TransactionFactory(
         provider_transaction_id="hYy9pRFVxpDsO1FB05SunFWUe9JZY", provider_fee=None
     )
 
-    with patch.object(SquareWebhooks, "is_valid_callback", return_value=True):
-        response = rest_client.post(
-            "/square",
-            TEST_PAYMENT_UPDATE_PAYLOAD,
-            HTTP_X_SQUARE_SIGNATURE="IoIb9bsLtyTbTcr+l2Ic039gOuo=",
-            format="json",
-        )
+    response = post_webhook(TEST_PAYMENT_UPDATE_PAYLOAD)
 
     assert response.status_code == 200
     assert payment.provider_fee is None
 
 
 @pytest.mark.django_db
-def test_handle_payment_update_webhook(rest_client):
+def test_handle_payment_update_webhook(post_webhook):
     payment = TransactionFactory(
         provider_transaction_id="hYy9pRFVxpDsO1FB05SunFWUe9JZY", provider_fee=0
     )
@@ -252,21 +308,18 @@ def test_handle_payment_update_webhook(rest_client):
         },
     ]
 
-    with patch.object(SquareWebhooks, "is_valid_callback", return_value=True):
-        response = rest_client.post(
-            "/square",
-            payload,
-            HTTP_X_SQUARE_SIGNATURE="signature",
-            format="json",
-        )
+    response = post_webhook(payload)
 
     payment.refresh_from_db()
     assert response.status_code == 200
     assert payment.provider_fee == 70
+    assert (
+        SquareWebhookEvent.objects.get().status == SquareWebhookEvent.Status.PROCESSED
+    )
 
 
 @pytest.mark.django_db
-def test_handle_payment_update_checkout_webhook(rest_client):
+def test_handle_payment_update_checkout_webhook(post_webhook):
     payment = TransactionFactory(
         provider_transaction_id="dhgENdnFOPXqO",
         provider_fee=0,
@@ -276,36 +329,51 @@ def test_handle_payment_update_checkout_webhook(rest_client):
     payload = deepcopy(TEST_PAYMENT_UPDATE_PAYLOAD)
     payload["data"]["object"]["payment"]["terminal_checkout_id"] = "dhgENdnFOPXqO"
 
-    with patch.object(
-        SquareWebhooks, "is_valid_callback", return_value=True
-    ), patch.object(SquarePOS, "sync_transaction", autospec=True) as sync_mock:
-        rest_client.post(
-            "/square",
-            payload,
-            HTTP_X_SQUARE_SIGNATURE="signature",
-            format="json",
-        )
+    with patch.object(SquarePOS, "sync_transaction", autospec=True) as sync_mock:
+        post_webhook(payload)
 
-    sync_mock.assert_called_once_with(payment, None)
+    sync_mock.assert_called_once_with(
+        payment, payments=[Payment(**payload["data"]["object"]["payment"])]
+    )
 
 
 @pytest.mark.django_db
-def test_square_webhook_unknown_type(rest_client):
-    with patch.object(SquareWebhooks, "is_valid_callback", return_value=True):
-        response = rest_client.post(
-            "/square",
-            {
-                "type": "unknown.type",
-            },
-            HTTP_X_SQUARE_SIGNATURE="signature",
-            format="json",
-        )
+def test_square_webhook_unknown_type(post_webhook):
+    response = post_webhook({"type": "unknown.type"})
 
     assert response.status_code == 202
+    assert not SquareWebhookEvent.objects.exists()
+
+
+@pytest.mark.django_db
+def test_process_event_of_unknown_type():
+    event = SquareWebhookEvent.objects.create(
+        event_id="unknown",
+        type="unknown.type",
+        provider_transaction_id="abc",
+        event_created_at=timezone.now(),
+        payload={"type": "unknown.type"},
+    )
+
+    assert SquareWebhooks.process_event(event) == SquareWebhookEvent.Status.IGNORED
 
 
 @pytest.mark.django_db
-def test_handle_refund_update_webhook(rest_client):
+@pytest.mark.parametrize("event_type", ["device.code.paired", "device.created"])
+def test_device_webhook_invalidates_device_lists(post_webhook, event_type):
+    device_list = SquareDeviceList.objects.create(fetched_at=timezone.now())
+
+    response = post_webhook({"type": event_type})
+
+    assert response.status_code == 200
+    device_list.refresh_from_db()
+    assert device_list.invalidated
+    assert device_list.is_stale
+    assert not SquareWebhookEvent.objects.exists()
+
+
+@pytest.mark.django_db
+def test_handle_refund_update_webhook(post_webhook):
     booking = BookingFactory()
     payment = TransactionFactory(
         pay_object=booking,
@@ -315,13 +383,7 @@ def test_handle_refund_update_webhook(rest_client):
         provider_name=SquareRefund.name,
     )
 
-    with patch.object(SquareWebhooks, "is_valid_callback", return_value=True):
-        response = rest_client.post(
-            "/square",
-            TEST_UPDATE_REFUND_PAYLOAD,
-            HTTP_X_SQUARE_SIGNATURE="signature",
-            format="json",
-        )
+    response = post_webhook(TEST_UPDATE_REFUND_PAYLOAD)
 
     payment.refresh_from_db()
     assert response.status_code == 200
@@ -332,27 +394,106 @@ def test_handle_refund_update_webhook(rest_client):
 
 
 @pytest.mark.django_db
-def test_handle_valid_but_unknown_transaction(rest_client):
-    with patch.object(SquareWebhooks, "is_valid_callback", return_value=True):
-        response = rest_client.post(
-            "/square",
-            TEST_PAYMENT_UPDATE_PAYLOAD,
-            HTTP_X_SQUARE_SIGNATURE="signature",
-            format="json",
-        )
-    assert response.status_code == 404
+def test_handle_valid_but_unknown_transaction(post_webhook):
+    with patch.object(
+        process_square_webhook_events,
+        "retry",
+        wraps=process_square_webhook_events.retry,
+    ) as retry_mock:
+        response = post_webhook(TEST_PAYMENT_UPDATE_PAYLOAD)
+
+    assert response.status_code == 200
+    # The transaction may not have been saved yet, so the event is retried
+    # before it is failed
+    assert retry_mock.call_count == process_square_webhook_events.max_retries
+    event = SquareWebhookEvent.objects.get()
+    assert event.status == SquareWebhookEvent.Status.FAILED
+    assert event.error == "Unknown Transaction"
 
 
 @pytest.mark.django_db
-def test_handle_valid_but_unknown_transaction_other_location(rest_client):
+def test_handle_valid_but_unknown_transaction_other_location(post_webhook):
     payload = deepcopy(TEST_PAYMENT_UPDATE_PAYLOAD)
     payload["data"]["object"]["payment"]["location_id"] = "LMHPTESTUNKNOWN"
 
-    with patch.object(SquareWebhooks, "is_valid_callback", return_value=True):
-        response = rest_client.post(
-            "/square",
-            payload,
-            HTTP_X_SQUARE_SIGNATURE="signature",
-            format="json",
-        )
-    assert response.status_code == 203
+    response = post_webhook(payload)
+
+    assert response.status_code == 200
+    assert SquareWebhookEvent.objects.get().status == SquareWebhookEvent.Status.IGNORED
+
+
+def _event(event_id, created_at, fee):
+    """A stored payment.updated webhook event with the given processing fee"""
+    payload = deepcopy(TEST_PAYMENT_UPDATE_PAYLOAD)
+    payload["event_id"] = event_id
+    payload["data"]["object"]["payment"]["processing_fee"] = [
+        {"type": "INITIAL", "amount_money": {"amount": fee, "currency": "GBP"}}
+    ]
+    return SquareWebhookEvent.objects.create(
+        event_id=event_id,
+        type="payment.updated",
+        provider_transaction_id="hYy9pRFVxpDsO1FB05SunFWUe9JZY",
+        event_created_at=created_at,
+        payload=payload,
+    )
+
+
+@pytest.mark.django_db
+def test_process_square_webhook_events_in_order():
+    payment = TransactionFactory(
+        provider_transaction_id="hYy9pRFVxpDsO1FB05SunFWUe9JZY", provider_fee=0
+    )
+    later = _event("later", "2021-10-03T11:20:00Z", 20)
+    earlier = _event("earlier", "2021-10-03T11:10:00Z", 10)
+
+    process_square_webhook_events.apply(("hYy9pRFVxpDsO1FB05SunFWUe9JZY",))
+
+    payment.refresh_from_db()
+    assert payment.provider_fee == 20
+    earlier.refresh_from_db()
+    later.refresh_from_db()
+    assert earlier.processed_at < later.processed_at
+    assert {earlier.status, later.status} == {SquareWebhookEvent.Status.PROCESSED}
+
+    # An older event delivered late doesn't overwrite the newer data
+    late = _event("late", "2021-10-03T11:15:00Z", 15)
+    process_square_webhook_events.apply(("hYy9pRFVxpDsO1FB05SunFWUe9JZY",))
+
+    payment.refresh_from_db()
+    assert payment.provider_fee == 20
+    late.refresh_from_db()
+    assert late.status == SquareWebhookEvent.Status.IGNORED
+
+
+@pytest.mark.django_db
+def test_process_square_webhook_events_failure():
+    TransactionFactory(provider_transaction_id="hYy9pRFVxpDsO1FB05SunFWUe9JZY")
+    failing = _event("failing", "2021-10-03T11:10:00Z", 10)
+    following = _event("following", "2021-10-03T11:20:00Z", 20)
+
+    with patch.object(
+        SquareWebhooks,
+        "process_event",
+        side_effect=[ValueError("Broken"), SquareWebhookEvent.Status.PROCESSED],
+    ):
+        process_square_webhook_events.apply(("hYy9pRFVxpDsO1FB05SunFWUe9JZY",))
+
+    failing.refresh_from_db()
+    following.refresh_from_db()
+    assert failing.status == SquareWebhookEvent.Status.FAILED
+    assert failing.error == "Broken"
+    assert following.status == SquareWebhookEvent.Status.PROCESSED
+
+
+@pytest.mark.django_db
+def test_resume_square_webhook_events():
+    stale = _event("stale", "2021-10-03T11:10:00Z", 10)
+    SquareWebhookEvent.objects.filter(pk=stale.pk).update(
+        created_at=timezone.now() - datetime.timedelta(hours=1)
+    )
+    _event("recent", "2021-10-03T11:20:00Z", 20)
+
+    with patch.object(process_square_webhook_events, "delay") as delay_mock:
+        resume_square_webhook_events()
+
+    delay_mock.assert_called_once_with("hYy9pRFVxpDsO1FB05SunFWUe9JZY")
@@ -1,15 +1,30 @@
 import re
+from datetime import timedelta
 from unittest.mock import patch
 
 import pytest
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from django_celery_results.models import TaskResult
 
 from uobtheatre.bookings.test.factories import BookingFactory
 from uobtheatre.payments.exceptions import CantBeRefundedException
-from uobtheatre.payments.tasks import RefundTask, refund_payable, refund_payment
+from uobtheatre.payments.models import AssociatedTask, Transaction
+from uobtheatre.payments.payables import Payable
+from uobtheatre.payments.square_models import SquareReconciliation
+from uobtheatre.payments.tasks import (
+    RefundTask,
+    prune_task_results,
+    reconcile_square_transactions,
+    refund_payable,
+    refund_payment,
+    sync_provider_fees,
+)
 from uobtheatre.payments.test.factories import TransactionFactory
+from uobtheatre.payments.transaction_providers import Cash, SquareOnline
 from uobtheatre.productions.test.factories import ProductionFactory
 from uobtheatre.users.test.factories import UserFactory
+from uobtheatre.utils.test.factories import TaskResultFactory
 
 
 @pytest.mark.parametrize(
@@ -98,3 +113,79 @@ def test_refund_payable_task_invalid_content_type():
         ),
     ):
         refund_payable(1, content_type.pk, auth_user.pk)
+
+
+@pytest.mark.django_db
+def test_prune_task_results(settings):
+    settings.TASK_RESULT_RETENTION = {
+        "default": timedelta(days=7),
+        "uobtheatre.payments.tasks.refund_payment": timedelta(days=30),
+    }
+    refunding_booking = BookingFactory(status=Payable.Status.REFUND_PROCESSING)
+    refunding_payment = TransactionFactory(pay_object=refunding_booking)
+    refunded_payment = TransactionFactory(
+        pay_object=BookingFactory(status=Payable.Status.REFUNDED)
+    )
+
+    def task_result(days_old, task_name="uobtheatre.mail.tasks.send_emails", obj=None):
+        result = TaskResultFactory(task_name=task_name)
+        TaskResult.objects.filter(pk=result.pk).update(
+            date_done=timezone.now() - timedelta(days=days_old)
+        )
+        if obj:
+            AssociatedTask.objects.create(
+                content_type=obj.content_type, object_id=obj.pk, task_id=result.task_id
+            )
+        return result
+
+    kept = [
+        task_result(1),
+        task_result(10, "uobtheatre.payments.tasks.refund_payment", refunded_payment),
+        # Open refunds are kept however old they are
+        task_result(50, "uobtheatre.payments.tasks.refund_payment", refunding_payment),
+        task_result(50, "uobtheatre.payments.tasks.refund_payable", refunding_booking),
+    ]
+    task_result(10)
+    task_result(10, None)
+    task_result(50, "uobtheatre.payments.tasks.refund_payment", refunded_payment)
+    task_result(10, "uobtheatre.payments.tasks.refund_payable", refunded_payment)
+
+    assert prune_task_results(batch_size=2) == 4
+
+    assert set(TaskResult.objects.all()) == set(kept)
+    assert set(AssociatedTask.objects.values_list("task_id", flat=True)) == {
+        result.task_id for result in kept[1:]
+    }
+
+
+@pytest.mark.django_db
+def test_sync_provider_fees():
+    missing = TransactionFactory(provider_fee=None)
+    TransactionFactory(provider_fee=None, status=Transaction.Status.PENDING)
+    TransactionFactory(provider_fee=None, provider_name=Cash.name)
+    TransactionFactory(provider_fee=5)
+    # Transactions from before the window aren't fetched again
+    old = TransactionFactory(provider_fee=None)
+    Transaction.objects.filter(pk=old.pk).update(
+        created_at=timezone.now() - timedelta(days=8)
+    )
+
+    with patch.object(
+        SquareOnline, "get_provider_fee", return_value=12
+    ) as get_provider_fee_mock:
+        assert sync_provider_fees() == 1
+
+    get_provider_fee_mock.assert_called_once_with(missing)
+    missing.refresh_from_db()
+    assert missing.provider_fee == 12
+
+
+@pytest.mark.django_db
+def test_reconcile_square_transactions():
+    with patch.object(SquareReconciliation, "reconcile") as reconcile_mock:
+        reconcile_square_transactions()
+
+    reconcile_mock.assert_called_once()
+    reconciliation = SquareReconciliation.objects.get()
+    assert reconciliation.status == SquareReconciliation.Status.SUCCESS
+    assert reconciliation.end_time - reconciliation.begin_time == timedelta(days=2)
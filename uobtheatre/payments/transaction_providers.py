@@ -1,10 +1,21 @@
 import abc
+import datetime
 import re
-from typing import TYPE_CHECKING, Any, Dict, Literal, Optional, Sequence, Type, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    Literal,
+    Optional,
+    Sequence,
+    Type,
+    Union,
+)
 from uuid import uuid4
 
 from django.conf import settings
-from square import Square as Client
 from square.core.api_error import ApiError
 from square.requests.device_checkout_options import (
     DeviceCheckoutOptionsParams as DeviceCheckoutOptions,
@@ -17,6 +28,8 @@ from square.types.payment_refund import PaymentRefund
 from square.types.terminal_checkout import TerminalCheckout
 
 from uobtheatre.payments import models as payment_models
+from uobtheatre.payments.square_client import create_client
+from uobtheatre.utils.concurrency import map_concurrently
 from uobtheatre.utils.exceptions import PaymentException, SquareException
 from uobtheatre.utils.models import classproperty
 
@@ -77,6 +90,18 @@ class TransactionProvider(abc.ABC):
     ):
         """Syncs the refund payment from the provider"""
 
+    @classmethod
+    def get_provider_fee(
+        cls, payment: "payment_models.Transaction"  # pylint: disable=unused-argument
+    ) -> Optional[int]:
+        """Get the fee the provider charged for the transaction, without
+        updating the transaction
+
+        Returns None if the provider doesn't charge fees, or hasn't yet
+        worked out the fee.
+        """
+        return None
+
     @classmethod
     def cancel(
         cls, payment: "payment_models.Transaction"  # pylint: disable=unused-argument
@@ -206,7 +231,7 @@ class SquareAPIMixin(abc.ABC):
     if square_url := settings.SQUARE_SETTINGS["SQUARE_URL"]:  # pragma: no cover
         kwargs["base_url"] = square_url
 
-    client = Client(**kwargs)
+    client = create_client(**kwargs)
 
     @classmethod
     def _square_transaction_processing_fee(
@@ -277,6 +302,27 @@ class SquarePaymentMethod(SquareAPIMixin, abc.ABC):
 
         return response.payment
 
+    @classmethod
+    def list_payments(
+        cls, begin_time: datetime.datetime, end_time: datetime.datetime
+    ) -> Iterator[Payment]:
+        """Page through the payments at our location which were updated in
+        the time window.
+
+        Raises:
+            SquareException: When a page can't be fetched
+        """
+        try:
+            yield from cls.client.payments.list(
+                updated_at_begin_time=begin_time.isoformat(),
+                updated_at_end_time=end_time.isoformat(),
+                sort_field="UPDATED_AT",
+                location_id=settings.SQUARE_SETTINGS["SQUARE_LOCATION"],  # type: ignore
+                limit=100,
+            )
+        except ApiError as error:
+            raise SquareException(error) from error
+
 
 class ManualCardRefund(RefundProvider):
     """
@@ -433,6 +479,40 @@ class SquareRefund(RefundProvider, SquareAPIMixin):
 
         cls._fill_payment_from_square_response_object(payment, data).save()
 
+    @classmethod
+    def list_refunds(
+        cls, begin_time: datetime.datetime, end_time: datetime.datetime
+    ) -> Iterator[PaymentRefund]:
+        """Page through the refunds at our location which were updated in the
+        time window.
+
+        Raises:
+            SquareException: When a page can't be fetched
+        """
+        try:
+            yield from cls.client.refunds.list(
+                updated_at_begin_time=begin_time.isoformat(),
+                updated_at_end_time=end_time.isoformat(),
+                sort_field="UPDATED_AT",
+                location_id=settings.SQUARE_SETTINGS["SQUARE_LOCATION"],  # type: ignore
+                limit=100,
+            )
+        except ApiError as error:
+            raise SquareException(error) from error
+
+    @classmethod
+    def get_provider_fee(cls, payment: "payment_models.Transaction") -> Optional[int]:
+        try:
+            response = cls.client.refunds.get(cls.get_payment_provider_id(payment))
+        except ApiError as error:
+            raise SquareException(error) from error
+
+        return (
+            cls._square_transaction_processing_fee(response.refund)
+            if response.refund
+            else None
+        )
+
 
 class ManualPaymentMethodMixin(abc.ABC):
     """
@@ -624,10 +704,78 @@ class SquarePOS(PaymentProvider, SquarePaymentMethod):
             raise SquareException(error) from error
 
     @classmethod
-    def sync_transaction(
-        cls, payment: "payment_models.Transaction", data: Optional[TerminalCheckout] = None  # type: ignore[override]
+    def _checkout_processing_fee(
+        cls, checkout: TerminalCheckout, payments: Iterable[Payment] = ()
+    ) -> Optional[int]:
+        """The total processing fee of a terminal checkout's payments.
+
+        The checkout's payments which aren't given are fetched from Square
+        concurrently, so a split tender checkout takes about as long as its
+        slowest payment to fetch.
+
+        Args:
+            checkout (TerminalCheckout): The checkout
+            payments (list of Payment): Any of the checkout's payments
+                already known. Those which carry their fee aren't fetched
+                again.
+        """
+        known_payments = {
+            payment.id: payment
+            for payment in payments
+            if payment.id and payment.processing_fee
+        }
+        payment_ids = checkout.payment_ids or []
+        missing_ids = [
+            payment_id for payment_id in payment_ids if payment_id not in known_payments
+        ]
+        fetched_payments = dict(
+            zip(
+                missing_ids,
+                map_concurrently(
+                    cls.get_payment,
+                    missing_ids,
+                    min(
+                        len(missing_ids),
+                        settings.SQUARE_CLIENT_SETTINGS["CONCURRENT_FETCHES"],
+                    ),
+                ),
+            )
+        )
+
+        provider_fee = None
+        for payment_id in payment_ids:
+            payment_object = known_payments.get(payment_id) or fetched_payments.get(
+                payment_id
+            )
+            if not payment_object:
+                continue
+
+            processing_fee = cls._square_transaction_processing_fee(payment_object)
+            if processing_fee:
+                provider_fee = (provider_fee or 0) + processing_fee
+        return provider_fee
+
+    @classmethod
+    def get_provider_fee(cls, payment: "payment_models.Transaction") -> Optional[int]:
+        checkout = cls.get_checkout(cls.get_payment_provider_id(payment))
+        return cls._checkout_processing_fee(checkout) if checkout else None
+
+    @classmethod
+    def sync_transaction(  # type: ignore[override]
+        cls,
+        payment: "payment_models.Transaction",
+        data: Optional[TerminalCheckout] = None,
+        payments: Iterable[Payment] = (),
     ):
-        """Syncs the given payment with the raw payment data"""
+        """Syncs the given payment with the raw payment data
+
+        Args:
+            payment (Transaction): The transaction to sync
+            data (TerminalCheckout): The checkout, if already known
+            payments (list of Payment): Any of the checkout's payments
+                already known (e.g. from a webhook), which aren't fetched
+                again
+        """
         payment_id = cls.get_payment_provider_id(payment)
 
         checkout = data if data else cls.get_checkout(payment_id)
@@ -637,17 +785,7 @@ class SquarePOS(PaymentProvider, SquarePaymentMethod):
                 f"Transaction failed to sync due to a lack of checkout: {payment.pay_object.payment_reference_id}"
             )
 
-        payment.provider_fee = None
-
-        if checkout.payment_ids:
-            for payment_id in checkout.payment_ids:
-                payment_object = cls.get_payment(payment_id)
-                if not payment_object:
-                    continue
-
-                processing_fee = cls._square_transaction_processing_fee(payment_object)
-                if processing_fee:
-                    payment.provider_fee = (payment.provider_fee or 0) + processing_fee
+        payment.provider_fee = cls._checkout_processing_fee(checkout, payments)
 
         old_status = payment.status
         payment.status = payment_models.Transaction.Status.from_square_status(
@@ -813,3 +951,12 @@ class SquareOnline(PaymentProvider, SquarePaymentMethod):
             )
 
         cls._fill_payment_from_square_response_object(payment, data).save()
+
+    @classmethod
+    def get_provider_fee(cls, payment: "payment_models.Transaction") -> Optional[int]:
+        square_payment = cls.get_payment(cls.get_payment_provider_id(payment))
+        return (
+            cls._square_transaction_processing_fee(square_payment)
+            if square_payment
+            else None
+        )
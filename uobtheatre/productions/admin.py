@@ -12,6 +12,7 @@ from uobtheatre.productions.models import (
     CrewMember,
     CrewRole,
     Performance,
+    PerformanceRefundJob,
     PerformanceSeatGroup,
     Production,
     ProductionTeamMember,
@@ -29,6 +30,22 @@ class PerformancesInline(TabularInline, ReadOnlyInlineMixin):
     model = Performance
 
 
+class PerformanceRefundJobsInline(TabularInline, ReadOnlyInlineMixin):
+    """Read-only progress of a performance's refund jobs"""
+
+    model = PerformanceRefundJob
+    fields = (
+        "status",
+        "total_count",
+        "refunded_count",
+        "skipped_count",
+        "failed_count",
+        "created_at",
+    )
+    readonly_fields = ("created_at",)
+    extra = 0
+
+
 class ProductionAdmin(GuardedModelAdmin):
     inlines = [PerformancesInline]
 
@@ -37,6 +54,7 @@ class ProductionAdmin(GuardedModelAdmin):
 class PerformanceAdmin(DangerousAdminConfirmMixin, ModelAdmin):
     """Custom performance admin page for actions"""
 
+    inlines = [PerformanceRefundJobsInline]
     actions = [
         "email_users",
         "issue_full_refunds",
@@ -66,7 +84,7 @@ class PerformanceAdmin(DangerousAdminConfirmMixin, ModelAdmin):
                 )
         self.message_user(
             request,
-            f"Requested refunds for {successful_count} {pluralize('performance', successful_count)}.",
+            f"Requested refunds for {successful_count} {pluralize('performance', successful_count)}. Their progress is shown on each performance's page.",
         )
 
     @confirm_dangerous_action
@@ -150,6 +168,28 @@ class PerformanceAdmin(DangerousAdminConfirmMixin, ModelAdmin):
         return TemplateResponse(request, "send_email_form.html", context)
 
 
+@admin.register(PerformanceRefundJob)
+class PerformanceRefundJobAdmin(ModelAdmin):
+    """Read only admin page to track the progress of refund jobs"""
+
+    list_display = (
+        "performance",
+        "status",
+        "total_count",
+        "refunded_count",
+        "skipped_count",
+        "failed_count",
+        "created_at",
+    )
+    list_filter = ("status",)
+
+    def has_add_permission(self, _):
+        return False
+
+    def has_change_permission(self, _, __=None):
+        return False
+
+
 admin.site.register(Production, ProductionAdmin)
 admin.site.register(ContentWarning)
 admin.site.register(CrewMember)
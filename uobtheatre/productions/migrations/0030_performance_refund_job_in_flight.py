@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("productions", "0029_performance_refund_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="performancerefundjob",
+            name="in_flight_booking_ids",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name="performancerefundjob",
+            name="refunded_payment_ids",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name="performancerefundjob",
+            name="started_payment_ids",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
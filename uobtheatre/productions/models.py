@@ -1,32 +1,39 @@
 # pylint: disable=too-many-public-methods,too-many-lines
 import datetime
 import math
-from typing import TYPE_CHECKING, Any, Dict, List, Optional
+import threading
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 from autoslug import AutoSlugField
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.mail import mail_admins
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import Max, Min, Q, Sum
+from django.db import models, transaction
+from django.db.models import Count, Max, Min, Q, Sum
 from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django_tiptap.fields import TipTapTextField
 from guardian.shortcuts import get_objects_for_user
+from sentry_sdk import capture_exception
 
 from uobtheatre.images.models import Image
+from uobtheatre.live.models import LiveEvent
 from uobtheatre.payments.exceptions import CantBeRefundedException
-from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.models import SalesBreakdown, Transaction
 from uobtheatre.payments.payables import Payable
 from uobtheatre.productions.exceptions import (
     InvalidConcessionTypeException,
     InvalidSeatGroupException,
     NotEnoughCapacityException,
 )
-from uobtheatre.productions.tasks import refund_performance
+from uobtheatre.productions.tasks import run_performance_refund_job
 from uobtheatre.societies.models import Society
 from uobtheatre.users.abilities import AbilitiesMixin
 from uobtheatre.users.models import User
+from uobtheatre.utils.concurrency import RateLimiter, map_concurrently
+from uobtheatre.utils.exceptions import GQLException
 from uobtheatre.utils.models import (
     BaseModel,
     PermissionableModel,
@@ -243,6 +250,21 @@ class PerformanceQuerySet(QuerySet):
             pay_object_type=ContentType.objects.get_for_model(Booking),
         )
 
+    def sales_breakdowns(
+        self, breakdowns: Optional[List[SalesBreakdown.Enums]] = None
+    ) -> Dict[int, SalesBreakdown]:
+        """
+        Returns the sales breakdown of every performance in the queryset,
+        keyed by performance ID and computed from the sales ledger in a single
+        GROUP BY query.
+        """
+        from uobtheatre.finance.models import SalesLedgerEntry
+
+        values = SalesLedgerEntry.objects.filter(
+            performance__in=self
+        ).sales_breakdowns_by("performance_id", breakdowns)
+        return grouped_sales_breakdowns(self, values, breakdowns)
+
     def booked_users(self):
         """
         Get all the users that have booked this performance.
@@ -256,6 +278,24 @@ class PerformanceQuerySet(QuerySet):
         ).distinct()
 
 
+def grouped_sales_breakdowns(
+    queryset: QuerySet,
+    values: Dict[int, Dict[str, int]],
+    breakdowns: Optional[List[SalesBreakdown.Enums]] = None,
+) -> Dict[int, SalesBreakdown]:
+    """Build memoised sales breakdowns for each object in the queryset from grouped ledger values"""
+    empty_values = {
+        breakdown.key: 0
+        for breakdown in (SalesBreakdown.Enums if breakdowns is None else breakdowns)
+    }
+    return {
+        instance.pk: SalesBreakdown(
+            instance.sales_ledger_entries.all(), values.get(instance.pk, empty_values)
+        )
+        for instance in queryset
+    }
+
+
 PerformanceManager = models.Manager.from_queryset(PerformanceQuerySet)
 
 
@@ -498,6 +538,36 @@ class Performance(
         """
         return self.unchecked_in_tickets.count()
 
+    def sold_tickets_counts(self) -> Dict[str, int]:
+        """The numbers of tickets sold and checked in for the performance, and
+        the last live event published before they were counted.
+
+        They are read in a single statement, so each change to the counts is
+        either counted or published after the event, never both.
+
+        Returns:
+            dict: The sold, checked_in and live_event_id
+        """
+        return (
+            Performance.objects.filter(pk=self.pk)
+            .annotate(
+                sold=Count(
+                    "bookings__tickets",
+                    filter=Q(bookings__status=Payable.Status.PAID),
+                ),
+                checked_in=Count(
+                    "bookings__tickets",
+                    filter=Q(
+                        bookings__status=Payable.Status.PAID,
+                        bookings__tickets__checked_in_at__isnull=False,
+                    ),
+                ),
+                live_event_id=LiveEvent.objects.latest_id_expression(),
+            )
+            .values("sold", "checked_in", "live_event_id")
+            .get()
+        )
+
     @property
     def duration(self) -> Optional[datetime.timedelta]:
         """The performances duration.
@@ -716,9 +786,14 @@ class Performance(
             return True
         return False
 
-    def sales_breakdown(self, breakdowns: Optional[list[str]] = None):
+    @cached_property
+    def sales(self) -> SalesBreakdown:
+        """The memoised sales breakdown of this performance, from the sales ledger"""
+        return SalesBreakdown(self.sales_ledger_entries.all())  # type: ignore
+
+    def sales_breakdown(self, breakdowns: Optional[List[SalesBreakdown.Enums]] = None):
         """Generates a breakdown of the sales of this performance"""
-        return self.qs.transactions().annotate_sales_breakdown(breakdowns)
+        return self.sales.as_dict(breakdowns)
 
     def refund_bookings(
         self,
@@ -737,15 +812,25 @@ class Performance(
                 i.e. the refund is reduced by the amount required to cover our fees (the various misc_costs, such as the theatre improvement levy).
                 If both preserve_provider_fees and preserve_app_fees are true, the refund is reduced by the larger of the two fees.
 
+        Returns:
+            PerformanceRefundJob: The job refunding the bookings in the background
+
         Raises:
             CantBeRefundedException: Raised if the performance can't be refunded
         """
         if not self.disabled:
             raise CantBeRefundedException(f"{self} is not set to disabled")
-
-        refund_performance.delay(
-            self.pk, authorizing_user.id, preserve_provider_fees, preserve_app_fees
+        if self.refund_jobs.active().exists():  # type: ignore
+            raise CantBeRefundedException(f"{self} is already being refunded")
+
+        job = PerformanceRefundJob.objects.create(
+            performance=self,
+            authorizing_user=authorizing_user,
+            preserve_provider_fees=preserve_provider_fees,
+            preserve_app_fees=preserve_app_fees,
         )
+        transaction.on_commit(lambda: run_performance_refund_job.delay(job.pk))
+        return job
 
     def __str__(self):
         if self.start is None:
@@ -756,6 +841,283 @@ class Performance(
         ordering = ["id"]
 
 
+PERFORMANCE_REFUND_JOB_TIMEOUT = datetime.timedelta(minutes=10)
+
+
+class PerformanceRefundJobQuerySet(QuerySet):
+    """Queryset for performance refund jobs"""
+
+    def active(self):
+        """Jobs which are waiting to run or running"""
+        return self.filter(status__in=PerformanceRefundJob.ACTIVE_STATUSES)
+
+    def stale(self):
+        """Active jobs which haven't made progress recently, so their worker has
+        probably been lost"""
+        return self.active().filter(
+            updated_at__lt=timezone.now() - PERFORMANCE_REFUND_JOB_TIMEOUT
+        )
+
+
+PerformanceRefundJobManager = models.Manager.from_queryset(PerformanceRefundJobQuerySet)
+
+
+class PerformanceRefundJob(TimeStampedMixin, models.Model):
+    """A refund of all of a performance's paid bookings, run in the background
+
+    The bookings are refunded a chunk at a time, in order of ID, with a
+    limited number of concurrent and rate limited payment provider calls. The
+    job's progress is checkpointed after each chunk so that, if its worker is
+    lost, the job resumes from the last checkpoint.
+
+    The bookings in the chunk being refunded, and their payments whose
+    refunds have been started and made, are recorded as the job goes. A
+    resumed job finishes refunding these bookings. If a refund was started
+    but not recorded as made, the job can't tell whether the provider made
+    it, so rather than risk refunding twice it fails the booking for it to be
+    checked.
+    """
+
+    objects = PerformanceRefundJobManager()
+
+    class Status(models.TextChoices):
+        """The status of the job"""
+
+        PENDING = "PENDING", "Pending"
+        RUNNING = "RUNNING", "Running"
+        SUCCESS = "SUCCESS", "Success"
+        FAILURE = "FAILURE", "Failure"
+
+    class Outcome(models.TextChoices):
+        """The outcome of refunding a booking"""
+
+        REFUNDED = "REFUNDED", "Refunded"
+        SKIPPED = "SKIPPED", "Skipped"
+        FAILED = "FAILED", "Failed"
+
+    ACTIVE_STATUSES = [Status.PENDING, Status.RUNNING]
+
+    performance = models.ForeignKey(
+        Performance, on_delete=models.CASCADE, related_name="refund_jobs"
+    )
+    authorizing_user = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name="performance_refund_jobs",
+    )
+    preserve_provider_fees = models.BooleanField(default=True)
+    preserve_app_fees = models.BooleanField(default=False)
+
+    status = models.CharField(
+        max_length=20, choices=Status.choices, default=Status.PENDING
+    )
+    error = models.TextField(null=True, blank=True)
+
+    total_count = models.PositiveIntegerField(default=0)
+    refunded_count = models.PositiveIntegerField(default=0)
+    skipped_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    # The bookings which were skipped or failed, and why
+    failures = models.JSONField(default=list, blank=True)
+
+    # The ID of the last booking processed, which the job resumes from
+    last_booking_id = models.PositiveIntegerField(null=True, blank=True)
+
+    # The bookings in the chunk being refunded, and their payments whose
+    # refunds have been started and made
+    in_flight_booking_ids = models.JSONField(default=list, blank=True)
+    started_payment_ids = models.JSONField(default=list, blank=True)
+    refunded_payment_ids = models.JSONField(default=list, blank=True)
+
+    @property
+    def processed_count(self) -> int:
+        return self.refunded_count + self.skipped_count + self.failed_count
+
+    def bookings_to_refund(self):
+        """The paid bookings the job is still to process, and the bookings it
+        was refunding when its worker was lost, in order of ID"""
+        bookings = self.performance.bookings.filter(
+            Q(status=Payable.Status.PAID)
+            | Q(
+                status=Payable.Status.REFUND_PROCESSING,
+                pk__in=self.in_flight_booking_ids,
+            )
+        ).order_by("pk")
+        if self.last_booking_id is not None:
+            bookings = bookings.filter(pk__gt=self.last_booking_id)
+        return bookings
+
+    def claim(self) -> bool:
+        """Claim the job to run it, unless it is already running elsewhere.
+
+        A running job which hasn't made progress recently has lost its worker,
+        so can be claimed again.
+        """
+        return bool(
+            PerformanceRefundJob.objects.filter(pk=self.pk)
+            .filter(
+                Q(status=self.Status.PENDING)
+                | Q(
+                    status=self.Status.RUNNING,
+                    updated_at__lt=timezone.now() - PERFORMANCE_REFUND_JOB_TIMEOUT,
+                )
+            )
+            .update(status=self.Status.RUNNING, updated_at=timezone.now())
+        )
+
+    def record_payment(self, field: str, payment_id: int, lock: threading.Lock):
+        """Record that the refund of one of the in-flight payments has been
+        started or made"""
+        with lock:
+            getattr(self, field).append(payment_id)
+            self.save(update_fields=[field, "updated_at"])
+
+    def refund_booking(
+        self, booking, rate_limiter: RateLimiter, lock: threading.Lock
+    ) -> Tuple[str, Optional[str]]:
+        """Refund each of the booking's payments.
+
+        A booking which the job was refunding when its worker was lost has
+        its remaining payments refunded.
+
+        Returns:
+            tuple: The outcome, and the reason if the booking was skipped or
+                the refund failed
+        """
+        started = []
+        if booking.status == Payable.Status.REFUND_PROCESSING:
+            # The job's worker was lost while refunding the booking
+            started = list(
+                booking.transactions.payments()
+                .filter(pk__in=self.started_payment_ids)
+                .values_list("pk", flat=True)
+            )
+        elif error := booking.validate_cant_be_refunded():
+            return self.Outcome.SKIPPED, error.message
+        else:
+            booking.status = Payable.Status.REFUND_PROCESSING
+            booking.save(update_fields=["status"])
+
+        refunded_payments = 0
+        try:
+            for payment in booking.transactions.payments().exclude(pk__in=started):
+                self.record_payment("started_payment_ids", payment.pk, lock)
+                # The provider's client retries transient errors, with the
+                # refund's idempotency key, so a retried refund is only made once
+                rate_limiter.wait()
+                payment.refund(
+                    preserve_provider_fees=self.preserve_provider_fees,
+                    preserve_app_fees=self.preserve_app_fees,
+                )
+                self.record_payment("refunded_payment_ids", payment.pk, lock)
+                refunded_payments += 1
+        except Exception as exc:  # pylint: disable=broad-except
+            if not isinstance(exc, GQLException):
+                capture_exception(exc)
+            if not refunded_payments and not started:
+                # Nothing was refunded, so the booking can be refunded again
+                booking.status = Payable.Status.PAID
+                booking.save(update_fields=["status"])
+            return self.Outcome.FAILED, getattr(exc, "message", str(exc))
+
+        if interrupted := set(started).difference(self.refunded_payment_ids):
+            return self.Outcome.FAILED, (
+                "The job was interrupted while refunding payments %s, so check "
+                "whether the provider refunded them"
+                % ", ".join(str(payment_id) for payment_id in sorted(interrupted))
+            )
+        return self.Outcome.REFUNDED, None
+
+    def run(self):
+        """Refund the remaining bookings, a chunk at a time"""
+        from uobtheatre.productions.emails import performances_refunded_email
+
+        is_new = self.status == self.Status.PENDING
+        if not self.claim():
+            return
+        self.status = self.Status.RUNNING
+
+        refund_settings = settings.PERFORMANCE_REFUND_SETTINGS
+        rate_limiter = RateLimiter(refund_settings["REQUESTS_PER_SECOND"])
+        lock = threading.Lock()
+        try:
+            if is_new:
+                self.total_count = self.bookings_to_refund().count()
+                self.save(update_fields=["total_count", "updated_at"])
+                if self.authorizing_user:
+                    mail = performances_refunded_email(
+                        self.authorizing_user, [self.performance]
+                    )
+                    mail_admins(
+                        "Performance Refunds Initiated",
+                        mail.to_plain_text(),
+                        html_message=mail.to_html(),
+                    )
+
+            while bookings := list(
+                self.bookings_to_refund()[: refund_settings["CHUNK_SIZE"]]
+            ):
+                self.in_flight_booking_ids.clear()
+                self.in_flight_booking_ids.extend(booking.pk for booking in bookings)
+                self.save(update_fields=["in_flight_booking_ids", "updated_at"])
+                outcomes = map_concurrently(
+                    lambda booking: self.refund_booking(booking, rate_limiter, lock),
+                    bookings,
+                    refund_settings["CONCURRENCY"],
+                )
+                for booking, (outcome, reason) in zip(bookings, outcomes):
+                    if outcome == self.Outcome.REFUNDED:
+                        self.refunded_count += 1
+                        continue
+                    if outcome == self.Outcome.SKIPPED:
+                        self.skipped_count += 1
+                    else:
+                        self.failed_count += 1
+                    self.failures.append(
+                        {
+                            "booking": booking.reference,
+                            "outcome": outcome,
+                            "reason": reason,
+                        }
+                    )
+
+                # Checkpoint the job's progress
+                self.last_booking_id = bookings[-1].pk
+                self.in_flight_booking_ids.clear()
+                self.started_payment_ids.clear()
+                self.refunded_payment_ids.clear()
+                self.save(
+                    update_fields=[
+                        "refunded_count",
+                        "skipped_count",
+                        "failed_count",
+                        "failures",
+                        "last_booking_id",
+                        "in_flight_booking_ids",
+                        "started_payment_ids",
+                        "refunded_payment_ids",
+                        "updated_at",
+                    ]
+                )
+        except Exception as exc:  # pylint: disable=broad-except
+            self.status = self.Status.FAILURE
+            self.error = str(exc)
+            self.save(update_fields=["status", "error", "updated_at"])
+            raise
+
+        self.status = self.Status.SUCCESS
+        self.save(update_fields=["status", "updated_at"])
+
+    def __str__(self):
+        return (
+            f"Refund of {self.performance} ({self.processed_count}/{self.total_count})"
+        )
+
+    class Meta:
+        ordering = ["-created_at"]
+
+
 class PerformanceSeatGroup(models.Model):
     """Pivot table for Performace SeatGroup relation.
 
@@ -840,6 +1202,23 @@ class ProductionQuerySet(QuerySet):
         """
         return self.performances().transactions()
 
+    def sales_breakdowns(
+        self, breakdowns: Optional[List[SalesBreakdown.Enums]] = None
+    ) -> Dict[int, SalesBreakdown]:
+        """
+        Returns the sales breakdown of every production in the queryset,
+        keyed by production ID and computed from the sales ledger in a single
+        GROUP BY query.
+        """
+        values = self.sales_ledger().sales_breakdowns_by("production_id", breakdowns)
+        return grouped_sales_breakdowns(self, values, breakdowns)
+
+    def sales_ledger(self):
+        """Returns the sales ledger entries of the productions in the queryset"""
+        from uobtheatre.finance.models import SalesLedgerEntry
+
+        return SalesLedgerEntry.objects.filter(production__in=self)
+
 
 ProductionManager = models.Manager.from_queryset(ProductionQuerySet)
 
@@ -1037,9 +1416,14 @@ class Production(TimeStampedMixin, PermissionableModel, AbilitiesMixin, BaseMode
             performance.total_tickets_sold() for performance in self.performances.all()
         )
 
-    def sales_breakdown(self, breakdowns: Optional[list[str]] = None):
+    @cached_property
+    def sales(self) -> SalesBreakdown:
+        """The memoised sales breakdown of this production, from the sales ledger"""
+        return SalesBreakdown(self.sales_ledger_entries.all())  # type: ignore
+
+    def sales_breakdown(self, breakdowns: Optional[List[SalesBreakdown.Enums]] = None):
         """Generates a breakdown of the sales of this production"""
-        return self.qs.transactions().annotate_sales_breakdown(breakdowns)
+        return self.sales.as_dict(breakdowns)
 
     def validate(self) -> Optional[ValidationErrors]:
         return self.VALIDATOR.validate(self)
@@ -4,14 +4,20 @@ from django.db.models.query_utils import Q
 from graphene import relay
 from graphene_django import DjangoListField
 from graphene_django.filter import DjangoFilterConnectionField
+from promise import Promise
+from promise.dataloader import DataLoader
 
 from uobtheatre.discounts.schema import ConcessionTypeNode
+from uobtheatre.live.models import performance_topic
+from uobtheatre.live.utils import live_events_uri
+from uobtheatre.payments.models import SalesBreakdown
 from uobtheatre.productions.models import (
     CastMember,
     ContentWarning,
     CrewMember,
     CrewRole,
     Performance,
+    PerformanceRefundJob,
     PerformanceSeatGroup,
     Production,
     ProductionContentWarning,
@@ -24,6 +30,7 @@ from uobtheatre.utils.schema import (
     DjangoObjectType,
     IdInputField,
     UserPermissionFilterMixin,
+    get_selected_fields,
 )
 
 ProductionStatusSchema = graphene.Enum.from_enum(Production.Status)
@@ -173,6 +180,42 @@ class SalesBreakdownNode(graphene.ObjectType):
     society_transfer_value = graphene.Int(required=True)
     society_revenue = graphene.Int(required=True)
 
+    @staticmethod
+    def selected_breakdowns(info) -> list[SalesBreakdown.Enums]:
+        """The breakdowns selected in the query for this node"""
+        return SalesBreakdown.Enums.from_keys(get_selected_fields(info))
+
+
+class SalesBreakdownLoader(DataLoader):
+    """Loads the sales breakdowns for a page of productions, performances or
+    bookings
+
+    All the objects resolved in the same request are computed in a single
+    query, only aggregating the breakdowns selected in the query.
+    """
+
+    def __init__(self, model, breakdowns: list[SalesBreakdown.Enums]):
+        super().__init__(cache=False)
+        self.model = model
+        self.breakdowns = breakdowns
+
+    def batch_load_fn(self, keys):  # pylint: disable=method-hidden
+        sales_breakdowns = self.model.objects.filter(pk__in=keys).sales_breakdowns(
+            self.breakdowns
+        )
+        return Promise.resolve([sales_breakdowns[key] for key in keys])
+
+    @classmethod
+    def for_request(cls, info, model) -> "SalesBreakdownLoader":
+        """Get the loader for the model and selected breakdowns, shared for the request"""
+        breakdowns = SalesBreakdownNode.selected_breakdowns(info)
+        if not hasattr(info.context, "sales_breakdown_loaders"):
+            info.context.sales_breakdown_loaders = {}
+        key = (model, tuple(breakdowns))
+        if key not in info.context.sales_breakdown_loaders:
+            info.context.sales_breakdown_loaders[key] = cls(model, breakdowns)
+        return info.context.sales_breakdown_loaders[key]
+
 
 class ProductionNode(PermissionsMixin, AssignedUsersMixin, DjangoObjectType):
     content_warnings = DjangoListField(ProductionContentWarningNode)
@@ -212,7 +255,7 @@ class ProductionNode(PermissionsMixin, AssignedUsersMixin, DjangoObjectType):
         if not info.context.user.has_perm("productions.sales", self):
             return None
 
-        return SalesBreakdownNode(**self.sales_breakdown())
+        return SalesBreakdownLoader.for_request(info, Production).load(self.pk)
 
     def resolve_total_capacity(self, info):
         return self.total_capacity
@@ -317,11 +360,55 @@ class PerformanceFilter(FilterSet):
 
 
 class PerformanceTicketsBreakdown(graphene.ObjectType):
+    """The counts of a performance's tickets"""
+
     total_capacity = graphene.Int(required=True)
     total_tickets_sold = graphene.Int(required=True)
     total_tickets_checked_in = graphene.Int(required=True)
     total_tickets_to_check_in = graphene.Int(required=True)
     total_tickets_available = graphene.Int(required=True)
+    live_event_id = graphene.Int(
+        required=True,
+        description="The last live event published before the counts were taken. Live updates continuing from this event keep the counts up to date.",
+    )
+
+
+class PerformanceRefundFailureNode(graphene.ObjectType):
+    """A booking a performance refund job skipped or failed to refund"""
+
+    booking = graphene.String(required=True)  # The booking's reference
+    outcome = graphene.String(required=True)
+    reason = graphene.String()
+
+
+class PerformanceRefundJobNode(DjangoObjectType):
+    processed_count = graphene.Int(required=True)
+    failures = graphene.List(
+        graphene.NonNull(PerformanceRefundFailureNode), required=True
+    )
+
+    def resolve_failures(self, info):
+        # self is the job, so failures is its list of failures (not the field)
+        return [
+            PerformanceRefundFailureNode(**failure)
+            for failure in self.failures  # pylint: disable=not-an-iterable
+        ]
+
+    class Meta:
+        model = PerformanceRefundJob
+        fields = (
+            "id",
+            "status",
+            "error",
+            "preserve_provider_fees",
+            "preserve_app_fees",
+            "total_count",
+            "refunded_count",
+            "skipped_count",
+            "failed_count",
+            "created_at",
+            "updated_at",
+        )
 
 
 class PerformanceNode(DjangoObjectType):
@@ -335,6 +422,10 @@ class PerformanceNode(DjangoObjectType):
     is_bookable = graphene.Boolean(required=True)
     tickets_breakdown = graphene.Field(PerformanceTicketsBreakdown, required=True)
     sales_breakdown = graphene.Field(SalesBreakdownNode)
+    refund_jobs = graphene.List(graphene.NonNull(PerformanceRefundJobNode))
+    live_updates_uri = graphene.String(
+        description="The URI of a server-sent events stream of the changes to the performance's bookings, tickets and payments"
+    )
 
     def resolve_ticket_options(self, info):
         return self.performance_seat_groups.all()
@@ -358,12 +449,14 @@ class PerformanceNode(DjangoObjectType):
         return self.is_sold_out
 
     def resolve_tickets_breakdown(self, info):
+        counts = self.sold_tickets_counts()
         return PerformanceTicketsBreakdown(
             self.total_capacity,
-            self.total_tickets_sold(),
-            self.total_tickets_checked_in,
-            self.total_tickets_unchecked_in,
+            counts["sold"],
+            counts["checked_in"],
+            counts["sold"] - counts["checked_in"],
             self.capacity_remaining,
+            counts["live_event_id"],
         )
 
     def resolve_sales_breakdown(self, info):
@@ -373,11 +466,29 @@ class PerformanceNode(DjangoObjectType):
         ):
             return None
 
-        return SalesBreakdownNode(**self.sales_breakdown())
+        return SalesBreakdownLoader.for_request(info, Performance).load(self.pk)
+
+    def resolve_refund_jobs(self, info):
+        if not info.context.user.has_perm(
+            "productions.sales",
+            self.production,
+        ):
+            return None
+
+        return self.refund_jobs.all()
 
     def resolve_is_bookable(self, info):
         return self.is_bookable
 
+    def resolve_live_updates_uri(self, info):
+        if not info.context.user.has_perm(
+            "productions.boxoffice",
+            self.production,
+        ):
+            return None
+
+        return live_events_uri([performance_topic(self.pk)])
+
     @classmethod
     def get_queryset(cls, queryset, info):
         return queryset.user_can_see(info.context.user)
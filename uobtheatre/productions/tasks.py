@@ -1,53 +1,22 @@
-from typing import Union
-from uuid import UUID
-
-from django.core.mail import mail_admins
-
 from config.celery import app
-from uobtheatre.payments.tasks import RefundTask
+from uobtheatre.utils.tasks import BaseTask
+
 
+# Acknowledge the task once it has finished, so that if the worker is lost
+# the job is run again, resuming from its last checkpoint. The job tracks its
+# own progress, so the task's result isn't needed.
+@app.task(base=BaseTask, acks_late=True, reject_on_worker_lost=True, ignore_result=True)
+def run_performance_refund_job(job_pk: int):
+    """Refund a performance's bookings, as set out by a refund job"""
+    from uobtheatre.productions.models import PerformanceRefundJob
 
-@app.task(base=RefundTask)
-def refund_performance(
-    performance_id: int,
-    authorizing_user_id,
-    preserve_provider_fees: bool = True,
-    preserve_app_fees: bool = False,
-):
-    """Refund the performance's bookings
-    Args:
-        performance_id (int): The id of the performance to refund
-        authorizing_user_id (int): Id of the user authorizing the refund
-        preserve_provider_fees (bool): If true the refund is reduced by the amount required to cover the payment's provider_fee
-            i.e. the refund is reduced by the amount required to cover only Square's fees.
-            If both preserve_provider_fees and preserve_app_fees are true, the refund is reduced by the larger of the two fees.
-        preserve_app_fees (bool): If true the refund is reduced by the amount required to cover the payment's app_fee
-            i.e. the refund is reduced by the amount required to cover our fees (the various misc_costs, such as the theatre improvement levy).
-            If both preserve_provider_fees and preserve_app_fees are true, the refund is reduced by the larger of the two fees.
-    Raises:
-        CantBeRefundedException: Raised if the performance can't be refunded
-    """
-    from uobtheatre.payments.payables import Payable
-    from uobtheatre.productions.emails import performances_refunded_email
-    from uobtheatre.productions.models import Performance
-    from uobtheatre.users.models import User
+    PerformanceRefundJob.objects.get(pk=job_pk).run()
 
-    performance = Performance.objects.get(pk=performance_id)
-    authorizing_user = User.objects.get(pk=authorizing_user_id)
 
-    for booking in performance.bookings.filter(status=Payable.Status.PAID):
-        booking.async_refund(
-            authorizing_user=authorizing_user,
-            preserve_provider_fees=preserve_provider_fees,
-            preserve_app_fees=preserve_app_fees,
-        )
+@app.task(base=BaseTask, ignore_result=True)
+def resume_performance_refund_jobs():
+    """Resume refund jobs which have stopped making progress"""
+    from uobtheatre.productions.models import PerformanceRefundJob
 
-    mail = performances_refunded_email(
-        authorizing_user,
-        [performance],
-    )
-    mail_admins(
-        "Performance Refunds Initiated",
-        mail.to_plain_text(),
-        html_message=mail.to_html(),
-    )
+    for job_pk in PerformanceRefundJob.objects.stale().values_list("pk", flat=True):
+        run_performance_refund_job.delay(job_pk)
@@ -1,6 +1,7 @@
 # pylint: disable=too-many-lines
 import math
 import random
+import threading
 from datetime import datetime, timedelta
 from unittest.mock import PropertyMock, patch
 
@@ -9,6 +10,7 @@ from dateutil import parser
 from django.utils import timezone
 from guardian.shortcuts import assign_perm
 from pytest_django.asserts import assertQuerysetEqual
+from square.core.api_error import ApiError
 
 from uobtheatre.bookings.models import Ticket
 from uobtheatre.bookings.test.factories import (
@@ -22,8 +24,9 @@ from uobtheatre.discounts.test.factories import (
     DiscountFactory,
     DiscountRequirementFactory,
 )
+from uobtheatre.live.models import LiveEvent
 from uobtheatre.payments.exceptions import CantBeRefundedException
-from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.models import SalesBreakdown, Transaction
 from uobtheatre.payments.payables import Payable
 from uobtheatre.payments.test.factories import TransactionFactory
 from uobtheatre.payments.transaction_providers import Card, Cash, SquareOnline
@@ -32,7 +35,12 @@ from uobtheatre.productions.exceptions import (
     InvalidSeatGroupException,
     NotEnoughCapacityException,
 )
-from uobtheatre.productions.models import Performance, PerformanceSeatGroup, Production
+from uobtheatre.productions.models import (
+    Performance,
+    PerformanceRefundJob,
+    PerformanceSeatGroup,
+    Production,
+)
 from uobtheatre.productions.test.factories import (
     CastMemberFactory,
     ContentWarningFactory,
@@ -43,6 +51,7 @@ from uobtheatre.productions.test.factories import (
     ProductionTeamMemberFactory,
 )
 from uobtheatre.users.test.factories import UserFactory
+from uobtheatre.utils.exceptions import SquareException
 from uobtheatre.utils.validators import ValidationError
 from uobtheatre.venues.test.factories import SeatGroupFactory, VenueFactory
 
@@ -533,6 +542,33 @@ def test_performance_total_tickets_checked_in():
     assert booking.performance.total_tickets_unchecked_in == 1
 
 
+@pytest.mark.django_db
+def test_performance_sold_tickets_counts():
+    booking = BookingFactory(status=Payable.Status.PAID)
+    TicketFactory(booking=booking)
+    TicketFactory(booking=booking, set_checked_in=True)
+    # Tickets which aren't sold aren't counted
+    TicketFactory(
+        booking=BookingFactory(
+            performance=booking.performance, status=Payable.Status.IN_PROGRESS
+        ),
+        set_checked_in=True,
+    )
+    TicketFactory(booking=BookingFactory(status=Payable.Status.PAID))
+    event = LiveEvent.objects.create(topic="performance:1", type="tickets.sold")
+
+    assert booking.performance.sold_tickets_counts() == {
+        "sold": 2,
+        "checked_in": 1,
+        "live_event_id": event.pk,
+    }
+    assert PerformanceFactory().sold_tickets_counts() == {
+        "sold": 0,
+        "checked_in": 0,
+        "live_event_id": event.pk,
+    }
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "seat_group_capacities,performance_capacity,venue_capacity,expected",
@@ -1269,6 +1305,74 @@ def test_sales_breakdown_with_blank_fees():
     }
 
 
+@pytest.mark.django_db
+def test_grouped_sales_breakdowns_match_individual():
+    production_1 = ProductionFactory()
+    production_2 = ProductionFactory()
+    ProductionFactory()  # No performances
+    performances = [
+        PerformanceFactory(production=production_1),
+        PerformanceFactory(production=production_1),
+        PerformanceFactory(production=production_2),
+        PerformanceFactory(production=production_2),  # No transactions
+    ]
+    for i, performance in enumerate(performances[:3]):
+        booking = BookingFactory(performance=performance)
+        TransactionFactory(pay_object=booking, value=200 * (i + 1), provider_fee=4)
+        TransactionFactory(pay_object=booking, value=-100, type=Transaction.Type.REFUND)
+        TransactionFactory(
+            pay_object=booking, value=300, provider_name=Cash.name, app_fee=None
+        )
+
+    performance_breakdowns = Performance.objects.all().sales_breakdowns()
+    production_breakdowns = Production.objects.all().sales_breakdowns()
+
+    assert len(performance_breakdowns) == Performance.objects.count()
+    assert len(production_breakdowns) == Production.objects.count()
+    for performance in Performance.objects.all():
+        assert (
+            performance_breakdowns[performance.pk].values
+            == performance.sales_breakdown()
+        )
+    for production in Production.objects.all():
+        assert (
+            production_breakdowns[production.pk].values == production.sales_breakdown()
+        )
+
+
+@pytest.mark.django_db
+def test_grouped_sales_breakdowns_single_query(django_assert_num_queries):
+    [TransactionFactory(pay_object=BookingFactory()) for _ in range(3)]
+
+    with django_assert_num_queries(2):
+        breakdowns = Performance.objects.all().sales_breakdowns(
+            [SalesBreakdown.Enums.TOTAL_PAYMENTS]
+        )
+        assert all(breakdown.total_payments > 0 for breakdown in breakdowns.values())
+
+
+@pytest.mark.django_db
+def test_sales_breakdown_is_memoised(django_assert_num_queries):
+    performance = PerformanceFactory()
+    TransactionFactory(pay_object=BookingFactory(performance=performance), value=100)
+
+    with django_assert_num_queries(1):
+        assert (
+            performance.sales_breakdown(
+                [SalesBreakdown.Enums.TOTAL_PAYMENTS, SalesBreakdown.Enums.APP_FEE]
+            )["total_payments"]
+            == 100
+        )
+        assert performance.sales.total_payments == 100
+        assert performance.sales.app_fee >= 0
+
+    # Only the missing breakdowns are computed
+    with django_assert_num_queries(1):
+        performance.sales_breakdown()
+    with django_assert_num_queries(0):
+        performance.sales_breakdown()
+
+
 @pytest.mark.django_db
 def test_performance_validate():
     performance = PerformanceFactory()
@@ -1298,19 +1402,29 @@ def test_performance_validate_without_possible_tickets():
     "disabled,fails",
     [(False, True), (True, False)],
 )
-def test_performance_refund_bookings(disabled, fails):
+def test_performance_refund_bookings(
+    disabled, fails, django_capture_on_commit_callbacks
+):
     performance = PerformanceFactory(id=1, disabled=disabled)
     user = UserFactory(id=123)
 
     with patch(
-        "uobtheatre.productions.tasks.refund_performance.delay",
-    ) as refund_task_mock:
+        "uobtheatre.productions.models.run_performance_refund_job.delay",
+    ) as refund_task_mock, django_capture_on_commit_callbacks(execute=True):
         if fails:
             with pytest.raises(CantBeRefundedException):
                 performance.refund_bookings(user)
         else:
-            performance.refund_bookings(user)
-            refund_task_mock.assert_called_once_with(1, 123, True, False)
+            job = performance.refund_bookings(user)
+
+    if fails:
+        refund_task_mock.assert_not_called()
+        assert not PerformanceRefundJob.objects.exists()
+    else:
+        refund_task_mock.assert_called_once_with(job.pk)
+        assert job.performance == performance
+        assert job.authorizing_user == user
+        assert job.status == PerformanceRefundJob.Status.PENDING
 
 
 @pytest.mark.django_db
@@ -1322,14 +1436,320 @@ def test_performance_refund_bookings_options(preserve_provider_fees, preserve_ap
     performance = PerformanceFactory(id=1, disabled=True)
     user = UserFactory(id=123)
 
-    with patch(
-        "uobtheatre.productions.tasks.refund_performance.delay",
-    ) as refund_task_mock:
-        performance.refund_bookings(user, preserve_provider_fees, preserve_app_fees)
-        refund_task_mock.assert_called_once_with(
-            1, 123, preserve_provider_fees, preserve_app_fees
+    with patch("uobtheatre.productions.models.run_performance_refund_job.delay"):
+        job = performance.refund_bookings(
+            user, preserve_provider_fees, preserve_app_fees
         )
 
+    assert job.preserve_provider_fees == preserve_provider_fees
+    assert job.preserve_app_fees == preserve_app_fees
+
+
+@pytest.mark.django_db
+def test_performance_refund_bookings_already_refunding():
+    performance = PerformanceFactory(disabled=True)
+    user = UserFactory()
+
+    with patch("uobtheatre.productions.models.run_performance_refund_job.delay"):
+        performance.refund_bookings(user)
+        with pytest.raises(CantBeRefundedException) as exception:
+            performance.refund_bookings(user)
+
+    assert exception.value.message == f"{performance} is already being refunded"
+
+
+def square_error(status_code):
+    return SquareException(
+        ApiError(
+            status_code=status_code,
+            body={"errors": [{"category": "API_ERROR", "code": "ERROR"}]},
+        )
+    )
+
+
+@pytest.mark.django_db
+def test_performance_refund_job_run(mailoutbox, settings):
+    settings.PERFORMANCE_REFUND_SETTINGS = {
+        **settings.PERFORMANCE_REFUND_SETTINGS,
+        "CHUNK_SIZE": 2,
+    }
+    performance = PerformanceFactory(disabled=True)
+    refunded_bookings = []
+    for _ in range(3):
+        booking = BookingFactory(performance=performance, status=Payable.Status.PAID)
+        TransactionFactory(pay_object=booking, provider_name=SquareOnline.name)
+        refunded_bookings.append(booking)
+    no_payments = BookingFactory(performance=performance, status=Payable.Status.PAID)
+    cash = BookingFactory(performance=performance, status=Payable.Status.PAID)
+    TransactionFactory(pay_object=cash, provider_name=Cash.name)
+    # Bookings which aren't paid, or are for another performance, are ignored
+    BookingFactory(performance=performance, status=Payable.Status.IN_PROGRESS)
+    TransactionFactory(pay_object=BookingFactory(status=Payable.Status.PAID))
+
+    job = PerformanceRefundJob.objects.create(
+        performance=performance, authorizing_user=UserFactory()
+    )
+    with patch(
+        "uobtheatre.payments.transaction_providers.SquareRefund.refund",
+        autospec=True,
+    ) as mock_refund:
+        job.run()
+
+    assert mock_refund.call_count == 3
+
+    job.refresh_from_db()
+    assert job.status == PerformanceRefundJob.Status.SUCCESS
+    assert (
+        job.total_count,
+        job.refunded_count,
+        job.skipped_count,
+        job.failed_count,
+    ) == (5, 3, 1, 1)
+    assert str(job) == f"Refund of {performance} (5/5)"
+    assert job.last_booking_id == cash.pk
+    assert job.failures == [
+        {
+            "booking": no_payments.reference,
+            "outcome": "SKIPPED",
+            "reason": f"Booking ({no_payments}) can't be refunded because it has no payments",
+        },
+        {
+            "booking": cash.reference,
+            "outcome": "FAILED",
+            "reason": "A CASH payment can't be refunded",
+        },
+    ]
+    for booking in refunded_bookings:
+        booking.refresh_from_db()
+        assert booking.status == Payable.Status.REFUND_PROCESSING
+    cash.refresh_from_db()
+    assert cash.status == Payable.Status.PAID
+
+    assert len(mailoutbox) == 1
+    assert mailoutbox[0].subject == "[UOBTheatre] Performance Refunds Initiated"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("status_code", [400, 503])
+def test_performance_refund_job_leaves_retries_to_the_client(status_code):
+    performance = PerformanceFactory(disabled=True)
+    booking = BookingFactory(performance=performance, status=Payable.Status.PAID)
+    TransactionFactory(pay_object=booking, provider_name=SquareOnline.name)
+
+    job = PerformanceRefundJob.objects.create(
+        performance=performance, authorizing_user=UserFactory()
+    )
+    with patch(
+        "uobtheatre.payments.transaction_providers.SquareRefund.refund",
+        side_effect=square_error(status_code),
+    ) as mock_refund:
+        job.run()
+
+    mock_refund.assert_called_once()
+    job.refresh_from_db()
+    assert job.failed_count == 1
+    assert (
+        job.failures[0]["reason"]
+        == "There was an issue processing your payment (ERROR)"
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "status,minutes_since_update,runs",
+    [
+        (PerformanceRefundJob.Status.RUNNING, 20, True),
+        (PerformanceRefundJob.Status.RUNNING, 1, False),
+        (PerformanceRefundJob.Status.SUCCESS, 20, False),
+    ],
+)
+def test_performance_refund_job_resumes_from_checkpoint(
+    status, minutes_since_update, runs
+):
+    performance = PerformanceFactory(disabled=True)
+    bookings = [
+        BookingFactory(performance=performance, status=Payable.Status.PAID)
+        for _ in range(3)
+    ]
+    for booking in bookings:
+        TransactionFactory(pay_object=booking, provider_name=SquareOnline.name)
+
+    # The job was lost after refunding the first booking
+    job = PerformanceRefundJob.objects.create(
+        performance=performance,
+        status=status,
+        total_count=3,
+        refunded_count=1,
+        last_booking_id=bookings[0].pk,
+    )
+    PerformanceRefundJob.objects.filter(pk=job.pk).update(
+        updated_at=timezone.now() - timedelta(minutes=minutes_since_update)
+    )
+    job.refresh_from_db()
+    assert (job in PerformanceRefundJob.objects.stale()) == runs
+
+    with patch(
+        "uobtheatre.payments.transaction_providers.SquareRefund.refund"
+    ) as mock_refund:
+        job.run()
+
+    job.refresh_from_db()
+    if runs:
+        assert mock_refund.call_count == 2
+        assert job.refunded_count == 3
+        assert job.status == PerformanceRefundJob.Status.SUCCESS
+    else:
+        mock_refund.assert_not_called()
+        assert job.status == status
+
+
+@pytest.mark.django_db
+def test_performance_refund_job_finishes_in_flight_bookings():
+    performance = PerformanceFactory(disabled=True)
+    refunded, interrupted, part_refunded, not_started = [
+        BookingFactory(performance=performance, status=status)
+        for status in [Payable.Status.REFUND_PROCESSING] * 3 + [Payable.Status.PAID]
+    ]
+    refunded_payment, interrupted_payment, part_refunded_payment = [
+        TransactionFactory(pay_object=booking, provider_name=SquareOnline.name)
+        for booking in [refunded, interrupted, part_refunded]
+    ]
+    TransactionFactory(pay_object=part_refunded, provider_name=SquareOnline.name)
+    TransactionFactory(pay_object=not_started, provider_name=SquareOnline.name)
+    # A booking being refunded other than by the job is ignored
+    BookingFactory(performance=performance, status=Payable.Status.REFUND_PROCESSING)
+
+    # The job was lost part way through refunding its first chunk
+    job = PerformanceRefundJob.objects.create(
+        performance=performance,
+        status=PerformanceRefundJob.Status.RUNNING,
+        total_count=4,
+        in_flight_booking_ids=[
+            booking.pk
+            for booking in [refunded, interrupted, part_refunded, not_started]
+        ],
+        started_payment_ids=[
+            refunded_payment.pk,
+            interrupted_payment.pk,
+            part_refunded_payment.pk,
+        ],
+        refunded_payment_ids=[refunded_payment.pk, part_refunded_payment.pk],
+    )
+    PerformanceRefundJob.objects.filter(pk=job.pk).update(
+        updated_at=timezone.now() - timedelta(minutes=20)
+    )
+    job.refresh_from_db()
+
+    with patch(
+        "uobtheatre.payments.transaction_providers.SquareRefund.refund",
+        autospec=True,
+    ) as mock_refund:
+        job.run()
+
+    # Only the payments whose refunds weren't started are refunded
+    assert [call.args[1].pay_object for call in mock_refund.call_args_list] == [
+        part_refunded,
+        not_started,
+    ]
+    job.refresh_from_db()
+    assert job.status == PerformanceRefundJob.Status.SUCCESS
+    assert (job.refunded_count, job.failed_count) == (3, 1)
+    assert job.failures == [
+        {
+            "booking": interrupted.reference,
+            "outcome": "FAILED",
+            "reason": "The job was interrupted while refunding payments %s, so check whether the provider refunded them"
+            % interrupted_payment.pk,
+        }
+    ]
+    assert job.in_flight_booking_ids == []
+    assert job.started_payment_ids == []
+    assert job.refunded_payment_ids == []
+    for booking in [refunded, interrupted, part_refunded, not_started]:
+        booking.refresh_from_db()
+        assert booking.status == Payable.Status.REFUND_PROCESSING
+
+
+@pytest.mark.django_db
+def test_performance_refund_job_resumed_booking_fails():
+    performance = PerformanceFactory(disabled=True)
+    booking = BookingFactory(
+        performance=performance, status=Payable.Status.REFUND_PROCESSING
+    )
+    refunded_payment = TransactionFactory(
+        pay_object=booking, provider_name=SquareOnline.name
+    )
+    TransactionFactory(pay_object=booking, provider_name=SquareOnline.name)
+    job = PerformanceRefundJob.objects.create(
+        performance=performance,
+        in_flight_booking_ids=[booking.pk],
+        started_payment_ids=[refunded_payment.pk],
+        refunded_payment_ids=[refunded_payment.pk],
+    )
+
+    with patch(
+        "uobtheatre.payments.transaction_providers.SquareRefund.refund",
+        side_effect=RuntimeError("Lost connection"),
+    ), patch("uobtheatre.productions.models.capture_exception") as mock_capture:
+        job.run()
+
+    mock_capture.assert_called_once()
+    job.refresh_from_db()
+    assert job.failures[0]["reason"] == "Lost connection"
+    # A payment was refunded, so the booking isn't made refundable again
+    booking.refresh_from_db()
+    assert booking.status == Payable.Status.REFUND_PROCESSING
+
+
+@pytest.mark.django_db
+def test_performance_refund_job_run_fails():
+    performance = PerformanceFactory(disabled=True)
+    BookingFactory(performance=performance, status=Payable.Status.PAID)
+    job = PerformanceRefundJob.objects.create(performance=performance)
+
+    with patch.object(
+        PerformanceRefundJob, "refund_booking", side_effect=ValueError("Failed")
+    ):
+        with pytest.raises(ValueError):
+            job.run()
+
+    job.refresh_from_db()
+    assert job.status == PerformanceRefundJob.Status.FAILURE
+    assert job.error == "Failed"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_performance_refund_job_run_concurrently(settings):
+    settings.PERFORMANCE_REFUND_SETTINGS = {
+        **settings.PERFORMANCE_REFUND_SETTINGS,
+        "CONCURRENCY": 2,
+    }
+    performance = PerformanceFactory(disabled=True)
+    bookings = [
+        BookingFactory(performance=performance, status=Payable.Status.PAID)
+        for _ in range(4)
+    ]
+    for booking in bookings:
+        TransactionFactory(pay_object=booking, provider_name=SquareOnline.name)
+    job = PerformanceRefundJob.objects.create(performance=performance)
+
+    # Each refund waits for another to be made at the same time, so the
+    # refunds fail unless they are made concurrently
+    barrier = threading.Barrier(2, timeout=5)
+    with patch(
+        "uobtheatre.payments.transaction_providers.SquareRefund.refund",
+        side_effect=lambda *_, **__: barrier.wait(),
+    ) as mock_refund:
+        job.run()
+
+    assert mock_refund.call_count == 4
+    job.refresh_from_db()
+    assert job.status == PerformanceRefundJob.Status.SUCCESS
+    assert (job.refunded_count, job.failed_count) == (4, 0)
+    for booking in bookings:
+        booking.refresh_from_db()
+        assert booking.status == Payable.Status.REFUND_PROCESSING
+
 
 @pytest.mark.django_db
 def test_performance_queryset_bookings():
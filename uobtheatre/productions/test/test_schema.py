@@ -1,6 +1,7 @@
 # pylint: disable=too-many-lines
 import datetime
 import math
+from unittest.mock import patch
 
 import pytest
 import pytz
@@ -17,9 +18,15 @@ from uobtheatre.discounts.test.factories import (
     DiscountFactory,
     DiscountRequirementFactory,
 )
+from uobtheatre.finance.models import SalesLedgerQuerySet
+from uobtheatre.payments.models import SalesBreakdown
 from uobtheatre.payments.payables import Payable
 from uobtheatre.payments.test.factories import TransactionFactory
-from uobtheatre.productions.models import Performance, Production
+from uobtheatre.productions.models import (
+    Performance,
+    PerformanceRefundJob,
+    Production,
+)
 from uobtheatre.productions.test.factories import (
     CastMemberFactory,
     ContentWarningFactory,
@@ -644,6 +651,118 @@ def test_production_and_performance_sales_breakdowns(gql_client):
     }
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize("with_permission", [False, True])
+def test_performance_refund_jobs(gql_client, with_permission):
+    performance = PerformanceFactory()
+    PerformanceRefundJob.objects.create(
+        performance=performance,
+        status=PerformanceRefundJob.Status.RUNNING,
+        total_count=10,
+        refunded_count=3,
+        skipped_count=1,
+        failures=[{"booking": "ABS1352EBV54", "outcome": "SKIPPED", "reason": "No"}],
+    )
+    gql_client.login()
+    if with_permission:
+        assign_perm("sales", gql_client.user, performance.production)
+
+    response = gql_client.execute(
+        """
+        {
+          performance(id: "%s") {
+            refundJobs {
+              status
+              totalCount
+              processedCount
+              refundedCount
+              skippedCount
+              failedCount
+              failures {
+                booking
+                outcome
+                reason
+              }
+            }
+          }
+        }
+        """
+        % to_global_id("PerformanceNode", performance.pk)
+    )
+
+    refund_jobs = response["data"]["performance"]["refundJobs"]
+    if not with_permission:
+        assert refund_jobs is None
+        return
+    assert refund_jobs == [
+        {
+            "status": "RUNNING",
+            "totalCount": 10,
+            "processedCount": 4,
+            "refundedCount": 3,
+            "skippedCount": 1,
+            "failedCount": 0,
+            "failures": [
+                {"booking": "ABS1352EBV54", "outcome": "SKIPPED", "reason": "No"}
+            ],
+        }
+    ]
+
+
+@pytest.mark.django_db
+def test_performance_sales_breakdowns_are_batched(
+    gql_client,
+):
+    production = ProductionFactory()
+    for value in [100, 200, 300]:
+        performance = PerformanceFactory(production=production)
+        TransactionFactory(
+            pay_object=BookingFactory(performance=performance), value=value
+        )
+    gql_client.login_as_super_user()
+
+    request = """
+        {
+          production(slug: "%s") {
+            salesBreakdown {
+              ...Payments
+            }
+            performances {
+              edges {
+                node {
+                  salesBreakdown {
+                    ...on SalesBreakdownNode {
+                      totalPayments
+                    }
+                  }
+                }
+              }
+            }
+          }
+        }
+
+        fragment Payments on SalesBreakdownNode {
+          totalPayments
+        }
+        """
+    with patch(
+        "uobtheatre.finance.models.SalesLedgerQuerySet.sales_breakdowns_by",
+        autospec=True,
+        side_effect=SalesLedgerQuerySet.sales_breakdowns_by,
+    ) as mock_grouped:
+        response = gql_client.execute(request % production.slug)
+
+    # One grouped query for the production and one for the page of performances
+    assert mock_grouped.call_count == 2
+    for call in mock_grouped.call_args_list:
+        assert call.args[2] == [SalesBreakdown.Enums.TOTAL_PAYMENTS]
+    assert response["data"]["production"]["salesBreakdown"] == {"totalPayments": 600}
+    assert [
+        edge["node"]["salesBreakdown"]["totalPayments"]
+        for edge in response["data"]["production"]["performances"]["edges"]
+    ] == [100, 200, 300]
+
+
 @pytest.mark.django_db
 def test_production_totals(gql_client):
     # Create 2 performances for the same production
@@ -1,30 +1,45 @@
-from unittest.mock import patch
+from datetime import timedelta
+from unittest.mock import call, patch
 
 import pytest
+from django.utils import timezone
 
-from uobtheatre.bookings.test.factories import BookingFactory
-from uobtheatre.productions.tasks import refund_performance
+from uobtheatre.productions.models import PerformanceRefundJob
+from uobtheatre.productions.tasks import (
+    resume_performance_refund_jobs,
+    run_performance_refund_job,
+)
 from uobtheatre.productions.test.factories import PerformanceFactory
-from uobtheatre.users.test.factories import UserFactory
 
 
 @pytest.mark.django_db
-def test_refund_performance_task(mailoutbox):
-    performance = PerformanceFactory()
-    booking = BookingFactory(performance=performance)
-    BookingFactory()
-    auth_user = UserFactory()
+def test_run_performance_refund_job_task():
+    job = PerformanceRefundJob.objects.create(performance=PerformanceFactory())
 
-    with patch(
-        "uobtheatre.bookings.models.Booking.async_refund", autospec=True
-    ) as refund_mock:
-        refund_performance(performance.pk, auth_user.pk)
-
-    refund_mock.assert_called_once_with(
-        booking,
-        authorizing_user=auth_user,
-        preserve_provider_fees=True,
-        preserve_app_fees=False,
+    with patch.object(PerformanceRefundJob, "run", autospec=True) as run_mock:
+        run_performance_refund_job(job.pk)
+
+    run_mock.assert_called_once_with(job)
+
+
+@pytest.mark.django_db
+def test_resume_performance_refund_jobs_task():
+    stale_job = PerformanceRefundJob.objects.create(
+        performance=PerformanceFactory(), status=PerformanceRefundJob.Status.RUNNING
+    )
+    PerformanceRefundJob.objects.create(
+        performance=PerformanceFactory(), status=PerformanceRefundJob.Status.RUNNING
     )
-    assert len(mailoutbox) == 1
-    assert mailoutbox[0].subject == "[UOBTheatre] Performance Refunds Initiated"
+    finished_job = PerformanceRefundJob.objects.create(
+        performance=PerformanceFactory(), status=PerformanceRefundJob.Status.SUCCESS
+    )
+    PerformanceRefundJob.objects.filter(pk__in=[stale_job.pk, finished_job.pk]).update(
+        updated_at=timezone.now() - timedelta(hours=1)
+    )
+
+    with patch(
+        "uobtheatre.productions.tasks.run_performance_refund_job.delay"
+    ) as delay_mock:
+        resume_performance_refund_jobs()
+
+    assert delay_mock.call_args_list == [call(stale_job.pk)]
@@ -0,0 +1,227 @@
+"""
+Columnar analytics over transactions, using NumPy arrays
+"""
+
+import datetime
+import itertools
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+TIME_BUCKETS = ["hour", "day", "week", "month"]
+
+# The NumPy datetime units for the time buckets (weeks are handled separately,
+# as NumPy's weeks start on a Thursday)
+TIME_BUCKET_UNITS = {"hour": "h", "day": "D", "month": "M"}
+
+NO_PRODUCTION = -1
+
+# Integer keys spanning up to this many values are grouped by counting rather
+# than sorting
+DENSE_KEY_SPAN = 1 << 20
+
+
+def _utc_offset(timestamp: int) -> int:
+    """The current timezone's UTC offset, in seconds, at the (UNIX) time"""
+    local_time = timezone.localtime(
+        datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    )
+    return int(local_time.utcoffset().total_seconds())  # type: ignore[union-attr]
+
+
+@dataclass
+class TransactionColumns:
+    """The columns of a set of transactions, as typed NumPy arrays
+
+    Provider names and types are stored as integer codes, indexing into the
+    providers and types lists. Transactions not for a production have a
+    production ID of NO_PRODUCTION.
+    """
+
+    value: np.ndarray  # int64, in pence
+    provider: np.ndarray  # int16 code
+    production_id: np.ndarray  # int64
+    type: np.ndarray  # int8 code
+    created_at: np.ndarray  # datetime64[s], in UTC
+    providers: List[str]
+    types: List[str]
+
+    def __len__(self):
+        return len(self.value)
+
+    @classmethod
+    def from_queryset(
+        cls, queryset: QuerySet, chunk_size: int = 10000
+    ) -> "TransactionColumns":
+        """Load the columns of the transactions in the queryset, a chunk at a time"""
+        rows = (
+            queryset.annotate_pay_object_performance()  # type: ignore
+            .order_by()
+            .values_list(
+                "value",
+                "provider_name",
+                "pay_object_production_id",
+                "type",
+                "created_at",
+            )
+            .iterator(chunk_size=chunk_size)
+        )
+
+        provider_codes: Dict[str, int] = {}
+        type_codes: Dict[str, int] = {}
+        chunks: List[List[np.ndarray]] = []
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            values, providers, production_ids, types, created_ats = zip(*chunk)
+            chunks.append(
+                [
+                    np.array(values, dtype=np.int64),
+                    np.array(
+                        [
+                            provider_codes.setdefault(provider, len(provider_codes))
+                            for provider in providers
+                        ],
+                        dtype=np.int16,
+                    ),
+                    np.array(
+                        [
+                            NO_PRODUCTION if production_id is None else production_id
+                            for production_id in production_ids
+                        ],
+                        dtype=np.int64,
+                    ),
+                    np.array(
+                        [
+                            type_codes.setdefault(type_name, len(type_codes))
+                            for type_name in types
+                        ],
+                        dtype=np.int8,
+                    ),
+                    np.array(
+                        [created_at.timestamp() for created_at in created_ats],
+                        dtype=np.int64,
+                    ).astype("datetime64[s]"),
+                ]
+            )
+
+        columns = (
+            [np.concatenate(column) for column in zip(*chunks)]
+            if chunks
+            else [
+                np.array([], dtype=dtype)
+                for dtype in (np.int64, np.int16, np.int64, np.int8, "datetime64[s]")
+            ]
+        )
+        return cls(
+            value=columns[0],
+            provider=columns[1],
+            production_id=columns[2],
+            type=columns[3],
+            created_at=columns[4],
+            providers=list(provider_codes),
+            types=list(type_codes),
+        )
+
+    def filter(self, mask: np.ndarray) -> "TransactionColumns":
+        """The transactions selected by the boolean mask"""
+        return TransactionColumns(
+            self.value[mask],
+            self.provider[mask],
+            self.production_id[mask],
+            self.type[mask],
+            self.created_at[mask],
+            self.providers,
+            self.types,
+        )
+
+    def of_type(self, type_name: str) -> "TransactionColumns":
+        """The transactions of the given type"""
+        if type_name not in self.types:
+            return self.filter(np.zeros(len(self), dtype=bool))
+        return self.filter(self.type == self.types.index(type_name))
+
+    def local_created_at(self) -> np.ndarray:
+        """The times the transactions were made in the current timezone (which
+        the daily sales rollups' days are in), as naive datetime64s"""
+        # UTC offsets change on the hour, so they are looked up once per hour
+        hours, inverse = _group_by_key(self.created_at.astype("datetime64[h]"))
+        offsets = np.array(
+            [
+                _utc_offset(hour)
+                for hour in hours.astype("datetime64[s]").astype(np.int64).tolist()
+            ],
+            dtype=np.int64,
+        )
+        return self.created_at + offsets[inverse].astype("timedelta64[s]")
+
+    def time_buckets(self, bucket: str) -> np.ndarray:
+        """The start of the time bucket (hour, day, week or month), in the
+        current timezone, each transaction was made in"""
+        created_at = self.local_created_at()
+        if bucket == "week":
+            days = created_at.astype("datetime64[D]")
+            # The epoch was a Thursday, so offset the days to start on Monday
+            return days - ((days.astype(np.int64) + 3) % 7)
+        return created_at.astype(f"datetime64[{TIME_BUCKET_UNITS[bucket]}]")
+
+
+def _group_by_key(key: np.ndarray):
+    """Group the rows by a single key, returning the unique keys and each row's group"""
+    is_datetime = np.issubdtype(key.dtype, np.datetime64)
+    if len(key) and (is_datetime or np.issubdtype(key.dtype, np.integer)):
+        as_int = key.view(np.int64) if is_datetime else key.astype(np.int64)
+        low = as_int.min()
+        span = int(as_int.max() - low) + 1
+        if span <= max(len(key), DENSE_KEY_SPAN):
+            # The keys are dense enough to group in linear time, by counting
+            offsets = as_int - low
+            present = np.flatnonzero(np.bincount(offsets, minlength=span))
+            groups = np.empty(span, dtype=np.int64)
+            groups[present] = np.arange(len(present))
+            unique = present + low
+            return (
+                unique.view(key.dtype) if is_datetime else unique.astype(key.dtype),
+                groups[offsets],
+            )
+    unique, inverse = np.unique(key, return_inverse=True)
+    return unique, inverse.reshape(-1)
+
+
+def group_by(*keys: np.ndarray):
+    """Group the rows by the keys
+
+    Returns:
+        tuple: The unique key rows (one array per key), and the index of each
+            row's group
+    """
+    grouped = [_group_by_key(key) for key in keys]
+    if len(grouped) == 1:
+        unique, inverse = grouped[0]
+        return [unique], inverse
+
+    # Combine the keys' groups into a single key, and group by that
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    for unique, inverse in grouped:
+        combined = combined * len(unique) + inverse
+    combined_unique, combined_inverse = _group_by_key(combined)
+
+    key_uniques = []
+    for unique, _ in reversed(grouped):
+        key_uniques.append(unique[combined_unique % len(unique)])
+        combined_unique = combined_unique // len(unique)
+    return key_uniques[::-1], combined_inverse
+
+
+def group_sum(inverse: np.ndarray, values: np.ndarray, groups: int) -> np.ndarray:
+    """Sum the integer values in each group"""
+    # Sums of pence are well within the integers a float64 represents exactly
+    return np.rint(np.bincount(inverse, weights=values, minlength=groups)).astype(
+        np.int64
+    )
+
+
+def group_count(inverse: np.ndarray, groups: int) -> np.ndarray:
+    """Count the rows in each group"""
+    return np.bincount(inverse, minlength=groups)
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("reports", "0002_report_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="reportjob",
+            name="format",
+            field=models.CharField(default="xlsx", max_length=20),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:53
+
+from django.db import migrations, models
+
+import uobtheatre.reports.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("reports", "0003_report_job_format"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="reportjob",
+            name="file",
+            field=models.FileField(
+                blank=True,
+                null=True,
+                storage=uobtheatre.reports.models.report_storage,
+                upload_to="reports/",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="reportjob",
+            name="result",
+            field=models.FileField(
+                blank=True,
+                null=True,
+                storage=uobtheatre.reports.models.report_storage,
+                upload_to="reports/",
+            ),
+        ),
+    ]
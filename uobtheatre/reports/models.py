@@ -1,4 +1,21 @@
-from django.db import models
+import datetime
+import hashlib
+import json
+import tempfile
+import uuid
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Tuple, Type
+
+from django.conf import settings
+from django.core.files import File
+from django.db import IntegrityError, models, transaction
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from uobtheatre.users.models import User
+from uobtheatre.utils.exceptions import AuthorizationException
+from uobtheatre.utils.models import TimeStampedMixin
 
 
 class Reports(models.Model):
@@ -12,3 +29,208 @@ class Reports(models.Model):
         # and "view" default permissions
 
         permissions = (("finance_reports", "Finance Reports"),)
+
+
+REPORT_JOB_TIMEOUT = datetime.timedelta(hours=1)
+
+
+def report_options_hash(name: str, options: List[Dict], export_format: str) -> str:
+    """A hash identifying a report, its options and its export format"""
+    return hashlib.sha256(
+        json.dumps([name, options, export_format], sort_keys=True).encode()
+    ).hexdigest()
+
+
+def report_storage():
+    """The storage for the stored reports, which hold personal and financial
+    data so mustn't be publicly readable"""
+    return import_string(settings.PRIVATE_FILE_STORAGE)(
+        location=settings.PRIVATE_MEDIAFILES_LOCATION
+    )
+
+
+class ReportJobQuerySet(QuerySet):
+    """Queryset for report jobs"""
+
+    def active(self):
+        """Jobs which are waiting to run or running"""
+        return self.filter(status__in=ReportJob.ACTIVE_STATUSES)
+
+    def expired(self):
+        """Finished jobs which are older than the REPORT_JOB_RETENTION"""
+        return self.exclude(status__in=ReportJob.ACTIVE_STATUSES).filter(
+            updated_at__lt=timezone.now() - settings.REPORT_JOB_RETENTION
+        )
+
+    def delete_with_files(self) -> int:
+        """Delete the jobs, and the reports stored for them
+
+        Returns:
+            int: The number of jobs deleted
+        """
+        count = 0
+        job: ReportJob
+        for job in self.iterator():  # type: ignore[assignment]
+            job.result.delete(save=False)
+            job.file.delete(save=False)
+            job.delete()
+            count += 1
+        return count
+
+    def get_or_create_for(
+        self, name: str, options: List[Dict], user, export_format: str = "xlsx"
+    ) -> Tuple:
+        """Get the active job for the report, options and format, or create one.
+
+        Returns:
+            tuple: The job, and whether it was created
+        """
+        options_hash = report_options_hash(name, options, export_format)
+
+        # Jobs which have been active for too long have been lost
+        self.active().filter(
+            options_hash=options_hash,
+            updated_at__lt=timezone.now() - REPORT_JOB_TIMEOUT,
+        ).update(status=ReportJob.Status.FAILURE, error="The report timed out")
+
+        job = self.active().filter(options_hash=options_hash).first()
+        if job:
+            return job, False
+        try:
+            with transaction.atomic():
+                return (
+                    self.create(
+                        name=name,
+                        options=options,
+                        options_hash=options_hash,
+                        user=user,
+                        format=export_format,
+                    ),
+                    True,
+                )
+        except IntegrityError:
+            # An identical job was created concurrently
+            return self.active().get(options_hash=options_hash), False
+
+
+ReportJobManager = models.Manager.from_queryset(ReportJobQuerySet)
+
+
+class ReportJob(TimeStampedMixin, models.Model):
+    """A report being generated in the background
+
+    The report's meta and datasets are stored as JSON, and its export (in
+    the requested format) as a file, so that the report only has to be run once however many
+    times it is viewed or downloaded. Requests for an identical report while
+    a job is active share that job.
+    """
+
+    objects = ReportJobManager()
+
+    class Status(models.TextChoices):
+        """The status of the job"""
+
+        PENDING = "PENDING", "Pending"
+        RUNNING = "RUNNING", "Running"
+        SUCCESS = "SUCCESS", "Success"
+        FAILURE = "FAILURE", "Failure"
+
+    ACTIVE_STATUSES = [Status.PENDING, Status.RUNNING]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=255)
+    options = models.JSONField(default=list)
+    options_hash = models.CharField(max_length=64)
+    format = models.CharField(max_length=20, default="xlsx")  # The export format
+    user = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, related_name="report_jobs"
+    )  # The user who first requested the report
+    status = models.CharField(
+        max_length=20, choices=Status.choices, default=Status.PENDING
+    )
+    error = models.TextField(null=True, blank=True)
+
+    result = models.FileField(
+        upload_to="reports/", storage=report_storage, null=True, blank=True
+    )
+    file = models.FileField(
+        upload_to="reports/", storage=report_storage, null=True, blank=True
+    )
+
+    @property
+    def report_class(self) -> Type:
+        from uobtheatre.reports.reports import available_reports
+
+        return available_reports[self.name]["cls"]  # type: ignore
+
+    def user_can_access(self, user) -> bool:
+        """Whether the user is authorized to view the job's report"""
+        try:
+            self.report_class.authorize_user(user, self.options)
+        except AuthorizationException:
+            return False
+        return True
+
+    def get_result(self) -> Optional[Dict]:
+        """The stored meta and datasets of the report, once it has been generated"""
+        if not self.result:
+            return None
+        with self.result.open("rb") as result_file:
+            return json.load(result_file)
+
+    def run(self):
+        """Run the report, storing its result and its export in the job's format"""
+        from uobtheatre.reports.reports import LazyDataSet, SpooledDataSet
+        from uobtheatre.reports.utils import renderers, write_report_json
+
+        # Claim the job, so that it is only run once
+        if not ReportJob.objects.filter(pk=self.pk, status=self.Status.PENDING).update(
+            status=self.Status.RUNNING, updated_at=timezone.now()
+        ):
+            return
+        self.status = self.Status.RUNNING
+
+        try:
+            report = self.report_class(self.options)
+            report.run()
+
+            with ExitStack() as spools:
+                # Generate the lazy data sets' rows once, for both the result
+                # and the export, so that they agree
+                report.datasets = [
+                    (
+                        spools.enter_context(SpooledDataSet(dataset))
+                        if isinstance(dataset, LazyDataSet)
+                        else dataset
+                    )
+                    for dataset in report.datasets
+                ]
+
+                with tempfile.TemporaryFile() as result_file:
+                    write_report_json(report, result_file)
+                    self.result.save(f"{self.pk}.json", File(result_file), save=False)
+
+                renderer = renderers[self.format](report, user=self.user)
+                with renderer.get_output() as export_file:
+                    self.file.save(
+                        f"{self.pk}.{renderer.extension}",
+                        File(export_file),
+                        save=False,
+                    )
+        except Exception as exc:  # pylint: disable=broad-except
+            self.status = self.Status.FAILURE
+            self.error = str(exc)
+            self.save(update_fields=["status", "error", "updated_at"])
+            raise
+
+        self.status = self.Status.SUCCESS
+        self.save(update_fields=["status", "result", "file", "updated_at"])
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["options_hash"],
+                condition=models.Q(status__in=["PENDING", "RUNNING"]),
+                name="unique_active_report_job",
+            )
+        ]
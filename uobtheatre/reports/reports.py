@@ -1,14 +1,31 @@
 import abc
+import datetime
+import pickle
+import tempfile
 from abc import ABC
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Prefetch, Q, Sum
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from graphql_relay.node.node import from_global_id
 
-from uobtheatre.bookings.models import Booking
-from uobtheatre.payments.models import Transaction
+from uobtheatre.bookings.models import Ticket
+from uobtheatre.finance.models import DailySalesRollup, DailySalesRollupDay, day_start
+from uobtheatre.payments.models import SalesBreakdown, Transaction
 from uobtheatre.payments.payables import Payable
 from uobtheatre.productions.models import Performance, Production
+from uobtheatre.reports.analytics import (
+    NO_PRODUCTION,
+    TIME_BUCKETS,
+    TransactionColumns,
+    group_by,
+    group_count,
+    group_sum,
+)
 from uobtheatre.users.models import User
 from uobtheatre.utils.exceptions import AuthorizationException, GQLException
 
@@ -40,20 +57,119 @@ class DataSet:
     headings: List[str]
     data: List[List[str]] = field(default_factory=list)
 
+    # Index of the rows by their first column, and the rows it was built from
+    _index: Dict = field(default_factory=dict, init=False, repr=False, compare=False)
+    _indexed_rows: Optional[List] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _indexed_count: int = field(default=0, init=False, repr=False, compare=False)
+
+    def _row_index(self) -> Dict:
+        """The index of the rows by their first column, rebuilt if the rows
+        have been changed other than through add_row"""
+        if self._indexed_rows is not self.data or self._indexed_count != len(self.data):
+            self._index = {}
+            for row in self.data:
+                self._index.setdefault(row[0], row)
+            self._indexed_rows = self.data
+            self._indexed_count = len(self.data)
+        return self._index
+
     def add_row(self, data):
+        index = self._row_index()
         self.data.append(data)
+        if data:
+            index.setdefault(data[0], data)
+        self._indexed_count += 1
 
     def find_or_create_row_by_first_column(self, value, default_row_data):
-        row = next((row for row in self.data if row[0] == value), None)
+        row = self._row_index().get(value)
         if not row:
             row = default_row_data
             self.add_row(row)
         return row
 
+    def iter_rows(self) -> Iterator[List]:
+        """Iterate over the rows of the data set"""
+        return iter(self.data)
+
+
+class LazyDataSet(DataSet):
+    """A data set whose rows are generated when they are iterated over,
+    rather than being held in memory"""
+
+    def __init__(self, name: str, headings: List[str], rows: Callable[[], Iterable]):
+        # pylint: disable=super-init-not-called
+        self.name = name
+        self.headings = headings
+        self.rows = rows
+
+    @property  # type: ignore
+    def data(self) -> List[List]:  # type: ignore
+        """All the rows of the data set, as a list"""
+        return list(self.iter_rows())
+
+    def add_row(self, data):
+        raise TypeError("Rows cannot be added to a lazy data set")
+
+    def iter_rows(self) -> Iterator[List]:
+        return iter(self.rows())
+
+
+class SpooledDataSet(LazyDataSet):
+    """A lazy data set whose rows are generated once, and spooled to a
+    temporary file, so that they can be iterated over again (e.g. for
+    multiple exports) without generating them again.
+
+    The spool is closed when the data set is used as a context manager.
+    """
+
+    def __init__(self, dataset: DataSet):
+        super().__init__(dataset.name, dataset.headings, self.read_rows)
+        self.spool = tempfile.TemporaryFile()  # pylint: disable=consider-using-with
+        for row in dataset.iter_rows():
+            pickle.dump(row, self.spool)
+
+    def read_rows(self) -> Iterator[List]:
+        """Read the rows back from the spool"""
+        self.spool.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.spool)
+            except EOFError:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.spool.close()
+
+
+def iterate_in_chunks(queryset: QuerySet, chunk_size: int = 2000) -> Iterator:
+    """Iterate over a queryset by primary key, a chunk at a time.
+
+    Unlike .iterator(), any prefetches on the queryset are performed for each
+    chunk.
+    """
+    last_pk = None
+    while True:
+        chunk_queryset = queryset.order_by("pk")
+        if last_pk is not None:
+            chunk_queryset = chunk_queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_queryset[:chunk_size])
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
+
 
 class Report(ABC):
     """An abstract class for a generic report"""
 
+    title: Optional[str] = None
+    descriptions: List[str] = []
+
     def __init__(self, options: Optional[list] = None):
         self.datasets: list[DataSet] = []
         self.meta: list[MetaItem] = []
@@ -74,6 +190,10 @@ class Report(ABC):
     def get_meta_array(self):
         return [[meta.name, meta.value] for meta in self.meta]
 
+    def get_export_meta(self) -> List[List[str]]:
+        """The meta to show at the top of the report's exports, where the format allows"""
+        return self.get_meta_array()
+
     @staticmethod
     def authorize_user(user: User, options: List):
         raise NotImplementedError()
@@ -97,6 +217,78 @@ class TimeScopedReport(Report):
 class PeriodTotalsBreakdown(TimeScopedReport):
     """Generates a report on payments made via specified providers over a given time period"""
 
+    title = "Period Totals Report"
+    descriptions = [
+        "This report provides summaries and totals of payments taken and recorded.",
+        "Totals are calcualted by summing the payments (which are positive in the case of a charge, or negative for a refund).",
+        "Totals are the amount collected, without any costs and fees that are charged to the society or the payment deducted. Hence, these figures should not be used to calculate account transfers to societies.",
+        "All currency is PENCE (i.e. 100 = £1.00)",
+    ]
+
+    def get_export_meta(self) -> List[List[str]]:
+        return [
+            ["Period From", str(self.get_option("start_time"))],
+            ["Period To", str(self.get_option("end_time"))],
+        ] + super().get_export_meta()
+
+    @staticmethod
+    def period_filter(start, end) -> Tuple[Q, List[datetime.date]]:
+        """
+        Split the period into the whole days which have been rolled up, and a
+        filter for the transactions in the rest of the period (the partial
+        days at either end, and any days not yet rolled up).
+        """
+        start_time, end_time = parse_datetime(str(start)), parse_datetime(str(end))
+        if not start_time or not end_time:
+            return Q(created_at__gt=start, created_at__lt=end), []
+        if timezone.is_naive(start_time):
+            start_time = timezone.make_aware(start_time)
+        if timezone.is_naive(end_time):
+            end_time = timezone.make_aware(end_time)
+
+        # Only days which start after the start and end before the end are whole
+        rolled_up_days = list(
+            DailySalesRollupDay.objects.filter(
+                date__gt=timezone.localdate(start_time),
+                date__lt=timezone.localdate(end_time),
+            )
+            .order_by("date")
+            .values_list("date", flat=True)
+        )
+
+        raw_filter = Q()
+        range_start = Q(created_at__gt=start)
+        range_start_time = None
+        for day in rolled_up_days:
+            if day_start(day) != range_start_time:
+                raw_filter |= range_start & Q(created_at__lt=day_start(day))
+            range_start_time = day_start(day + datetime.timedelta(days=1))
+            range_start = Q(created_at__gte=range_start_time)
+        raw_filter |= range_start & Q(created_at__lt=end)
+        return raw_filter, rolled_up_days
+
+    @classmethod
+    def period_totals(cls, payments, start, end) -> List[Dict]:
+        """
+        The total value and count of the payments by production and provider,
+        from the rollup for whole days and from the transactions for the rest
+        of the period.
+        """
+        raw_filter, rolled_up_days = cls.period_filter(start, end)
+        return list(
+            DailySalesRollup.objects.filter(date__in=rolled_up_days)
+            .order_by()
+            .values("production_id", "provider_name")
+            .annotate(total_value=Sum("value"), total_count=Sum("count"))
+        ) + [
+            {"production_id": row["pay_object_production_id"], **row}
+            for row in payments.filter(raw_filter)
+            .annotate_pay_object_performance()  # type: ignore
+            .order_by()
+            .values("pay_object_production_id", "provider_name")
+            .annotate(total_value=Sum("value"), total_count=Count("id"))
+        ]
+
     def run(self):
         start = self.get_option("start_time")
         end = self.get_option("end_time")
@@ -113,83 +305,93 @@ class PeriodTotalsBreakdown(TimeScopedReport):
             created_at__gt=start,
             status=Transaction.Status.COMPLETED,
             created_at__lt=end,
-        ).prefetch_related("pay_object__performance__production__society")
+        )
 
         # Resync any payments that dont have provider fees
         payments.missing_provider_fee().sync()  # type: ignore
 
-        self.meta.append(MetaItem("No. of Payments", str(len(payments))))
+        totals = self.period_totals(payments, start, end)
+        production_names = dict(
+            Production.objects.filter(
+                pk__in={row["production_id"] for row in totals}
+            ).values_list("id", "name")
+        )
+        production_totals: Dict = {}
+        provider_totals: Dict = {}
+        for row in totals:
+            production_id = row["production_id"] or ""
+            production_totals.setdefault(
+                production_id,
+                [production_id, production_names.get(production_id, ""), 0],
+            )[2] += row["total_value"]
+            provider_row = provider_totals.setdefault(
+                row["provider_name"], [row["provider_name"], 0]
+            )
+            provider_row[1] += row["total_value"]
+
         self.meta.append(
-            MetaItem("Total Income", str(sum(payment.value for payment in payments)))
+            MetaItem("No. of Payments", str(sum(row["total_count"] for row in totals)))
+        )
+        self.meta.append(
+            MetaItem("Total Income", str(sum(row["total_value"] for row in totals)))
         )
 
-        for payment in payments:
-            # Handle production
-            row = production_totals_set.find_or_create_row_by_first_column(
-                (
-                    payment.pay_object.performance.production.id
-                    if payment.pay_object
-                    else ""
-                ),
-                [
+        # Sort alphabetically
+        provider_totals_set.data = sorted(
+            provider_totals.values(), key=lambda provider: provider[0]
+        )
+        production_totals_set.data = sorted(
+            production_totals.values(), key=lambda production: production[0]
+        )
+
+        # Bookings are the only pay objects, and always have a performance
+        payment_rows = (
+            payments.annotate_pay_object_performance()  # type: ignore
+            .order_by("created_at")
+            .values(
+                "id",
+                "created_at",
+                "type",
+                "pay_object_id",
+                "pay_object_type_id",
+                "pay_object_performance_id",
+                "pay_object_production_id",
+                "value",
+                "provider_name",
+                "provider_transaction_id",
+            )
+        )
+
+        def payments_data():
+            for payment in payment_rows.iterator(chunk_size=2000):
+                yield [
+                    str(payment["id"]),
+                    payment["created_at"].strftime("%Y-%m-%d %H:%M:%S"),
+                    payment["type"],
                     (
-                        payment.pay_object.performance.production.id
-                        if payment.pay_object
+                        str(payment["pay_object_id"])
+                        if payment["pay_object_performance_id"]
                         else ""
                     ),
                     (
-                        payment.pay_object.performance.production.name
-                        if payment.pay_object
+                        ContentType.objects.get_for_id(payment["pay_object_type_id"])
+                        .model_class()
+                        .__name__
+                        if payment["pay_object_performance_id"]
                         else ""
                     ),
-                    0,
-                ],
-            )
-            row[2] += payment.value
-
-            # Handle Provider
-            row = provider_totals_set.find_or_create_row_by_first_column(
-                payment.provider_name,
-                [
-                    payment.provider_name,
-                    0,
-                ],
-            )
-            row[1] += payment.value
-
-        # Sort alphabetically
-        provider_totals_set.data.sort(key=lambda provider: provider[0])
-        production_totals_set.data.sort(key=lambda production: production[0])
-        payments_data = [
-            [
-                str(payment.id),
-                payment.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-                payment.type,
-                str(payment.pay_object.id) if payment.pay_object else "",
-                type(payment.pay_object).__name__ if payment.pay_object else "",
-                str(
-                    payment.pay_object.performance.production.id
-                    if isinstance(payment.pay_object, Booking)
-                    else ""
-                ),
-                str(
-                    payment.pay_object.performance.production.name
-                    if isinstance(payment.pay_object, Booking)
-                    else ""
-                ),
-                str(payment.value),
-                str(payment.provider_name),
-                str(payment.provider_transaction_id or ""),
-            ]
-            for payment in payments
-        ]
-        payments_data.sort(key=lambda payment: payment[1])
+                    str(payment["pay_object_production_id"] or ""),
+                    str(production_names.get(payment["pay_object_production_id"], "")),
+                    str(payment["value"]),
+                    str(payment["provider_name"]),
+                    str(payment["provider_transaction_id"] or ""),
+                ]
 
         self.datasets.extend(
             [
                 provider_totals_set,
                 production_totals_set,
-                DataSet(
+                LazyDataSet(
                     "Payments",
                     [
                         "Payment ID",
@@ -217,6 +419,27 @@ class PeriodTotalsBreakdown(TimeScopedReport):
 class OutstandingSocietyPayments(Report):
     """Generates a report on outstanding balances to be paid to societies"""
 
+    PRODUCTION_BREAKDOWNS = [
+        SalesBreakdown.Enums.TOTAL_PAYMENTS,
+        SalesBreakdown.Enums.TOTAL_CARD_PAYMENTS,
+        SalesBreakdown.Enums.TOTAL_REFUNDS,
+        SalesBreakdown.Enums.TOTAL_CARD_REFUNDS,
+        SalesBreakdown.Enums.NET_TRANSACTIONS,
+        SalesBreakdown.Enums.NET_CARD_TRANSACTIONS,
+        SalesBreakdown.Enums.PROVIDER_PAYMENT_VALUE,
+        SalesBreakdown.Enums.APP_PAYMENT_VALUE,
+        SalesBreakdown.Enums.SOCIETY_TRANSFER_VALUE,
+    ]
+
+    title = "Outstanding Society Payments"
+    descriptions = [
+        "This report details the production income at the time the report is generated.",
+        "Once the payment has been made, this MUST be recorded on the system in order to remove the balance.",
+        "If the balance for a certain production shows negative, this is because this society owes the STA money. Please do not action negative balances.",
+        "The balance that should be transferred to a production's society is indicated in the 'Society Payment Due' column.",
+        "All currency is PENCE (i.e. 100 = £1.00)",
+    ]
+
     def run(self):
         productions_dataset = DataSet(
             "Productions",
@@ -247,29 +470,40 @@ class OutstandingSocietyPayments(Report):
         )
 
         # Get productions that are marked closed
-        productions = Production.objects.filter(
-            status=Production.Status.CLOSED
-        ).prefetch_related("society")
+        productions = Production.objects.filter(status=Production.Status.CLOSED)
 
         # Sync all payments associated with these productions
         productions.transactions().missing_provider_fee().sync()  # type: ignore
 
-        sta_total_due = 0
-
-        for production in productions:
-            sales_breakdown = production.sales_breakdown()
-            production_sta_fees = sales_breakdown["app_payment_value"]
-            sta_total_due += production_sta_fees
+        # Get the figures for each production, each society and overall from
+        # the sales ledger, grouped in SQL
+        sales_ledger = productions.sales_ledger()  # type: ignore
+        production_breakdowns = sales_ledger.sales_breakdowns_by(
+            "production_id", self.PRODUCTION_BREAKDOWNS
+        )
+        society_breakdowns = sales_ledger.sales_breakdowns_by(
+            "production__society_id", [SalesBreakdown.Enums.SOCIETY_TRANSFER_VALUE]
+        )
+        sta_total_due = sales_ledger.annotate_sales_breakdown(
+            [SalesBreakdown.Enums.APP_PAYMENT_VALUE]
+        )["app_payment_value"]
 
-            if production.society is None:
-                raise GQLException(f"Production {production.id} has no society")
+        empty_breakdown = {breakdown.key: 0 for breakdown in SalesBreakdown.Enums}
+        for production in productions.order_by("id").values(
+            "id", "name", "society_id", "society__name"
+        ):
+            if production["society_id"] is None:
+                raise GQLException(f"Production {production['id']} has no society")
+            sales_breakdown = production_breakdowns.get(
+                production["id"], empty_breakdown
+            )
             productions_dataset.find_or_create_row_by_first_column(
-                production.id,
+                production["id"],
                 [
-                    production.id,
-                    production.name,
-                    production.society.id,
-                    production.society.name,
+                    production["id"],
+                    production["name"],
+                    production["society_id"],
+                    production["society__name"],
                     sales_breakdown["total_payments"],
                     sales_breakdown["total_card_payments"],
                     sales_breakdown["total_refunds"],
@@ -277,20 +511,21 @@ class OutstandingSocietyPayments(Report):
                     sales_breakdown["net_transactions"],
                     sales_breakdown["net_card_transactions"],
                     sales_breakdown["provider_payment_value"],
-                    production_sta_fees,
+                    sales_breakdown["app_payment_value"],
                     sales_breakdown["society_transfer_value"],
                 ],
             )
 
-            row = societies_dataset.find_or_create_row_by_first_column(
-                production.society.id,
+            societies_dataset.find_or_create_row_by_first_column(
+                production["society_id"],
                 [
-                    production.society.id,
-                    production.society.name,
-                    0,
+                    production["society_id"],
+                    production["society__name"],
+                    society_breakdowns.get(production["society_id"], empty_breakdown)[
+                        "society_transfer_value"
+                    ],
                 ],
             )
-            row[2] += sales_breakdown["society_transfer_value"]
 
         societies_dataset.add_row(["", "Stage Technicians' Association", sta_total_due])
         self.meta.append(
@@ -312,28 +547,32 @@ class OutstandingSocietyPayments(Report):
 class PerformanceBookings(Report):
     """Generates a report with the bookings for a production"""
 
+    title = "Performance Bookings"
+    descriptions = [
+        "This report provides details of the bookings for the specified performance",
+    ]
+
     def run(self):
         performance = Performance.objects.get(
             pk=from_global_id(self.get_option("id"))[1]
         )
-        bookings_dataset = DataSet(
-            "Bookings",
-            ["ID", "Reference", "Name", "Email", "Tickets", "Total Paid (Pence)"],
-        )
-
-        self.meta.append(MetaItem("Performance", str(performance)))
-        for booking in (
+        bookings = (
             performance.bookings.filter(status=Payable.Status.PAID)
+            .annotate_sales_breakdowns([SalesBreakdown.Enums.TOTAL_PAYMENTS])
+            .select_related("user")
             .prefetch_related(
-                "transactions",
-                "user",
-                "tickets__seat_group",
-                "tickets__concession_type",
+                Prefetch(
+                    "tickets",
+                    queryset=Ticket.objects.select_related(
+                        "seat_group", "concession_type"
+                    ),
+                )
             )
-            .all()
-        ):
-            bookings_dataset.add_row(
-                [
+        )
+
+        def bookings_data():
+            for booking in iterate_in_chunks(bookings):
+                yield [
                     booking.id,
                     booking.reference,
                     str(booking.user),
@@ -341,8 +580,13 @@ class PerformanceBookings(Report):
                     "\r\n".join([str(ticket) for ticket in booking.tickets.all()]),
                     str(booking.sales_breakdown.total_payments),
                 ]
-            )
 
+        bookings_dataset = LazyDataSet(
+            "Bookings",
+            ["ID", "Reference", "Name", "Email", "Tickets", "Total Paid (Pence)"],
+            bookings_data,
+        )
+        self.meta.append(MetaItem("Performance", str(performance)))
         self.datasets.append(bookings_dataset)
 
     @staticmethod
@@ -363,3 +607,95 @@ class PerformanceBookings(Report):
             pk=from_global_id(get_option(options, "id"))[1]
         ).exists():
             raise GQLException(message="Invalid performance ID option", field="options")
+
+
+class SalesVelocity(TimeScopedReport):
+    """Generates a report on how quickly each production's tickets sold over a given time period"""
+
+    title = "Sales Velocity Report"
+    descriptions = [
+        "This report provides the number and value of the payments taken for each production in each period of time.",
+        "Refunds are not included.",
+        "All currency is PENCE (i.e. 100 = £1.00)",
+    ]
+
+    def get_export_meta(self) -> List[List[str]]:
+        return [
+            ["Period From", str(self.get_option("start_time"))],
+            ["Period To", str(self.get_option("end_time"))],
+        ] + super().get_export_meta()
+
+    @classmethod
+    def validate_options(cls, options: List):
+        super().validate_options(options)
+        if get_option(options, "bucket", "day") not in TIME_BUCKETS:
+            raise GQLException(
+                message="The bucket option must be one of %s" % ", ".join(TIME_BUCKETS),
+                field="options",
+            )
+
+    def run(self):
+        bucket = self.get_option("bucket", "day")
+        payments = TransactionColumns.from_queryset(
+            Transaction.objects.filter(
+                created_at__gt=self.get_option("start_time"),
+                created_at__lt=self.get_option("end_time"),
+                status=Transaction.Status.COMPLETED,
+            )
+        ).of_type(Transaction.Type.PAYMENT)
+
+        (periods, production_ids), inverse = group_by(
+            payments.time_buckets(bucket), payments.production_id
+        )
+        counts = group_count(inverse, len(periods))
+        totals = group_sum(inverse, payments.value, len(periods))
+
+        production_names = dict(
+            Production.objects.filter(pk__in=production_ids.tolist()).values_list(
+                "id", "name"
+            )
+        )
+        self.meta.append(MetaItem("Time Bucket", bucket.title()))
+        self.meta.append(MetaItem("No. of Payments", str(len(payments))))
+        self.meta.append(MetaItem("Total Income", str(int(payments.value.sum()))))
+
+        self.datasets.append(
+            DataSet(
+                "Sales Velocity",
+                [
+                    "Period Start",
+                    "Production ID",
+                    "Production Name",
+                    "No. of Payments",
+                    "Total Income (Pence)",
+                ],
+                [
+                    [
+                        str(period),
+                        "" if production_id == NO_PRODUCTION else production_id,
+                        production_names.get(production_id, ""),
+                        count,
+                        total,
+                    ]
+                    for period, production_id, count, total in zip(
+                        periods.tolist(),
+                        production_ids.tolist(),
+                        counts.tolist(),
+                        totals.tolist(),
+                    )
+                ],
+            )
+        )
+
+    @staticmethod
+    def authorize_user(user: User, options: List):
+        if not user.has_perm("reports.finance_reports"):
+            raise AuthorizationException()
+
+
+available_reports = {
+    "PeriodTotals": {"cls": PeriodTotalsBreakdown},
+    "OutstandingPayments": {"cls": OutstandingSocietyPayments},
+    "PerformanceBookings": {"cls": PerformanceBookings},
+    "SalesVelocity": {"cls": SalesVelocity},
+}
@@ -2,30 +2,27 @@ from typing import List, Optional
 
 import graphene
 from django.conf import settings
+from django.db import transaction
 from django.urls import reverse
-from django.urls.exceptions import NoReverseMatch
+from graphene import relay
 from graphene.types.datetime import DateTime
 from graphene.types.scalars import String
+from graphene_django import DjangoObjectType
 
-from uobtheatre.reports import reports
+from uobtheatre.reports.models import ReportJob
+from uobtheatre.reports.reports import available_reports
+from uobtheatre.reports.tasks import generate_report
 from uobtheatre.reports.utils import generate_report_download_signature
 from uobtheatre.utils.exceptions import GQLException, SafeMutation
 from uobtheatre.utils.schema import AuthRequiredMixin
 
-available_reports = {
-    "PeriodTotals": {
-        "cls": reports.PeriodTotalsBreakdown,
-        "uri": "period_totals",
-    },
-    "OutstandingPayments": {
-        "cls": reports.OutstandingSocietyPayments,
-        "uri": "outstanding_society_payments",
-    },
-    "PerformanceBookings": {
-        "cls": reports.PerformanceBookings,
-        "uri": "performance_bookings",
-    },
-}
+
+class ReportFormat(graphene.Enum):
+    """The formats a report can be exported in"""
+
+    XLSX = "xlsx"
+    CSV = "csv"
+    PARQUET = "parquet"
 
 
 class ReportOption(graphene.InputObjectType):
@@ -49,6 +46,53 @@ class ReportNode(graphene.ObjectType):
     meta = graphene.List(MetaItemNode)
 
 
+class ReportJobNode(DjangoObjectType):
+    """A report being generated in the background"""
+
+    report = graphene.Field(ReportNode)
+    download_uri = graphene.String()
+
+    class Meta:
+        model = ReportJob
+        interfaces = (relay.Node,)
+        fields = (
+            "id",
+            "name",
+            "status",
+            "format",
+            "error",
+            "created_at",
+            "updated_at",
+        )
+
+    @classmethod
+    def get_node(cls, info, id):  # pylint: disable=redefined-builtin
+        job = super().get_node(info, id)
+        if not job or not job.user_can_access(info.context.user):
+            return None
+        return job
+
+    def resolve_report(self, _):
+        result = self.get_result()
+        if not result:
+            return None
+        return {
+            "datasets": result["datasets"],
+            "meta": [{"name": name, "value": value} for name, value in result["meta"]],
+        }
+
+    def resolve_download_uri(self, info):
+        signature = generate_report_download_signature(
+            info.context.user, self.name, self.options, str(self.pk)
+        )
+        return (
+            settings.BASE_URL
+            + reverse("report_job", kwargs={"job_id": self.pk})
+            + "?signature="
+            + signature
+        )
+
+
 class GenerateReport(AuthRequiredMixin, SafeMutation):
     """Mutation to generate a report"""
 
@@ -57,13 +101,24 @@ class GenerateReport(AuthRequiredMixin, SafeMutation):
         start_time = graphene.DateTime()
         end_time = graphene.DateTime()
         options = graphene.List(ReportOption)
+        export_format = ReportFormat(name="format")
 
     download_uri = graphene.String()
-    report = graphene.Field(ReportNode)
-
-    def resolve_report(self, _):
-        self.report.run()
-        return self.report
+    job = graphene.Field(ReportJobNode)
+    report = graphene.Field(
+        ReportNode,
+        deprecation_reason="Reports are generated in the background, use job.report once the job has succeeded",
+    )
+
+    def resolve_download_uri(self, info):
+        if not self.job:
+            return None
+        return ReportJobNode.resolve_download_uri(self.job, info)
+
+    def resolve_report(self, info):
+        if not self.job:
+            return None
+        return ReportJobNode.resolve_report(self.job, info)
 
     @classmethod
     def resolve_mutation(
@@ -74,6 +129,7 @@ class GenerateReport(AuthRequiredMixin, SafeMutation):
         start_time: Optional[DateTime] = None,
         end_time: Optional[DateTime] = None,
         options: Optional[List] = None,
+        export_format: str = "xlsx",
     ):
         if not name in available_reports:
             raise GQLException(
@@ -105,22 +161,18 @@ class GenerateReport(AuthRequiredMixin, SafeMutation):
         matching_report["cls"].validate_options(options)  # type: ignore
         matching_report["cls"].authorize_user(info.context.user, options)  # type: ignore
 
-        # Generate signature to authorize user to access
-        signature = generate_report_download_signature(info.context.user, name, options)
-        try:
-            download_uri = reverse(
-                str(matching_report["uri"]),
-                kwargs={"start_time": start_time, "end_time": end_time},
-            )
-        except NoReverseMatch:
-            download_uri = reverse(
-                str(matching_report["uri"]),
-            )
-
-        return GenerateReport(
-            download_uri=settings.BASE_URL + download_uri + "?signature=" + signature,
-            report=matching_report["cls"](options),  # type: ignore
+        # Share the job for an identical report if one is already running
+        job, created = ReportJob.objects.get_or_create_for(
+            name, options, info.context.user, export_format
         )
+        if created:
+            transaction.on_commit(lambda: generate_report.delay(str(job.pk)))
+
+        return GenerateReport(job=job)
+
+
+class Query(graphene.ObjectType):
+    report_job = relay.Node.Field(ReportJobNode)
 
 
 class Mutation(graphene.ObjectType):
@@ -0,0 +1,20 @@
+from config.celery import app
+from uobtheatre.utils.tasks import BaseTask
+
+
+# The job stores the report, so the task's result isn't needed
+@app.task(base=BaseTask, ignore_result=True)
+def generate_report(job_pk: str):
+    """Run a report job"""
+    from uobtheatre.reports.models import ReportJob
+
+    ReportJob.objects.get(pk=job_pk).run()
+
+
+@app.task(base=BaseTask, ignore_result=True)
+def prune_report_jobs():
+    """Delete the report jobs, and their stored reports, which are past the
+    REPORT_JOB_RETENTION"""
+    from uobtheatre.reports.models import ReportJob
+
+    ReportJob.objects.expired().delete_with_files()
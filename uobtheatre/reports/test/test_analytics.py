@@ -0,0 +1,226 @@
+import datetime
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from django.core.management import CommandError, call_command
+from django.test import override_settings
+from django.utils import timezone
+
+from uobtheatre.bookings.test.factories import BookingFactory
+from uobtheatre.payments.models import Transaction
+from uobtheatre.payments.test.factories import TransactionFactory
+from uobtheatre.reports.analytics import (
+    NO_PRODUCTION,
+    TIME_BUCKETS,
+    TransactionColumns,
+    group_by,
+    group_count,
+    group_sum,
+)
+from uobtheatre.reports.reports import SalesVelocity
+from uobtheatre.utils.exceptions import GQLException
+
+
+def make_aware(*args):
+    return timezone.make_aware(datetime.datetime(*args))
+
+
+@pytest.mark.django_db
+def test_transaction_columns_from_queryset():
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=100)
+    TransactionFactory(
+        pay_object=booking,
+        value=-50,
+        type=Transaction.Type.REFUND,
+        provider_name="CASH",
+    )
+    # A transaction whose booking no longer exists
+    orphan = TransactionFactory(pay_object=booking, value=200)
+    Transaction.objects.filter(pk=orphan.pk).update(pay_object_id=booking.pk + 1000)
+    Transaction.objects.update(created_at=make_aware(2021, 9, 8, 12, 30))
+
+    columns = TransactionColumns.from_queryset(
+        Transaction.objects.order_by("id"), chunk_size=2
+    )
+
+    assert len(columns) == 3
+    assert sorted(columns.value.tolist()) == [-50, 100, 200]
+    assert sorted(columns.production_id.tolist()) == sorted(
+        [booking.performance.production_id] * 2 + [NO_PRODUCTION]
+    )
+    assert set(columns.types) == {"PAYMENT", "REFUND"}
+    assert len(columns.of_type("REFUND")) == 1
+    assert columns.of_type("REFUND").value.tolist() == [-50]
+    assert (
+        columns.time_buckets("hour").tolist() == [datetime.datetime(2021, 9, 8, 12)] * 3
+    )
+    # 2021-09-08 was a Wednesday
+    assert columns.time_buckets("week").tolist() == [datetime.date(2021, 9, 6)] * 3
+    assert columns.time_buckets("month").tolist() == [datetime.date(2021, 9, 1)] * 3
+
+
+@pytest.mark.django_db
+@override_settings(TIME_ZONE="Europe/London")
+def test_transaction_columns_time_buckets_in_current_timezone():
+    for created_at in [
+        # 00:30 BST on 2021-09-08
+        datetime.datetime(2021, 9, 7, 23, 30, tzinfo=datetime.timezone.utc),
+        # 23:30 GMT on 2021-12-07
+        datetime.datetime(2021, 12, 7, 23, 30, tzinfo=datetime.timezone.utc),
+    ]:
+        Transaction.objects.filter(pk=TransactionFactory().pk).update(
+            created_at=created_at
+        )
+
+    columns = TransactionColumns.from_queryset(Transaction.objects.order_by("id"))
+
+    assert columns.time_buckets("hour").tolist() == [
+        datetime.datetime(2021, 9, 8, 0),
+        datetime.datetime(2021, 12, 7, 23),
+    ]
+    assert columns.time_buckets("day").tolist() == [
+        datetime.date(2021, 9, 8),
+        datetime.date(2021, 12, 7),
+    ]
+
+
+@pytest.mark.django_db
+def test_transaction_columns_from_empty_queryset():
+    columns = TransactionColumns.from_queryset(Transaction.objects.none())
+
+    assert len(columns) == 0
+    assert len(columns.of_type("PAYMENT")) == 0
+    (periods, production_ids), inverse = group_by(
+        columns.time_buckets("day"), columns.production_id
+    )
+    assert len(periods) == len(production_ids) == len(inverse) == 0
+
+
+@pytest.mark.parametrize(
+    "keys",
+    [
+        [np.array([3, 1, 3, 2, 1, 3])],
+        [np.array([3, 1, 3, 2, 1, 3]), np.array([1, 1, 2, 2, 1, 1], dtype=np.int8)],
+        # Sparse keys are grouped by sorting
+        [np.array([10**12, 1, 10**12, 5, 1, 10**12])],
+        [
+            np.array(["2021-09-08", "2021-09-01", "2021-09-08"] * 2, "datetime64[D]"),
+            np.array([1, 2, 1, 1, 2, 1]),
+        ],
+    ],
+)
+def test_group_by(keys):
+    values = np.array([1, 2, 3, 4, 5, 6])
+
+    uniques, inverse = group_by(*keys)
+    groups = len(uniques[0])
+    sums = group_sum(inverse, values, groups)
+    counts = group_count(inverse, groups)
+
+    expected = {}
+    for i, key in enumerate(zip(*[key.tolist() for key in keys])):
+        total, count = expected.get(key, (0, 0))
+        expected[key] = (total + values[i], count + 1)
+
+    assert {
+        key: (total, count)
+        for key, total, count in zip(
+            zip(*[unique.tolist() for unique in uniques]),
+            sums.tolist(),
+            counts.tolist(),
+        )
+    } == expected
+    assert list(zip(*[unique.tolist() for unique in uniques])) == sorted(expected)
+
+
+@pytest.mark.django_db
+def test_sales_velocity_report():
+    booking = BookingFactory()
+    payments = [
+        TransactionFactory(pay_object=booking, value=100),
+        TransactionFactory(pay_object=booking, value=200),
+        TransactionFactory(pay_object=booking, value=300),
+        TransactionFactory(
+            pay_object=booking, value=-300, type=Transaction.Type.REFUND
+        ),
+        TransactionFactory(
+            pay_object=booking, value=500, status=Transaction.Status.PENDING
+        ),
+    ]
+    for payment, created_at in zip(
+        payments,
+        [
+            make_aware(2021, 9, 8, 10),
+            make_aware(2021, 9, 8, 11),
+            make_aware(2021, 9, 9, 10),
+            make_aware(2021, 9, 9, 10),
+            make_aware(2021, 9, 9, 10),
+        ],
+    ):
+        Transaction.objects.filter(pk=payment.pk).update(created_at=created_at)
+
+    report = SalesVelocity(
+        [
+            {"name": "start_time", "value": "2021-09-01T00:00:00+00:00"},
+            {"name": "end_time", "value": "2021-10-01T00:00:00+00:00"},
+        ]
+    )
+    report.run()
+
+    assert report.get_meta_array() == [
+        ["Time Bucket", "Day"],
+        ["No. of Payments", "3"],
+        ["Total Income", "600"],
+    ]
+    production = booking.performance.production
+    assert report.datasets[0].data == [
+        ["2021-09-08", production.id, production.name, 2, 300],
+        ["2021-09-09", production.id, production.name, 1, 300],
+    ]
+
+
+def test_sales_velocity_report_validates_bucket():
+    with pytest.raises(GQLException):
+        SalesVelocity(
+            [
+                {"name": "start_time", "value": "2021-09-01T00:00:00+00:00"},
+                {"name": "end_time", "value": "2021-10-01T00:00:00+00:00"},
+                {"name": "bucket", "value": "fortnight"},
+            ]
+        )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("bucket", TIME_BUCKETS)
+def test_benchmark_report_analytics(capsys, bucket):
+    booking = BookingFactory()
+    TransactionFactory(pay_object=booking, value=100)
+
+    call_command("benchmark_report_analytics", synthetic=50, bucket=bucket)
+
+    output = capsys.readouterr().out
+    assert "Model instances" in output
+    assert "The SalesVelocity report is" in output
+    # The synthetic payments are rolled back
+    assert Transaction.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_benchmark_report_analytics_mismatch(capsys):
+    TransactionFactory(value=100)
+
+    with patch(
+        "uobtheatre.management.commands.benchmark_report_analytics.aggregate_report",
+        return_value={},
+    ):
+        call_command("benchmark_report_analytics")
+
+    assert "The results do not match" in capsys.readouterr().out
+
+
+@pytest.mark.django_db
+def test_benchmark_report_analytics_without_bookings():
+    with pytest.raises(CommandError):
+        call_command("benchmark_report_analytics", synthetic=50)
@@ -1,6 +1,8 @@
+import datetime
 from unittest.mock import patch
 
 import pytest
+from django.db.models import Q
 from django.utils import timezone
 from graphql_relay import to_global_id
 
@@ -15,6 +17,7 @@ from uobtheatre.discounts.test.factories import (
     ConcessionTypeFactory,
     DiscountRequirementFactory,
 )
+from uobtheatre.finance.models import DailySalesRollup
 from uobtheatre.payments import transaction_providers
 from uobtheatre.payments.models import Transaction
 from uobtheatre.payments.payables import Payable
@@ -23,12 +26,15 @@ from uobtheatre.productions.models import Performance, Production
 from uobtheatre.productions.test.factories import PerformanceFactory, ProductionFactory
 from uobtheatre.reports.reports import (
     DataSet,
+    LazyDataSet,
     MetaItem,
     OutstandingSocietyPayments,
     PerformanceBookings,
     PeriodTotalsBreakdown,
     Report,
+    SpooledDataSet,
     get_option,
+    iterate_in_chunks,
     require_option,
 )
 from uobtheatre.societies.test.factories import SocietyFactory
@@ -199,6 +205,79 @@ def test_dataset_class():
     assert len(dataset.data) == 1
     assert row is row_2
 
+    # Rows added or replaced directly are still found
+    dataset.data.append(["Another ID", "Another value"])
+    assert dataset.find_or_create_row_by_first_column("Another ID", []) == [
+        "Another ID",
+        "Another value",
+    ]
+    dataset.data = [["Replaced ID", "Replaced value"]]
+    assert dataset.find_or_create_row_by_first_column("My Unique ID", ["My Unique ID"])
+    assert dataset.data == [["Replaced ID", "Replaced value"], ["My Unique ID"]]
+
+    # Empty rows are added, but not indexed
+    dataset.add_row([])
+    assert dataset.find_or_create_row_by_first_column("My Unique ID", []) == [
+        "My Unique ID"
+    ]
+    assert dataset.data == [["Replaced ID", "Replaced value"], ["My Unique ID"], []]
+
+
+def test_lazy_dataset_class():
+    generated = []
+
+    def rows():
+        for i in range(3):
+            generated.append(i)
+            yield [i, "Row %s" % i]
+
+    dataset = LazyDataSet("My Dataset", ["Heading 1", "Heading 2"], rows)
+
+    # Rows aren't generated until they are iterated over
+    assert not generated
+    assert next(dataset.iter_rows()) == [0, "Row 0"]
+    assert dataset.data == [[0, "Row 0"], [1, "Row 1"], [2, "Row 2"]]
+
+    with pytest.raises(TypeError):
+        dataset.add_row([3, "Row 3"])
+
+
+def test_spooled_dataset_class():
+    generated = []
+
+    def rows():
+        for i in range(3):
+            generated.append(i)
+            yield [i, datetime.date(2021, 9, i + 1)]
+
+    with SpooledDataSet(
+        LazyDataSet("My Dataset", ["Heading 1", "Heading 2"], rows)
+    ) as dataset:
+        # The rows are generated once, and can be iterated over repeatedly
+        assert generated == [0, 1, 2]
+        for _ in range(2):
+            assert list(dataset.iter_rows()) == [
+                [i, datetime.date(2021, 9, i + 1)] for i in range(3)
+            ]
+        assert generated == [0, 1, 2]
+        assert dataset.name == "My Dataset"
+        assert dataset.headings == ["Heading 1", "Heading 2"]
+
+    assert dataset.spool.closed
+
+
+@pytest.mark.django_db
+def test_iterate_in_chunks(django_assert_num_queries):
+    bookings = BookingFactory.create_batch(5)
+
+    with django_assert_num_queries(3 * 2):
+        assert [
+            (booking, list(booking.tickets.all()))
+            for booking in iterate_in_chunks(
+                Booking.objects.prefetch_related("tickets"), chunk_size=2
+            )
+        ] == [(booking, []) for booking in bookings]
+
 
 def test_abstract_report():
     class SimpleReport(Report):
@@ -236,7 +315,7 @@ def test_require_option():
 
 @pytest.mark.django_db
 def test_period_totals_breakdown_report():
-    (payment_1, _, payment_3, payment_4, refund_1) = create_fixtures()
+    payment_1, _, payment_3, payment_4, refund_1 = create_fixtures()
     booking_1 = payment_1.pay_object
     booking_3 = payment_3.pay_object
     booking_5 = payment_4.pay_object
@@ -338,6 +417,55 @@ def test_period_totals_breakdown_report():
     ]
 
 
+@pytest.mark.django_db
+def test_period_totals_breakdown_report_uses_rollup():
+    create_fixtures()
+    options = [
+        {"name": "start_time", "value": "2021-09-04T12:00:00+00:00"},
+        {"name": "end_time", "value": "2021-09-09T12:00:00+00:00"},
+    ]
+
+    raw_report = PeriodTotalsBreakdown(options)
+    raw_report.run()
+
+    DailySalesRollup.objects.update_rollups(today=datetime.date(2021, 9, 10))
+    _, rolled_up_days = PeriodTotalsBreakdown.period_filter(
+        options[0]["value"], options[1]["value"]
+    )
+    assert rolled_up_days == [datetime.date(2021, 9, day) for day in range(5, 9)]
+
+    rollup_report = PeriodTotalsBreakdown(options)
+    rollup_report.run()
+
+    assert raw_report.meta[0].value == "5"
+    assert rollup_report.get_meta_array() == raw_report.get_meta_array()
+    assert rollup_report.datasets == raw_report.datasets
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "start, end, expected_days",
+    [
+        # Naive times are in the current timezone
+        ("2021-09-04T12:00:00", "2021-09-09T12:00:00", range(5, 9)),
+        ("2021-09-04T12:00:00+00:00", "2021-09-09T12:00:00", range(5, 9)),
+        ("2021-09-04T12:00:00", "2021-09-09T12:00:00+00:00", range(5, 9)),
+        # Times which aren't datetimes are filtered on as given
+        ("2021-09-04", "2021-09-09T12:00:00+00:00", []),
+        ("2021-09-04T12:00:00+00:00", "2021-09-09", []),
+    ],
+)
+def test_period_filter(start, end, expected_days):
+    create_fixtures()
+    DailySalesRollup.objects.update_rollups(today=datetime.date(2021, 9, 10))
+
+    raw_filter, rolled_up_days = PeriodTotalsBreakdown.period_filter(start, end)
+
+    assert rolled_up_days == [datetime.date(2021, 9, day) for day in expected_days]
+    if not expected_days:
+        assert raw_filter == Q(created_at__gt=start, created_at__lt=end)
+
+
 @pytest.mark.django_db
 def test_outstanding_society_payments_report():
     create_fixtures()
@@ -392,15 +520,74 @@ def test_outstanding_society_payments_report():
     ]
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize("productions_per_society", [1, 3])
+def test_outstanding_society_payments_report_queries(
+    django_assert_num_queries, productions_per_society
+):
+    for society in SocietyFactory.create_batch(2):
+        for _ in range(productions_per_society):
+            TransactionFactory(
+                pay_object=BookingFactory(
+                    performance=PerformanceFactory(
+                        production=ProductionFactory(
+                            society=society, status=Production.Status.CLOSED
+                        )
+                    )
+                ),
+                value=100,
+                app_fee=10,
+                provider_fee=0,
+            )
+
+    # The number of queries doesn't depend on the number of productions
+    with patch("uobtheatre.payments.models.TransactionQuerySet.sync"):
+        with django_assert_num_queries(4):
+            report = OutstandingSocietyPayments()
+            report.run()
+
+    assert len(report.datasets[1].data) == 2 * productions_per_society
+    assert [row[2] for row in report.datasets[0].data] == [
+        90 * productions_per_society,
+        90 * productions_per_society,
+        20 * productions_per_society,
+    ]
+
+
 @pytest.mark.django_db
 def test_outstanding_society_payments_report_production_no_society():
     ProductionFactory(id=1, status=Production.Status.CLOSED, society=None)
 
-    with patch("uobtheatre.payments.models.TransactionQuerySet.sync") as mock_sync:
-        with pytest.raises(GQLException) as exception:
-            OutstandingSocietyPayments().run()
-        assert exception.value.message == "Production 1 has no society"
-    mock_sync.aassert_not_called()
+    with pytest.raises(GQLException) as exception:
+        OutstandingSocietyPayments().run()
+    assert exception.value.message == "Production 1 has no society"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("num_bookings", [1, 5])
+def test_performance_bookings_report_query_count(
+    num_bookings, django_assert_num_queries
+):
+    performance = PerformanceFactory()
+    for _ in range(num_bookings):
+        booking = BookingFactory(performance=performance, status=Payable.Status.PAID)
+        TicketFactory(booking=booking)
+        TicketFactory(booking=booking)
+        TransactionFactory(pay_object=booking, value=1000)
+        TransactionFactory(pay_object=booking, value=-200, type=Transaction.Type.REFUND)
+
+    report = PerformanceBookings(
+        [{"name": "id", "value": to_global_id("PerformanceNode", performance.pk)}]
+    )
+    report.run()
+
+    # One query for the bookings (with their users and payment totals) and one
+    # for their tickets, however many bookings there are
+    with django_assert_num_queries(2):
+        data = report.datasets[0].data
+
+    assert len(data) == num_bookings
+    assert all(row[5] == "1000" for row in data)
 
 
 @pytest.mark.django_db
@@ -1,33 +1,35 @@
+from unittest.mock import patch
+
 import pytest
 from graphql_relay.node.node import to_global_id
 from guardian.shortcuts import assign_perm
 
 from uobtheatre.productions.test.factories import PerformanceFactory
+from uobtheatre.reports.models import ReportJob
+from uobtheatre.reports.tasks import generate_report
+from uobtheatre.users.test.factories import UserFactory
 
 
 @pytest.mark.django_db
 @pytest.mark.parametrize(
-    "report_name, expected_uri, dataset_names",
+    "report_name, dataset_names",
     [
-        (
-            "PeriodTotals",
-            "https://api.example.com/reports/period_totals/2020-01-01%2000:00:00+00:00/2021-01-01%2000:00:00+00:00",
-            ["Provider Totals", "Production Totals", "Payments"],
-        ),
-        (
-            "OutstandingPayments",
-            "https://api.example.com/reports/outstanding_society_payments",
-            ["Societies", "Productions"],
-        ),
+        ("PeriodTotals", ["Provider Totals", "Production Totals", "Payments"]),
+        ("OutstandingPayments", ["Societies", "Productions"]),
+        ("SalesVelocity", ["Sales Velocity"]),
     ],
 )
 def test_can_generate_report_link_for_finance_reports(
-    gql_client, report_name, expected_uri, dataset_names
+    gql_client, django_capture_on_commit_callbacks, report_name, dataset_names
 ):
     request = """
         mutation{
             generateReport(name: "%s", startTime: "2020-01-01T00:00:00+00:00", endTime:"2021-01-01T00:00:00+00:00") {
                 downloadUri
+                job {
+                    id
+                    status
+                }
                 report {
                     datasets {
                         name
@@ -38,22 +40,104 @@ def test_can_generate_report_link_for_finance_reports(
     """
     gql_client.login()
     assign_perm("reports.finance_reports", gql_client.user)
-    response = gql_client.execute(request % report_name)
+    with patch("uobtheatre.reports.schema.generate_report.delay") as mock_delay:
+        with django_capture_on_commit_callbacks(execute=True):
+            response = gql_client.execute(request % report_name)
+
+    job = ReportJob.objects.get()
+    mock_delay.assert_called_once_with(str(job.pk))
+    assert response["data"]["generateReport"]["job"] == {
+        "id": to_global_id("ReportJobNode", job.pk),
+        "status": "PENDING",
+    }
+    assert response["data"]["generateReport"]["report"] is None
     split_url = response["data"]["generateReport"]["downloadUri"].split("?")
-    assert split_url[0] == expected_uri
+    assert split_url[0] == "https://api.example.com/reports/jobs/%s" % job.pk
     assert split_url[1] is not None
 
-    assert response["data"]["generateReport"]["report"]["datasets"] == [
+    # Once the job has run, the report can be fetched from it
+    generate_report(str(job.pk))
+
+    response = gql_client.execute("""
+        {
+            reportJob(id: "%s") {
+                status
+                report {
+                    datasets {
+                        name
+                    }
+                }
+            }
+        }
+        """ % to_global_id("ReportJobNode", job.pk))
+    assert response["data"]["reportJob"]["status"] == "SUCCESS"
+    assert response["data"]["reportJob"]["report"]["datasets"] == [
         {"name": name} for name in dataset_names
     ]
 
 
+@pytest.mark.django_db
+def test_identical_reports_share_active_job(gql_client):
+    request = """
+        mutation{
+            generateReport(name: "OutstandingPayments") {
+                job {
+                    id
+                }
+            }
+        }
+    """
+    gql_client.login()
+    assign_perm("reports.finance_reports", gql_client.user)
+
+    first_job = gql_client.execute(request)["data"]["generateReport"]["job"]
+    assert gql_client.execute(request)["data"]["generateReport"]["job"] == first_job
+
+    # A different format is a different job
+    csv_job = gql_client.execute(
+        request.replace(
+            'name: "OutstandingPayments"', 'name: "OutstandingPayments", format: CSV'
+        )
+    )["data"]["generateReport"]["job"]
+    assert csv_job != first_job
+    assert ReportJob.objects.get(format="csv").status == ReportJob.Status.PENDING
+    ReportJob.objects.filter(format="csv").delete()
+
+    # Once the job has finished, a new job is created
+    generate_report(str(ReportJob.objects.get().pk))
+    assert gql_client.execute(request)["data"]["generateReport"]["job"] != first_job
+    assert ReportJob.objects.count() == 2
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("with_perm", [True, False])
+def test_report_job_requires_report_authorization(gql_client, with_perm):
+    job, _ = ReportJob.objects.get_or_create_for(
+        "OutstandingPayments", [], UserFactory()
+    )
+    request = """
+        {
+            reportJob(id: "%s") {
+                status
+            }
+        }
+    """ % to_global_id("ReportJobNode", job.pk)
+    gql_client.login()
+    if with_perm:
+        assign_perm("reports.finance_reports", gql_client.user)
+
+    assert gql_client.execute(request)["data"]["reportJob"] == (
+        {"status": "PENDING"} if with_perm else None
+    )
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "report_name",
     [
         ("PeriodTotals",),
         ("OutstandingPayments",),
+        ("SalesVelocity",),
     ],
 )
 def test_unauthorized_cant_generate_finance_reports(gql_client, report_name):
@@ -124,7 +208,9 @@ def test_can_generate_report_for_performance_bookings(
         }
     else:
         split_url = response["data"]["generateReport"]["downloadUri"].split("?")
-        assert split_url[0] == "https://api.example.com/reports/performance_bookings"
+        assert split_url[0] == "https://api.example.com/reports/jobs/%s" % (
+            ReportJob.objects.get().pk
+        )
         assert split_url[1] is not None
 
 
@@ -134,6 +220,11 @@ def test_requesting_nonexistant_report(gql_client):
         mutation{
             generateReport(name: "FakeReport") {
                 downloadUri
+                report {
+                    meta {
+                        name
+                    }
+                }
                 success
                 errors {
                     __typename
@@ -149,6 +240,7 @@ def test_requesting_nonexistant_report(gql_client):
     response = gql_client.login().execute(request)
 
     assert response["data"]["generateReport"]["downloadUri"] is None
+    assert response["data"]["generateReport"]["report"] is None
     assert response["data"]["generateReport"]["success"] is False
     assert response["data"]["generateReport"]["errors"][0]["__typename"] == "FieldError"
     assert response["data"]["generateReport"]["errors"][0]["field"] == "name"
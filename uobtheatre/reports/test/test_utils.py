@@ -1,11 +1,19 @@
+import csv
+import io
 import time
+import zipfile
 from datetime import timedelta
 from unittest.mock import patch
 
 import pytest
+from django.http.response import FileResponse, StreamingHttpResponse
 
 from uobtheatre.reports.exceptions import InvalidReportSignature
+from uobtheatre.reports.reports import DataSet, LazyDataSet, Report
 from uobtheatre.reports.utils import (
+    CsvReport,
+    ExcelReport,
+    ParquetReport,
     generate_report_download_signature,
     validate_report_download_signature,
 )
@@ -44,3 +52,111 @@ def test_validate_expired_report_signature():
 
     with pytest.raises(InvalidReportSignature):
         validate_report_download_signature(signature)
+
+
+class MyReport(Report):  # pylint: disable=abstract-method
+    def run(self):
+        self.datasets.append(DataSet("Totals", ["Name", "Total"], [["A", 1]]))
+        self.datasets.append(
+            LazyDataSet(
+                "Rows",
+                ["ID", "Value"],
+                lambda: ([i, "Value %s" % i] for i in range(1000)),
+            )
+        )
+
+
+@pytest.mark.django_db
+def test_excel_report_streams_lazy_datasets():
+    response = ExcelReport(MyReport(), "My Report", ["A description"]).get_response()
+
+    assert isinstance(response, FileResponse)
+    assert response["Content-Disposition"] == 'attachment; filename="my_report.xlsx"'
+    with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as xlsx:
+        sheet = xlsx.read("xl/worksheets/sheet1.xml").decode()
+    assert "Description and Usage Notes:" in sheet
+    assert "Value 0" in sheet
+    assert "Value 999" in sheet
+
+
+@pytest.mark.django_db
+def test_excel_report_writers():
+    excel = ExcelReport(
+        MyReport(), "", [], meta=["Not a pair", ["Key", "Value"]], user=UserFactory()
+    )
+    row = excel.row_tracker
+    excel.set_col_width("E:E", 30)
+    excel.write_bold(row, 0, "Bold text")
+    excel.write_currency(row, 1, 12.5)
+    excel.write_formula(row, 2, "=B%s*2" % (row + 1))
+    excel.row_tracker += 2
+
+    with zipfile.ZipFile(excel.get_output()) as xlsx:
+        sheet = xlsx.read("xl/worksheets/sheet1.xml").decode()
+    assert "Key" in sheet
+    assert "Not a pair" not in sheet
+    assert "Description and Usage Notes:" not in sheet
+    assert "Bold text" in sheet
+    assert "<v>12.5</v>" in sheet
+    assert "<f>B%s*2</f>" % (row + 1) in sheet
+    assert "Value 999" in sheet
+
+
+def test_csv_report():
+    response = CsvReport(MyReport(), "My Report").get_response()
+
+    assert isinstance(response, StreamingHttpResponse)
+    assert response["Content-Type"] == "text/csv"
+    assert response["Content-Disposition"] == 'attachment; filename="my_report.csv"'
+    rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+    assert rows[:6] == [
+        ["Totals"],
+        ["Name", "Total"],
+        ["A", "1"],
+        [],
+        ["Rows"],
+        ["ID", "Value"],
+    ]
+    assert len(rows) == 6 + 1000 + 1
+    assert rows[-2] == ["999", "Value 999"]
+
+
+def test_csv_report_single_dataset():
+    report = MyReport()
+    report.datasets.append(DataSet("Totals", ["Name", "Total"], [["A", 1]]))
+
+    assert CsvReport(report).get_output().read() == b"Name,Total\r\nA,1\r\n"
+
+
+def test_parquet_report():
+    parquet = pytest.importorskip("pyarrow.parquet")
+    renderer = ParquetReport(MyReport(), "My Report")
+
+    assert renderer.filename == "my_report.zip"
+    with patch.object(ParquetReport, "ROW_GROUP_SIZE", 300):
+        output = renderer.get_output()
+    with zipfile.ZipFile(output) as archive:
+        assert archive.namelist() == ["totals.parquet", "rows.parquet"]
+        with archive.open("rows.parquet") as rows_file:
+            rows = parquet.ParquetFile(io.BytesIO(rows_file.read()))
+
+    assert rows.metadata.num_row_groups == 4
+    table = rows.read()
+    assert table.column_names == ["ID", "Value"]
+    assert table.num_rows == 1000
+    assert table.column("Value")[999].as_py() == "Value 999"
+
+
+def test_parquet_report_single_dataset():
+    parquet = pytest.importorskip("pyarrow.parquet")
+    report = MyReport()
+    report.datasets.append(
+        DataSet("Totals", ["Name", "Total"], [["A", 1], ["B", None]])
+    )
+    renderer = ParquetReport(report, "My Report")
+
+    assert renderer.filename == "my_report.parquet"
+    assert parquet.read_table(renderer.get_output()).to_pylist() == [
+        {"Name": "A", "Total": "1"},
+        {"Name": "B", "Total": None},
+    ]
@@ -1,20 +1,30 @@
+import json
+import zipfile
 from datetime import datetime, timedelta
 from unittest.mock import patch
+from xml.etree import ElementTree
 
 import pytest
 import pytz
+from django.conf import settings
 from django.http.response import HttpResponse
 from django.test import TestCase
 from django.test.client import RequestFactory
 from django.urls import reverse
+from django.utils import timezone
 from graphql_relay.node.node import to_global_id
+from guardian.shortcuts import assign_perm
 
 from uobtheatre.productions.test.factories import PerformanceFactory
+from uobtheatre.reports.models import ReportJob, ReportJobQuerySet
 from uobtheatre.reports.reports import (
+    DataSet,
+    LazyDataSet,
     OutstandingSocietyPayments,
     PerformanceBookings,
     PeriodTotalsBreakdown,
 )
+from uobtheatre.reports.tasks import prune_report_jobs
 from uobtheatre.reports.utils import ExcelReport, generate_report_download_signature
 from uobtheatre.reports.views import ValidSignatureMiddleware
 from uobtheatre.users.test.factories import UserFactory
@@ -124,3 +134,223 @@ class PerformanceBookingsTests(TestCase):
             )
         )
         self.assertEqual(response.status_code, 403)
+
+
+@pytest.mark.django_db
+def test_report_job_download(client):
+    user = UserFactory()
+    assign_perm("reports.finance_reports", user)
+    job, _ = ReportJob.objects.get_or_create_for("OutstandingPayments", [], user)
+    url = reverse("report_job", kwargs={"job_id": job.pk})
+    signature = generate_report_download_signature(
+        user, "OutstandingPayments", [], str(job.pk)
+    )
+
+    # Signatures must be for the job
+    response = client.get(
+        url
+        + "?signature="
+        + generate_report_download_signature(user, "OutstandingPayments", [])
+    )
+    assert response.status_code == 403
+
+    response = client.get(url + "?signature=" + signature)
+    assert response.status_code == 409
+
+    with patch.object(
+        OutstandingSocietyPayments, "run", side_effect=Exception("Report failed")
+    ):
+        with pytest.raises(Exception):
+            job.run()
+    assert job.status == ReportJob.Status.FAILURE
+    assert job.error == "Report failed"
+
+    job, _ = ReportJob.objects.get_or_create_for("OutstandingPayments", [], user)
+    job.run()
+    job.refresh_from_db()
+    assert job.status == ReportJob.Status.SUCCESS
+
+    # The report is only run once, however many times it is downloaded
+    with patch.object(OutstandingSocietyPayments, "run") as mock_run:
+        for _ in range(2):
+            response = client.get(
+                reverse("report_job", kwargs={"job_id": job.pk})
+                + "?signature="
+                + generate_report_download_signature(
+                    user, "OutstandingPayments", [], str(job.pk)
+                )
+            )
+            assert response.status_code == 200
+            assert response["Content-Disposition"] == (
+                'attachment; filename="outstanding_society_payments.xlsx"'
+            )
+            assert b"".join(response.streaming_content)[:2] == b"PK"
+        mock_run.assert_not_called()
+
+
+def read_xlsx_rows(file):
+    """The text of the cells in each row of an XLSX file's first sheet"""
+    namespace = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+    with zipfile.ZipFile(file) as xlsx:
+        sheet = ElementTree.fromstring(xlsx.read("xl/worksheets/sheet1.xml"))
+    return [
+        ["".join(cell.itertext()) for cell in row.iter(namespace + "c")]
+        for row in sheet.iter(namespace + "row")
+    ]
+
+
+@pytest.mark.django_db
+def test_report_job_stores_datasets():
+    user = UserFactory()
+    job, _ = ReportJob.objects.get_or_create_for("OutstandingPayments", [], user)
+
+    def run(report):
+        report.datasets.append(
+            DataSet(
+                "Payments",
+                ["Society", "Total"],
+                [["Society A", 100], ["Society B", 200]],
+            )
+        )
+
+    with patch.object(
+        OutstandingSocietyPayments, "run", autospec=True, side_effect=run
+    ):
+        job.run()
+
+    with job.file.open("rb") as file:
+        rows = read_xlsx_rows(file)
+    payments_index = rows.index(["Payments"])
+    assert rows[payments_index + 1 :] == [
+        ["Society", "Total"],
+        ["Society A", "100"],
+        ["Society B", "200"],
+    ]
+
+    with job.result.open("rb") as file:
+        assert json.load(file)["datasets"] == [
+            {
+                "name": "Payments",
+                "headings": ["Society", "Total"],
+                "data": [["Society A", 100], ["Society B", 200]],
+            }
+        ]
+
+
+@pytest.mark.django_db
+def test_report_job_generates_lazy_datasets_once():
+    job, _ = ReportJob.objects.get_or_create_for(
+        "OutstandingPayments", [], UserFactory()
+    )
+    generated = []
+
+    def payment_rows():
+        generated.append(len(generated))
+        yield ["Society %s" % len(generated), 100]
+
+    def run(report):
+        report.datasets.append(
+            LazyDataSet("Payments", ["Society", "Total"], payment_rows)
+        )
+
+    with patch.object(
+        OutstandingSocietyPayments, "run", autospec=True, side_effect=run
+    ):
+        job.run()
+
+    # The result and the export are written from the same rows
+    assert generated == [0]
+    assert job.get_result()["datasets"][0]["data"] == [["Society 1", 100]]
+    with job.file.open("rb") as file:
+        rows = read_xlsx_rows(file)
+    assert rows[rows.index(["Payments"]) + 2 :] == [["Society 1", "100"]]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "export_format, status_code, content_type",
+    [
+        ("csv", 200, "text/csv"),
+        ("parquet", 200, "application/zip"),
+        ("pdf", 404, None),
+    ],
+)
+def test_report_view_export_formats(client, export_format, status_code, content_type):
+    user = UserFactory()
+    assign_perm("reports.finance_reports", user)
+    response = client.get(
+        reverse("outstanding_society_payments")
+        + "?format=%s&signature=%s"
+        % (
+            export_format,
+            generate_report_download_signature(user, "OutstandingPayments"),
+        )
+    )
+
+    assert response.status_code == status_code
+    if content_type:
+        assert response["Content-Type"] == content_type
+
+
+@pytest.mark.django_db
+def test_report_job_created_concurrently():
+    user = UserFactory()
+    job, _ = ReportJob.objects.get_or_create_for("OutstandingPayments", [], user)
+
+    # The job is created by another request between the lookup and the create
+    with patch.object(ReportJobQuerySet, "first", return_value=None):
+        assert ReportJob.objects.get_or_create_for("OutstandingPayments", [], user) == (
+            job,
+            False,
+        )
+
+
+@pytest.mark.django_db
+def test_report_job_only_runs_once():
+    job, _ = ReportJob.objects.get_or_create_for(
+        "OutstandingPayments", [], UserFactory()
+    )
+
+    job.run()
+    with patch.object(OutstandingSocietyPayments, "run") as mock_run:
+        job.run()
+
+    mock_run.assert_not_called()
+    assert job.status == ReportJob.Status.SUCCESS
+
+
+@pytest.mark.django_db
+def test_report_job_stores_reports_privately():
+    job, _ = ReportJob.objects.get_or_create_for(
+        "OutstandingPayments", [], UserFactory()
+    )
+    job.run()
+
+    for stored in (job.result, job.file):
+        assert stored.storage.location == settings.PRIVATE_MEDIAFILES_LOCATION
+        assert stored.storage.exists(stored.name)
+
+
+@pytest.mark.django_db
+def test_prune_report_jobs():
+    user = UserFactory()
+    expired, _ = ReportJob.objects.get_or_create_for("OutstandingPayments", [], user)
+    expired.run()
+    recent, _ = ReportJob.objects.get_or_create_for(
+        "OutstandingPayments", [], user, export_format="csv"
+    )
+    recent.run()
+    running, _ = ReportJob.objects.get_or_create_for(
+        "OutstandingPayments", [], user, export_format="parquet"
+    )
+    ReportJob.objects.filter(pk=running.pk).update(status=ReportJob.Status.RUNNING)
+    ReportJob.objects.exclude(pk=recent.pk).update(
+        updated_at=timezone.now() - settings.REPORT_JOB_RETENTION - timedelta(hours=1)
+    )
+
+    prune_report_jobs()
+
+    assert set(ReportJob.objects.all()) == {recent, running}
+    assert not expired.result.storage.exists(expired.result.name)
+    assert not expired.file.storage.exists(expired.file.name)
+    assert recent.file.storage.exists(recent.file.name)
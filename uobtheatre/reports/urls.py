@@ -3,6 +3,11 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
+    path(
+        "jobs/<uuid:job_id>",
+        views.report_job,  # type: ignore[arg-type]
+        name="report_job",
+    ),
     path(
         "period_totals/<str:start_time>/<str:end_time>",
         views.period_totals,  # type: ignore[arg-type]
@@ -1,11 +1,22 @@
-import io
+import abc
+import csv
+import itertools
+import json
+import tempfile
+import zipfile
+from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import List, Optional, Tuple
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple, Type
 
 import xlsxwriter
 from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.signing import TimestampSigner
-from django.http.response import HttpResponse
+from django.http.response import (
+    FileResponse,
+    HttpResponseBase,
+    StreamingHttpResponse,
+)
 
 from uobtheatre.reports.exceptions import InvalidReportSignature
 from uobtheatre.users.models import User
@@ -15,8 +26,11 @@ from . import reports
 signer = TimestampSigner()
 
 
-class ExcelReport:  # pragma: no cover
-    """Generates an Excel xlxs spreadsheet"""
+class ReportRenderer(abc.ABC):
+    """Base class for the formats a report can be exported in"""
+
+    extension: str
+    content_type: str
 
     def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
         self,
@@ -26,17 +40,69 @@ class ExcelReport:  # pragma: no cover
         meta: Optional[List] = None,
         user: Optional[User] = None,
     ) -> None:
-        """Initalise worbook, sheet, formatters, meta, headers and description"""
-        self.name = name
-        self.output_buffer = io.BytesIO()
-        self.row_tracker = 1  # Track the row we are currently at
-
         self.report = report
         if not self.report.datasets:
             self.report.run()
 
+        # Default to the report's title, descriptions and meta
+        self.name = report.title if name is None else name
+        self.descriptions = (
+            report.descriptions if descriptions is None else descriptions
+        )
+        self.meta = report.get_export_meta() if meta is None else meta
+        self.user = user
+
+    @property
+    def filename(self) -> str:
+        return (
+            (self.name or "uobtheatre-export").lower().replace(" ", "_")
+            + "."
+            + self.extension
+        )
+
+    @abc.abstractmethod
+    def get_output(self) -> IO[bytes]:
+        """Renders the report to a file, returned at its start"""
+
+    def get_response(self) -> HttpResponseBase:
+        """Renders the report and returns a streaming Http response to download the result"""
+        return FileResponse(
+            self.get_output(),
+            as_attachment=True,
+            filename=self.filename,
+            content_type=self.content_type,
+        )
+
+
+class ExcelReport(ReportRenderer):
+    """Generates an Excel xlxs spreadsheet
+
+    The workbook is written a row at a time, in xlsxwriter's constant memory
+    mode, to a temporary file which is then streamed in the response. This
+    keeps the memory used flat however many rows the report's data sets
+    generate.
+    """
+
+    extension = "xlsx"
+    content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        report: reports.Report,
+        name: Optional[str] = None,
+        descriptions: Optional[List] = None,
+        meta: Optional[List] = None,
+        user: Optional[User] = None,
+    ) -> None:
+        """Initalise worbook, sheet, formatters, meta, headers and description"""
+        super().__init__(report, name, descriptions, meta, user)
+        name, descriptions, meta = self.name, self.descriptions, self.meta
+
+        self.output_file = tempfile.TemporaryFile()
+        self.row_tracker = 0  # Track the (zero-indexed) row we are currently at
+
         # Setup Workbook and Sheet
-        self.workbook = xlsxwriter.Workbook(self.output_buffer)
+        self.workbook = xlsxwriter.Workbook(self.output_file, {"constant_memory": True})
         self.worksheet = self.workbook.add_worksheet()
 
         # Setup Formatters
@@ -48,50 +114,44 @@ class ExcelReport:  # pragma: no cover
             "currency": self.workbook.add_format({"num_format": "£#,##0.00"}),
         }
 
-        if not meta:
-            meta = []
-
         # Add default meta
-        meta.append(["Generated At", datetime.now().strftime("%Y-%m-%d %H:%M")])
+        meta = list(meta) + [
+            ["Generated At", datetime.now().strftime("%Y-%m-%d %H:%M")]
+        ]
         if user:
             meta.append(["Generated By", str(user)])
 
+        # In constant memory mode rows must be written in order, so the
+        # header's cells are collected by row before being written
+        header: Dict[int, List[Tuple[int, Any, Optional[str]]]] = defaultdict(list)
+
         # Add Header
-        self.write_bold("A1", "UOB Theatre")
         self.worksheet.set_column("A:A", 15)
         self.worksheet.set_column("B:B", 20)
+        header[0].append((0, "UOB Theatre", "bold"))
         if name:
-            self.write("B1", name)
-
-        self.increment_row_tracker(amount=2)
+            header[0].append((1, name, None))
 
         # Add meta
-        if len(meta) > 0:
-            for i, item in enumerate(meta):
-                if isinstance(item, List):
-                    self.write_bold("A%s" % self.row_tracker, item[0])
-                    self.write("B%s" % self.row_tracker, item[1])
-                self.increment_row_tracker()
+        for i, item in enumerate(meta):
+            if isinstance(item, List):
+                header[2 + i].append((0, item[0], "bold"))
+                header[2 + i].append((1, item[1], None))
 
         # Add description
-        if descriptions and len(descriptions) > 0:
+        if descriptions:
             self.worksheet.set_column("D:D", 20)
-            self.write_bold("D1", "Description and Usage Notes:")
+            header[0].append((3, "Description and Usage Notes:", "bold"))
             for i, item in enumerate(descriptions):
-                row_num = 2 + i
-                self.write("D%s" % row_num, item)
-                self.increment_row_tracker(current_row=row_num)
+                header[1 + i].append((3, item, None))
 
-        self.increment_row_tracker(amount=2)  # Add gap
+        for row in sorted(header):
+            for col, value, cell_format in header[row]:
+                self.write(
+                    row, col, value, self.formats[cell_format] if cell_format else None
+                )
 
-    def increment_row_tracker(self, current_row=None, amount=1) -> None:
-        """Increments the row tracker"""
-        if current_row:
-            if current_row >= self.row_tracker:
-                self.row_tracker = current_row
-            else:
-                return
-        self.row_tracker += amount
+        self.row_tracker = max(header) + 3  # Add gap
 
     def write_formula(self, *args) -> None:
         self.worksheet.write_formula(*args)
@@ -114,36 +174,17 @@ class ExcelReport:  # pragma: no cover
         """
         self.write(row, col, *args, self.formats["currency"])
 
-    def write_list(
-        self,
-        start: Tuple[int, int],
-        items: List,
-        title: Optional[str] = None,
-        items_format: Optional[str] = None,
-    ):
-        """Writes a list (with optional header)"""
-        start_row = start[0]
-        if title:
-            self.write_bold(start_row, start[1], title)
-            start_row += 1
-
-        for i, item in enumerate(items):
-            self.write(
-                start_row + i,
-                start[1],
-                item,
-                self.formats[items_format] if items_format else None,
-            )
-            self.increment_row_tracker(
-                current_row=(start_row + i)
-            )  # Plus one due to excel non-zero first row
-
-    def write_dataset(self, dataset: reports.DataSet, start: Tuple[int, int]):
-        self.write(start[0], start[1], dataset.name, self.formats["dataset_title"])
-        for i, header in enumerate(dataset.headings):
-            self.write_list(
-                (start[0] + 1, start[1] + i), [data[i] for data in dataset.data], header
-            )
+    def write_dataset(self, dataset: reports.DataSet):
+        """Writes a data set (with its title and headings) a row at a time, from the current row"""
+        self.write(self.row_tracker, 0, dataset.name, self.formats["dataset_title"])
+        self.worksheet.write_row(
+            self.row_tracker + 1, 0, dataset.headings, self.formats["bold"]
+        )
+        self.row_tracker += 2
+
+        for row in dataset.iter_rows():
+            self.worksheet.write_row(self.row_tracker, 0, row)
+            self.row_tracker += 1
 
     def write(self, *args, **kwargs) -> None:
         """Write to the spreadsheet"""
@@ -152,33 +193,171 @@ class ExcelReport:  # pragma: no cover
     def set_col_width(self, *args):
         self.worksheet.set_column(*args)
 
-    def get_response(self):
-        """Converts a list of datasets into a standard XLSX file and returns a Http response to download the result"""
+    def get_output(self) -> IO[bytes]:
+        """Writes the report's datasets and gets the output file, starting at the start"""
         for dataset in self.report.datasets:
-            self.write_dataset(dataset, (self.row_tracker, 0))
-            self.increment_row_tracker()
+            self.write_dataset(dataset)
+            self.row_tracker += 1  # Add gap
+        self.workbook.close()
 
-        response = HttpResponse(
-            self.get_output(),
-            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
-        response["Content-Disposition"] = (
-            "attachment; filename=%s"
-            % (self.name or "uobtheatre-export").lower().replace(" ", "_")
-            + ".xlsx"
+        self.output_file.seek(0)
+        return self.output_file
+
+
+class _Echo:  # pylint: disable=too-few-public-methods
+    """A file-like object which returns what is written to it, for streaming
+    the lines written by a csv writer"""
+
+    def write(self, value):
+        return value
+
+
+class CsvReport(ReportRenderer):
+    """Generates a CSV file, streamed straight from the report's data set rows
+
+    If the report has more than one data set, each is written as a section
+    starting with a row containing its name and ending with an empty row.
+    """
+
+    extension = "csv"
+    content_type = "text/csv"
+
+    def iter_rows(self) -> Iterator[List]:
+        """The rows of the CSV file"""
+        sections = len(self.report.datasets) > 1
+        for dataset in self.report.datasets:
+            if sections:
+                yield [dataset.name]
+            yield dataset.headings
+            yield from dataset.iter_rows()
+            if sections:
+                yield []
+
+    def iter_lines(self) -> Iterator[str]:
+        """The lines of the CSV file"""
+        writer = csv.writer(_Echo())
+        for row in self.iter_rows():
+            yield writer.writerow(row)
+
+    def get_output(self) -> IO[bytes]:
+        output = tempfile.TemporaryFile()
+        for line in self.iter_lines():
+            output.write(line.encode())
+        output.seek(0)
+        return output
+
+    def get_response(self) -> HttpResponseBase:
+        response = StreamingHttpResponse(
+            self.iter_lines(), content_type=self.content_type
         )
+        response["Content-Disposition"] = 'attachment; filename="%s"' % self.filename
         return response
 
-    def get_output(self) -> io.BytesIO:
-        """Gets the output buffer, starting at the start"""
-        self.workbook.close()
 
-        self.output_buffer.seek(0)
-        return self.output_buffer
+class ParquetReport(ReportRenderer):
+    """Generates a Parquet file for each of the report's data sets
+
+    Each data set's rows are written in row groups, so that only one row
+    group is held in memory at a time. All columns are stored as strings.
+    Reports with more than one data set are exported as a zip of Parquet
+    files.
+    """
+
+    ROW_GROUP_SIZE = 10000
+
+    @property
+    def extension(self) -> str:  # type: ignore
+        return "parquet" if len(self.report.datasets) == 1 else "zip"
+
+    @property
+    def content_type(self) -> str:  # type: ignore
+        return (
+            "application/vnd.apache.parquet"
+            if len(self.report.datasets) == 1
+            else "application/zip"
+        )
+
+    def write_dataset(self, dataset: reports.DataSet, output: IO[bytes]):
+        """Writes a data set to the file as Parquet, in row groups"""
+        # pylint: disable=import-outside-toplevel
+        import pyarrow
+        import pyarrow.parquet
+
+        schema = pyarrow.schema(
+            [(heading, pyarrow.string()) for heading in dataset.headings]
+        )
+        with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+            rows = dataset.iter_rows()
+            while row_group := list(itertools.islice(rows, self.ROW_GROUP_SIZE)):
+                writer.write_table(
+                    pyarrow.Table.from_arrays(
+                        [
+                            pyarrow.array(
+                                [
+                                    None if value is None else str(value)
+                                    for value in column
+                                ],
+                                pyarrow.string(),
+                            )
+                            for column in zip(*row_group)
+                        ],
+                        schema=schema,
+                    )
+                )
+
+    def get_output(self) -> IO[bytes]:
+        output = tempfile.TemporaryFile()
+        if len(self.report.datasets) == 1:
+            self.write_dataset(self.report.datasets[0], output)
+        else:
+            with zipfile.ZipFile(output, "w") as archive:
+                for dataset in self.report.datasets:
+                    with archive.open(
+                        dataset.name.lower().replace(" ", "_") + ".parquet", "w"
+                    ) as dataset_file:
+                        self.write_dataset(dataset, dataset_file)
+        output.seek(0)
+        return output
+
+
+renderers: Dict[str, Type[ReportRenderer]] = {
+    "xlsx": ExcelReport,
+    "csv": CsvReport,
+    "parquet": ParquetReport,
+}
+
+
+def write_report_json(report: reports.Report, output: IO[bytes]):
+    """Writes the report's meta and datasets to the file as JSON, a row at a time"""
+
+    def dump(obj) -> bytes:
+        return json.dumps(obj, cls=DjangoJSONEncoder).encode()
+
+    output.write(b'{"meta": ' + dump(report.get_meta_array()) + b', "datasets": [')
+    for i, dataset in enumerate(report.datasets):
+        if i:
+            output.write(b", ")
+        output.write(
+            b'{"name": '
+            + dump(dataset.name)
+            + b', "headings": '
+            + dump(dataset.headings)
+            + b', "data": ['
+        )
+        for j, row in enumerate(dataset.iter_rows()):
+            if j:
+                output.write(b", ")
+            output.write(dump(row))
+        output.write(b"]}")
+    output.write(b"]}")
+    output.seek(0)
 
 
 def generate_report_download_signature(
-    user: User, report_name: str, options: Optional[List] = None
+    user: User,
+    report_name: str,
+    options: Optional[List] = None,
+    job_id: Optional[str] = None,
 ):
     """Generate a signed hash for the report to be downloaded
 
@@ -186,13 +365,15 @@ def generate_report_download_signature(
         user (User): The user generating the report
         report_name (str): The report name
         options (List): List of options
+        job_id (str): The ID of the job generating the report, if any
 
     Returns:
         str: The signed hash
     """
-    return signer.sign_object(  # type: ignore
-        {"user_id": str(user.id), "report": report_name, "options": options}
-    )
+    payload = {"user_id": str(user.id), "report": report_name, "options": options}
+    if job_id:
+        payload["job_id"] = job_id
+    return signer.sign_object(payload)  # type: ignore
 
 
 def validate_report_download_signature(signature: str):
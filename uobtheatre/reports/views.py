@@ -1,8 +1,18 @@
-from django.http.response import HttpResponse
+import os
+from typing import Type
+
+from django.http import Http404
+from django.http.response import FileResponse, HttpResponse
+from django.shortcuts import get_object_or_404
 from django.utils.decorators import decorator_from_middleware_with_args
 
 from uobtheatre.reports.exceptions import InvalidReportSignature
-from uobtheatre.reports.utils import ExcelReport, validate_report_download_signature
+from uobtheatre.reports.models import ReportJob
+from uobtheatre.reports.utils import (
+    ReportRenderer,
+    renderers,
+    validate_report_download_signature,
+)
 from uobtheatre.users.models import User
 
 from . import reports
@@ -41,6 +51,53 @@ class ValidSignatureMiddleware:
 valid_signature = decorator_from_middleware_with_args(ValidSignatureMiddleware)
 
 
+def get_renderer(request) -> Type[ReportRenderer]:
+    """The renderer for the export format requested (XLSX by default)"""
+    export_format = request.GET.get("format", "xlsx")
+    if export_format not in renderers:
+        raise Http404("Unknown report format '%s'" % export_format)
+    return renderers[export_format]
+
+
+def report_job(request, job_id):
+    """Downloads the Excel export stored by a report job
+
+    Args:
+        request (HttpRequest): The HttpRequest
+        job_id (UUID): The ID of the report job
+
+    Returns:
+        HttpResponse: The HttpResponse
+    """
+    try:
+        signature_object = validate_report_download_signature(
+            request.GET.get("signature")
+        )
+        if signature_object.get("job_id") != str(job_id):
+            raise InvalidReportSignature()
+    except InvalidReportSignature:
+        return HttpResponse(
+            content="Invalid signature. Maybe this link has expired?",
+            status=403,
+        )
+
+    job = get_object_or_404(ReportJob, pk=job_id)
+    if job.status != ReportJob.Status.SUCCESS:
+        return HttpResponse(
+            content="This report has not been generated yet.",
+            status=409,
+        )
+
+    return FileResponse(
+        job.file.open("rb"),
+        as_attachment=True,
+        filename=(job.report_class.title or "uobtheatre-export")
+        .lower()
+        .replace(" ", "_")
+        + os.path.splitext(str(job.file.name))[1],
+    )
+
+
 @valid_signature("PeriodTotals")
 def period_totals(request, start_time, end_time):
     """Generates excel for period totals report
@@ -68,24 +125,7 @@ def period_totals(request, start_time, end_time):
         ]
     )
 
-    excel = ExcelReport(
-        report,
-        "Period Totals Report",
-        [
-            "This report provides summaries and totals of payments taken and recorded.",
-            "Totals are calcualted by summing the payments (which are positive in the case of a charge, or negative for a refund).",
-            "Totals are the amount collected, without any costs and fees that are charged to the society or the payment deducted. Hence, these figures should not be used to calculate account transfers to societies.",
-            "All currency is PENCE (i.e. 100 = £1.00)",
-        ],
-        [
-            ["Period From", str(start_time)],
-            ["Period To", str(end_time)],
-        ]
-        + report.get_meta_array(),
-        request.user,
-    )
-
-    return excel.get_response()
+    return get_renderer(request)(report, user=request.user).get_response()
 
 
 @valid_signature("OutstandingPayments")
@@ -93,21 +133,7 @@ def outstanding_society_payments(request):
     """Generates excel of society payments report"""
     report = reports.OutstandingSocietyPayments()
 
-    excel = ExcelReport(
-        report,
-        "Outstanding Society Payments",
-        [
-            "This report details the production income at the time the report is generated.",
-            "Once the payment has been made, this MUST be recorded on the system in order to remove the balance.",
-            "If the balance for a certain production shows negative, this is because this society owes the STA money. Please do not action negative balances.",
-            "The balance that should be transferred to a production's society is indicated in the 'Society Payment Due' column.",
-            "All currency is PENCE (i.e. 100 = £1.00)",
-        ],
-        report.get_meta_array(),
-        request.user,
-    )
-
-    return excel.get_response()
+    return get_renderer(request)(report, user=request.user).get_response()
 
 
 @valid_signature("PerformanceBookings")
@@ -124,14 +150,4 @@ def performance_bookings(request):
     # Generate report
     report = reports.PerformanceBookings(request.report_options)
 
-    excel = ExcelReport(
-        report,
-        "Performance Bookings",
-        [
-            "This report provides details of the bookings for the specified performance",
-        ],
-        report.get_meta_array(),
-        request.user,
-    )
-
-    return excel.get_response()
+    return get_renderer(request)(report, user=request.user).get_response()
@@ -30,6 +30,7 @@ class Query(
     payments_schema.Query,
     image_schema.Query,
     site_messages_schema.Query,
+    reports_schema.Query,
     graphene.ObjectType,
 ):
     """
@@ -10,3 +10,12 @@ class StaticStorage(S3Boto3Storage):
 
 class MediaStorage(S3Boto3Storage):
     location = settings.MEDIAFILES_LOCATION
+
+
+class PrivateMediaStorage(S3Boto3Storage):
+    """Storage for files which mustn't be publicly readable, which are only
+    accessed through expiring signed URLs"""
+
+    default_acl = "private"
+    querystring_auth = True
+    file_overwrite = False
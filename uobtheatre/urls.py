@@ -13,6 +13,7 @@ from graphene_django.views import GraphQLView
 from config.settings.common import SQUARE_SETTINGS
 from uobtheatre.images.views import ImageView
 from uobtheatre.payments.square_webhooks import SquareWebhooks
+from uobtheatre.utils.metrics import metrics_view
 
 urlpatterns = [
     path(
@@ -20,8 +21,10 @@ urlpatterns = [
         csrf_exempt(GraphQLView.as_view(graphiql=True)),
     ),
     path("reports/", include("uobtheatre.reports.urls")),
+    path("live/", include("uobtheatre.live.urls")),
     path("admin/", admin.site.urls),
     path(SQUARE_SETTINGS["PATH"], SquareWebhooks.as_view()),
+    path("metrics", metrics_view),
     # Redirect root to graphql
     re_path(r"^$", RedirectView.as_view(url="graphql/", permanent=False)),
     re_path(r"^upload/$", ImageView.as_view(), name="file-upload"),
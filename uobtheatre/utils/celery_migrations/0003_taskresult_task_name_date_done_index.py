@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("django_celery_results", "0002_taskresult_periodic_task_name"),
+    ]
+
+    # The index is for pruning expired results of each task. It isn't on the
+    # (third party) model, so it is only added to the database.
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.AddIndex(
+                    model_name="taskresult",
+                    index=models.Index(
+                        fields=["task_name", "date_done"],
+                        name="task_result_name_done_idx",
+                    ),
+                ),
+            ],
+        ),
+    ]
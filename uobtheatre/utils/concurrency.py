@@ -0,0 +1,169 @@
+"""
+Helpers for making rate limited, retried, circuit broken and concurrent calls,
+such as calls to payment provider APIs
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar
+
+from django.db import connection
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class RateLimiter:
+    """Spaces out calls so that at most the given number start each second,
+    across all the threads sharing the limiter"""
+
+    def __init__(self, per_second: Optional[float]):
+        self.interval = 1 / per_second if per_second else 0
+        self.lock = threading.Lock()
+        self.next_call_at = 0.0
+
+    def wait(self):
+        """Block until the next call is allowed"""
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call_at)
+            self.next_call_at = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+def retry(
+    func: Callable[[], R],
+    attempts: int = 3,
+    backoff: float = 0.5,
+    should_retry: Callable[[Exception], bool] = lambda _: True,
+    jitter: bool = False,
+) -> R:
+    """Call the function, retrying with exponential backoff if it raises an
+    exception that should be retried.
+
+    Args:
+        func (callable): The function to call
+        attempts (int): The maximum number of times to call the function
+        backoff (float): The seconds to wait before the first retry, doubling
+            for each retry after that
+        should_retry (callable): Whether an exception raised by the function
+            should be retried
+        jitter (bool): Whether to wait a random time of up to the backoff
+            instead, so that callers retrying at once are spread out
+
+    Returns:
+        The function's return value
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as exc:  # pylint: disable=broad-except
+            if attempt == attempts - 1 or not should_retry(exc):
+                raise
+            delay = backoff * 2**attempt
+            time.sleep(random.uniform(0, delay) if jitter else delay)
+    raise ValueError("At least one attempt must be made")
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call isn't made because its circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops calls to a failing service for a while, so that callers fail
+    fast rather than each waiting on it.
+
+    The breaker opens after the given number of consecutive failures. Once
+    the reset timeout has passed a single trial call is let through, which
+    closes the breaker if it succeeds and reopens it if it fails.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def is_open(self) -> bool:
+        """Whether calls are currently being stopped"""
+        return self.opened_at is not None
+
+    def before_call(self):
+        """Check a call may be made
+
+        Raises:
+            CircuitOpenError: If the breaker is open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if (
+                self.trial_running
+                or time.monotonic() - self.opened_at < self.reset_timeout
+            ):
+                raise CircuitOpenError()
+            self.trial_running = True
+
+    def record_success(self):
+        """Record that a call succeeded, closing the breaker"""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        """Record that a call failed, opening the breaker if there have been
+        too many failures in a row"""
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+def map_concurrently(
+    func: Callable[[T], R], items: Iterable[T], max_workers: int
+) -> List[R]:
+    """Call the function on each item, in at most max_workers threads.
+
+    The results are returned in the order of the items, and the first
+    exception raised (in the order of the items) is re-raised. Each worker
+    thread takes items until there are none left, and closes its database
+    connection once it is done. With a single worker the items are processed
+    in the calling thread.
+    """
+    if max_workers <= 1:
+        return [func(item) for item in items]
+
+    indexed_items = iter(enumerate(items))
+    lock = threading.Lock()
+    results: Dict[int, R] = {}
+    errors: Dict[int, Exception] = {}
+
+    def work():
+        try:
+            while True:
+                with lock:
+                    index, item = next(indexed_items, (None, None))
+                if index is None:
+                    return
+                try:
+                    results[index] = func(item)  # type: ignore[arg-type]
+                except Exception as exc:  # pylint: disable=broad-except
+                    errors[index] = exc
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in range(max_workers):
+            executor.submit(work)
+
+    if errors:
+        raise errors[min(errors)]
+    return [results[index] for index in range(len(results))]
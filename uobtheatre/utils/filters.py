@@ -1,4 +1,4 @@
-from typing import Callable, Union
+from typing import Callable, List, Type, TypeVar, Union
 
 import django_filters
 from django.db import models
@@ -22,3 +22,23 @@ def filter_passes_on_model(
 ):
     """Run a filter on an individual model instance to see if it passes"""
     return filter_function(instance.__class__.objects).filter(pk=instance.pk).exists()
+
+
+RelatedModel = TypeVar("RelatedModel", bound=Model)  # pylint: disable=invalid-name
+
+
+def get_related_objects(
+    instance: Model,
+    related_name: str,
+    related_model: Type[RelatedModel],  # pylint: disable=unused-argument
+) -> List[RelatedModel]:
+    """Get the related objects for a relation, using the prefetch cache if it has been populated
+
+    This allows in-memory predicates to avoid a query when the relation has
+    been loaded with prefetch_related. If it hasn't, the relation is fetched in
+    a single query. The related model types the returned objects.
+    """
+    prefetched = getattr(instance, "_prefetched_objects_cache", {})
+    if related_name in prefetched:
+        return list(prefetched[related_name])
+    return list(getattr(instance, related_name).all())
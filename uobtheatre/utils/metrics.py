@@ -0,0 +1,63 @@
+"""
+Metrics, exposed in the Prometheus text format for scraping
+
+Metrics are recorded with prometheus_client. In production, the web and
+Celery worker processes share a PROMETHEUS_MULTIPROC_DIR, which each process
+writes its metrics to. /metrics then exposes the metrics of every process
+(including those recorded by tasks, e.g. the latency of Square calls), so a
+scrape doesn't depend on which web process serves it. Without the directory
+(e.g. locally), only the serving process's metrics are exposed.
+"""
+
+import hmac
+import os
+import socket
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+    values,
+)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def process_identifier() -> str:
+    """The name of this process's metrics files. Processes in different
+    containers can have the same PID, so the files are named by host too."""
+    # Underscores separate the parts of the files' names
+    return f"{socket.gethostname().replace('_', '-')}-{os.getpid()}"
+
+
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:  # pragma: no cover
+    values.ValueClass = values.MultiProcessValue(process_identifier)
+
+
+def metrics_registry() -> CollectorRegistry:
+    """The registry of the metrics to expose: those of every process sharing
+    the PROMETHEUS_MULTIPROC_DIR, or this process's without one"""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view(request):
+    """Expose the metrics for scraping, to requests with the METRICS_TOKEN
+    as a bearer token. The endpoint doesn't exist if no token is set."""
+    token = settings.METRICS_TOKEN
+    if not token:
+        raise Http404()
+    if not hmac.compare_digest(
+        request.META.get("HTTP_AUTHORIZATION", ""), f"Bearer {token}"
+    ):
+        return HttpResponse("Invalid token", status=401)
+    return HttpResponse(
+        generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST
+    )
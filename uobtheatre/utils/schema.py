@@ -5,9 +5,15 @@ import graphene
 from django.db.models import RestrictedError
 from django.forms.models import ModelChoiceField
 from graphene.types.mutation import MutationOptions
+from graphene.utils.str_converters import to_snake_case
 from graphene_django import DjangoObjectType
 from graphene_django.forms.mutation import DjangoModelFormMutation
-from graphql.language.ast import IntValue, StringValue
+from graphql.language.ast import (
+    FragmentSpread,
+    InlineFragment,
+    IntValue,
+    StringValue,
+)
 from graphql_relay.node.node import from_global_id
 from guardian.shortcuts import (
     assign,
@@ -35,6 +41,32 @@ from uobtheatre.utils.exceptions import (
 from uobtheatre.utils.models import PermissionableModel
 
 
+def get_selected_fields(info) -> List[str]:
+    """Get the (snake case) names of the fields selected on the field being resolved
+
+    Fragments and inline fragments are expanded.
+    """
+
+    def selected_fields(selection_set) -> List[str]:
+        fields: List[str] = []
+        for selection in selection_set.selections if selection_set else []:
+            if isinstance(selection, FragmentSpread):
+                fields += selected_fields(
+                    info.fragments[selection.name.value].selection_set
+                )
+            elif isinstance(selection, InlineFragment):
+                fields += selected_fields(selection.selection_set)
+            else:
+                fields.append(to_snake_case(selection.name.value))
+        return fields
+
+    return [
+        field
+        for field_ast in info.field_asts
+        for field in selected_fields(field_ast.selection_set)
+    ]
+
+
 class CustomDjangoObjectType(DjangoObjectType):
     class Meta:
         abstract = True
@@ -0,0 +1,154 @@
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from uobtheatre.utils.concurrency import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RateLimiter,
+    map_concurrently,
+    retry,
+)
+
+
+def test_rate_limiter_spaces_out_calls():
+    limiter = RateLimiter(per_second=4)
+
+    with patch("uobtheatre.utils.concurrency.time.monotonic", return_value=10.0):
+        with patch("uobtheatre.utils.concurrency.time.sleep") as mock_sleep:
+            for _ in range(3):
+                limiter.wait()
+
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [0.25, 0.5]
+
+
+def test_rate_limiter_without_rate():
+    limiter = RateLimiter(per_second=None)
+
+    with patch("uobtheatre.utils.concurrency.time.sleep") as mock_sleep:
+        for _ in range(3):
+            limiter.wait()
+
+    mock_sleep.assert_not_called()
+
+
+def test_retry_with_backoff():
+    func = MagicMock(side_effect=[ValueError("1"), ValueError("2"), "result"])
+
+    with patch("uobtheatre.utils.concurrency.time.sleep") as mock_sleep:
+        assert retry(func, attempts=3, backoff=1) == "result"
+
+    assert func.call_count == 3
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [1, 2]
+
+
+def test_retry_with_jitter():
+    func = MagicMock(side_effect=[ValueError("1"), ValueError("2"), "result"])
+
+    with patch("uobtheatre.utils.concurrency.time.sleep") as mock_sleep, patch(
+        "uobtheatre.utils.concurrency.random.uniform", side_effect=lambda _, b: b / 2
+    ) as mock_uniform:
+        assert retry(func, attempts=3, backoff=1, jitter=True) == "result"
+
+    assert [call.args for call in mock_uniform.call_args_list] == [(0, 1), (0, 2)]
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [0.5, 1]
+
+
+def test_retry_gives_up():
+    func = MagicMock(side_effect=ValueError("Failed"))
+
+    with patch("uobtheatre.utils.concurrency.time.sleep"):
+        with pytest.raises(ValueError):
+            retry(func, attempts=3)
+
+    assert func.call_count == 3
+
+
+def test_retry_only_retries_some_exceptions():
+    func = MagicMock(side_effect=KeyError("Failed"))
+
+    with pytest.raises(KeyError):
+        retry(func, attempts=3, should_retry=lambda exc: isinstance(exc, ValueError))
+
+    assert func.call_count == 1
+
+
+def test_retry_without_attempts():
+    func = MagicMock()
+
+    with pytest.raises(ValueError):
+        retry(func, attempts=0)
+
+    func.assert_not_called()
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_map_concurrently(max_workers):
+    threads = set()
+
+    def double(item):
+        threads.add(threading.get_ident())
+        return item * 2
+
+    with patch("uobtheatre.utils.concurrency.connection") as mock_connection:
+        assert map_concurrently(double, range(20), max_workers) == [
+            item * 2 for item in range(20)
+        ]
+
+    if max_workers == 1:
+        assert threads == {threading.get_ident()}
+        mock_connection.close.assert_not_called()
+    else:
+        assert threading.get_ident() not in threads
+        # Each worker thread's connection is closed once
+        assert mock_connection.close.call_count == 4
+
+
+def test_map_concurrently_raises_first_error():
+    def fail_odd(item):
+        if item % 2:
+            raise ValueError(item)
+        return item
+
+    with patch("uobtheatre.utils.concurrency.connection") as mock_connection:
+        with pytest.raises(ValueError) as exc:
+            map_concurrently(fail_odd, range(20), 4)
+
+    assert exc.value.args == (1,)
+    assert mock_connection.close.call_count == 4
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    with patch("uobtheatre.utils.concurrency.time.monotonic", return_value=100.0):
+        breaker.before_call()
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_success()
+
+        # Only failures in a row open the breaker
+        breaker.record_failure()
+        assert not breaker.is_open
+        breaker.record_failure()
+        assert breaker.is_open
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+    with patch("uobtheatre.utils.concurrency.time.monotonic", return_value=131.0):
+        # After the timeout a single trial call is let through
+        breaker.before_call()
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+        # A failed trial reopens the breaker
+        breaker.record_failure()
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+    with patch("uobtheatre.utils.concurrency.time.monotonic", return_value=162.0):
+        breaker.before_call()
+        breaker.record_success()
+        assert not breaker.is_open
+        breaker.before_call()
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+from prometheus_client import Histogram, values
+
+from uobtheatre.utils.metrics import metrics_registry, process_identifier
+
+VIEW_LATENCY = Histogram("test_view_seconds", "View", ["endpoint"])
+
+
+def test_process_identifier(monkeypatch):
+    monkeypatch.setattr("socket.gethostname", lambda: "api_1")
+
+    assert process_identifier() == f"api-1-{os.getpid()}"
+
+
+def test_metrics_registry_collects_every_process(monkeypatch, tmp_path):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    # A web process and a worker process record the same metric
+    for process in ("api-1", "worker-1"):
+        monkeypatch.setattr(
+            values, "ValueClass", values.MultiProcessValue(lambda p=process: p)
+        )
+        Histogram(
+            "test_multiprocess_seconds", "Multiprocess", ["endpoint"], registry=None
+        ).labels(endpoint="/a").observe(0.2)
+
+    assert sorted(os.listdir(tmp_path)) == [
+        "histogram_api-1.db",
+        "histogram_worker-1.db",
+    ]
+    assert (
+        metrics_registry().get_sample_value(
+            "test_multiprocess_seconds_count", {"endpoint": "/a"}
+        )
+        == 2
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "token,authorization,expected_status",
+    [
+        ("", "Bearer ", 404),
+        ("secret", "", 401),
+        ("secret", "Bearer wrong", 401),
+        ("secret", "Bearer secret", 200),
+    ],
+)
+def test_metrics_view(client, settings, token, authorization, expected_status):
+    settings.METRICS_TOKEN = token
+    VIEW_LATENCY.labels(endpoint="/a").observe(0.2)
+
+    response = client.get("/metrics", HTTP_AUTHORIZATION=authorization)
+
+    assert response.status_code == expected_status
+    if expected_status == 200:
+        assert b"# TYPE test_view_seconds histogram" in response.content
@@ -1,7 +1,14 @@
+import re
+from pathlib import Path
 from unittest.mock import patch
 
+import pytest
+
+from config.celery import app
 from uobtheatre.utils.tasks import BaseTask
 
+QUEUES = {"payments", "mail", "reports", "maintenance"}
+
 
 def test_base_task_on_failure():
     task = BaseTask()
@@ -14,3 +21,36 @@ def test_base_task_on_failure():
 
     mock_capture_exception.assert_called_once_with(exception)
     super_on_failure.assert_called_once_with(exception, "abc", tuple(), {}, None)
+
+
+def test_every_task_is_routed():
+    app.loader.import_default_modules()
+
+    # Celery's built in tasks run wherever they are needed
+    queues = {
+        name: app.amqp.router.route({}, name)["queue"].name
+        for name in app.tasks
+        if not name.startswith("celery.")
+    }
+
+    assert queues
+    assert {name: queue for name, queue in queues.items() if queue not in QUEUES} == {}
+
+
+def test_worker_without_queues_consumes_every_queue():
+    assert QUEUES | {app.conf.task_default_queue} <= {
+        queue.name for queue in app.conf.task_queues
+    }
+
+
+@pytest.mark.parametrize("compose_file", ["local.yml", "production.yml"])
+def test_every_queue_has_workers(compose_file):
+    compose = (Path(__file__).parents[3] / compose_file).read_text()
+
+    consumed = {
+        queue
+        for queues in re.findall(r"celery -A config worker .*-Q ([\w,]+)", compose)
+        for queue in queues.split(",")
+    }
+
+    assert QUEUES | {app.conf.task_default_queue} <= consumed